@@ -76,6 +76,7 @@ if 'ugc' in REG_SERVERS:
 if 'query' in REG_SERVERS:
     app.post('/query/task')(aq_optimized_task.get_task_api)
     app.post('/query/task/log')(at_exp.task_node_log_api)
+    app.get('/query/task/log/stream')(at_exp.task_node_log_stream_api)
     app.post('/query/task/sys_log')(at_exp.task_sys_log_api)
     app.post('/query/task/log/search')(at_exp.task_search_in_global)
     app.post('/query/task/ssh_ip')(at_port.task_ssh_ip)
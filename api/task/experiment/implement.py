@@ -7,11 +7,14 @@ import ciso8601
 import datetime
 import inspect
 import json
+import os
 import pickle
 import time
 import urllib
 from typing import Optional, List
 from fastapi import Depends, Request, Query, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 from logm import logger
 from api.depends import get_api_user_with_token, get_api_task, JUPYTER_ADMIN_GROUP, check_user_access_to_task
@@ -19,16 +22,18 @@ from api.task_schema import TaskSchema
 from api.task.service_task import create_service_task, VISIBLE_TASK_TAG
 from api.operation import operate_task_base, create_task_base_queue_v2
 from base_model.training_task import TrainingTask
+from conf import CONF
 from conf.flags import TASK_OP_CODE, TASK_PRIORITY, QUE_STATUS, STOP_CODE, EXP_STATUS, TASK_TYPE
 from db import MarsDB
 from db import a_redis as redis
 from server_model.auto_task_impl import AutoTaskApiImpl
-from server_model.selector import AioUserSelector
+from server_model.selector import AioUserSelector, AioTrainingTaskSelector
 from server_model.task_impl import AioDbOperationImpl
 from server_model.training_task_impl import TaskApiImpl, DashboardApiImpl
 from server_model.user import User
 from server_model.task_runtime_config import TaskRuntimeConfig
 from utils import convert_to_external_node, convert_to_external_task, get_task_node_idx_log
+from utils.log_stream import get_log_tail
 
 
 async def create_task_v2(
@@ -96,8 +101,7 @@ async def suspend_task_by_name(
     return res
 
 
-async def task_node_log_api(task: TrainingTask = Depends(get_api_task(allow_shared_task=True)), rank: int = 0,
-                            last_seen: str = 'null', service: str = None):
+def parse_log_last_seen(last_seen: str):
     try:
         last_seen = json.loads(last_seen)
     except:
@@ -107,6 +111,10 @@ async def task_node_log_api(task: TrainingTask = Depends(get_api_task(allow_shar
             last_seen['timestamp'] = datetime.datetime.strptime(last_seen['timestamp'], "%Y-%m-%dT%H:%M:%S.%f")
         except:
             last_seen['timestamp'] = datetime.datetime.strptime(last_seen['timestamp'], "%Y-%m-%dT%H:%M:%S")
+    return last_seen
+
+
+async def get_task_node_log(task: TrainingTask, rank: int, last_seen, service: str = None):
     task.re_impl(AutoTaskApiImpl)
     res = await task.log(rank, last_seen=last_seen, service=service)
     # 兜底逻辑，任务没启动就失败了，日志文件都没有，标记 stop
@@ -115,6 +123,62 @@ async def task_node_log_api(task: TrainingTask = Depends(get_api_task(allow_shar
     return res
 
 
+def log_finished(res):
+    """ 和 client 追加查看日志时的退出条件保持一致 """
+    stop_code = res['stop_code']
+    return stop_code < STOP_CODE.HOOK_RESTART and (stop_code == STOP_CODE.STOP or stop_code >= STOP_CODE.FAILED)
+
+
+async def task_node_log_api(task: TrainingTask = Depends(get_api_task(allow_shared_task=True)), rank: int = 0,
+                            last_seen: str = 'null', service: str = None):
+    res = await get_task_node_log(task, rank, parse_log_last_seen(last_seen), service=service)
+    # 告诉 client 可以用 /query/task/log/stream 追加查看日志
+    res['log_stream'] = bool(CONF.try_get('experiment.log.stream.enabled', default=0))
+    return res
+
+
+async def task_node_log_stream_api(request: Request, task: TrainingTask = Depends(get_api_task(allow_shared_task=True)),
+                                   rank: int = 0, last_seen: str = 'null', service: str = None):
+    """
+    server-sent events 推送日志, 每条 data 和 /query/task/log 的返回一样;
+    同一个 chain / rank / service 的订阅者共享一个 tail, 各自维护 last_seen
+    """
+    if not CONF.try_get('experiment.log.stream.enabled', default=0):
+        raise HTTPException(status_code=404, detail={'success': 0, 'msg': '没有开启日志推送'})
+    log_dir = task.user.config.log_dir()
+    latest = {'task': task}
+
+    async def fetch(cursor):
+        # 任务链可能重启出新的任务, 每次重新查一下
+        t = await AioTrainingTaskSelector.find_one(None, chain_id=task.chain_id) or latest['task']
+        t.user = task.user
+        latest['task'] = t
+        # task.log 会改 last_seen 里的 id, 传个拷贝进去
+        return await get_task_node_log(t, rank, dict(cursor) if cursor else None, service=service)
+
+    tail = get_log_tail(
+        (task.chain_id, rank, service),
+        fetch=fetch,
+        watch_paths=lambda: [log_dir, os.path.join(log_dir, str(max(latest['task'].id_list)))],
+        finished=log_finished,
+        poll_interval=CONF.try_get('experiment.log.stream.poll_interval', default=2.0),
+        use_inotify=bool(CONF.try_get('experiment.log.stream.inotify', default=1)),
+    )
+    heartbeat = CONF.try_get('experiment.log.stream.heartbeat', default=15.0)
+
+    async def events():
+        async for res in tail.subscribe(parse_log_last_seen(last_seen), heartbeat=heartbeat):
+            if res is None:
+                if await request.is_disconnected():
+                    return
+                yield ': ping\n\n'
+            else:
+                yield f'data: {json.dumps(jsonable_encoder(res), ensure_ascii=False)}\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 async def task_sys_log_api(task: TrainingTask = Depends(get_api_task())):
     res = await task.re_impl(TaskApiImpl).sys_log()
     # if not user.is_internal:
@@ -0,0 +1,246 @@
+"""
+CDC 模式的回放测试, 用录下来的 DB 变动和触发器发出的 notify 走一遍 sync point 的 CDC 流程, 不需要数据库和 redis:
+    python -m benchmarks.cdc_replay --users 1000
+
+  - DB 换成内存里的几张表 (user / user_group / quota / storage), 按 table_config 里的 SQL 返回漫游表的结果,
+    带 keys 参数的查询 (pull_rows_diff_from_db) 只返回这些主键的行
+  - RECORDED_CHANGES 里每一步是一次 DB 写操作, 以及 db_schemas/036 的 notify_user_data_change 为这次写操作发出的 payload
+  - 每一步把 payload 交给 UserData._on_db_change, 再跑 _sync_db_changes, 发出的 patch 经过 pickle 后给一个议员副本 apply_patch
+每一步之后 sync point 和议员副本的每张表都要和从 DB 全量拉取的一样, 同时统计 CDC 从 DB 读了多少行, 和每秒轮询全部表的做法对比
+"""
+import argparse
+import pickle
+import re
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import ujson
+
+from server_model.user_data import data_table, patchable_dataframe, user_data as user_data_module
+from server_model.user_data.patchable_dataframe import PatchableDataFrame, hash_rows
+from server_model.user_data.table_config import TABLES, spawn_private_tables
+from server_model.user_data.user_data import UserData
+
+# 回放涉及的漫游表
+REPLAY_TABLES = ['user', 'quota', 'user_all_groups', 'storage']
+
+# (说明, DB 写操作, 触发器发出的 notify payload, 是否再跑一次全量同步)
+# 写操作: ('insert', 表, 行) / ('update', 表, 条件, 新值) / ('delete', 表, 条件)
+RECORDED_CHANGES = [
+    ('修改一条 quota',
+     [('update', 'quota', {'user_name': 'user_1', 'resource': 'node-jd_a00-20'}, {'quota': 64})],
+     ['{"keys":[["user_1","node-jd_a00-20"],["user_1","node-jd_a00-20"]],"table":"quota"}'], False),
+    ('新增一条 quota, 删除一条 quota',
+     [('insert', 'quota', {'user_name': 'user_2', 'resource': 'node-jd_a02-30', 'quota': 8, 'expire_time': pd.NaT}),
+      ('delete', 'quota', {'user_name': 'user_3', 'resource': 'node-jd_a00-20'})],
+     ['{"keys":[["user_2","node-jd_a02-30"]],"table":"quota"}',
+      '{"keys":[["user_3","node-jd_a00-20"]],"table":"quota"}'], False),
+    ('一条语句修改多个用户的 quota',
+     [('update', 'quota', {'user_name': f'user_{i}', 'resource': 'node-jd_a01-30'}, {'quota': 0}) for i in range(10, 15)],
+     [f'{{"keys":[["user_{i}","node-jd_a01-30"],["user_{i}","node-jd_a01-30"]],"table":"quota"}}' for i in range(10, 15)], False),
+    ('修改 quota 的主键',
+     [('update', 'quota', {'user_name': 'user_4', 'resource': 'node-jd_a00-20'}, {'resource': 'node-jd_a02-20'})],
+     ['{"keys":[["user_4","node-jd_a00-20"],["user_4","node-jd_a02-20"]],"table":"quota"}'], False),
+    ('修改用户的 role, user_all_groups 物化视图跟着变',
+     [('update', 'user', {'user_id': 5}, {'role': 'external'})],
+     ['{"keys":[[5],[5]],"table":"user"}'], False),
+    ('新增用户',
+     [('insert', 'user', {'user_id': 0, 'user_name': 'user_new', 'token': 'token_new', 'role': 'internal', 'active': True,
+                          'shared_group': 'user_new', 'nick_name': 'user_new'})],
+     ['{"keys":[[0]],"table":"user"}'], False),
+    ('用户加入分组, user_group 是语句级触发器',
+     [('insert', 'user_group', {'user_name': 'user_7', 'group': 'group_x'})],
+     ['{"table":"user_group"}'], False),
+    ('修改 storage, 没有主键的表是语句级触发器',
+     [('update', 'storage', {'host_path': '/weka/group_1'}, {'read_only': True})],
+     ['{"table":"storage"}'], False),
+    ('不在回放里的表有变动, 不应该有 patch',
+     [],
+     ['{"table":"train_image"}'], False),
+    ('quota 过期, 没有写操作也就没有 notify, 靠定时全量同步兜底',
+     [('update', 'quota', {'user_name': 'user_6', 'resource': 'node-jd_a00-20'}, {'expire_time': pd.Timestamp('2000-01-01')})],
+     [], True),
+]
+
+
+class FakeDB(object):
+    """
+    内存里的 DB 表, read_sql 按 SQL 里 from 的表名返回 table_config 里对应 SQL 的结果
+    """
+
+    def __init__(self, users):
+        user_ids = np.arange(1, users + 1)
+        user_names = [f'user_{i}' for i in user_ids]
+        self.tables = {
+            'user': pd.DataFrame({
+                'user_id': user_ids, 'user_name': user_names, 'token': [f'token_{i}' for i in user_ids],
+                'role': 'internal', 'active': True,
+                'shared_group': [f'group_{i % 10}' if i % 3 == 0 else name for i, name in zip(user_ids, user_names)],
+                'nick_name': user_names,
+            }),
+            'user_group': pd.DataFrame({'user_name': [f'group_{i % 10}' for i in range(20)] + user_names[:50],
+                                        'group': [f'group_{i % 10}' for i in range(20)] + [f'group_{i % 5}' for i in range(50)]}),
+            'quota': pd.DataFrame({
+                'user_name': [name for name in user_names for _ in range(2)],
+                'resource': ['node-jd_a00-20', 'node-jd_a01-30'] * users,
+                'quota': 16,
+                'expire_time': pd.Series(pd.NaT, index=range(2 * users), dtype='datetime64[ns]'),
+            }),
+            'storage': pd.DataFrame({
+                'host_path': [f'/weka/group_{i}' for i in range(10)], 'mount_path': [f'/mnt/group_{i}' for i in range(10)],
+                'owners': [[f'group_{i}'] for i in range(10)], 'conditions': [[] for _ in range(10)],
+                'mount_type': 'weka', 'read_only': False, 'action': 'mount', 'active': True,
+            }),
+        }
+        self.clock = time.time()
+        self.queries = 0
+        self.rows_read = 0
+
+    def _match(self, table, where):
+        df = self.tables[table]
+        return np.logical_and.reduce([df[col] == value for col, value in where.items()])
+
+    def write(self, op, table, *args):
+        df = self.tables[table]
+        if op == 'insert':
+            self.tables[table] = pd.concat([df, pd.DataFrame([args[0]], columns=df.columns).astype(df.dtypes)], ignore_index=True)
+        elif op == 'update':
+            where, values = args
+            mask = self._match(table, where)
+            for col, value in values.items():
+                df.loc[mask, col] = value
+        elif op == 'delete':
+            self.tables[table] = df[~self._match(table, args[0])].reset_index(drop=True)
+
+    def view(self, table_name):
+        """
+        漫游表在 DB 里查出来的样子
+        """
+        if table_name == 'quota':
+            quota_df = self.tables['quota']
+            return quota_df[quota_df.expire_time.isna() | (quota_df.expire_time > pd.Timestamp.now())]
+        if table_name == 'user_all_groups':
+            user_df, user_group_df = self.tables['user'], self.tables['user_group']
+            groups = user_group_df.groupby('user_name').group.agg(set).to_dict()
+            return pd.DataFrame({
+                'user_name': user_df.user_name,
+                'user_groups': [[role, 'public'] + sorted(groups.get(name, set()) | groups.get(shared_group, set()))
+                                for name, role, shared_group in zip(user_df.user_name, user_df.role, user_df.shared_group)],
+            })
+        return self.tables[table_name]
+
+    def read_sql(self, sql, params=None):
+        table_name = re.search(r'from "(\w+)"', str(sql)).group(1)
+        df = self.view(table_name)[TABLES[table_name].columns]
+        if params is not None and 'keys' in params:
+            # pull_rows_diff_from_db: 只查这些主键的行
+            primary_key_columns = re.findall(r'"rows"\."(\w+)"', str(sql))
+            keys = set(tuple(key) for key in ujson.loads(params['keys']))
+            df = df[np.array([key in keys for key in zip(*[df[col].tolist() for col in primary_key_columns])], dtype=bool)]
+        self.clock += 1
+        self.queries += 1
+        self.rows_read += len(df)
+        return df.assign(query_timestamp=pd.Timestamp(self.clock, unit='s', tz='UTC')).reset_index(drop=True)
+
+    def full_rows(self):
+        return sum(len(self.view(table_name)) for table_name in REPLAY_TABLES)
+
+
+class FakeMarsDB(object):
+    db = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FakeMessageQueue(object):
+    sent = []
+
+    @classmethod
+    def send(cls, type, data):
+        cls.sent.append(pickle.dumps({'type': type, 'data': data}))
+
+
+def install_fakes(fake_db: FakeDB):
+    FakeMarsDB.db = fake_db
+    data_table.MarsDB = FakeMarsDB
+    patchable_dataframe.MarsDB = FakeMarsDB
+    user_data_module.MessageQueue = FakeMessageQueue
+    read_sql = pd.read_sql
+
+    def fake_read_sql(sql, con, *args, params=None, **kwargs):
+        return con.read_sql(sql, params=params) if isinstance(con, FakeDB) else read_sql(sql, con, *args, params=params, **kwargs)
+    pd.read_sql = fake_read_sql
+
+
+def make_sync_point() -> UserData:
+    """
+    只初始化 CDC 流程用到的部分, 不起线程
+    """
+    spawn_private_tables(is_roaming_enabled=True)
+    sync_point = UserData.__new__(UserData)
+    sync_point._subscribed_tables = []
+    sync_point._tables = {}
+    sync_point._throttling_cnt = defaultdict(lambda: 0)
+    sync_point._pending_reload = None
+    sync_point._cdc_enabled = True
+    sync_point._cdc_pending = {}
+    sync_point._cdc_lock = threading.Lock()
+    for table_name in REPLAY_TABLES:
+        assert sync_point._subscribe_single_table(table_name), f'初始化 {table_name} 表失败'
+    return sync_point
+
+
+def check_same(name, df, expected_df):
+    """
+    按行内容的 hash 比较, 不管行的顺序
+    """
+    same = len(df) == len(expected_df) and (np.sort(hash_rows(df[expected_df.columns])) == np.sort(hash_rows(expected_df))).all()
+    assert same, f'{name} 和 DB 不一致:\n{df}\n{expected_df}'
+
+
+def replay(fake_db: FakeDB, sync_point: UserData, replicas: dict):
+    for desc, writes, payloads, full_sync in RECORDED_CHANGES:
+        for op, table, *args in writes:
+            fake_db.write(op, table, *args)
+        queries, rows_read = fake_db.queries, fake_db.rows_read
+        for payload in payloads:
+            sync_point._on_db_change(ujson.loads(payload))
+        sync_point._sync_db_changes()
+        if full_sync:
+            sync_point.patch(sync_point._make_patches(set(REPLAY_TABLES)), broadcast=True)
+        # 议员收到的是 pickle 过的 patch
+        patches = [patch for msg in FakeMessageQueue.sent for patch in pickle.loads(msg)['data']]
+        FakeMessageQueue.sent.clear()
+        for patch in patches:
+            replicas[patch['table_name']].apply_patch(patch['diff'])
+        queries, rows_read = fake_db.queries - queries, fake_db.rows_read - rows_read
+        for table_name in REPLAY_TABLES:
+            expected_df = fake_db.view(table_name)[TABLES[table_name].columns]
+            check_same(f'sync point 的 {table_name} 表', sync_point._get_df(table_name), expected_df)
+            check_same(f'议员的 {table_name} 表', replicas[table_name].df, expected_df)
+        changed = {patch['table_name']: len(patch['diff'].upserts.df) + len(patch['diff'].deletes.df) for patch in patches}
+        print(f'{desc}: {len(payloads)} 个 notify, patch 涉及的行 {changed or "无"}, '
+              f'从 DB 读了 {rows_read} 行 / {queries} 次查询 (轮询一次所有表 {fake_db.full_rows()} 行)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CDC 模式回放测试')
+    parser.add_argument('--users', type=int, default=1000, help='user 表的行数')
+    args = parser.parse_args()
+
+    fake_db = FakeDB(args.users)
+    install_fakes(fake_db)
+    sync_point = make_sync_point()
+    replicas = {table_name: PatchableDataFrame.from_df(fake_db.read_sql(TABLES[table_name].sql()),
+                                                       primary_key_columns=TABLES[table_name].primary_key_columns)
+                for table_name in REPLAY_TABLES}
+    replay(fake_db, sync_point, replicas)
+    print(f'回放 {len(RECORDED_CHANGES)} 步, sync point 和议员的表每一步都和 DB 一致')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+传输调度的吞吐 benchmark, 用本地目录模拟对象存储 (MockApi root), 不需要连云端和 redis:
+    python -m benchmarks.cloud_storage_transfer --requests 4 --small-files 2000 --large-files 4
+
+对比两种方式把同样的文件从 "云端" 下载到本地:
+  - per_file: 原来的做法, 每个请求一个 4 进程的进程池, 每个文件单独提交
+  - scheduler: 所有请求交给同一个 TransferScheduler, 小文件打包
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+from cloud_storage.provider.mock import MockApi
+from cloud_storage.scheduler import TransferScheduler
+
+
+BUCKET_NAME = 'benchmark'
+
+
+def bench_download(root, key, filename):
+    MockApi(root=root).resumable_download(BUCKET_NAME, key, filename)
+    return {'key': key, 'size': os.path.getsize(filename)}
+
+
+def prepare(root, num_requests, small_files, small_size, large_files, large_size):
+    """ 每个请求 small_files 个小文件和 large_files 个大文件, 返回每个请求的 [(key, size)] """
+    cloud_api = MockApi(root=root)
+    small, large = os.urandom(small_size), os.urandom(large_size)
+    requests = []
+    for r in range(num_requests):
+        files = [(f'req{r}/small/{i // 100}/{i}', small_size) for i in range(small_files)]
+        files += [(f'req{r}/large/{i}', large_size) for i in range(large_files)]
+        for key, size in files:
+            cloud_api.put_object(BUCKET_NAME, key, small if size == small_size else large)
+        requests.append(files)
+    return requests
+
+
+def download_items(root, dst, files):
+    items = []
+    for key, size in files:
+        filename = os.path.join(dst, key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        items.append((dict(root=root, key=key, filename=filename), size))
+    return items
+
+
+def run_per_file(root, dst, requests, workers_per_request=4):
+    pools = [ProcessPoolExecutor(max_workers=workers_per_request, mp_context=get_context('spawn')) for _ in requests]
+    futures = []
+    for pool, files in zip(pools, requests):
+        for kwargs, _ in download_items(root, dst, files):
+            futures.append(pool.submit(bench_download, **kwargs))
+    wait(futures)
+    for pool in pools:
+        pool.shutdown()
+    return futures
+
+
+def run_scheduler(root, dst, requests, max_workers):
+    scheduler = TransferScheduler(max_workers=max_workers, user_concurrency=max_workers)
+    futures = []
+    for r, files in enumerate(requests):
+        futures += scheduler.submit(f'req{r}', f'user{r % 2}', bench_download, download_items(root, dst, files))
+    wait(futures)
+    scheduler.pool.shutdown()
+    return futures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cloud_storage 传输调度 benchmark')
+    parser.add_argument('--requests', type=int, default=4, help='并发的同步请求数')
+    parser.add_argument('--small-files', type=int, default=2000, help='每个请求的小文件数')
+    parser.add_argument('--small-size', type=int, default=64 << 10)
+    parser.add_argument('--large-files', type=int, default=4, help='每个请求的大文件数')
+    parser.add_argument('--large-size', type=int, default=64 << 20)
+    parser.add_argument('--max-workers', type=int, default=16, help='scheduler 的进程池大小')
+    parser.add_argument('--dir', default=None, help='临时目录, 默认系统临时目录')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cloud_storage_benchmark_', dir=args.dir)
+    try:
+        root = os.path.join(workdir, 'cloud')
+        requests = prepare(root, args.requests, args.small_files, args.small_size, args.large_files, args.large_size)
+        num_files = sum(len(files) for files in requests)
+        total_bytes = sum(size for files in requests for _, size in files)
+        print(f'{args.requests} 个请求, 共 {num_files} 个文件, {total_bytes / (1 << 20):.1f}MiB')
+        for name, run in [('per_file', lambda dst: run_per_file(root, dst, requests)),
+                          ('scheduler', lambda dst: run_scheduler(root, dst, requests, args.max_workers))]:
+            dst = os.path.join(workdir, name)
+            started_at = time.perf_counter()
+            futures = run(dst)
+            elapsed = time.perf_counter() - started_at
+            failed = sum(1 for f in futures if f.exception() is not None)
+            print(f'{name:>10}: {elapsed:.2f}s, {num_files / elapsed:.0f} files/s, '
+                  f'{total_bytes / (1 << 20) / elapsed:.1f}MiB/s, failed {failed}')
+            shutil.rmtree(dst)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
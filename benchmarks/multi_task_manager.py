@@ -0,0 +1,288 @@
+"""
+多任务 manager 的内存压测，用假的 k8s pod 列表和内存里的 redis 跑 MultiTaskManager，看每个任务占多少内存:
+    python -m benchmarks.multi_task_manager --tasks 1000 --nodes 4
+
+  - 不起 list-watch，直接把假的 pod 列表交给 reconcile，和 TaskPodListWatcher.process 一样
+  - 任务从假的 selector 里拿，写数据库 / 删 pod 都是空操作，redis 是内存里的
+  - 所有任务都接管完、monitor_loop 开始等 pod 事件之后，看 RSS 和 tracemalloc 的增长，再给每个 pod 发一轮 MODIFIED 事件看处理速度
+对比: 单任务 manager 每个任务有 len(MULTI_TASK_MODULES) 个检查进程，每个进程至少是 import 完依赖之后的 RSS
+"""
+import argparse
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import munch
+
+from conf import CONTAINER_NAME
+from conf.flags import EXP_STATUS, QUE_STATUS, TASK_TYPE
+from experiment_manager.manager import multi_task_manager, task_lifecycle
+from experiment_manager.manager.task_lifecycle import MULTI_TASK_LABEL
+
+# manager_utils 一 import 就要 TASK_ID，这里抄一份
+MULTI_TASK_MODULES = ['check_running.py', 'check_resource_released.py', 'check_unschedulable.py', 'stop_func.py', 'suspend_func.py']
+# 单任务 manager 检查进程 import 的依赖
+SCRIPT_IMPORTS = 'import zmq, munch, kubernetes; import conf, db, k8s, logm, roman_parliament; ' \
+                 'import server_model.selector, server_model.auto_task_impl, server_model.user_data'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+class FakeRedis(object):
+    """
+    manager 用到的那几个命令
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lists = defaultdict(list)
+        self.commands = 0
+
+    def get(self, key):
+        self.commands += 1
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.commands += 1
+        self.values[key] = value if isinstance(value, bytes) else str(value).encode()
+
+    def append(self, key, value):
+        self.commands += 1
+        self.values[key] = self.values.get(key, b'') + value.encode()
+
+    def lpush(self, key, value):
+        self.commands += 1
+        self.lists[key].insert(0, value if isinstance(value, bytes) else str(value).encode())
+
+    def expire(self, key, seconds):
+        self.commands += 1
+
+    def sismember(self, key, value):
+        self.commands += 1
+        return False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def rpop_any(self, keys):
+        for key in keys:
+            if self.lists.get(key):
+                return key.encode(), self.lists[key].pop()
+        return None
+
+
+class FakeAsyncRedis(object):
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+
+    async def get(self, key):
+        return self.redis.get(key)
+
+    async def lpush(self, key, value):
+        return self.redis.lpush(key, value)
+
+    async def brpop(self, keys, timeout=0):
+        result = self.redis.rpop_any(keys)
+        if result is None:
+            await asyncio.sleep(min(timeout, 0.1))
+        return result
+
+
+class FakeTask(object):
+    """
+    ManagedTask / TaskLifecycle 用到的任务字段，写数据库的方法只计数
+    """
+
+    def __init__(self, task_id, nodes):
+        self.id = task_id
+        self.user_name = 'bench_user'
+        self.nb_name = f'bench-{task_id}'
+        self.chain_id = f'chain-{task_id}'
+        self.job_info = f'[bench_user][{self.nb_name}][{task_id}]'
+        self.priority = 20
+        self.nodes = nodes
+        self.assigned_nodes = [f'node-{task_id}-{i}' for i in range(nodes)]
+        self.pods = [munch.Munch(pod_id=f'bench-user-{task_id}-{i}', job_id=str(i), node=node, status=EXP_STATUS.CREATED)
+                     for i, node in enumerate(self.assigned_nodes)]
+        self.schema = {'options': {}}
+        self.begin_at = None
+        self.queue_status = QUE_STATUS.SCHEDULED
+        self.task_type = TASK_TYPE.TRAINING_TASK
+        self.db_writes = 0
+
+    def update_pod_status(self, rank, status, *args, **kwargs):
+        self.db_writes += 1
+        self.pods[rank].status = status
+
+    def re_pods(self):
+        return self
+
+    def update(self, *args, **kwargs):
+        self.db_writes += 1
+
+
+class FakeSelector(object):
+    tasks = {}
+
+    @classmethod
+    def find_one_by_id(cls, impl, id):
+        return cls.tasks[id]
+
+
+class FakeWatcher(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def run(self):
+        pass
+
+
+def fake_pod(task_id, name, version, manager=False):
+    labels = {'task_id': str(task_id), 'user_id': 'bench_user', 'type': 'manager' if manager else 'training'}
+    if manager:
+        labels[MULTI_TASK_LABEL] = 'true'
+    return {
+        'metadata': {'name': name, 'labels': labels, 'resourceVersion': str(version)},
+        'spec': {'nodeName': 'node'},
+        'status': {
+            'phase': 'Running',
+            'conditions': [{'type': c, 'status': 'True'} for c in ['PodScheduled', 'Initialized', 'ContainersReady']],
+            'containerStatuses': [{'name': CONTAINER_NAME, 'ready': True, 'state': {'running': {'startedAt': '2024-01-01T00:00:00Z'}}}],
+        },
+    }
+
+
+def fake_pods(tasks, nodes, version):
+    pods = {}
+    for task_id in range(1, tasks + 1):
+        name = f'bench-user-{task_id}-manager-0'
+        pods[name] = fake_pod(task_id, name, version, manager=True)
+        for i in range(nodes):
+            name = f'bench-user-{task_id}-{i}'
+            pods[name] = fake_pod(task_id, name, version)
+    return pods
+
+
+def install_fakes(tasks, nodes):
+    redis = FakeRedis()
+    FakeSelector.tasks = {task_id: FakeTask(task_id, nodes) for task_id in range(1, tasks + 1)}
+    task_lifecycle.redis_conn = redis
+    multi_task_manager.a_redis = FakeAsyncRedis(redis)
+    multi_task_manager.TaskPodListWatcher = FakeWatcher
+    multi_task_manager.TrainingTaskSelector = FakeSelector
+    multi_task_manager.register_archive = lambda *args, **kwargs: None
+    multi_task_manager.remove_archive_locally = lambda *args, **kwargs: None
+    multi_task_manager.update_mass_key_list = lambda *args, **kwargs: None
+    return redis
+
+
+async def wait_until(predicate, timeout):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise TimeoutError('等待超时')
+        await asyncio.sleep(0.05)
+
+
+def script_process_rss_mb():
+    """
+    单任务 manager 一个检查进程 import 完依赖之后的 RSS
+    """
+    code = f'{SCRIPT_IMPORTS}; import os; print(int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))'
+    try:
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=120, check=True).stdout
+        return int(output.strip().splitlines()[-1]) / 1024 / 1024
+    except Exception as e:
+        print(f'测不了单任务 manager 进程的 RSS: {e}')
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多任务 manager 内存压测')
+    parser.add_argument('--tasks', type=int, default=1000, help='模拟的任务数')
+    parser.add_argument('--nodes', type=int, default=4, help='每个任务的 pod 数')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    install_fakes(args.tasks, args.nodes)
+    manager = multi_task_manager.MultiTaskManager(shard=0, shards=1)
+    loop = manager.loop
+    signal_loop = asyncio.ensure_future(manager.signal_loop())
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    gc.collect()
+    tracemalloc.start()
+    rss_before = rss_mb()
+    started_at = time.perf_counter()
+    manager.reconcile(fake_pods(args.tasks, args.nodes, version=1))
+    all_started = lambda: len(manager.tasks) == args.tasks and all(
+        m.lifecycle is not None and m.pod_events.empty() for m in manager.tasks.values())
+    loop.run_until_complete(wait_until(all_started, args.timeout))
+    # monitor_loop 里 check_pod_disappeared 跑完，开始等事件
+    loop.run_until_complete(asyncio.sleep(1))
+    adopt_seconds = time.perf_counter() - started_at
+    gc.collect()
+    rss_after = rss_mb()
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 每个 pod 一个 MODIFIED 事件
+    pods = fake_pods(args.tasks, args.nodes, version=2)
+    db_writes = sum(task.db_writes for task in FakeSelector.tasks.values())
+    started_at = time.perf_counter()
+    for pod in pods.values():
+        manager.on_pod_event('MODIFIED', pod)
+    loop.run_until_complete(wait_until(
+        lambda: sum(task.db_writes for task in FakeSelector.tasks.values()) - db_writes >= args.tasks * args.nodes, args.timeout))
+    event_seconds = time.perf_counter() - started_at
+
+    signal_loop.cancel()
+    for task_id in list(manager.tasks):
+        manager.release(task_id)
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    print(f'{args.tasks} 个任务, 每个 {args.nodes} 个 pod')
+    print(f'接管: {adopt_seconds:.2f}s, RSS +{rss_after - rss_before:.1f}MB ({(rss_after - rss_before) * 1024 / args.tasks:.1f}KB/任务), '
+          f'python 对象 {traced / 1024 / 1024:.1f}MB ({traced / 1024 / args.tasks:.1f}KB/任务)')
+    print(f'pod 事件: {args.tasks * args.nodes} 个, {event_seconds:.2f}s, {args.tasks * args.nodes / event_seconds:.0f} 个/s')
+    if (script_rss := script_process_rss_mb()) is not None:
+        print(f'单任务 manager: 每个检查进程至少 {script_rss:.1f}MB, 每个任务 {len(MULTI_TASK_MODULES)} 个进程 '
+              f'{script_rss * len(MULTI_TASK_MODULES):.1f}MB, {args.tasks} 个任务 {script_rss * len(MULTI_TASK_MODULES) * args.tasks / 1024:.1f}GB')
+
+
+if __name__ == '__main__':
+    main()
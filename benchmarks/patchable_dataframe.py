@@ -0,0 +1,185 @@
+"""
+PatchableDataFrame 的 benchmark, 造 10 万行的 user 表和 quota 表, 改几十行, 不需要数据库:
+    python -m benchmarks.patchable_dataframe --rows 100000 --changes 30 --rounds 5
+
+对比两种实现, 走一遍同步点 load_from_db -> diff -> 广播 patch -> 议员 apply_patch:
+  - merge: 原来的做法, object 列转成 string 得到 df_indexing, diff / apply_patch 对所有列做 outer merge
+  - hash: 现在的 PatchableDataFrame, 按主键定位行, 只比较行内容的 hash
+测 构造 (拉到新数据后建 df_indexing / 算 hash)、diff、apply_patch 的耗时和 pickle 后 patch 的大小,
+两种实现 apply_patch 之后的 df 都要和新数据一样
+"""
+import argparse
+import gc
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from server_model.user_data.patchable_dataframe import PatchableDataFrame, PatchConflictException
+
+
+class LegacyPatchableDataFrame(object):
+    """
+    原来的 PatchableDataFrame, 只留了 diff / apply_patch 用到的部分
+    """
+
+    def __init__(self, df=None, df_indexing=None, timestamp=0):
+        self.df = df
+        self.timestamp = timestamp
+        if df_indexing is None:
+            self.df_indexing = df.copy()
+            obj_columns = df.columns[df.dtypes == object]
+            self.df_indexing[obj_columns] = self.df_indexing[obj_columns].astype(str, copy=False)
+            datetime_columns = [col for col in df.columns if pd.api.types.is_datetime64_any_dtype(df[col].dtype)]
+            for col in datetime_columns:
+                transform = lambda t: f'{t.timestamp():.6f}' if not pd.isna(t) else ''
+                self.df_indexing[col] = self.df_indexing[col].apply(transform)
+        else:
+            self.df_indexing = df_indexing
+
+    def index_select(self, indices):
+        return LegacyPatchableDataFrame(df=self.df.loc[indices].copy(),
+                                        df_indexing=self.df_indexing.loc[indices].copy(),
+                                        timestamp=self.timestamp)
+
+    def diff(self, df_new):
+        df_new_indexing = df_new.df_indexing.reset_index().rename(columns={'index': 'rindex'})
+        merged_df = self.df_indexing.reset_index().merge(df_new_indexing, how='outer', indicator=True)
+        to_del_indices = merged_df[merged_df._merge == 'left_only']['index'].astype(int)
+        to_add_indices = merged_df[merged_df._merge == 'right_only']['rindex'].astype(int)
+        if len(to_del_indices) + len(to_add_indices) > 0:
+            return self.index_select(to_del_indices), df_new.index_select(to_add_indices)   # to_del, to_add
+        else:
+            return None
+
+    def apply_patch(self, patch):
+        to_del, to_add = patch
+        merge_w_to_del = self.df_indexing.reset_index().merge(to_del.df_indexing, how='outer', indicator=True)
+        merge_w_to_add = self.df_indexing.reset_index().merge(to_add.df_indexing, how='outer', indicator=True)
+        if len(merge_w_to_del[merge_w_to_del._merge == 'right_only']) > 0:
+            raise PatchConflictException("找不到要删除的 data row")
+        if len(merge_w_to_add[merge_w_to_add._merge == 'both']) > 0:
+            raise PatchConflictException("要添加的 data row 已经存在于 df 中")
+        keep_indices = merge_w_to_del[merge_w_to_del._merge == 'left_only']['index'].dropna().astype(int)
+        df = self.df.loc[keep_indices].copy()
+        self.df = pd.concat([df, to_add.df]).reset_index(drop=True)
+        df_indexing = self.df_indexing.loc[keep_indices].copy()
+        self.df_indexing = pd.concat([df_indexing, to_add.df_indexing]).reset_index(drop=True)
+
+
+IMPLS = {
+    'merge': lambda df, primary_key_columns: LegacyPatchableDataFrame(df=df),
+    'hash': lambda df, primary_key_columns: PatchableDataFrame(df=df, primary_key_columns=primary_key_columns),
+}
+
+
+def make_user_df(rows, rng):
+    """
+    和 UserTable 的列一样
+    """
+    user_ids = np.arange(1, rows + 1)
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'user_name': [f'user_{i}' for i in user_ids],
+        'token': [f'{i * 2654435761 % (1 << 64):016x}' for i in user_ids],
+        'role': rng.choice(np.array(['internal', 'external'], dtype=object), size=rows),
+        'active': rng.random(rows) < 0.9,
+        'shared_group': [[f'group_{i % 50}'] if i % 3 == 0 else [] for i in user_ids],
+        'nick_name': [f'nick_{i}' for i in user_ids],
+    })
+
+
+def make_quota_df(rows, rng):
+    """
+    和 QuotaTable 的列一样, 每个用户几种 resource
+    """
+    resources = np.array([f'node-jd_a{i:02d}-{p}' for i in range(8) for p in [20, 30]] + ['cpu', 'memory'], dtype=object)
+    num_resources = len(resources)
+    user_index = np.arange(rows) // num_resources
+    expire_time = pd.Series(pd.NaT, index=range(rows), dtype='datetime64[ns]')
+    has_expire = rng.random(rows) < 0.1
+    expire_time[has_expire] = pd.Timestamp('2030-01-01') + pd.to_timedelta(rng.integers(0, 86400 * 365, size=has_expire.sum()), unit='s')
+    return pd.DataFrame({
+        'user_name': [f'user_{i}' for i in user_index],
+        'resource': resources[np.arange(rows) % num_resources],
+        'quota': rng.integers(0, 512, size=rows),
+        'expire_time': expire_time,
+    })
+
+
+def change_df(df, primary_key_columns, changes, rng):
+    """
+    改 changes 行: 一半修改, 四分之一删除, 四分之一新增 (从删掉的行改主键以外的列得到, 主键不会和已有的重复)
+    """
+    positions = rng.choice(len(df), size=changes, replace=False)
+    modify, delete = positions[:changes // 2], positions[changes // 2: changes * 3 // 4]
+    value_column = [col for col in df.columns if col not in primary_key_columns and df[col].dtype != object][0]
+    new_df = df.copy()
+    new_df.loc[modify, value_column] = new_df.loc[modify, value_column].apply(lambda v: not v if isinstance(v, (bool, np.bool_)) else v + 1)
+    inserted = df.iloc[positions[changes * 3 // 4:]].copy()
+    for col in primary_key_columns:
+        inserted[col] = inserted[col].map(lambda v: v + len(df) if isinstance(v, (int, np.integer)) else f'{v}_new')
+    return pd.concat([new_df.drop(delete), inserted]).reset_index(drop=True)
+
+
+def check_same(df, expected_df, primary_key_columns):
+    sort = lambda d: d.sort_values(primary_key_columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sort(df), sort(expected_df))
+
+
+def best_ms(func, rounds):
+    costs = []
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            result = func()
+            costs.append(time.perf_counter() - started_at)
+        finally:
+            gc.enable()
+    return min(costs) * 1000, result
+
+
+def run(df, primary_key_columns, changes, rounds, rng):
+    new_df = change_df(df, primary_key_columns, changes, rng)
+    results = {}
+    for impl, build in IMPLS.items():
+        old = build(df, primary_key_columns)
+        build_ms, new = best_ms(lambda: build(new_df, primary_key_columns), rounds)
+        diff_ms, patch = best_ms(lambda: old.diff(new), rounds)
+        patch_size = len(pickle.dumps(patch))
+        # 议员那边收到的是 pickle 过来的 patch
+        patch = pickle.loads(pickle.dumps(patch))
+        members = [build(df, primary_key_columns) for _ in range(rounds)]
+        apply_ms, _ = best_ms(lambda: members.pop().apply_patch(patch), rounds)
+        member = build(df, primary_key_columns)
+        member.apply_patch(patch)
+        check_same(member.df, new_df, primary_key_columns)
+        results[impl] = (build_ms, diff_ms, apply_ms, patch_size)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PatchableDataFrame benchmark')
+    parser.add_argument('--rows', type=int, default=100000, help='每张表的行数')
+    parser.add_argument('--changes', type=int, default=30, help='每次同步改多少行')
+    parser.add_argument('--rounds', type=int, default=5, help='每项测几次取最快的')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tables = {
+        'user': (make_user_df(args.rows, rng), ['user_id']),
+        'quota': (make_quota_df(args.rows, rng), ['user_name', 'resource']),
+    }
+    for table_name, (df, primary_key_columns) in tables.items():
+        results = run(df, primary_key_columns, args.changes, args.rounds, rng)
+        print(f'{table_name} 表 {len(df)} 行, 改 {args.changes} 行:')
+        for impl, (build_ms, diff_ms, apply_ms, patch_size) in results.items():
+            print(f'  {impl:>5}: 构造 {build_ms:.1f}ms, diff {diff_ms:.1f}ms, apply_patch {apply_ms:.1f}ms, '
+                  f'patch {patch_size / 1024:.1f}KB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+FIFOAssigner.filter_in_quota 的回放 benchmark, 拿 tick_data 回放原来逐行的 iterrows 实现和现在的 quota_cascade, 比较结果和耗时:
+    python -m benchmarks.quota --snapshots /tmp/tick_data_1.bin /tmp/tick_data_2.bin
+    python -m benchmarks.quota --tasks 1000 5000 10000 --rounds 3
+
+  - --snapshots: 录下来的 tick_data, 每个文件是 beater 写给下游的 TickData.dumps(tick_data)
+  - 不给 --snapshots 就用 benchmarks/tick_data.py 造的 tick_data, 换成按需求随机的 quota, 有一部分 AUTO 任务
+每个 snapshot 上两种实现的 assign_result 和 priority 要逐个一样，不一样直接报错
+"""
+import argparse
+import copy
+import gc
+import time
+
+import numpy as np
+import pandas as pd
+
+from conf.flags import TASK_TYPE, TASK_PRIORITY
+from scheduler.base_model import TickData, ASSIGN_RESULT
+from benchmarks.tick_data import make_tick_data
+from scheduler.modules.assigners.simple_fifo import FIFOAssigner
+
+
+def legacy_filter_in_quota(task_df: pd.DataFrame, user_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    原来 FIFOAssigner.filter_in_quota 的实现，逐行 iterrows + .loc 写回
+    只改了一处: 用户在分组里完全没有 quota 的 AUTO 任务，原来 max() 空序列会抛 ValueError，这里按 quota 0 算成 QUOTA_EXCEEDED，和现在的实现一样
+    """
+    task_df = task_df[task_df.task_type == TASK_TYPE.TRAINING_TASK].copy()
+    task_df.assign_result = ASSIGN_RESULT.OUT_OF_QUOTA
+    raw_user_training_quota = user_df[user_df.active & (user_df.resource == 'node')].groupby(['user_name', 'priority', 'group']).quota.max().to_dict()
+    user_training_quota = copy.deepcopy(raw_user_training_quota)
+    for _, task in task_df.sort_values(['custom_rank', 'first_id']).iterrows():
+        if task.priority != TASK_PRIORITY.AUTO.value:
+            if user_training_quota.get((task.user_name, task.priority, task.group), 0) - task.nodes >= 0:
+                task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.NOT_SURE
+                user_training_quota[task.user_name, task.priority, task.group] -= task.nodes
+            elif raw_user_training_quota.get((task.user_name, task.priority, task.group), 0) < task.nodes:
+                task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.QUOTA_EXCEEDED
+        else:
+            for priority_level in TASK_PRIORITY.all_priorities():
+                if user_training_quota.get((task.user_name, priority_level.value, task.group), 0) - task.nodes >= 0:
+                    task_df.loc[task.id, ['priority', 'assign_result']] = [priority_level.value, ASSIGN_RESULT.NOT_SURE]
+                    user_training_quota[task.user_name, priority_level.value, task.group] -= task.nodes
+                    break
+            else:
+                if task.nodes > max((quota for (user_name, priority, group), quota in raw_user_training_quota.items() if user_name == task.user_name and group == task.group), default=0):
+                    task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.QUOTA_EXCEEDED
+    return task_df
+
+
+def current_filter_in_quota(task_df: pd.DataFrame, user_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    现在的 FIFOAssigner.filter_in_quota，不起进程，直接给一个 tick_data
+    """
+    assigner = FIFOAssigner.__new__(FIFOAssigner)
+    assigner.tick_data = TickData(task_df=task_df, user_df=user_df)
+    assigner.filter_in_quota()
+    return assigner.task_df
+
+
+def make_snapshot(num_tasks, seed=0) -> TickData:
+    """
+    在 benchmarks/tick_data.py 的 tick_data 上换一份 user_df: 大部分 (用户, 优先级, 分组) 有 quota，大小在这个 key 需求的 0 ~ 1.5 倍之间，
+    这样有的 key 一下就放得下，有的要逐个挤，AUTO 任务也会往下找优先级
+    """
+    rng = np.random.default_rng(seed)
+    tick_data = make_tick_data(num_tasks, seed=seed)
+    task_df = tick_data.task_df
+    task_df['task_type'] = np.where(rng.random(num_tasks) < 0.9, TASK_TYPE.TRAINING_TASK, task_df.task_type)
+    task_df['priority'] = rng.choice(TASK_PRIORITY.values(), size=num_tasks, p=[0.1] * 8 + [0.2])
+    demand = task_df.groupby(['user_name', 'priority', 'group']).nodes.sum().to_dict()
+    tick_data.user_df = pd.DataFrame([
+        {'user_name': user_name, 'resource': 'node', 'group': group, 'quota': int(rng.integers(0, nodes * 3 // 2 + 2)),
+         'role': 'internal', 'priority': priority, 'active': bool(rng.random() < 0.95)}
+        for (user_name, priority, group), nodes in demand.items()
+        if priority != TASK_PRIORITY.AUTO.value and rng.random() < 0.8
+    ], columns=tick_data.user_df.columns)
+    return tick_data
+
+
+def load_snapshot(path) -> TickData:
+    with open(path, 'rb') as f:
+        return TickData.loads(f.read())
+
+
+def check_same(legacy_df: pd.DataFrame, current_df: pd.DataFrame):
+    # 原来 .loc 同时写 priority 和 assign_result 会把 priority 列变成 object，这里只比值
+    pd.testing.assert_frame_equal(legacy_df[['assign_result', 'priority']], current_df[['assign_result', 'priority']],
+                                  check_dtype=False)
+
+
+def best_ms(func, rounds):
+    costs = []
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            result = func()
+            costs.append(time.perf_counter() - started_at)
+        finally:
+            gc.enable()
+    return min(costs) * 1000, result
+
+
+def run(name, tick_data: TickData, rounds):
+    task_df, user_df = tick_data.task_df, tick_data.user_df
+    # 原来的实现上万个任务要跑几十秒，只测一次
+    legacy_ms, legacy_df = best_ms(lambda: legacy_filter_in_quota(task_df, user_df), 1)
+    current_ms, current_df = best_ms(lambda: current_filter_in_quota(task_df, user_df), rounds)
+    check_same(legacy_df, current_df)
+    counts = current_df.assign_result.value_counts().to_dict()
+    print(f'{name}: {len(current_df)} 个训练任务, iterrows {legacy_ms:.1f}ms, quota_cascade {current_ms:.1f}ms '
+          f'({legacy_ms / current_ms:.1f}x), 结果一致 {counts}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FIFOAssigner.filter_in_quota 回放 benchmark')
+    parser.add_argument('--snapshots', nargs='*', default=[], help='TickData.dumps 录下来的 tick_data 文件')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1000, 5000, 10000], help='没有 --snapshots 时造的 task_df 行数')
+    parser.add_argument('--seeds', type=int, default=2, help='每个任务数造几份 tick_data')
+    parser.add_argument('--rounds', type=int, default=3, help='quota_cascade 测几次取最快的')
+    args = parser.parse_args()
+
+    if args.snapshots:
+        for path in args.snapshots:
+            run(path, load_snapshot(path), args.rounds)
+        return
+    for num_tasks in args.tasks:
+        for seed in range(args.seeds):
+            run(f'{num_tasks} 个任务 seed={seed}', make_snapshot(num_tasks, seed=seed), args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+runtime 通信的压测, 在本机起一个 RuntimeServer (handler 是假的, sleep 一段时间模拟访问数据库), 模拟很多 rank 同时调用:
+    python -m benchmarks.runtime_channel --ranks 1000 --rounds 3
+
+对比两种客户端:
+  - legacy: 原来的做法, 每次调用新建一个连接
+  - channel: 每个 rank 一个 RuntimeChannel 长连接
+每一轮所有 rank 同时调用 receive_suspend_command / set_whole_life_state / set_priority / report_git_revision
+"""
+import argparse
+import pickle
+import socket
+import threading
+import time
+from collections import Counter
+
+from conf.runtime_channel import RuntimeChannel, legacy_request
+from experiment_manager.manager.runtime_server import RuntimeServer
+
+
+def fake_handlers(handler_ms, executed: Counter):
+    def make(source):
+        def handler(**kwargs):
+            executed[source] += 1
+            time.sleep(handler_ms / 1000)
+            return {'success': 1, 'msg': f'{source} 成功'}
+        return handler
+    return {source: make(source) for source in
+            ['receive_suspend_command', 'set_whole_life_state', 'set_priority', 'report_git_revision']}
+
+
+def rank_calls(rank):
+    return [
+        {'source': 'receive_suspend_command'},
+        {'source': 'set_whole_life_state', 'whole_life_state': 100},
+        {'source': 'set_priority', 'priority': 20},
+        {'source': 'report_git_revision', 'rank': rank, 'commit_sha': 'a' * 40},
+    ]
+
+
+def run(mode, address, ranks, rounds, timeout):
+    latencies, failures = [], Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(ranks)
+
+    def rank_main(rank):
+        channel = RuntimeChannel(address)
+        for _ in range(rounds):
+            barrier.wait()
+            for data in rank_calls(rank):
+                b_data = pickle.dumps(data)
+                started_at = time.perf_counter()
+                try:
+                    if mode == 'channel':
+                        result = pickle.loads(channel.request(b_data, timeout))
+                    else:
+                        result = pickle.loads(legacy_request(address, b_data, timeout))
+                    ok = result['success'] == 1
+                except Exception as e:
+                    ok = False
+                    with lock:
+                        failures[type(e).__name__] += 1
+                with lock:
+                    latencies.append(time.perf_counter() - started_at)
+                    if not ok:
+                        failures['failed'] += 1
+        if channel.connection is not None:
+            channel.connection.close(ConnectionError('benchmark 结束'))
+
+    threads = [threading.Thread(target=rank_main, args=(rank, ), daemon=True) for rank in range(ranks)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started_at, sorted(latencies), failures
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='runtime 通信压测')
+    parser.add_argument('--ranks', type=int, default=1000, help='模拟的 rank 数')
+    parser.add_argument('--rounds', type=int, default=3, help='每个 rank 调用几轮')
+    parser.add_argument('--handler-ms', type=float, default=20, help='handler 耗时 (模拟数据库)')
+    parser.add_argument('--workers', type=int, default=16, help='server 的 handler 线程数')
+    parser.add_argument('--coalesce-seconds', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    calls = args.ranks * args.rounds * len(rank_calls(0))
+    print(f'{args.ranks} 个 rank, 每个 {args.rounds} 轮, 共 {calls} 次调用')
+    for mode in ['legacy', 'channel']:
+        executed = Counter()
+        server = RuntimeServer(free_port(), fake_handlers(args.handler_ms, executed), workers=args.workers,
+                               coalesce_seconds=args.coalesce_seconds)
+        server.daemon = True
+        server.start()
+        server.ready.wait()
+        elapsed, latencies, failures = run(mode, ('127.0.0.1', server.port), args.ranks, args.rounds, args.timeout)
+        p50, p99 = (latencies[int(len(latencies) * q)] * 1000 for q in (0.5, 0.99)) if latencies else (0, 0)
+        print(f'{mode:>8}: {elapsed:.2f}s, {calls / elapsed:.0f} calls/s, p50 {p50:.1f}ms, p99 {p99:.1f}ms, '
+              f'handler 执行 {sum(executed.values())} 次, 合并 {server.stats["coalesced"]} 次, 失败 {dict(failures)}')
+        server.loop.call_soon_threadsafe(server.loop.stop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+任务日志接口 get_task_node_idx_log 的 benchmark, 在本地目录造几个 GB 的轮转日志, 不需要共享盘和数据库:
+    python -m benchmarks.task_log --gb 2 --file-mb 512 --max-bytes 1048576
+
+对比两种实现, 都按前端的方式调用:
+  - legacy: 原来的做法, 从 offset 读到文件末尾, 再从后往前逐字节找时间戳, last_seen 对不上的文件整个重读
+  - indexed: 现在的 utils/real_time_logs.py, 每个文件一个稀疏索引, 一次最多返回 max_bytes 字节
+测这几种请求的耗时和返回的字节数:
+  - 打开页面: 没有 last_seen, indexed 第一次要建索引 (冷), 第二次索引已经缓存 (热)
+  - 跟踪: 最新的文件追加几十行, 用上一次的 last_seen 拉
+  - 跳转: last_seen 指向最老的文件中间, offset 对不上, 要按时间戳找
+legacy 每次会把日志全部读到内存里, 日志很大的时候可以加 --no-legacy 只测 indexed
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import aiofiles
+
+from utils import real_time_logs
+from utils.real_time_logs import check_file_match, get_task_node_idx_log, get_timestamp_from_line
+
+TASK_ID = 1
+START = datetime.datetime(2024, 1, 1)
+TRACEBACK = ''.join(f'  File "/marsv2/scripts/train.py", line {i}, in forward\n' for i in range(20))
+
+
+async def legacy_file_read_all(fp, timestamp, offset, mtime):
+    await fp.seek(offset, 0)
+    data = await fp.read()
+    last_seen = {"timestamp": timestamp, "offset": offset, "mtime": mtime}
+    for i in range(len(data) - 1, -1, -1):
+        if data[i] == ord('[') and (i == 0 or data[i - 1] == ord('\n')):
+            try:
+                line_timestamp = await get_timestamp_from_line(data[i:])
+                if timestamp and line_timestamp <= timestamp:
+                    return {"data": "", "last_seen": last_seen}
+                return {"data": data.decode(errors='replace'),
+                        "last_seen": {"timestamp": line_timestamp, "offset": i + offset, "mtime": mtime}}
+            except:
+                pass
+    return {"data": "", "last_seen": last_seen}
+
+
+async def legacy_get_file_log(path, last_seen):
+    """
+    原来的 get_file_log, 只去掉了 success 字段
+    """
+    mtime = os.path.getmtime(path)
+    if last_seen and 'mtime' in last_seen and mtime < last_seen['mtime']:
+        return {"data": "", "last_seen": last_seen}
+    async with aiofiles.open(path, "rb") as fp:
+        if not last_seen:
+            return await legacy_file_read_all(fp, None, 0, mtime)
+        timestamp = last_seen['timestamp']
+        await fp.seek(last_seen['offset'], 0)
+        try:
+            if await get_timestamp_from_line(await fp.readline()) == timestamp:
+                return await legacy_file_read_all(fp, timestamp, await fp.tell(), mtime)
+        except:
+            pass
+        await fp.seek(0, 0)
+        try:
+            if timestamp < await get_timestamp_from_line(await fp.readline()):
+                return await legacy_file_read_all(fp, timestamp, 0, mtime)
+        except:
+            try:
+                current_idx = await fp.tell()
+                if timestamp < await get_timestamp_from_line(await fp.readline()):
+                    return await legacy_file_read_all(fp, timestamp, current_idx, mtime)
+            except:
+                pass
+        return await legacy_file_read_all(fp, timestamp, 0, mtime)
+
+
+async def legacy_get_task_node_idx_log(task_id, user, node_idx, last_seen=None, max_line_length=4096, max_bytes=None):
+    """
+    原来的 get_task_node_idx_log, 没有 suffix_filter 和 error 文件, max_bytes 不起作用
+    """
+    path = os.path.join(user.config.log_dir(), str(task_id))
+    files = sorted(((file, os.path.getmtime(os.path.join(path, file))) for file in os.listdir(path)
+                    if check_file_match(file, node_idx)), key=lambda t: t[1])
+    data, rst_last_seen = [], last_seen
+    for file, _ in files:
+        info = await legacy_get_file_log(os.path.join(path, file), last_seen)
+        if info['last_seen'] and info['last_seen']['timestamp']:
+            if not rst_last_seen or info['last_seen']['timestamp'] > rst_last_seen['timestamp']:
+                rst_last_seen = info['last_seen']
+        data.append(info['data'])
+    cut_log = []
+    for line_log in ''.join(data).split('\n'):
+        if len(line_log) > max_line_length and line_log[29:40] != '[HFAI_PRINT':
+            line_log = line_log[0:max_line_length] + f'...(日志长度超过 {max_line_length}，已被截断)'
+        cut_log.append(line_log)
+    return {"data": '\n'.join(cut_log), "last_seen": rst_last_seen, "truncated": False}
+
+
+IMPLS = {
+    'legacy': legacy_get_task_node_idx_log,
+    'indexed': get_task_node_idx_log,
+}
+
+
+def log_lines(first, count):
+    """
+    训练日志的样子: 每行一个时间戳, 每 1000 行夹一段没有时间戳的 traceback
+    """
+    for i in range(first, first + count):
+        yield f'[{START + datetime.timedelta(milliseconds=i):%Y-%m-%d %H:%M:%S.%f}] step {i} loss 0.{i % 9973:04d} lr 1e-4 {"x" * 80}\n'
+        if i % 1000 == 999:
+            yield TRACEBACK
+
+
+def make_logs(log_dir, total_bytes, file_bytes):
+    """
+    造轮转过的日志 exp#0.log.N ... exp#0.log.1, exp#0.log, 越新的文件 mtime 越大, 返回写了多少行
+    """
+    task_dir = os.path.join(log_dir, str(TASK_ID))
+    os.makedirs(task_dir)
+    num_files = max(total_bytes // file_bytes, 1)
+    line_no, batch = 0, 10000
+    for n in range(num_files):
+        suffix = f'.{num_files - 1 - n}' if n < num_files - 1 else ''
+        path = os.path.join(task_dir, f'exp#0.log{suffix}')
+        with open(path, 'w') as f:
+            while f.tell() < file_bytes:
+                f.writelines(log_lines(line_no, batch))
+                line_no += batch
+        os.utime(path, (1000 + n, 1000 + n))
+    return task_dir, line_no
+
+
+def clear_caches():
+    real_time_logs._log_indexes.clear()
+    real_time_logs._dir_listings.clear()
+
+
+def timed(func, **kwargs):
+    started_at = time.perf_counter()
+    res = asyncio.run(func(TASK_ID, kwargs.pop('user'), 0, **kwargs))
+    return (time.perf_counter() - started_at) * 1000, res
+
+
+def run(impl, user, task_dir, num_lines, max_bytes):
+    func = IMPLS[impl]
+    results = []
+    clear_caches()
+    cold_ms, res = timed(func, user=user, max_bytes=max_bytes)
+    results.append(('打开页面 (冷)', cold_ms, res))
+    warm_ms, res = timed(func, user=user, max_bytes=max_bytes)
+    results.append(('打开页面 (热)', warm_ms, res))
+
+    with open(os.path.join(task_dir, 'exp#0.log'), 'a') as f:
+        f.writelines(log_lines(num_lines, 50))
+    follow_ms, follow_res = timed(func, user=user, last_seen=res['last_seen'], max_bytes=max_bytes)
+    results.append(('跟踪', follow_ms, follow_res))
+
+    # 最老的文件中间的一行, offset 故意给错, 要按时间戳找
+    middle = START + datetime.timedelta(milliseconds=num_lines // (2 * len(os.listdir(task_dir))))
+    jump_ms, jump_res = timed(func, user=user, last_seen={'timestamp': middle, 'offset': 0, 'mtime': 0},
+                              max_bytes=max_bytes)
+    results.append(('跳转', jump_ms, jump_res))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='get_task_node_idx_log benchmark')
+    parser.add_argument('--gb', type=float, default=2, help='日志总大小')
+    parser.add_argument('--file-mb', type=int, default=512, help='轮转前每个文件多大')
+    parser.add_argument('--max-bytes', type=int, default=1 << 20, help='indexed 一次最多返回多少字节')
+    parser.add_argument('--dir', default=None, help='日志放在哪, 默认是临时目录, 测完删掉')
+    parser.add_argument('--no-legacy', action='store_true', help='不测 legacy')
+    args = parser.parse_args()
+
+    log_dir = args.dir or tempfile.mkdtemp(prefix='task_log_benchmark_')
+    try:
+        started_at = time.perf_counter()
+        task_dir, num_lines = make_logs(log_dir, int(args.gb * (1 << 30)), args.file_mb << 20)
+        sizes = {file: os.path.getsize(os.path.join(task_dir, file)) for file in sorted(os.listdir(task_dir))}
+        print(f'造了 {len(sizes)} 个文件, 共 {sum(sizes.values()) / (1 << 30):.2f}GB, {num_lines} 行, '
+              f'{time.perf_counter() - started_at:.1f}s')
+        user = type('User', (), {'config': type('Config', (), {'log_dir': staticmethod(lambda: log_dir)})})
+        for impl in IMPLS:
+            if impl == 'legacy' and args.no_legacy:
+                continue
+            # 每个实现用一样的日志, 跟踪的时候追加的行先去掉
+            shutil.copyfile(os.path.join(task_dir, 'exp#0.log'), os.path.join(log_dir, 'exp#0.log.orig'))
+            for name, ms, res in run(impl, user, task_dir, num_lines, args.max_bytes):
+                print(f'{impl:>7} {name}: {ms:.1f}ms, 返回 {len(res["data"]) / 1024:.1f}KB, truncated={res["truncated"]}')
+            os.replace(os.path.join(log_dir, 'exp#0.log.orig'), os.path.join(task_dir, 'exp#0.log'))
+            os.utime(os.path.join(task_dir, 'exp#0.log'), (1000 + len(sizes) - 1,) * 2)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(log_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+TickData 编码的 benchmark, 造 1k / 10k / 50k 个任务的 tick_data, 不需要数据库:
+    python -m benchmarks.tick_data --tasks 1000 10000 50000 --rounds 5
+
+对比两种编码:
+  - pickle: 现在的 TickData.dumps / TickData.loads, 整个 TickData pickle.dumps / pickle.loads
+  - columnar: 按列编码 (utils/columnar.py 的 dumps_state / loads_state), 测下来没有比 pickle 快, TickData 没有用它
+每种编码测 编码 / 解码的耗时和大小, 以及经过 ProcessConnection 一次 put + get 的 tick 延迟 (上游写入到下游拿到 TickData),
+columnar 解出来的 df 会和原来的逐个比较, 保证是一样的
+"""
+import argparse
+import gc
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.columnar import dumps_state, loads_state
+from scheduler.base_model.base_types import TickData
+from scheduler.base_model.connection import ProcessConnection
+
+
+def make_tick_data(num_tasks, seed=0) -> TickData:
+    """
+    按线上的分布造 tick_data: 几百个用户, 十几个分组, 大部分任务在排队, 节点数大约是任务数的一半
+    """
+    rng = np.random.default_rng(seed)
+    num_users, num_nodes = max(num_tasks // 20, 10), max(num_tasks // 2, 100)
+    users = np.array([f'user_{i}' for i in range(num_users)], dtype=object)
+    groups = np.array([f'jd_a{i:02d}' for i in range(16)], dtype=object)
+    node_names = np.array([f'jd-a{i // 1000:02d}{i % 1000:03d}' for i in range(num_nodes)], dtype=object)
+    ids = np.arange(1, num_tasks + 1, dtype=np.int64) + 1000000
+    nodes = rng.choice([1, 1, 1, 2, 4, 8, 16, 64], size=num_tasks)
+    queue_status = rng.choice(np.array(['queued', 'queued', 'queued', 'scheduled', 'finished'], dtype=object), size=num_tasks)
+    task_users = users[rng.integers(0, num_users, size=num_tasks)]
+    task_groups = groups[rng.integers(0, len(groups), size=num_tasks)]
+    task_df = pd.DataFrame({
+        'id': ids,
+        'nb_name': [f'exp_{i}.py' for i in ids],
+        'user_name': task_users,
+        'code_file': [f'/weka-jd/prod/public/permanent/group_{i % 7}/exp_{i}.py' for i in ids],
+        'group': task_groups,
+        'nodes': nodes,
+        'assigned_nodes': [list(node_names[rng.integers(0, num_nodes, size=n)]) if s == 'scheduled' else []
+                           for n, s in zip(nodes, queue_status)],
+        'backend': 'train_image:default',
+        'task_type': rng.choice(np.array(['training', 'training', 'jupyter', 'validation'], dtype=object), size=num_tasks),
+        'queue_status': queue_status,
+        'priority': rng.choice([-1, 0, 10, 20, 30, 40, 50], size=num_tasks),
+        'first_id': ids - rng.integers(0, 1000, size=num_tasks),
+        'running_seconds': rng.random(num_tasks) * 86400,
+        'chain_id': [f'{i:032x}' for i in ids],
+        'config_json': [{'schema': {'resource': {'image': 'default', 'group': g}, 'options': {'whole_life_state': 0}}}
+                        for g in task_groups],
+        'user_role': rng.choice(np.array(['internal', 'external'], dtype=object), size=num_tasks),
+        'assign_result': rng.choice(np.array(['NOT_SURE', 'CAN_RUN', 'QUOTA_EXCEEDED'], dtype=object), size=num_tasks),
+        'match_result': rng.choice(np.array(['NOT_SURE', 'RESOURCE_OK', 'RESOURCE_NOT_ENOUGH'], dtype=object), size=num_tasks),
+        'scheduler_msg': '',
+        'created_seconds': rng.random(num_tasks) * 86400 * 7,
+        'custom_rank': rng.integers(0, 100, size=num_tasks),
+        'worker_status': rng.choice(np.array(['queued', 'running', 'succeeded'], dtype=object), size=num_tasks),
+        'memory': rng.integers(0, 1 << 40, size=num_tasks),
+        'cpu': rng.integers(0, 128, size=num_tasks),
+        'assigned_gpus': [list(range(8)) for _ in range(num_tasks)],
+        'schedule_zone': rng.choice(np.array(['zone_a', 'zone_b'], dtype=object), size=num_tasks),
+        'client_group': task_groups,
+        'current_schedule_zone': rng.choice(np.array(['zone_a', 'zone_b'], dtype=object), size=num_tasks),
+        'is_spot_jupyter': rng.random(num_tasks) < 0.05,
+        'match_rank': rng.integers(0, num_tasks, size=num_tasks),
+        'runtime_config_json': [{} if i % 3 else {'runtime_priority': {'custom_rank': int(i % 100)}} for i in ids],
+    }, index=ids)
+    resource_df = pd.DataFrame({
+        'cpu': 128, 'nodes': 1, 'name': node_names, 'gpu_num': 8,
+        'status': rng.choice(np.array(['Ready', 'Ready', 'Ready', 'NotReady'], dtype=object), size=num_nodes),
+        'mars_group': groups[np.arange(num_nodes) % len(groups)], 'memory': 1 << 40,
+        'group': groups[np.arange(num_nodes) % len(groups)], 'working': rng.choice(np.array(['training', None], dtype=object), size=num_nodes),
+        'leaf': [f'leaf_{i // 40}' for i in range(num_nodes)], 'spine': [f'spine_{i // 800}' for i in range(num_nodes)],
+        'active': True, 'schedule_zone': rng.choice(np.array(['zone_a', 'zone_b'], dtype=object), size=num_nodes),
+        'working_user_role': rng.choice(np.array(['internal', 'external', None], dtype=object), size=num_nodes),
+        'origin_group': groups[np.arange(num_nodes) % len(groups)], 'allocated': rng.random(num_nodes) < 0.7,
+        'flag': rng.integers(0, 4, size=num_nodes),
+    })
+    user_df = pd.DataFrame([
+        {'user_name': u, 'resource': 'node', 'group': g, 'quota': int(rng.integers(0, 512)), 'role': 'internal',
+         'priority': p, 'active': True}
+        for u in users for g in groups[:4] for p in [20, 30]
+    ])
+    return TickData(seq=1, valid=True, resource_df=resource_df, user_df=user_df, task_df=task_df,
+                    extra_data={'perf': {}}, metrics={'tasks': num_tasks})
+
+
+def check_same(origin: TickData, decoded: TickData):
+    for name in ['resource_df', 'user_df', 'task_df']:
+        pd.testing.assert_frame_equal(getattr(origin, name), getattr(decoded, name))
+    assert (origin.seq, origin.valid, origin.extra_data, origin.metrics) == \
+        (decoded.seq, decoded.valid, decoded.extra_data, decoded.metrics)
+
+
+def best_ms(func, rounds):
+    """
+    和 timeit 一样计时的时候关掉 gc，不然解出来的 dict / list 越积越多，后面测的那个会被 gc 拖慢
+    """
+    costs = []
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            result = func()
+            costs.append(time.perf_counter() - started_at)
+        finally:
+            gc.enable()
+    return min(costs) * 1000, result
+
+
+def columnar_loads(data) -> TickData:
+    tick_data = TickData.__new__(TickData)
+    tick_data.__dict__.update(loads_state(data))
+    return tick_data
+
+
+CODECS = {
+    'pickle': (TickData.dumps, TickData.loads),
+    'columnar': (lambda tick_data: dumps_state(tick_data.__dict__), columnar_loads),
+}
+
+
+def run(num_tasks, rounds):
+    tick_data = make_tick_data(num_tasks)
+    results = {}
+    for codec, (dumps, loads) in CODECS.items():
+        dumps_ms, data = best_ms(lambda: dumps(tick_data), rounds)
+        loads_ms, decoded = best_ms(lambda: loads(data), rounds)
+        check_same(tick_data, decoded)
+        shm_name = f'tick_data_benchmark_{os.getpid()}_{codec}'
+        conn = ProcessConnection(shm_name, rotate_num=2, init_obj=TickData(), dumps=dumps, loads=loads)
+        try:
+            tick_ms, _ = best_ms(lambda: (conn.put(tick_data, seq=1), conn.get())[1], rounds)
+        finally:
+            conn.close(unlink=True)
+        results[codec] = (len(data), dumps_ms, loads_ms, tick_ms)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TickData 编码 benchmark')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1000, 10000, 50000], help='task_df 的行数')
+    parser.add_argument('--rounds', type=int, default=5, help='每项测几次取最快的')
+    args = parser.parse_args()
+
+    for num_tasks in args.tasks:
+        results = run(num_tasks, args.rounds)
+        print(f'{num_tasks} 个任务:')
+        for codec, (size, dumps_ms, loads_ms, tick_ms) in results.items():
+            print(f'  {codec:>8}: {size / 1024 / 1024:.1f}MB, dumps {dumps_ms:.1f}ms, loads {loads_ms:.1f}ms, '
+                  f'put + get {tick_ms:.1f}ms')
+        speedup = results['pickle'][3] / results['columnar'][3]
+        print(f'  tick 延迟 columnar / pickle: {1 / speedup:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 # 萤火2号 api
+import json
 import os
 from abc import ABC
 from io import StringIO
 from typing import Tuple, List, Union
 import datetime
 
+import aiohttp
 import munch
 from hfai.base_model.base_task import BasePod
 from hfai.base_model.training_task import TrainingTask, ITrainingTaskImpl
@@ -179,6 +181,34 @@ class ExperimentImpl(ITrainingTaskImpl, ABC):
         self.task.last_seen = res['last_seen']
         return res
 
+    async def log_stream(self, rank: int = 0, last_seen: str = 'null', *args, **kwargs):
+        """
+        追加查看日志, 由 server 推送新日志 (server-sent events), 每次返回的内容和 log_ng 一样;
+        log_ng 返回 log_stream 为 True 时才能用, 任务结束后迭代结束
+        @param rank:
+        @param last_seen:
+        @return:
+        """
+        task = self.task
+        token = kwargs.get('token', mars_token())
+        url = f'{mars_url()}/query/task/log/stream?token={token}&chain_id={task.chain_id}&rank={rank}&last_seen={last_seen}'
+        # server 没有新日志的时候会定期发心跳, 只限制两次读之间的间隔
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=kwargs.get('timeout', 60))
+        async with aiohttp.ClientSession(trust_env=True) as session:
+            async with session.get(url=url, timeout=timeout) as response:
+                assert response.status == 200, await response.text()
+                buffer = b''
+                # 一条日志可能很大, 不能用 readline (有长度限制)
+                async for chunk in response.content.iter_any():
+                    buffer += chunk
+                    *events, buffer = buffer.split(b'\n\n')
+                    for event in events:
+                        for line in event.decode().split('\n'):
+                            if line.startswith('data: '):
+                                res = json.loads(line[len('data: '):])
+                                self.task.last_seen = res['last_seen']
+                                yield res
+
     async def sys_log(self, *args, **kwargs):
         """
         查看系统错误日志
@@ -5,9 +5,9 @@ from typing import Optional
 import sysv_ipc
 import itertools
 import pickle
-import socket
 from hfai.base_model.base_task import BaseTask
 from hfai.conf.flags import EXP_PRIORITY, WARN_TYPE
+from hfai.conf.runtime_channel import RUNTIME_PORT, get_runtime_channel
 
 
 WATCHDOG_TIME_SHM_ID = 237965198
@@ -59,7 +59,7 @@ def current_selector_task() -> BaseTask:
 def send_data(data, timeout: int = 500, raise_exception: bool = True):
     """
     把 data 发送给 manager
-    socket的 backlog 为1024，超过1024的并发请求可能会变得很慢，请注意
+    同一个进程里的调用共用一个和 manager 的长连接，manager 会把所有 rank 相同的调用合并成一次处理
 
     Args:
          data (dict):
@@ -70,9 +70,8 @@ def send_data(data, timeout: int = 500, raise_exception: bool = True):
          bool: 表示是否通信成功
     """
     b_data = pickle.dumps(data)
-    header = str(len(b_data) + 8).rjust(8).encode()
+    channel = get_runtime_channel((f'{user_name()}-{task_id()}-manager-0', RUNTIME_PORT))
     start_time = time.time()
-    result = None
     while True:
         if time.time() - start_time > timeout:
             if raise_exception:
@@ -82,31 +81,27 @@ def send_data(data, timeout: int = 500, raise_exception: bool = True):
             return False
         try:
             waiting_time = max(1, timeout - int(time.time() - start_time))
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((f'{user_name()}-{task_id()}-manager-0', 7000))
-            s.settimeout(waiting_time)
-            s.send(header + b_data)
-            result = s.recv(1024)
-        except:
+            result = channel.request(b_data, waiting_time)
+        except Exception:
             time.sleep(1)
-        if result is not None:
-            try:
-                result = pickle.loads(result)
-                success = result['success']
-                msg = result['msg']
-            except Exception as e:
-                if raise_exception:
-                    raise Exception(f'解析返回值失败: {e}，请联系管理员')
-                else:
-                    print(f'解析返回值失败: {e}，请联系管理员')
-                    return False
-            if success == 0:
-                if raise_exception:
-                    raise Exception(msg)
-                else:
-                    print(msg)
+            continue
+        try:
+            result = pickle.loads(result)
+            success = result['success']
+            msg = result['msg']
+        except Exception as e:
+            if raise_exception:
+                raise Exception(f'解析返回值失败: {e}，请联系管理员')
+            else:
+                print(f'解析返回值失败: {e}，请联系管理员')
                 return False
-            return True
+        if success == 0:
+            if raise_exception:
+                raise Exception(msg)
+            else:
+                print(msg)
+            return False
+        return True
 
 
 def set_watchdog_time(seconds: int):
@@ -5,6 +5,7 @@ import getpass
 import json
 import math
 import os
+import aiohttp
 import munch
 import yaml
 
@@ -105,9 +106,10 @@ async def logs(experiment, follow, rank, exp_type, container=False):
     else:
         console.print('=' * 20 + f' [blue] fetching [/blue] log on rank {rank}... ' + '=' * 20)
         hf_tqdm = False
-        while True:
-            log, exit_code, stop_code = await experiment.log(rank=rank, last_seen=json.dumps(experiment.last_seen), with_code=True)
-            log = '' if log == '还没产生日志' else log
+
+        def show_log(res):
+            nonlocal hf_tqdm
+            log = '' if res['data'] == '还没产生日志' else res['data']
             # console.out(log, end='')
             log_lines = log.split('\n')
             if log_lines[-1] == '':
@@ -128,7 +130,11 @@ async def logs(experiment, follow, rank, exp_type, container=False):
                 segments = log_line.split('\r')
                 for idx, seg in enumerate(segments):
                     console.out(seg, end='\r' if idx + 1 < len(segments) else '\n')
+            # 一次返回的日志有上限，没读完 (truncated) 的话先接着读完，不能 exit
+            if res.get('truncated'):
+                return
             # 如果 stop_code 不是被打断的，那么 exit
+            stop_code, exit_code = res['stop_code'], res['exit_code']
             if stop_code < STOP_CODE.HOOK_RESTART:
                 if stop_code == STOP_CODE.STOP:
                     sys.exit(0)
@@ -136,10 +142,27 @@ async def logs(experiment, follow, rank, exp_type, container=False):
                     sys.exit(exit_code or 1)
             # 其他的任务就算 stop 了，也没跑完，等着调度
 
-            if follow:
-                await asyncio.sleep(11)
-            else:
+        use_log_stream = True
+        while True:
+            last_seen = experiment.last_seen
+            res = await experiment.log_ng(rank=rank, last_seen=json.dumps(last_seen))
+            show_log(res)
+            if res.get('truncated') and res['last_seen'] != last_seen:
+                continue    # 还有没读完的日志，不用等直接接着读
+            if not follow:
                 break
+            # server 支持推送日志的话改成订阅, 连接断了再退回轮询; 外部用户走 bff 转发, 没法推送
+            if use_log_stream and res.get('log_stream') and os.environ.get('external') != 'true':
+                try:
+                    async for res in experiment.log_stream(rank=rank, last_seen=json.dumps(experiment.last_seen)):
+                        show_log(res)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                    console.print(f'日志推送连接断开 ({type(e).__name__}: {e})，先轮询，稍后重连')
+                except Exception as e:
+                    # 不是连接的问题 (server 报错 / 返回的数据不对)，重连也没用，之后一直轮询
+                    use_log_stream = False
+                    console.print(f'日志推送出错 ({type(e).__name__}: {e})，改为轮询查看日志')
+            await asyncio.sleep(11)
 
 
 @click.command(cls=HandleHfaiCommandArgsWithExpArg)
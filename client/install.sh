@@ -29,6 +29,8 @@ rm ${HFAI_PATH}/client/create_develop_env.sh
 rm -rf ${HFAI_PATH}/client/README.md
 
 cp conf/utils.py ${HFAI_PATH}/conf
+cp conf/packed_dataset.py ${HFAI_PATH}/conf
+cp conf/runtime_channel.py ${HFAI_PATH}/conf
 
 if [[ ! -f ${BIN_PATH} ]]; then
   cp client/hfai ${BIN_PATH}
@@ -8,6 +8,7 @@ from concurrent.futures import wait
 from datetime import datetime, timedelta, timezone
 from typing import List
 from functools import partial
+from urllib.parse import parse_qsl
 
 from fastapi import Depends, HTTPException, Body
 from fastapi_pagination import add_pagination, Page, Params
@@ -16,6 +17,7 @@ from .auth import *
 from .audit import run_audit
 from .utils import *
 from .metrics import *
+from .scheduler import TransferScheduler
 from api.app import app
 from api.depends import get_api_user_with_name
 from conf.utils import FileInfo, FileList, FileInfoList, FilePrivacy, DatasetType, \
@@ -24,7 +26,16 @@ from server_model.user import User
 
 
 pod_id = os.environ.get('POD_NAME', 'POD_NAME-0').split('-')[-1]
-worker_pools = WorkerPools()
+# 所有同步请求共用一个传输调度
+transfer_scheduler = TransferScheduler(
+    max_workers=CONF.try_get('cloud.storage.service.transfer.max_workers', default=int(os.environ.get('WORKERS', 4)) * 4),
+    user_concurrency=CONF.try_get('cloud.storage.service.transfer.user_concurrency', default=8),
+    bandwidth=CONF.try_get('cloud.storage.service.transfer.bandwidth', default=0),
+    user_bandwidth=CONF.try_get('cloud.storage.service.transfer.user_bandwidth', default=0),
+    small_file_bytes=CONF.try_get('cloud.storage.service.transfer.small_file_bytes', default=4 << 20),
+    batch_files=CONF.try_get('cloud.storage.service.transfer.batch_files', default=64),
+    batch_bytes=CONF.try_get('cloud.storage.service.transfer.batch_bytes', default=64 << 20))
+transfer_threads = CONF.try_get('cloud.storage.service.transfer.threads_per_file', default=4)
 
 
 # 启动时捞出running的任务，重新上传
@@ -164,6 +175,7 @@ async def sync_to_cluster(token: str,
                           file_privacy: Optional[FilePrivacy] = FilePrivacy.GROUP_SHARED,
                           dataset_type: Optional[DatasetType] = DatasetType.MINI,
                           no_zip: Optional[bool] = True,
+                          delta: Optional[bool] = False,
                           file_list: FileList = Body(default=None)):
     """
     下载外部文件到集群内，目前不支持下载目录
@@ -174,9 +186,11 @@ async def sync_to_cluster(token: str,
     @param name:      工作区/env 名字
     @param file_type: 文件类型
     @param no_zip:    是否禁用文件压缩
+    @param delta:     文件是按内容分块增量上传的, 根据 manifest 拼出文件
     @param file_list: body, 用户工作区下文件列表
     """
-    return await _sync_to_cluster_impl(token, username, userid, group, name, file_type, file_privacy, dataset_type, no_zip, file_list)
+    return await _sync_to_cluster_impl(token, username, userid, group, name, file_type, file_privacy, dataset_type, no_zip, file_list,
+                                       delta=delta)
 
 
 async def _sync_to_cluster_impl(token: str,
@@ -190,7 +204,8 @@ async def _sync_to_cluster_impl(token: str,
                                 no_zip: bool,
                                 file_list: FileList,
                                 index: str = None,
-                                force: bool = False):
+                                force: bool = False,
+                                delta: bool = False):
     """
     注: 对dataset下载做了特判:
         - 校验时间戳以避免重复下载
@@ -214,18 +229,35 @@ async def _sync_to_cluster_impl(token: str,
     is_dataset = file_type == FileType.DATASET
     total_size = 0
     files = list()
+    # 文件大小, 用于调度时小文件打包和带宽限制
+    file_sizes = dict()
+    packed = None
     if file_list:
         files = file_list.files
+        if len(files) > 1 and not delta:
+            try:
+                file_infos, _ = await async_list_bucket_files_inner(cloud_base_path, bucket_name, recursive=True)
+                file_sizes = {fi.path: fi.size for fi in file_infos}
+            except Exception as e:
+                logger.warning(f'list bucket 获取文件大小失败, 不打包小文件: {str(e)}')
     elif is_dataset:
         try:
-            file_infos, downloaded_file_infos = await async_list_bucket_files_inner(cloud_base_path, bucket_name, recursive=True, diff=True, cluster_base_path=cluster_base_path)
+            # 打包格式的数据集只同步 shard 和索引
+            packed = await async_list_packed_dataset_files(cloud_base_path, bucket_name, cluster_base_path)
+            if packed is not None:
+                file_infos, downloaded_file_infos = packed
+            else:
+                file_infos, downloaded_file_infos = await async_list_bucket_files_inner(cloud_base_path, bucket_name, recursive=True, diff=True, cluster_base_path=cluster_base_path)
             for fi in file_infos:
                 total_size += fi.size
                 files.append(fi.path)
+                file_sizes[fi.path] = fi.size
+            downloaded_progress = dict()
             for downloaded_file_info in downloaded_file_infos:
                 total_size += downloaded_file_info.size
                 key = os.path.join(cloud_base_path, downloaded_file_info.path)
-                await status_recorder.a_hset(status_key(index, 'progress', False), key, downloaded_file_info.size)
+                downloaded_progress[key] = downloaded_file_info.size
+            await status_recorder.a_hset_mapping(status_key(index, 'progress', False), downloaded_progress)
         except Exception as e:
             logger.error(f'list bucket error {str(e)}')
             return {'success': 0, 'msg': str(e)}
@@ -234,6 +266,8 @@ async def _sync_to_cluster_impl(token: str,
         index = hashkey(token, name, file_type, *files)
     logger.debug(f'hashkey for {name}, {file_type}, {files}: {index}')
     if len(files) == 0:
+        if packed is not None:
+            commit_packed_dataset(cluster_base_path)
         await status_recorder.a_set(status_key(index, 'status', False), SyncPhase.FINISHED)
         return {'success': 1, 'msg': 'files already synced', 'index': index, 'dst_path': cluster_base_path}
 
@@ -256,7 +290,8 @@ async def _sync_to_cluster_impl(token: str,
         'dataset_type': dataset_type,
         'no_zip': no_zip,
         'file_list': file_list.dict() if file_list else None,
-        'index': index
+        'index': index,
+        'delta': delta
     }
     await status_recorder.a_set(status_key(index, f'param:{pod_id}', False), ujson.dumps(index_info))
 
@@ -273,8 +308,9 @@ async def _sync_to_cluster_impl(token: str,
         # TODO: trim dataset on nfs
 
     subpath_set = set()
-    futures = list()
+    items = list()
     msg = ''
+    queued_keys = set() if force else set(await status_recorder.a_get_hkeys(status_key(index, 'progress', False)))
     for fname in files:
         key = os.path.join(cloud_base_path, fname)
         # 如为打包上传，临时放到工作区.hfai目录下，避免文件名冲突
@@ -295,43 +331,43 @@ async def _sync_to_cluster_impl(token: str,
                 if subpath not in subpath_set and not is_dataset:
                     os.chown(subpath, int(userid), int(userid))
                     subpath_set.add(subpath)
-        if not force and key in await status_recorder.a_get_hkeys(status_key(index, 'progress', False)):
+        if key in queued_keys:
             warn_msg = f'{key} 正在下载队列中, 忽略本次请求;'
             logger.warning(warn_msg)
             msg += warn_msg
             continue
         logger.debug(f'提交下载文件 {key}')
-        loop = asyncio.get_running_loop()
-        pool = worker_pools.get(index)
-        func_call = partial(pool.submit,
-                            resumable_download_with_retry,
-                            bucket_name=bucket_name,
-                            key=key,
-                            filename=local_path,
-                            file_type=file_type,
-                            multiget_threshold=slice_bytes,
-                            part_size=slice_bytes,
-                            num_threads=4,
-                            index=index,
-                            username=username,
-                            userid=userid,
-                            use_zip=use_zip,
-                            retries=10)
-        future = await loop.run_in_executor(None, func_call)
+        items.append((dict(bucket_name=bucket_name,
+                           key=key,
+                           filename=local_path,
+                           file_type=file_type,
+                           multiget_threshold=slice_bytes,
+                           part_size=slice_bytes,
+                           num_threads=transfer_threads,
+                           index=index,
+                           username=username,
+                           userid=userid,
+                           use_zip=use_zip,
+                           cloud_base_path=cloud_base_path,
+                           delta=delta and not is_dataset,
+                           retries=10), file_sizes.get(fname)))
+
+    futures = transfer_scheduler.submit(index, username, resumable_download_with_retry, items)
+    for future in futures:
         future.add_done_callback(download_callback)
-        futures.append(future)
-        RUNNING_TASKS_GAUGE.labels('push', username, file_type).inc()
+    RUNNING_TASKS_GAUGE.labels('push', username, file_type).inc(len(futures))
 
+    finalize = partial(commit_packed_dataset, cluster_base_path) if packed is not None else None
     threading.Thread(target=wait_sync_to_cluster,
                      name=f'download-{index}',
-                     args=(futures, index, user, file_type, name),
+                     args=(futures, index, user, file_type, name, finalize),
                      daemon=True).start()
 
     logger.info(f'提交同步任务成功, 文件列表: {files}')
     return {'success': 1, 'msg': '提交同步任务成功', 'index': index, 'dst_path': cluster_base_path}
 
 
-def wait_sync_to_cluster(futures, index, user, file_type, name):
+def wait_sync_to_cluster(futures, index, user, file_type, name, finalize=None):
     # wait for complete
     logger.info(f'开始等待下载任务 {index}..')
     wait(futures)
@@ -340,10 +376,15 @@ def wait_sync_to_cluster(futures, index, user, file_type, name):
         e = future.exception()
         if e:
             msg += f'{str(e)};'
+    # 全部下载成功后的收尾, 如换上打包数据集的新索引
+    if not msg and finalize is not None:
+        try:
+            finalize()
+        except Exception as e:
+            msg += f'{str(e)};'
     if not msg:
         msg = SyncPhase.FINISHED
     logger.info(f'下载任务 {index} 完成: {msg}')
-    worker_pools.finish(index)
     status_recorder.delete(status_key(index, f'param:{pod_id}', False))
     # 对于已结束任务，延期删除相应status key
     status_recorder.set(status_key(index, 'status', False), msg, expires=None if file_type == FileType.DATASET else 300)
@@ -486,18 +527,19 @@ async def _sync_from_cluster_impl(token: str,
                                 'msg': str(e)
                             })
 
-    futures = list()
+    items = list()
     msg = ''
     src_files = [os.path.join(cluster_base_path, f.path) for f in upload_file_infos]
     dst_files = [os.path.join(cloud_base_path, f.path) for f in upload_file_infos]
 
     logger.info(f'开始上传本地目录 {src_files} 到远端，总共{upload_mb}MB...')
     await status_recorder.a_set(redis_status_key, SyncPhase.RUNNING)
+    queued_keys = set() if force else set(await status_recorder.a_get_hkeys(status_key(index, 'progress', True)))
     for i in range(len(src_files)):
         # 校验是否有非法路径
         check_is_subpath(cluster_base_path, src_files[i])
         # 校验是否已在上传队列
-        if not force and dst_files[i] in await status_recorder.a_get_hkeys(status_key(index, 'progress', True)):
+        if dst_files[i] in queued_keys:
             warn_msg = f'{dst_files[i]} 正在上传队列中, 忽略本次请求;'
             logger.warning(warn_msg)
             msg += warn_msg
@@ -506,27 +548,24 @@ async def _sync_from_cluster_impl(token: str,
         logger.debug(f'提交上传文件 {src_files[i]}')
 
         # 小文件直接上传，大文件分片上传，阈值100MB
-        loop = asyncio.get_running_loop()
-        pool = worker_pools.get(index)
-        func_call = partial(pool.submit,
-                            resumable_upload_with_retry,
-                            bucket_name=bucket_name,
-                            key=dst_files[i],
-                            filename=src_files[i],
-                            multipart_threshold=slice_bytes,
-                            part_size=slice_bytes,
-                            num_threads=4,
-                            index=index,
-                            user=user,
-                            file_type=file_type,
-                            file_info=upload_file_infos[i],
-                            filtered=filtered,
-                            retries=10)
-        future = await loop.run_in_executor(None, func_call)
-        future.add_done_callback(upload_callback)
-        futures.append(future)
-        RUNNING_TASKS_GAUGE.labels('pull', username, file_type).inc()
+        items.append((dict(bucket_name=bucket_name,
+                           key=dst_files[i],
+                           filename=src_files[i],
+                           multipart_threshold=slice_bytes,
+                           part_size=slice_bytes,
+                           num_threads=transfer_threads,
+                           index=index,
+                           user=user,
+                           file_type=file_type,
+                           file_info=upload_file_infos[i],
+                           filtered=filtered,
+                           retries=10), upload_file_infos[i].size))
         SYNCING_FILESIZE_GAUGE.labels('pull', username, file_type).inc(upload_file_infos[i].size)
+
+    futures = transfer_scheduler.submit(index, username, resumable_upload_with_retry, items)
+    for future in futures:
+        future.add_done_callback(upload_callback)
+    RUNNING_TASKS_GAUGE.labels('pull', username, file_type).inc(len(futures))
     args = (futures, index, user, file_type, name, bucket_name, [f.path for f in original_upload_file_infos], cloud_base_path) if file_type in [FileType.DOC, FileType.PYPI] else (futures, index, user, file_type, name)
     threading.Thread(target=wait_sync_from_cluster,
                      name=f'upload-{index}',
@@ -567,7 +606,6 @@ def wait_sync_from_cluster(futures, index, user, file_type, name, bucket_name=No
         msg = SyncPhase.FINISHED
 
     logger.info(f'上传任务 {index} 完成: {msg}')
-    worker_pools.finish(index)
     status_recorder.delete(status_key(index, f'param:{pod_id}', True))
     # 对于已结束任务，延期删除相应status key
     status_recorder.set(status_key(index, 'status', True), msg, expires=300)
@@ -627,11 +665,13 @@ def resumable_download_with_retry(bucket_name,
                                   username=None,
                                   userid=None,
                                   use_zip=None,
+                                  cloud_base_path=None,
+                                  delta=False,
                                   retries=3):
 
     def percentage(consumed_bytes, total_bytes):
         if total_bytes:
-            status_recorder.hset(status_key(index, 'progress', False), key, consumed_bytes)
+            progress_buffer.hset(status_key(index, 'progress', False), key, consumed_bytes)
 
     download_succeed = False
     is_dataset = file_type == FileType.DATASET
@@ -639,16 +679,24 @@ def resumable_download_with_retry(bucket_name,
         try:
             filemode = None
             tagging = dict()
-            try:
-                tagging = cloud_api.get_object_tagging(bucket_name, key)
-                filemode = tagging.get('filemode', None)
-            except Exception as e:
-                logger.info(f'获取文件tagging {key}失败, 忽略: {str(e)}')
+            if delta:
+                # 增量上传的文件没有完整的对象, 按 manifest 拼出来, filemode 记在 manifest 里
+                if not download_succeed:
+                    logger.info(f'开始按 manifest 拼接 {key}')
+                    manifest = assemble_from_delta(cloud_api, bucket_name, cloud_base_path, os.path.relpath(key, cloud_base_path),
+                                                   filename, percentage, num_threads)
+                    filemode = dict(parse_qsl(manifest.get('tagging', ''))).get('filemode', None)
+            else:
+                try:
+                    tagging = cloud_api.get_object_tagging(bucket_name, key)
+                    filemode = tagging.get('filemode', None)
+                except Exception as e:
+                    logger.info(f'获取文件tagging {key}失败, 忽略: {str(e)}')
 
-            logger.info(f'开始下载 {key}')
-            if not download_succeed:
-                cloud_api.resumable_download(bucket_name, key, filename, multiget_threshold,
-                                             part_size, percentage, num_threads)
+                logger.info(f'开始下载 {key}')
+                if not download_succeed:
+                    cloud_api.resumable_download(bucket_name, key, filename, multiget_threshold,
+                                                 part_size, percentage, num_threads)
             download_succeed = True
             logger.info(f'下载 {key} 完成')
             if not is_dataset:
@@ -717,7 +765,7 @@ def resumable_upload_with_retry(bucket_name,
 
     def percentage(consumed_bytes, total_bytes):
         if total_bytes:
-            status_recorder.hset(status_key(index, 'progress', True), key, consumed_bytes)
+            progress_buffer.hset(status_key(index, 'progress', True), key, consumed_bytes)
 
     upload_succeed = False
     for i in range(1, retries + 1):
@@ -729,7 +777,7 @@ def resumable_upload_with_retry(bucket_name,
                     md5 = tagging.get('md5', None)
                     if md5 == file_info.md5:
                         logger.info(f'  {filename} 之前已上传, md5: {md5}, 跳过')
-                        status_recorder.hset(status_key(index, 'progress', True), key, file_info.size)
+                        progress_buffer.hset(status_key(index, 'progress', True), key, file_info.size)
                         return {'key': key, 'size': file_info.size, 'username': user.user_name, 'file_type': file_type}
                 except Exception as e:
                     pass
@@ -881,15 +929,7 @@ async def dump():
     """
     debug用
     """
-    msg = ''
-    for name, pool in worker_pools.pools.items():
-        msg += f'Name: {name},\n\tProcesses: {pool._processes}\n\tTotal tasks: {pool._queue_count}\n'
-        if len(pool._pending_work_items) > 0:
-            msg += f'\tPending tasks:\n'
-        for k, v in pool._pending_work_items.items():
-            msg += f'\t\ttask_id: {k}, is_running: {v.future.running()}, func_name: {v.fn.__name__}, args: {v.args}, kwargs: {v.kwargs}'.replace('\n', ', ') + '\n'
-
-    return msg
+    return transfer_scheduler.dump()
 
 
 @app.on_event("shutdown")
@@ -0,0 +1,234 @@
+"""
+按内容分块 (content-defined chunking) 的增量同步:
+  - 文件按内容切成变长的 chunk, 文件中间插入 / 修改一段内容只会影响附近的几个 chunk
+  - chunk 按 sha256 存在 {base}/.hfai/chunks/{sha256}, 文件由哪些 chunk 组成记录在 manifest {base}/.hfai/manifests/{path}.json
+  - 上传时只上传云端还没有的 chunk; 集群侧拼文件的时候, 集群上旧文件里已有的 chunk 直接复用, 其余的从云端下载
+"""
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import ujson
+
+from .interface import CloudApiException, CloudObjectStorageInterface
+
+
+MANIFEST_VERSION = 1
+CHUNK_MIN_SIZE = 1 << 20        # 1MiB
+CHUNK_AVG_BITS = 22             # 切点概率 1 / 4MiB
+CHUNK_MAX_SIZE = 16 << 20       # 16MiB
+WINDOW_SIZE = 64                # 滚动 hash 的窗口
+READ_SIZE = 64 << 20
+HASH_BLOCK_SIZE = 1 << 20       # 分块算滚动 hash, 中间数组能放进 cache
+# 滚动 hash 的随机表, 客户端和集群必须完全一致, 不依赖 numpy 的随机数实现
+GEAR = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)], dtype=np.uint32)
+CUT_THRESHOLD = np.uint32(1 << (32 - CHUNK_AVG_BITS))
+
+
+def chunk_key(base: str, digest: str) -> str:
+    return f'{base}/.hfai/chunks/{digest}'
+
+
+def manifest_key(base: str, path: str) -> str:
+    return f'{base}/.hfai/manifests/{path}.json'
+
+
+def _cut_candidates(buf: bytes, offset: int) -> List[int]:
+    """
+    窗口内字节的随机值之和 (mod 2^32) 作为滚动 hash, 用 cumsum 向量化计算, 小于阈值的位置可以切;
+    返回可以切的位置 (chunk 的结束位置, 绝对偏移). buf 的前 WINDOW_SIZE 字节是上一段的末尾, 只用来算 hash
+    """
+    candidates = []
+    for begin in range(0, len(buf) - WINDOW_SIZE, HASH_BLOCK_SIZE):
+        block = np.frombuffer(buf, dtype=np.uint8, offset=begin,
+                              count=min(HASH_BLOCK_SIZE, len(buf) - WINDOW_SIZE - begin) + WINDOW_SIZE)
+        sums = np.cumsum(GEAR[block], dtype=np.uint32)
+        window = sums[WINDOW_SIZE:] - sums[:-WINDOW_SIZE]
+        candidates.extend((np.flatnonzero(window < CUT_THRESHOLD) + (offset + begin + WINDOW_SIZE + 1)).tolist())
+    return candidates
+
+
+def iter_chunks(fobj) -> Iterator[Tuple[int, bytes]]:
+    """
+    按内容切分文件, 依次返回 (offset, data)
+    """
+    pending = b''               # 上一个切点之后还没切出去的数据 (从 pending[consumed:] 开始)
+    consumed = 0
+    start = 0                   # 下一个 chunk 的起始偏移
+    end = 0                     # 已经读到的位置
+    context = b''
+    candidates = deque()
+    eof = False
+    while not eof:
+        block = fobj.read(READ_SIZE)
+        eof = not block
+        if block:
+            candidates.extend(_cut_candidates(context + block, end - len(context)))
+            context = block[-WINDOW_SIZE:] if len(block) >= WINDOW_SIZE else (context + block)[-WINDOW_SIZE:]
+            pending, consumed = pending[consumed:] + block, 0
+            end += len(block)
+        while end > start:
+            while candidates and candidates[0] < start + CHUNK_MIN_SIZE:
+                candidates.popleft()
+            limit = start + CHUNK_MAX_SIZE
+            if candidates and candidates[0] <= min(limit, end):
+                cut = candidates.popleft()
+            elif end >= limit:
+                cut = limit
+            elif eof:
+                cut = end
+            else:
+                break   # 数据不够, 后面可能还有切点
+            yield start, pending[consumed:consumed + cut - start]
+            consumed += cut - start
+            start = cut
+
+
+def build_manifest(filename: str) -> Dict:
+    """
+    计算文件的 manifest: chunks 为 [[sha256, size], ...], 同时算出整个文件的 md5 用于集群侧校验
+    """
+    md5 = hashlib.md5()
+    chunks = []
+    with open(filename, 'rb') as f:
+        for _, data in iter_chunks(f):
+            md5.update(data)
+            chunks.append([hashlib.sha256(data).hexdigest(), len(data)])
+    return {
+        'version': MANIFEST_VERSION,
+        'size': sum(size for _, size in chunks),
+        'md5': md5.hexdigest(),
+        'chunks': chunks,
+    }
+
+
+def load_manifest(cloud_api: CloudObjectStorageInterface, bucket_name: str, base: str, path: str) -> Optional[Dict]:
+    raw = cloud_api.get_object(bucket_name, manifest_key(base, path))
+    if raw is None:
+        return None
+    manifest = ujson.loads(raw)
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def _ordered_map(func, items, num_threads):
+    """ 和 pool.map 一样按顺序返回, 但最多同时在跑 2 * num_threads 个, 避免 chunk 全读进内存 """
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = deque()
+        for item in items:
+            futures.append(pool.submit(func, item))
+            if len(futures) >= 2 * num_threads:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def upload_delta(cloud_api: CloudObjectStorageInterface, bucket_name: str, base: str, path: str, filename: str,
+                 expire_at: str, tagging: str = '', uploaded_chunks: Set[str] = None,
+                 percentage: Callable = None, num_threads: int = 4) -> int:
+    """
+    增量上传文件: 上传 manifest 以及云端没有的 chunk
+    @param expire_at: chunk 和 manifest 的过期时间, 格式 %Y-%m-%d %H:%M:%S
+    @param tagging: 额外的对象标签 (filemode 等), 会写进 manifest
+    @param uploaded_chunks: 本次推送已经上传过的 chunk, 多个文件之间共享
+    @return: 实际上传的字节数
+    """
+    uploaded_chunks = set() if uploaded_chunks is None else uploaded_chunks
+    manifest = build_manifest(filename)
+    manifest['tagging'] = tagging
+    manifest['expire_at'] = expire_at
+    old = load_manifest(cloud_api, bucket_name, base, path)
+    known = set(uploaded_chunks)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if old is not None and old.get('expire_at', '') > now:
+        # 复用的 chunk 可能比新上传的先过期, manifest 按最早的算
+        known |= {digest for digest, _ in old['chunks']}
+        manifest['expire_at'] = min(expire_at, old['expire_at'])
+        if old['md5'] == manifest['md5'] and old.get('tagging') == tagging:
+            if percentage is not None:
+                percentage(manifest['size'], manifest['size'])
+            return 0
+
+    todo, offset = [], 0
+    for digest, size in manifest['chunks']:
+        if digest not in known:
+            todo.append((digest, offset, size))
+            known.add(digest)
+        offset += size
+    chunk_tagging = f'source=client&expire_at={expire_at}'
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        def _upload(item):
+            digest, offset, size = item
+            data = os.pread(fd, size, offset)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise CloudApiException(f'{filename} 上传过程中被修改')
+            cloud_api.put_object(bucket_name, chunk_key(base, digest), data, tagging=chunk_tagging)
+            return size
+
+        uploaded = 0
+        for size in _ordered_map(_upload, todo, num_threads):
+            uploaded += size
+            if percentage is not None:
+                percentage(uploaded, manifest['size'])
+    finally:
+        os.close(fd)
+    uploaded_chunks.update(digest for digest, _, _ in todo)
+    cloud_api.put_object(bucket_name, manifest_key(base, path), ujson.dumps(manifest).encode(),
+                         tagging=f'source=client&expire_at={expire_at}')
+    if percentage is not None:
+        percentage(manifest['size'], manifest['size'])
+    return uploaded
+
+
+def assemble_from_delta(cloud_api: CloudObjectStorageInterface, bucket_name: str, base: str, path: str, filename: str,
+                        percentage: Callable = None, num_threads: int = 4) -> Dict:
+    """
+    根据 manifest 在集群上拼出文件, filename 已存在的话复用里面相同的 chunk, 拼好并校验 md5 后替换 filename
+    @return: manifest
+    """
+    manifest = load_manifest(cloud_api, bucket_name, base, path)
+    if manifest is None:
+        raise CloudApiException(f'{path} 的 manifest 不存在')
+    local_chunks = {}
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            for offset, data in iter_chunks(f):
+                local_chunks[hashlib.sha256(data).hexdigest()] = offset
+
+    tmp_filename = f'{filename}.hfai_delta'
+    old_fd = os.open(filename, os.O_RDONLY) if local_chunks else None
+    try:
+        def _fetch(item):
+            digest, size = item
+            if digest in local_chunks:
+                data = os.pread(old_fd, size, local_chunks[digest])
+            else:
+                data = cloud_api.get_object(bucket_name, chunk_key(base, digest))
+                if data is None:
+                    raise CloudApiException(f'{path} 的 chunk {digest} 不存在, 请重新推送')
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise CloudApiException(f'{path} 的 chunk {digest} 校验失败')
+            return data
+
+        md5, written = hashlib.md5(), 0
+        with open(tmp_filename, 'wb') as out:
+            for data in _ordered_map(_fetch, manifest['chunks'], num_threads):
+                out.write(data)
+                md5.update(data)
+                written += len(data)
+                if percentage is not None:
+                    percentage(written, manifest['size'])
+        if md5.hexdigest() != manifest['md5']:
+            raise CloudApiException(f'{path} 拼接后 md5 校验失败')
+        os.replace(tmp_filename, filename)
+    finally:
+        if old_fd is not None:
+            os.close(old_fd)
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return manifest
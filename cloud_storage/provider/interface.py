@@ -1,11 +1,21 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Tuple, Any
+from dataclasses import dataclass
+from typing import List, Dict, Tuple, Any, Optional
 
 
 class CloudApiException(Exception):
     pass
 
 
+@dataclass
+class FileInfo:
+    path: str
+    size: Optional[int] = None
+    last_modified: Optional[str] = None
+    md5: Optional[str] = None
+    ignored: Optional[bool] = None
+
+
 class CloudObjectStorageInterface(ABC):
 
     @abstractmethod
@@ -42,6 +52,22 @@ class CloudObjectStorageInterface(ABC):
         '''
         raise NotImplementedError
 
+    @abstractmethod
+    def put_object(self, bucket_name: str, key: str, data: bytes,
+                   tagging: str = None, **kwargs) -> None:
+        '''
+        上传一个小对象 (增量同步的 chunk / manifest)
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_object(self, bucket_name: str, key: str,
+                   **kwargs) -> Optional[bytes]:
+        '''
+        下载一个小对象, 不存在时返回 None
+        '''
+        raise NotImplementedError
+
     @abstractmethod
     def get_object_tagging(self, bucket_name: str, key: str,
                            **kwargs) -> Dict[str, str]:
@@ -1,14 +1,41 @@
+import os
+import shutil
+import ujson
+from typing import Callable
+from urllib.parse import parse_qsl
 
 from .interface import *
 from loguru import logger
 
 
 class MockApi(CloudObjectStorageInterface):
-    def __init__(self, **kwargs) -> None:
-        pass
+    """
+    不指定 root 时只打日志;
+    指定 root (或者 endpoint 为 file://{root}) 时用本地目录模拟对象存储, 对象存在 {root}/{bucket}/{key},
+    标签存在 {root}/.tagging/{bucket}/{key}, 可以不连云端测试上传下载流程
+    """
+    def __init__(self, root: str = None, endpoint: str = None, **kwargs) -> None:
+        if root is None and endpoint and endpoint.startswith('file://'):
+            root = endpoint[len('file://'):]
+        self.root = root
 
     def _get_bucket_handler(self, bucket_name, **kwargs):
-        return None
+        return None if self.root is None else os.path.join(self.root, bucket_name)
+
+    def _object_path(self, bucket_name, key):
+        path = os.path.normpath(os.path.join(self.root, bucket_name, key))
+        if not path.startswith(os.path.join(self.root, bucket_name) + os.path.sep):
+            raise CloudApiException(f'非法的 key: {key}')
+        return path
+
+    def _tagging_path(self, bucket_name, key):
+        return os.path.join(self.root, '.tagging', os.path.relpath(self._object_path(bucket_name, key), self.root))
+
+    def _write_tagging(self, bucket_name, key, tag):
+        path = self._tagging_path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            ujson.dump(tag, f)
 
     def list_bucket(self,
                     bucket_name: str,
@@ -20,25 +47,93 @@ class MockApi(CloudObjectStorageInterface):
         '''
         logger.info(
             f'mock list_bucket: bucket_name {bucket_name}, prefix {prefix}')
-        return (list(), list())
+        files, folders = list(), list()
+        if self.root is None:
+            return files, folders
+        bucket_path = self._get_bucket_handler(bucket_name)
+        for dirpath, dirnames, filenames in os.walk(bucket_path):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_path)
+                if not key.startswith(prefix):
+                    continue
+                if not recursive and '/' in key[len(prefix):]:
+                    folder = prefix + key[len(prefix):].split('/')[0] + '/'
+                    if all(f.path != folder for f in folders):
+                        folders.append(FileInfo(path=folder))
+                    continue
+                st = os.stat(os.path.join(dirpath, filename))
+                files.append(FileInfo(path=key, size=st.st_size, last_modified=int(st.st_mtime)))
+        return files, folders
 
     def resumable_download(self, bucket_name: str, key: str, filename: str,
+                           multipart_threshold: int = None, part_size: int = None,
+                           percentage: Callable = None, num_threads: int = None,
                            **kwargs) -> None:
         '''
         从对象存储中下载
         '''
         logger.info(
             f'mock resumable_download: bucket_name {bucket_name}, key {key}')
-        return
+        if self.root is None:
+            return
+        path = self._object_path(bucket_name, key)
+        if not os.path.exists(path):
+            raise CloudApiException(f'download {key} failed: not found')
+        shutil.copyfile(path, filename)
+        if percentage is not None:
+            size = os.path.getsize(filename)
+            percentage(size, size)
 
     def resumable_upload(self, bucket_name: str, key: str, filename: str,
-                         **kwargs) -> None:
+                         multipart_threshold: int = None, part_size: int = None,
+                         percentage: Callable = None, num_threads: int = None,
+                         tagging: str = None, **kwargs) -> None:
         '''
         上传到对象存储
         '''
         logger.info(
             f'mock resumable_upload: bucket_name {bucket_name}, key {key}')
-        return
+        if self.root is None:
+            return
+        path = self._object_path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+        if tagging:
+            self._write_tagging(bucket_name, key, dict(parse_qsl(tagging)))
+        if percentage is not None:
+            size = os.path.getsize(path)
+            percentage(size, size)
+
+    def put_object(self, bucket_name: str, key: str, data: bytes,
+                   tagging: str = None, **kwargs) -> None:
+        '''
+        上传一个小对象 (增量同步的 chunk / manifest)
+        '''
+        logger.info(
+            f'mock put_object: bucket_name {bucket_name}, key {key}')
+        if self.root is None:
+            return
+        path = self._object_path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if tagging:
+            self._write_tagging(bucket_name, key, dict(parse_qsl(tagging)))
+
+    def get_object(self, bucket_name: str, key: str,
+                   **kwargs) -> Optional[bytes]:
+        '''
+        下载一个小对象, 不存在时返回 None
+        '''
+        logger.info(
+            f'mock get_object: bucket_name {bucket_name}, key {key}')
+        if self.root is None:
+            return None
+        try:
+            with open(self._object_path(bucket_name, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
 
     def get_object_tagging(self, bucket_name: str, key: str,
                            **kwargs) -> Dict[str, str]:
@@ -47,7 +142,13 @@ class MockApi(CloudObjectStorageInterface):
         '''
         logger.info(
             f'mock get_object_tagging: bucket_name {bucket_name}, key {key}')
-        return dict()
+        if self.root is None:
+            return dict()
+        try:
+            with open(self._tagging_path(bucket_name, key)) as f:
+                return ujson.load(f)
+        except FileNotFoundError:
+            return dict()
 
     def set_object_tagging(self, bucket_name: str, key: str,
                            tag: Dict[str, str], **kwargs) -> None:
@@ -56,7 +157,11 @@ class MockApi(CloudObjectStorageInterface):
         '''
         logger.info(
             f'mock set_object_tagging: bucket_name {bucket_name}, key {key}')
-        return
+        if self.root is None:
+            return
+        if not os.path.exists(self._object_path(bucket_name, key)):
+            raise CloudApiException(f'set tagging failed {key}: not found')
+        self._write_tagging(bucket_name, key, tag)
 
     def batch_delete_objects(self, bucket_name: str, files: List[str],
                              **kwargs) -> None:
@@ -66,11 +171,28 @@ class MockApi(CloudObjectStorageInterface):
         logger.info(
             f'mock batch_delete_objects: bucket_name {bucket_name}, files {files}'
         )
-        return
+        if self.root is None:
+            return
+        for key in files:
+            for path in (self._object_path(bucket_name, key), self._tagging_path(bucket_name, key)):
+                if os.path.exists(path):
+                    os.remove(path)
 
-    def get_access_token(self, bucket_name: str, **kwargs) -> Dict[str, str]:
+    def get_access_token(self, bucket_name: str, prefix: str = '', ttl_seconds=None,
+                         **kwargs) -> Dict[str, str]:
         '''
         获取临时访问token
         '''
         logger.info(f'mock get_access_token: bucket_name {bucket_name}')
-        return dict()
+        if self.root is None:
+            return dict()
+        return {
+            'request_id': 'mock',
+            'access_key_id': 'mock',
+            'access_key_secret': 'mock',
+            'security_token': '',
+            'expiration': '',
+            'bucket': bucket_name,
+            'endpoint': f'file://{self.root}',
+            'authorized_path': prefix
+        }
@@ -1,5 +1,4 @@
 import ujson
-from dataclasses import dataclass
 from typing import List, Dict, Callable, Tuple, Optional
 
 from aliyunsdkcore import client
@@ -9,13 +8,6 @@ import oss2
 from loguru import logger
 from .interface import *
 
-@dataclass
-class FileInfo:
-    path: str
-    size: Optional[int] = None
-    last_modified: Optional[str] = None
-    md5: Optional[str] = None
-    ignored: Optional[bool] = None
 
 class OSSApi(CloudObjectStorageInterface):
 
@@ -119,6 +111,29 @@ class OSSApi(CloudObjectStorageInterface):
             raise CloudApiException(
                 f'upload {key} failed: {result.status}, {result.request_id}')
 
+    def put_object(self, bucket_name: str, key: str, data: bytes,
+                   tagging: str = None, **kwargs) -> None:
+        '''
+        上传一个小对象 (增量同步的 chunk / manifest)
+        '''
+        bucket = self._get_bucket_handler(bucket_name)
+        headers = {oss2.headers.OSS_OBJECT_TAGGING: tagging} if tagging else None
+        result = bucket.put_object(key, data, headers=headers)
+        if result.status != 200:
+            raise CloudApiException(
+                f'put {key} failed: {result.status}, {result.request_id}')
+
+    def get_object(self, bucket_name: str, key: str,
+                   **kwargs) -> Optional[bytes]:
+        '''
+        下载一个小对象, 不存在时返回 None
+        '''
+        bucket = self._get_bucket_handler(bucket_name)
+        try:
+            return bucket.get_object(key).read()
+        except (oss2.exceptions.NotFound, oss2.exceptions.NoSuchKey):
+            return None
+
     def get_object_tagging(self, bucket_name: str, key: str,
                            **kwargs) -> Dict[str, str]:
         '''
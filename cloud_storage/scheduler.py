@@ -0,0 +1,231 @@
+"""
+全局的传输调度: sync_to_cluster / sync_from_cluster 的所有文件都交给同一个 TransferScheduler
+  - 共用一个进程池, 全局 / 每个用户同时在跑的 job 数有上限
+  - 全局 / 每个用户的带宽用令牌桶限制, 按派发出去的字节数扣, 允许透支一个 job, 大文件不会一直等不到
+  - 同一个请求里的小文件打包成一个 job, 在一个进程里顺序传, 省掉每个文件一次的进程间调度
+  - 先提交的请求先派发, 被用户并发数 / 带宽卡住的时候才轮到后面的请求
+"""
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from logm import logger
+
+
+class TokenBucket:
+    """
+    rate 为 0 时不限速; tokens 可以是负数 (透支), 回到正数之前不能再派发
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """ 还要等多久才能派发, 0 表示现在就可以 """
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens > 0 else (-self.tokens) / self.rate + 1e-3
+
+    def consume(self, size: int):
+        if self.rate:
+            self.tokens -= size
+
+
+@dataclass
+class TransferJob:
+    func: Callable
+    kwargs_list: List[dict]
+    futures: List[Future]
+    sizes: List[int]
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes)
+
+
+@dataclass
+class TransferRequest:
+    index: str
+    username: str
+    created_at: float
+    jobs: Deque[TransferJob] = field(default_factory=deque)
+    running: int = 0
+
+
+def run_transfer_job(func: Callable, kwargs_list: List[dict]) -> List[Tuple[bool, object]]:
+    """
+    在 worker 进程里顺序传一个 job 里的文件, 单个文件失败不影响后面的文件; 结束前把进度刷进 redis
+    """
+    from .utils import progress_buffer
+    results = []
+    try:
+        for kwargs in kwargs_list:
+            try:
+                results.append((True, func(**kwargs)))
+            except Exception as e:
+                results.append((False, e))
+    finally:
+        progress_buffer.flush()
+    return results
+
+
+class TransferScheduler:
+    def __init__(self,
+                 max_workers: int = 16,
+                 user_concurrency: int = 8,
+                 bandwidth: float = 0,
+                 user_bandwidth: float = 0,
+                 small_file_bytes: int = 4 << 20,
+                 batch_files: int = 64,
+                 batch_bytes: int = 64 << 20,
+                 method: str = 'spawn'):
+        """
+            max_workers: 进程池大小, 也是全局同时在跑的 job 数
+            user_concurrency: 每个用户同时在跑的 job 数
+            bandwidth / user_bandwidth: 全局 / 每个用户的带宽上限 (B/s), 0 表示不限
+            small_file_bytes: 小于这个大小的文件会打包, 最多 batch_files 个 / batch_bytes 字节一个 job
+        """
+        self.max_workers = max_workers
+        self.user_concurrency = user_concurrency
+        self.user_bandwidth = user_bandwidth
+        self.small_file_bytes = small_file_bytes
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.context = get_context(method)
+        self.bucket = TokenBucket(bandwidth)
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        self.requests: List[TransferRequest] = []       # 按提交时间排序
+        self.running = 0
+        self.running_by_user = Counter()
+        self.cond = threading.Condition()
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.dispatcher: Optional[threading.Thread] = None
+
+    def submit(self, index: str, username: str, func: Callable, items: List[Tuple[dict, Optional[int]]]) -> List[Future]:
+        """
+        提交一个请求的所有文件, items 为 (func 的参数, 文件大小), 大小未知的文件单独一个 job
+        @return: 和 items 一一对应的 future, 结果和直接调用 func 一样
+        """
+        futures = [Future() for _ in items]
+        request = TransferRequest(index=index, username=username, created_at=time.monotonic())
+        batch = TransferJob(func, [], [], [])
+        for (kwargs, size), future in zip(items, futures):
+            if size is None or size >= self.small_file_bytes:
+                request.jobs.append(TransferJob(func, [kwargs], [future], [size or 0]))
+                continue
+            batch.kwargs_list.append(kwargs)
+            batch.futures.append(future)
+            batch.sizes.append(size)
+            if len(batch.kwargs_list) >= self.batch_files or batch.size >= self.batch_bytes:
+                request.jobs.append(batch)
+                batch = TransferJob(func, [], [], [])
+        if batch.kwargs_list:
+            request.jobs.append(batch)
+        with self.cond:
+            if request.jobs:
+                self.requests.append(request)
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._dispatch_loop, name='transfer-dispatcher', daemon=True)
+                self.dispatcher.start()
+            self.cond.notify()
+        logger.info(f'[{index}] 提交 {len(items)} 个文件, 共 {len(request.jobs)} 个 job')
+        return futures
+
+    def _user_bucket(self, username: str) -> TokenBucket:
+        if username not in self.user_buckets:
+            self.user_buckets[username] = TokenBucket(self.user_bandwidth)
+        return self.user_buckets[username]
+
+    def _select(self) -> Tuple[List[Tuple[TransferRequest, TransferJob]], Optional[float]]:
+        """
+        按请求的先后挑出现在可以派发的 job, 同时返回还要等令牌的时间; 需要持有 cond
+        """
+        selected, timeout = [], None
+        now = time.monotonic()
+        for request in self.requests:
+            if self.running >= self.max_workers:
+                break
+            buckets = [self.bucket, self._user_bucket(request.username)]
+            while request.jobs and self.running < self.max_workers \
+                    and self.running_by_user[request.username] < self.user_concurrency:
+                delay = max(bucket.delay(now) for bucket in buckets)
+                if delay > 0:
+                    timeout = delay if timeout is None else min(timeout, delay)
+                    break
+                job = request.jobs.popleft()
+                for bucket in buckets:
+                    bucket.consume(job.size)
+                request.running += 1
+                self.running += 1
+                self.running_by_user[request.username] += 1
+                selected.append((request, job))
+        self.requests = [request for request in self.requests if request.jobs]
+        return selected, timeout
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                selected, timeout = self._select()
+                if not selected:
+                    self.cond.wait(timeout)
+                    continue
+            # 提交进程池不要拿着锁, 避免和进程池回调线程互相等待
+            for request, job in selected:
+                self._start(request, job)
+
+    def _start(self, request: TransferRequest, job: TransferJob):
+        try:
+            if self.pool is None:
+                logger.info(f'creating transfer process workers, worker_num: {self.max_workers}')
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.context)
+            pool_future = self.pool.submit(run_transfer_job, job.func, job.kwargs_list)
+        except Exception as e:
+            pool_future = Future()
+            pool_future.set_exception(e)
+        pool_future.add_done_callback(lambda f: self._on_done(request, job, f))
+
+    def _on_done(self, request: TransferRequest, job: TransferJob, pool_future: Future):
+        with self.cond:
+            request.running -= 1
+            self.running -= 1
+            self.running_by_user[request.username] -= 1
+            if self.running_by_user[request.username] <= 0:
+                self.running_by_user.pop(request.username)
+            self.cond.notify()
+        try:
+            results = pool_future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # worker 进程挂了, 下个 job 重新建进程池
+                logger.error(f'[{request.index}] transfer process workers broken: {e}')
+                self.pool = None
+            # 和传输函数自己抛的异常格式一致, 回调里要用
+            results = [(False, Exception({'key': kwargs.get('key'), 'size': size, 'username': request.username,
+                                          'file_type': kwargs.get('file_type'), 'msg': str(e)}))
+                       for kwargs, size in zip(job.kwargs_list, job.sizes)]
+        for future, (succeed, value) in zip(job.futures, results):
+            if succeed:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def dump(self) -> str:
+        """
+        debug用
+        """
+        with self.cond:
+            msg = f'Running jobs: {self.running}/{self.max_workers}, by user: {dict(self.running_by_user)}\n'
+            for request in self.requests:
+                pending_files = sum(len(job.kwargs_list) for job in request.jobs)
+                msg += f'\tindex: {request.index}, user: {request.username}, running jobs: {request.running}, ' \
+                       f'pending jobs: {len(request.jobs)}, pending files: {pending_files}\n'
+        return msg
@@ -4,27 +4,28 @@ import functools
 import ujson
 import os
 import shutil
+import threading
 from cachetools import TTLCache
-from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
-from multiprocessing import get_context
-from time import sleep
+from time import sleep, monotonic
 from random import randint
 from enum import Enum
 from pathlib import Path
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, Dict, Tuple
 
 from fastapi import HTTPException
 from fastapi_pagination.api import create_page, resolve_params
 from fastapi_pagination.bases import AbstractPage, AbstractParams
 
 from conf import CONF
-from conf.utils import FileInfo, FileType, FilePrivacy, DatasetType, list_local_files_inner, hashkey
+from conf.utils import FileInfo, FileType, FilePrivacy, DatasetType, list_local_files_inner, hashkey, slice_bytes
+from conf.packed_dataset import PACKED_INDEX_FILE, PACKED_SHARD_DIR, read_packed_shards, remove_stale_shards, shard_path
 from db import a_redis, redis_conn
 from utils import asyncwrap
 from .metrics import DB_FAILURE_COUNTER
 from logm import logger
 from .provider import OSSApi, MockApi
+from .provider.delta import assemble_from_delta
 
 
 # 集群内访问外网的proxy
@@ -43,40 +44,8 @@ if PROVIDER == 'oss':
                        breakpoint_info_path=CONF.cloud.storage.service.breakpoint_info_path,
                        proxies=proxies)
 else:
-    cloud_api = MockApi()
-
-
-class WorkerPools:
-    def __init__(self, method='spawn'):
-        self.init_worker_num = int(os.environ.get('WORKERS', 4))
-        self.shared_worker_num = self.init_worker_num * 4
-        self.context = get_context(method)
-        self.pools = dict()
-        self.max_pools = 10
-
-    def get(self, name):
-        if name not in self.pools.keys():
-            # 超出max_pools的任务放到共享pool里运行
-            if len(self.pools) > self.max_pools or name == 'shared':
-                if 'shared' not in self.pools.keys():
-                    self._create('shared', True)
-                return self.pools['shared']
-            self._create(name)
-        return self.pools[name]
-
-    def _create(self, name, shared=False):
-        worker_num = self.shared_worker_num if shared else self.init_worker_num
-        logger.info(f'creating process workers, name: {name}, worker_num: {worker_num}')
-        self.pools[name] = ProcessPoolExecutor(max_workers=worker_num, mp_context=self.context)
-        logger.info(f'create process workers successful, name: {name}, worker_num: {worker_num}')
-
-    def finish(self, name):
-        if name not in self.pools.keys():
-            return
-        logger.info(f'shutting down process workers, name: {name}')
-        self.pools[name].shutdown()
-        logger.info(f'shutdown process workers successful, name: {name}')
-        self.pools.pop(name, None)
+    # 配置了 mock_root 的话用本地目录模拟对象存储
+    cloud_api = MockApi(root=CONF.try_get('cloud.storage.mock_root', default=None))
 
 
 class ClientException(Exception):
@@ -183,6 +152,11 @@ class StatusRecorder:
     async def a_hset(self, name, key, value):
         await self.aio_recorder.hset(name, key, value)
 
+    @metrics_wrapper
+    async def a_hset_mapping(self, name, mapping):
+        if mapping:
+            await self.aio_recorder.hset(name, mapping=mapping)
+
     @metrics_wrapper
     async def a_set(self, key, value, expires=604800):
         await self.aio_recorder.set(key, value, expires)
@@ -220,6 +194,16 @@ class StatusRecorder:
     def hset(self, name, key, value):
         self.recorder.hset(name, key, value)
 
+    @metrics_wrapper
+    def hset_many(self, items: Dict[Tuple[str, str], int]):
+        '''
+        一个 pipeline 写多个 hash 的多个 key, items 为 (name, key) -> value
+        '''
+        pipe = self.recorder.pipeline(transaction=False)
+        for (name, key), value in items.items():
+            pipe.hset(name, key, value)
+        pipe.execute()
+
     @metrics_wrapper
     def delete(self, key):
         self.recorder.delete(key)
@@ -228,6 +212,40 @@ class StatusRecorder:
 status_recorder = StatusRecorder(redis_conn, a_redis)
 
 
+class ProgressBuffer:
+    '''
+    传输进度先记在本地, 每隔 flush_interval 秒用一个 pipeline 批量写进 redis, 同一个文件只写最新的进度;
+    每个进程一份, job 结束前要 flush
+    '''
+    def __init__(self, recorder: StatusRecorder, flush_interval: float):
+        self.recorder = recorder
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple[str, str], int] = {}
+        self.flushed_at = monotonic()
+
+    def hset(self, name, key, value):
+        with self.lock:
+            self.pending[(name, key)] = value
+            due = monotonic() - self.flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = monotonic()
+        if not pending:
+            return
+        try:
+            self.recorder.hset_many(pending)
+        except Exception as e:
+            logger.warning(f'写入传输进度失败, 忽略: {str(e)}')
+
+
+progress_buffer = ProgressBuffer(status_recorder, CONF.try_get('cloud.storage.service.transfer.progress_flush_interval', default=1.0))
+
+
 def status_key(index, key, is_upload: bool):
     top_key = 'sync_from_cluster' if is_upload else 'sync_to_cluster'
     return f'{PROVIDER}:{top_key}:{index}:{key}'
@@ -276,7 +294,11 @@ def list_bucket_files_inner(prefix, bucket_name, recursive=False, diff=False, cl
         f = FileInfo(path=key, size=fi.size, last_modified=ts)
         if diff and cluster_base_path:
             local_path = os.path.join(cluster_base_path, key)
-            if os.path.exists(local_path) and os.path.getmtime(local_path) > float(ts):
+            try:
+                downloaded = os.stat(local_path).st_mtime > float(ts)
+            except FileNotFoundError:
+                downloaded = False
+            if downloaded:
                 logger.info(f'{local_path} 之前已下载, 跳过')
                 downloaded_files.append(f)
                 continue
@@ -286,6 +308,44 @@ def list_bucket_files_inner(prefix, bucket_name, recursive=False, diff=False, cl
     return files, downloaded_files
 
 
+def staged_packed_index(cluster_base_path):
+    return os.path.join(cluster_base_path, '.hfai', PACKED_INDEX_FILE)
+
+
+def list_packed_dataset_files(prefix, bucket_name, cluster_base_path):
+    '''
+    打包格式的数据集 (conf/packed_dataset.py): 先把索引下载到 .hfai 下, 按索引里的 shard 对比集群上的文件,
+    shard 按内容命名, 本地有同名同大小的就是已下载, 不需要逐个文件比较 mtime; 不是打包格式返回 None.
+    所有 shard 下载完后调用 commit_packed_dataset 换上新索引
+    '''
+    prefix = prefix.rstrip('/')
+    index_key = f'{prefix}/{PACKED_INDEX_FILE}'
+    if all(fi.path != index_key for fi in cloud_api.list_bucket(bucket_name, index_key)[0]):
+        return None
+    staged_index = staged_packed_index(cluster_base_path)
+    os.makedirs(os.path.dirname(staged_index), exist_ok=True)
+    cloud_api.resumable_download(bucket_name, index_key, staged_index, slice_bytes, slice_bytes, None, 4)
+    files, downloaded_files = [], []
+    for name, size, _ in read_packed_shards(staged_index):
+        f = FileInfo(path=f'{PACKED_SHARD_DIR}/{name}', size=size)
+        try:
+            downloaded = os.stat(shard_path(cluster_base_path, name)).st_size == size
+        except FileNotFoundError:
+            downloaded = False
+        (downloaded_files if downloaded else files).append(f)
+    logger.debug(f'packed dataset {bucket_name}/{prefix}: {len(files)} shards to download, {len(downloaded_files)} downloaded')
+    return files, downloaded_files
+
+
+def commit_packed_dataset(cluster_base_path):
+    '''
+    换上新索引, 删掉旧版本的 shard
+    '''
+    os.replace(staged_packed_index(cluster_base_path), os.path.join(cluster_base_path, PACKED_INDEX_FILE))
+    stale = remove_stale_shards(cluster_base_path)
+    logger.info(f'packed dataset {cluster_base_path} 更新完成, 清理 {len(stale)} 个旧 shard')
+
+
 @asyncwrap
 def filter_synced_files(bucket_name, index, prefix, upload_file_infos):
     filtered_file_infos = list()
@@ -297,12 +357,13 @@ def filter_synced_files(bucket_name, index, prefix, upload_file_infos):
             md5 = tagging.get('md5', None)
             if md5 == file_info.md5:
                 logger.info(f'  {key} 之前已上传, md5: {md5}, 跳过')
-                status_recorder.hset(status_key(index, 'progress', True), key, file_info.size)
+                progress_buffer.hset(status_key(index, 'progress', True), key, file_info.size)
                 continue
         except Exception as e:
             logger.error(f'filter_synced_files {key} error: {str(e)}')
 
         filtered_file_infos.append(upload_file_infos[i])
+    progress_buffer.flush()
     return filtered_file_infos
 
 
@@ -310,6 +371,8 @@ rmtree = asyncwrap(shutil.rmtree)
 
 async_list_bucket_files_inner = asyncwrap(list_bucket_files_inner)
 
+async_list_packed_dataset_files = asyncwrap(list_packed_dataset_files)
+
 async_list_local_files_inner = asyncwrap(list_local_files_inner)
 
 ### paginate
@@ -0,0 +1,236 @@
+"""
+打包的数据集格式, 用于百万级小文件的数据集:
+  - shards/{md5}.bin: 若干文件内容直接拼接而成的大文件, 按内容的 md5 命名, 内容不变名字就不变
+  - packed_index.db: sqlite 索引, 记录每个文件在哪个 shard 的哪个位置, 以及每个 shard 的大小和 md5
+
+同步到集群的时候只需要传 shard 和索引; 训练时用 PackedDataset 随机读取, 不需要解包:
+    dataset = PackedDataset('/path/to/dataset')
+    data = dataset[i]                      # 第 i 个文件的内容
+    data = dataset.read('train/0001.jpg')  # 按路径读
+"""
+import hashlib
+import os
+import sqlite3
+import zlib
+from array import array
+from typing import Iterator, List, Optional, Tuple
+
+
+PACKED_FORMAT_VERSION = 1
+PACKED_INDEX_FILE = 'packed_index.db'
+PACKED_SHARD_DIR = 'shards'
+# shard 至少这么大, 之后遇到路径 hash 命中的文件就切, 最多 2 倍;
+# 切点只和路径有关, 增删文件只会改变附近的 shard, 重新打包后大部分 shard 的 md5 不变, 不用重新同步
+DEFAULT_SHARD_BYTES = 1 << 30
+SHARD_CUT_MASK = 63
+
+
+def shard_path(root: str, name: str) -> str:
+    return os.path.join(root, PACKED_SHARD_DIR, name)
+
+
+def is_packed_dataset(root: str) -> bool:
+    return os.path.isfile(os.path.join(root, PACKED_INDEX_FILE))
+
+
+def open_packed_index(index_path: str, check_same_thread=True) -> sqlite3.Connection:
+    conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=check_same_thread)
+    try:
+        version = conn.execute("select value from meta where key = 'version'").fetchone()
+    except sqlite3.Error:
+        version = None
+    if version is None or int(version[0]) != PACKED_FORMAT_VERSION:
+        conn.close()
+        raise ValueError(f'{index_path} 不是支持的打包数据集索引')
+    return conn
+
+
+def read_packed_shards(index_path: str) -> List[Tuple[str, int, str]]:
+    """
+    读取索引里的 shard 列表, [(name, size, md5)]
+    """
+    conn = open_packed_index(index_path)
+    try:
+        return conn.execute('select name, size, md5 from shards order by id').fetchall()
+    finally:
+        conn.close()
+
+
+def pack_dataset(src_dir: str, dst_dir: str, shard_bytes: int = DEFAULT_SHARD_BYTES) -> int:
+    """
+    把 src_dir 下的所有文件打包到 dst_dir, dst_dir 里之前打包留下的、新索引用不到的 shard 会被删掉
+    @return: 打包的文件数
+    """
+    os.makedirs(os.path.join(dst_dir, PACKED_SHARD_DIR), exist_ok=True)
+    paths = []
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        paths += [os.path.relpath(os.path.join(root, f), src_dir) for f in sorted(files)]
+
+    tmp_index = os.path.join(dst_dir, f'.{PACKED_INDEX_FILE}.tmp')
+    if os.path.exists(tmp_index):
+        os.remove(tmp_index)
+    conn = sqlite3.connect(tmp_index)
+    conn.execute('create table meta (key text primary key, value text)')
+    conn.execute('create table shards (id integer primary key, name text, size integer, md5 text)')
+    conn.execute('create table files (id integer primary key, path text unique, shard integer, offset integer, size integer)')
+
+    tmp_shard = shard_path(dst_dir, '.packing.tmp')
+    shard_id, shard_size, md5, out, records = 0, 0, None, None, []
+
+    def close_shard():
+        nonlocal shard_id, out
+        out.close()
+        digest = md5.hexdigest()
+        name = f'{digest}.bin'
+        os.replace(tmp_shard, shard_path(dst_dir, name))
+        conn.execute('insert into shards values (?, ?, ?, ?)', (shard_id, name, shard_size, digest))
+        conn.executemany('insert into files (path, shard, offset, size) values (?, ?, ?, ?)', records)
+        records.clear()
+        shard_id, out = shard_id + 1, None
+
+    try:
+        for path in paths:
+            size = os.path.getsize(os.path.join(src_dir, path))
+            if out is not None and shard_size + size > 2 * shard_bytes:
+                close_shard()
+            if out is None:
+                out, md5, shard_size = open(tmp_shard, 'wb'), hashlib.md5(), 0
+            with open(os.path.join(src_dir, path), 'rb') as f:
+                while True:
+                    data = f.read(8 << 20)
+                    if not data:
+                        break
+                    out.write(data)
+                    md5.update(data)
+            records.append((path, shard_id, shard_size, size))
+            shard_size += size
+            if shard_size >= shard_bytes and zlib.crc32(path.encode()) & SHARD_CUT_MASK == 0:
+                close_shard()
+        if out is not None:
+            close_shard()
+        conn.executemany('insert into meta values (?, ?)',
+                         [('version', str(PACKED_FORMAT_VERSION)), ('num_files', str(len(paths)))])
+        conn.commit()
+    finally:
+        conn.close()
+        if out is not None:
+            out.close()
+        if os.path.exists(tmp_shard):
+            os.remove(tmp_shard)
+    os.replace(tmp_index, os.path.join(dst_dir, PACKED_INDEX_FILE))
+    remove_stale_shards(dst_dir)
+    return len(paths)
+
+
+def remove_stale_shards(root: str) -> List[str]:
+    """
+    删掉索引里没有的 shard (旧版本), 返回删掉的文件名
+    """
+    referenced = {name for name, _, _ in read_packed_shards(os.path.join(root, PACKED_INDEX_FILE))}
+    stale = [name for name in os.listdir(os.path.join(root, PACKED_SHARD_DIR)) if name not in referenced]
+    for name in stale:
+        os.remove(shard_path(root, name))
+    return stale
+
+
+class PackedDataset(object):
+    """
+    打包数据集的随机读取, 按下标读不查 sqlite, 只用内存里的 offset 表和 pread;
+    DataLoader 多进程 fork 之后, 每个进程会重新打开自己的文件句柄
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, PACKED_INDEX_FILE)
+        conn = open_packed_index(self.index_path)
+        try:
+            self.shard_names = [name for name, in conn.execute('select name from shards order by id')]
+            self.shards, self.offsets, self.sizes = array('q'), array('q'), array('q')
+            for shard, offset, size in conn.execute('select shard, offset, size from files order by id'):
+                self.shards.append(shard)
+                self.offsets.append(offset)
+                self.sizes.append(size)
+        finally:
+            conn.close()
+        self._pid = None
+        self._fds = {}
+        self._conn = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # fork 出来的进程不能共用父进程的 sqlite 连接, 文件句柄也各开各的
+            self._pid, self._fds, self._conn = os.getpid(), {}, None
+
+    def _fd(self, shard: int) -> int:
+        self._check_pid()
+        fd = self._fds.get(shard)
+        if fd is None:
+            fd = self._fds[shard] = os.open(shard_path(self.root, self.shard_names[shard]), os.O_RDONLY)
+        return fd
+
+    def _query(self, sql, *args):
+        self._check_pid()
+        if self._conn is None:
+            self._conn = open_packed_index(self.index_path, check_same_thread=False)
+        return self._conn.execute(sql, args)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __getitem__(self, i: int) -> bytes:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return os.pread(self._fd(self.shards[i]), self.sizes[i], self.offsets[i])
+
+    def index_of(self, path: str) -> Optional[int]:
+        row = self._query('select id from files where path = ?', path).fetchone()
+        return None if row is None else row[0] - 1
+
+    def path(self, i: int) -> str:
+        return self._query('select path from files where id = ?', i + 1).fetchone()[0]
+
+    def paths(self) -> List[str]:
+        return [path for path, in self._query('select path from files order by id')]
+
+    def read(self, path: str) -> bytes:
+        i = self.index_of(path)
+        if i is None:
+            raise FileNotFoundError(path)
+        return self[i]
+
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self._pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+            if self._conn is not None:
+                self._conn.close()
+        self._pid, self._fds, self._conn = None, {}, None
+
+    def __getstate__(self):
+        # 传给 DataLoader 的 spawn worker 时不带文件句柄
+        state = self.__dict__.copy()
+        state.update(_pid=None, _fds={}, _conn=None)
+        return state
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='打包小文件数据集')
+    parser.add_argument('src', help='数据集目录')
+    parser.add_argument('dst', help='打包输出目录, 上传到数据集的 bucket 目录')
+    parser.add_argument('--shard-bytes', type=int, default=DEFAULT_SHARD_BYTES)
+    args = parser.parse_args()
+    print(f'打包完成, 共 {pack_dataset(args.src, args.dst, args.shard_bytes)} 个文件')
@@ -0,0 +1,185 @@
+"""
+训练进程和任务 manager 之间的 runtime 通信 (set_whole_life_state / receive_suspend_command / set_priority 等)
+
+原来每次调用都新建一个 tcp 连接, 几百个节点的任务所有 rank 同时调用时会把 manager 的 backlog 打满;
+现在每个进程和 manager 保持一个长连接:
+  - 建连后客户端先发 CHANNEL_HELLO (按老协议打包的 CHANNEL_MAGIC), manager 回 CHANNEL_MAGIC;
+    老版本 manager 会把它当成一个解析不了的老协议请求, 回一个报错的结果然后断开, 这时退回一次一连接的老协议;
+    握手超时 / 连接被 reset 不能说明是老版本 (可能是 manager 负载高或者正在重启), 抛错由调用方重试
+  - 之后每个请求 / 响应一帧: [FRAME_HEADER: payload 长度, request id][pickle 的 payload]
+  - 请求带 id, 同一个连接上可以同时有多个请求, 响应不保证按顺序返回
+老协议: [8 字节, 右对齐的 总长度 (含这 8 字节)][pickle 的 payload], manager 返回 pickle 的结果后关闭连接
+"""
+import itertools
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+
+RUNTIME_PORT = 7000
+CHANNEL_MAGIC = b'HFAIRT01'
+FRAME_HEADER = struct.Struct('>IQ')
+HANDSHAKE_TIMEOUT = 5
+
+
+def legacy_pack(b_data: bytes) -> bytes:
+    return str(len(b_data) + 8).rjust(8).encode() + b_data
+
+
+CHANNEL_HELLO = legacy_pack(CHANNEL_MAGIC)
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('连接被关闭了')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def legacy_request(address: Tuple[str, int], b_data: bytes, timeout: float) -> bytes:
+    """
+    老协议, 一次请求一个连接
+    """
+    with socket.create_connection(address, timeout=timeout) as s:
+        s.sendall(legacy_pack(b_data))
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class _Connection(object):
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.pending: Dict[int, Future] = {}
+        self.closed = False
+
+    def close(self, exc: Exception):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for request_id in list(self.pending):
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_exception(exc)
+
+
+class RuntimeChannel(object):
+    """
+    和 manager 的长连接, 一个进程共用一个 (见 get_runtime_channel), 多个线程可以同时发请求;
+    连接断了的话正在等的请求会抛 ConnectionError, 下一次请求重新建连
+    """
+
+    def __init__(self, address: Tuple[str, int]):
+        self.address = address
+        self.lock = threading.Lock()
+        self.connection: Optional[_Connection] = None
+        self.request_ids = itertools.count(1)
+        # manager 不支持长连接
+        self.legacy = False
+
+    @staticmethod
+    def _recv_ack(sock: socket.socket) -> bytes:
+        """
+        读 manager 的握手回复, 对面关闭连接的话返回已经读到的部分
+        """
+        ack = b''
+        while len(ack) < len(CHANNEL_MAGIC):
+            chunk = sock.recv(len(CHANNEL_MAGIC) - len(ack))
+            if not chunk:
+                break
+            ack += chunk
+        return ack
+
+    def _connect(self) -> Optional[_Connection]:
+        sock = socket.create_connection(self.address, timeout=HANDSHAKE_TIMEOUT)
+        try:
+            sock.sendall(CHANNEL_HELLO)
+            ack = self._recv_ack(sock)
+        except Exception:
+            # 超时 / 连接被 reset, 不能说明 manager 是老版本, 抛出去让调用方重试
+            sock.close()
+            raise
+        if ack != CHANNEL_MAGIC:
+            # 对面回了别的东西 (老版本 manager 返回的报错) 或者直接关了连接, 是不认识长连接的老版本 manager
+            sock.close()
+            self.legacy = True
+            return None
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _Connection(sock)
+        threading.Thread(target=self._read_loop, args=(connection, ), name='runtime-channel-reader', daemon=True).start()
+        return connection
+
+    def _read_loop(self, connection: _Connection):
+        try:
+            while True:
+                length, request_id = FRAME_HEADER.unpack(recv_exactly(connection.sock, FRAME_HEADER.size))
+                payload = recv_exactly(connection.sock, length)
+                future = connection.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+        except Exception as e:
+            with self.lock:
+                if self.connection is connection:
+                    self.connection = None
+            connection.close(ConnectionError(f'和 manager 的连接断开了: {e}'))
+
+    def request(self, b_data: bytes, timeout: float) -> bytes:
+        """
+        发送 pickle 好的请求, 返回 pickle 的响应
+        """
+        with self.lock:
+            if self.connection is None and not self.legacy:
+                self.connection = self._connect()
+            connection = self.connection
+        if connection is None:
+            return legacy_request(self.address, b_data, timeout)
+        request_id = next(self.request_ids)
+        future = Future()
+        connection.pending[request_id] = future
+        try:
+            with connection.send_lock:
+                if connection.closed:
+                    raise ConnectionError('和 manager 的连接断开了')
+                try:
+                    connection.sock.sendall(FRAME_HEADER.pack(len(b_data), request_id) + b_data)
+                except OSError as e:
+                    with self.lock:
+                        if self.connection is connection:
+                            self.connection = None
+                    connection.close(ConnectionError(f'和 manager 的连接断开了: {e}'))
+                    raise
+            return future.result(timeout)
+        finally:
+            connection.pending.pop(request_id, None)
+
+
+_channel: Optional[RuntimeChannel] = None
+_channel_pid = None
+_channel_lock = threading.Lock()
+
+
+def get_runtime_channel(address: Tuple[str, int]) -> RuntimeChannel:
+    """
+    当前进程的 channel, fork 出来的子进程会新建自己的
+    """
+    global _channel, _channel_pid
+    with _channel_lock:
+        if _channel is None or _channel_pid != os.getpid() or _channel.address != address:
+            _channel, _channel_pid = RuntimeChannel(address), os.getpid()
+        return _channel
@@ -2,10 +2,13 @@ import hashlib
 import fnmatch
 import mmap
 import os
+import re
 import shutil
+import sqlite3
 import stat
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from enum import Enum
@@ -16,6 +19,13 @@ from pydantic import BaseModel
 # 文件分片大小
 slice_bytes = 104857600  # 100 * 1024 * 1024
 
+# 计算 md5 时每次读多少
+md5_chunk_bytes = 8 * 1024 * 1024
+# 并行计算 md5 的线程数, hashlib 计算时会释放 GIL
+checksum_workers = min(8, os.cpu_count() or 1)
+# 工作区 .hfai 目录下的 md5 缓存
+checksum_cache_file = 'checksum_cache.db'
+
 # 北京时间
 tz_utc_8 = timezone(timedelta(hours=8))
 
@@ -116,15 +126,78 @@ def calculate_md5(file_name, size, directio=False):
                 offset += len(m)
                 md5.update(m)
     else:
-        with open(file_name, mode='rb') as fobj:
+        # 小文件不用分配整块 buffer
+        buffer = bytearray(max(min(size, md5_chunk_bytes), 4096))
+        view = memoryview(buffer)
+        with open(file_name, mode='rb', buffering=0) as fobj:
             while True:
-                data = fobj.read(chunk_size)
-                if not data:
+                n = fobj.readinto(buffer)
+                if not n:
                     break
-                md5.update(data)
+                md5.update(view[:n])
     return md5.hexdigest()
 
 
+class ChecksumCache(object):
+    """
+    工作区文件的 md5 缓存, 存在 .hfai/checksum_cache.db (sqlite) 里,
+    (st_dev, st_ino, size, mtime_ns) 都没变的文件直接用缓存的 md5; 目录不可写或者 sqlite 出错时不缓存
+    """
+
+    def __init__(self, base_path):
+        self.conn = None
+        self.cached = {}
+        self.updates = {}
+        self.seen = set()
+        try:
+            cache_dir = os.path.join(base_path, '.hfai')
+            os.makedirs(cache_dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(cache_dir, checksum_cache_file), timeout=5)
+            self.conn.execute('create table if not exists checksum '
+                              '(file_id text primary key, size integer, mtime_ns integer, md5 text)')
+            self.cached = {row[0]: row[1:] for row in self.conn.execute('select file_id, size, mtime_ns, md5 from checksum')}
+        except (OSError, sqlite3.Error):
+            self.close()
+
+    @staticmethod
+    def file_id(st):
+        # st_ino 可能超过 sqlite integer 的范围, 存成字符串
+        return f'{st.st_dev}:{st.st_ino}'
+
+    def get(self, st) -> Optional[str]:
+        file_id = self.file_id(st)
+        self.seen.add(file_id)
+        cached = self.cached.get(file_id)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        return None
+
+    def put(self, st, md5):
+        self.updates[self.file_id(st)] = (st.st_size, st.st_mtime_ns, md5)
+
+    def save(self, prune=False):
+        """
+        @param prune: 是否删掉这次没有遍历到的文件的缓存, 只有遍历了整个工作区的时候才能删
+        """
+        if self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany('insert or replace into checksum values (?, ?, ?, ?)',
+                                      [(file_id, *value) for file_id, value in self.updates.items()])
+                if prune:
+                    self.conn.executemany('delete from checksum where file_id = ?',
+                                          [(file_id, ) for file_id in self.cached.keys() - self.seen])
+        except sqlite3.Error:
+            pass
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
 # 默认忽略文件
 default_ignored_patterns = [
     '.vscode',
@@ -178,14 +251,31 @@ def get_ignored_pattern(hfignore_path):
     return patterns
 
 
+def compile_ignored_pattern(patterns):
+    """
+    把 get_ignored_pattern 得到的所有 pattern 合成一个正则, 一次 match 判断是否被忽略
+    """
+    return re.compile('|'.join(f'(?:{fnmatch.translate(p)})' for p in patterns) or r'(?!)')
+
+
 def is_file_ignored(abspath, base_path, patterns, no_hfignore=False):
     if no_hfignore:
         return False
     subpath = abspath[len(base_path):]
     subpath = subpath.lstrip(os.path.sep)
+    if isinstance(patterns, re.Pattern):
+        return patterns.match(subpath) is not None
     return any(fnmatch.fnmatch(subpath, p) for p in patterns)
 
 
+def is_hfai_internal_file(fullpath):
+    """ .hfai 目录下打包用的 zip 和 md5 缓存不需要同步 """
+    if os.path.dirname(fullpath).split('/')[-1] != '.hfai':
+        return False
+    filename = os.path.basename(fullpath)
+    return '.zip' in filename or filename.startswith(checksum_cache_file)
+
+
 def get_file_info(file_path, base_path, no_checksum, directio=False):
     key = file_path[len(base_path):].replace('//', '/').replace('\\', '/').lstrip('/')
     size = os.path.getsize(file_path)
@@ -201,6 +291,41 @@ def get_file_info(file_path, base_path, no_checksum, directio=False):
                         md5=md5)
 
 
+def get_file_infos(entries, base_path, no_checksum, directio=False, cache: Optional[ChecksumCache] = None):
+    """
+    批量获取文件详情, md5 先查缓存, 没命中的用线程池并行计算
+    @param entries: [(文件路径, os.stat 结果)]
+    @return: FileInfo列表, 计算 md5 时被删除的文件不返回
+    """
+    infos = [
+        FileInfo(path=file_path[len(base_path):].replace('//', '/').replace('\\', '/').lstrip('/'),
+                 size=st.st_size,
+                 last_modified=datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M:%S'))
+        for file_path, st in entries
+    ]
+    if no_checksum:
+        return infos
+    todo = []
+    for info, (file_path, st) in zip(infos, entries):
+        info.md5 = cache.get(st) if cache is not None else None
+        if info.md5 is None:
+            todo.append((info, file_path, st))
+
+    def _md5(item):
+        _, file_path, st = item
+        try:
+            return calculate_md5(file_path, st.st_size, directio)
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=checksum_workers) as pool:
+        for (info, _, st), md5 in zip(todo, pool.map(_md5, todo)):
+            info.md5 = md5
+            if md5 is not None and cache is not None:
+                cache.put(st, md5)
+    return [info for info in infos if info.md5 is not None]
+
+
 def list_local_files_inner(base_path, subpath, no_checksum=False, no_hfignore=False, recursive=True, directio=False):
     """
     获取本地文件详情列表
@@ -217,7 +342,7 @@ def list_local_files_inner(base_path, subpath, no_checksum=False, no_hfignore=Fa
     if not root_path.startswith(base_path):
         return ret
     subpath = root_path[len(base_path):]
-    patterns = get_ignored_pattern(f'{base_path}/.hfignore')
+    patterns = compile_ignored_pattern(get_ignored_pattern(f'{base_path}/.hfignore'))
 
     if not os.path.exists(root_path):
         return ret
@@ -230,21 +355,27 @@ def list_local_files_inner(base_path, subpath, no_checksum=False, no_hfignore=Fa
             ret.append(info)
             return ret
 
-        for filepath, _, files in os.walk(root_path):
-            if is_file_ignored(filepath, base_path, patterns, no_hfignore):
-                continue
+        entries = []
+        for filepath, dirs, files in os.walk(root_path):
+            # 目录被忽略的话目录下所有内容都被忽略 (见 get_ignored_pattern), 不用往下遍历
+            dirs[:] = [d for d in dirs if not is_file_ignored(os.path.join(filepath, d), base_path, patterns, no_hfignore)]
             for filename in files:
                 fullpath = os.path.join(filepath, filename)
-                if os.path.dirname(fullpath).split('/')[-1] == '.hfai' and '.zip' in os.path.basename(fullpath):
+                if is_hfai_internal_file(fullpath):
                     continue
                 if is_file_ignored(fullpath, base_path, patterns, no_hfignore):
                     continue
                 try:
-                    info = get_file_info(fullpath, base_path, no_checksum, directio)
+                    entries.append((fullpath, os.stat(fullpath)))
                 except FileNotFoundError as e:
                     # print(f'本地文件 {fullpath} 被删除或链接不存在，忽略: {str(e)}')
                     continue
-                ret.append(info)
+        cache = None if no_checksum else ChecksumCache(base_path)
+        try:
+            ret = get_file_infos(entries, base_path, no_checksum, directio, cache)
+        finally:
+            if cache is not None:
+                cache.save(prune=root_path == base_path)
     else:
         # 该分支仅给前端展示用
         if os.path.isfile(root_path):
@@ -0,0 +1,37 @@
+-- task_runtime_config 变化时 touch 一下对应的任务行，让 scheduler 增量获取 task_df 时能通过 xmin 感知到
+-- 只有 beater 打开了增量模式才 touch (beater 启动时写 multi_server_config 里 module = 'beater' 的 task_df_incremental)
+-- 按语句触发，beater / matcher logger 一条语句批量 upsert 几千行也只查一次开关，config_json 没变的行不 touch
+create or replace function touch_unfinished_task_by_runtime_config()
+returns trigger as $$
+begin
+    if not coalesce((select "value" = 'true'::jsonb from "multi_server_config" where "module" = 'beater' and "key" = 'task_df_incremental'), false) then
+        return null;
+    end if;
+    if tg_op = 'INSERT' then
+        update "unfinished_task_ng" set "id" = "id"
+        where "id" in (select "task_id" from "new_rows") or "chain_id" in (select "chain_id" from "new_rows");
+    elsif tg_op = 'DELETE' then
+        update "unfinished_task_ng" set "id" = "id"
+        where "id" in (select "task_id" from "old_rows") or "chain_id" in (select "chain_id" from "old_rows");
+    else
+        -- 只 touch config_json 真的变了的行，新旧两边都算 (update 改了 task_id / chain_id 的话两边都要 touch)
+        with "changed" as (
+            (select "task_id", "chain_id", "source", "config_json" from "new_rows"
+             except select "task_id", "chain_id", "source", "config_json" from "old_rows")
+            union all
+            (select "task_id", "chain_id", "source", "config_json" from "old_rows"
+             except select "task_id", "chain_id", "source", "config_json" from "new_rows")
+        )
+        update "unfinished_task_ng" set "id" = "id"
+        where "id" in (select "task_id" from "changed") or "chain_id" in (select "chain_id" from "changed");
+    end if;
+    return null;
+end;
+$$ language 'plpgsql';
+-- 带 transition table 的 trigger 只能对应一种操作，分成三个
+create trigger trigger_touch_unfinished_task_by_runtime_config_insert after insert on "task_runtime_config"
+    referencing new table as "new_rows" for each statement execute procedure touch_unfinished_task_by_runtime_config();
+create trigger trigger_touch_unfinished_task_by_runtime_config_update after update on "task_runtime_config"
+    referencing old table as "old_rows" new table as "new_rows" for each statement execute procedure touch_unfinished_task_by_runtime_config();
+create trigger trigger_touch_unfinished_task_by_runtime_config_delete after delete on "task_runtime_config"
+    referencing old table as "old_rows" for each statement execute procedure touch_unfinished_task_by_runtime_config();
@@ -0,0 +1,47 @@
+-- user data 漫游 CDC 模式: 相关的表有变动时通过 notify 推送给 sync point
+-- 行级触发器的参数是主键列, 推送变动行的主键; 没有参数 (语句级触发器) 时只推送表名, sync point 会同步整张表
+create or replace function notify_user_data_change()
+returns trigger as $$
+declare
+    row_keys jsonb := '[]'::jsonb;
+    row_json jsonb;
+    row_key jsonb;
+    col text;
+begin
+    if tg_level = 'STATEMENT' or tg_nargs = 0 then
+        perform pg_notify('user_data_change', jsonb_build_object('table', tg_table_name)::text);
+        return null;
+    end if;
+    -- update 可能修改了主键, 新旧主键都推送
+    foreach row_json in array array[to_jsonb(old), to_jsonb(new)] loop
+        continue when row_json is null;
+        row_key := '[]'::jsonb;
+        foreach col in array tg_argv loop
+            row_key := row_key || jsonb_build_array(row_json -> col);
+        end loop;
+        row_keys := row_keys || jsonb_build_array(row_key);
+    end loop;
+    perform pg_notify('user_data_change', jsonb_build_object('table', tg_table_name, 'keys', row_keys)::text);
+    return null;
+end;
+$$ language 'plpgsql';
+
+-- user 表的 last_activity 更新很频繁, 且不在漫游的列里, 只有漫游的列变化时才推送
+create trigger trigger_notify_user_data_change_user after insert or delete on "user" for each row execute procedure notify_user_data_change('user_id');
+create trigger trigger_notify_user_data_change_user_update after update on "user" for each row
+    when ((old."user_id", old."user_name", old."token", old."role", old."active", old."shared_group", old."nick_name")
+        is distinct from (new."user_id", new."user_name", new."token", new."role", new."active", new."shared_group", new."nick_name"))
+    execute procedure notify_user_data_change('user_id');
+create trigger trigger_notify_user_data_change_user_truncate after truncate on "user" for each statement execute procedure notify_user_data_change();
+
+create trigger trigger_notify_user_data_change_quota after insert or update or delete on "quota" for each row execute procedure notify_user_data_change('user_name', 'resource');
+create trigger trigger_notify_user_data_change_quota_truncate after truncate on "quota" for each statement execute procedure notify_user_data_change();
+
+create trigger trigger_notify_user_data_change_train_environment after insert or update or delete on "train_environment" for each row execute procedure notify_user_data_change('env_name');
+create trigger trigger_notify_user_data_change_train_environment_truncate after truncate on "train_environment" for each statement execute procedure notify_user_data_change();
+
+-- 没有主键的表, 以及 user_all_groups 物化视图依赖的 user_group 表, 按语句推送
+create trigger trigger_notify_user_data_change_user_group after insert or update or delete or truncate on "user_group" for each statement execute procedure notify_user_data_change();
+create trigger trigger_notify_user_data_change_user_access_token after insert or update or delete or truncate on "user_access_token" for each statement execute procedure notify_user_data_change();
+create trigger trigger_notify_user_data_change_storage after insert or update or delete or truncate on "storage" for each statement execute procedure notify_user_data_change();
+create trigger trigger_notify_user_data_change_train_image after insert or update or delete or truncate on "train_image" for each statement execute procedure notify_user_data_change();
@@ -1,12 +1,10 @@
-import json
 import os
 import time
 
-from conf import CONF
 from base_model.training_task import TrainingTask
-from conf.flags import EXP_STATUS
 from db import redis_conn
-from experiment_manager.manager.manager_utils import waiting_exit, get_log_uuid
+from experiment_manager.manager.manager_utils import waiting_exit, get_log_uuid, managed_by_multi_task_manager, exit_for_multi_task_manager
+from experiment_manager.manager.task_lifecycle import TaskLifecycle
 from server_model.user_data import initialize_user_data_roaming
 from k8s import get_custom_corev1_api
 
@@ -18,6 +16,9 @@ from server_model.selector import TrainingTaskSelector
 
 module = os.path.basename(__file__)
 log_id = get_log_uuid(module)
+with logger.contextualize(uuid=f'{log_id}.enter_exit'):
+    if managed_by_multi_task_manager(module):
+        exit_for_multi_task_manager()
 with logger.contextualize(uuid=f'{log_id}.init'):
     task_id = int(os.environ['TASK_ID'])
     if redis_conn.get(f'manager_ban:{task_id}') == b'1':
@@ -30,40 +31,34 @@ with logger.contextualize(uuid=f'{log_id}.init'):
     k8s_namespace = task.user.config.task_namespace
     bind_logger_task(task)
     register_archive(task, sign='id')
+    lifecycle = TaskLifecycle(task, log_id)
 
 
 @log_stage(log_id)
 def check_resource_released():
-    unreleased_pods = {pod.pod_id for pod in task.re_pods().pods if pod.status not in EXP_STATUS.FINISHED}
+    unreleased_pods = lifecycle.unreleased_pods()
     pods_name = []
     try:
-        pods_name = json.loads(redis_conn.get('active_pods_name').decode())
         redis_time = float(redis_conn.get('active_pods_time').decode())
         if time.time() - redis_time > 10:  # 缓存已超时
-            redis_conn.set('active_pods_time', time.time())  # 让其它manager先用以前的cache，这个manager来负责更新
+            # k8swatcher 没有在更新 active_pods，不能刷新 active_pods_time 让其它 manager 继续用旧的缓存，各自去查 k8s
             raise Exception
-        else:  # 缓存没有超时，可以继续拿缓存的
-            if unreleased_pods & set(pods_name) != unreleased_pods:  # 缓存里存活的pod没有包含未释放的pod
-                logger.debug(f'task {task_id}缓存里存活的pod没有包含未释放的pod')
+        else:  # 缓存没有超时，可以继续拿缓存的，只查这个任务的 pod 在不在
+            unreleased_pods_list = list(unreleased_pods)
+            with redis_conn.pipeline(transaction=False) as pipe:
+                for pod_name in unreleased_pods_list:
+                    pipe.sismember('active_pods', pod_name)
+                pods_name = [pod_name for pod_name, active in zip(unreleased_pods_list, pipe.execute()) if active]
     except Exception as e:
         try:
+            # active_pods 由 k8swatcher 增量维护，这里只查了这个 namespace，只用查到的结果，不回写
             k8s_pods = custom_k8s_api.list_namespaced_pod_with_retry(namespace=k8s_namespace, label_selector='compute_node=true,type!=manager', resource_version='0')
             pods_name = [k8s_pod['metadata']['name'] for k8s_pod in k8s_pods['items']]
-            redis_conn.set('active_pods_time', time.time())
-            redis_conn.set('active_pods_name', json.dumps(pods_name))
         except Exception as e:
             logger.exception(e)
             logger.f_error(f'manager因为{e}挂了，自杀manager，请系统组检查')
             os._exit(1)
-    reported_pods = unreleased_pods - set(pods_name)
-
-    for reported_pod in reported_pods:
-        logger.info(f'发现{reported_pod}已经结束，该pod正式进入结束状态')  # 更改pod状态
-        task.update_pod_status(rank=int(reported_pod.split('-')[-1]), status='terminated')
-    if len(unreleased_pods) == 0:  # 所有pod都结束了
-        logger.info('发送stop manager')  # 加进日志大盘里
-        redis_conn.lpush(f'{CONF.manager.stop_channel}:{task.id}', json.dumps({'action': 'stop_manager'}))
-        redis_conn.expire(f'{CONF.manager.stop_channel}:{task.id}', 5 * 60)
+    lifecycle.release_pods(unreleased_pods, pods_name)
 
     return False
 
@@ -1,6 +1,7 @@
 import asyncio
 import json
 import os
+import sys
 import time
 
 from conf import CONF
@@ -8,6 +9,8 @@ from server_model.selector import BaseTaskSelector
 from server_model.auto_task_impl import AutoTaskSchemaImpl
 from logm import logger, bind_logger_task
 from db import redis_conn
+from experiment_manager.manager.task_lifecycle import MULTI_TASK_LABEL
+from k8s import get_corev1_api
 
 
 loop = asyncio.new_event_loop()
@@ -18,6 +21,8 @@ task = BaseTaskSelector.find_one(AutoTaskSchemaImpl, id=task_id)
 bind_logger_task(task)
 user_name = task.user_name
 n_module = None
+# manager pod 打了 multi_task_manager label 的任务，这些模块由 multi_task_manager.py 统一处理
+MULTI_TASK_MODULES = ['check_running.py', 'check_resource_released.py', 'check_unschedulable.py', 'stop_func.py', 'suspend_func.py']
 
 
 def setup_n_module(module):
@@ -47,12 +52,32 @@ def get_log_uuid(module):
     return f'#{task_id}#{module}#{setup_n_module(module)}'
 
 
+def managed_by_multi_task_manager(module):
+    """
+    任务的 manager pod 上打了 multi_task_manager label，这个模块就由多任务 manager 处理，不用在 pod 里跑了
+    launcher 通过 downward api 把 label 放在 MULTI_TASK_MANAGER 环境变量里，之前起的 manager pod 没有这个环境变量，直接查 pod
+    """
+    if module not in MULTI_TASK_MODULES:
+        return False
+    label = os.environ.get('MULTI_TASK_MANAGER')
+    if label is None:
+        pod = get_corev1_api().read_namespaced_pod_with_retry(f'{os.environ["MANAGER_NAME"]}-0', os.environ['NAMESPACE'])
+        label = (pod.metadata.labels or {}).get(MULTI_TASK_LABEL)
+    return label == 'true'
+
+
 def waiting_exit():
     logger.info(f'waiting for stop container...')
     while True:
         time.sleep(1000)
 
 
+def exit_for_multi_task_manager():
+    # 新的 manager pod 里 supervisord 不会启动这几个模块，这里是没有 MULTI_TASK_MANAGER 环境变量的 pod，直接退出，exitcodes=0 不会被拉起
+    logger.info('由 multi_task_manager 管理，退出')
+    sys.exit(0)
+
+
 def kill_all_manager_process():
     # 需要，重启 manager 相关的所有进程来处理异常，我们把他们杀掉，然后由 systemd 来处理
     os.system(
@@ -0,0 +1,390 @@
+"""
+多任务 manager：一个进程按 task_id 分片管理多个任务，代替每个任务 manager pod 里的
+check_running / check_resource_released / check_unschedulable / stop_func / suspend_func 这几个进程
+所有任务共用一个 pod list-watch、一个 redis 连接池，每个任务的逻辑跑在 asyncio 的协程里，阻塞的 db / k8s 调用丢到线程池
+check_logs 和 client_responder 要在任务自己的 manager pod 上监听端口，仍然留在任务的 manager pod 里
+只管理 manager pod 上打了 multi_task_manager label 的任务，各个检查的逻辑和单任务 manager 共用 task_lifecycle.py
+"""
+import asyncio
+import os
+import time
+from typing import Dict
+
+import munch
+import ujson
+import zmq
+import zmq.asyncio
+
+from conf import CONF
+from base_model.training_task import TrainingTask
+from conf.flags import EXP_STATUS, STOP_CODE
+from db import a_redis
+from experiment_manager.manager.task_lifecycle import TaskLifecycle, MULTI_TASK_LABEL
+from k8s import get_corev1_api, get_custom_corev1_api
+from k8s_watcher.base import ListWatcher
+from logm import logger, log_stage
+from roman_parliament import register_archive, set_mass_info, register_parliament, update_mass_key_list, \
+    remove_archive_locally
+from roman_parliament.utils import generate_key
+from server_model.auto_task_impl import AutoTaskSchemaWithDbImpl
+from server_model.selector import TrainingTaskSelector
+from server_model.user_data import initialize_user_data_roaming
+from utils import asyncwrap
+
+module = 'multi_task_manager'
+SHARD = int(os.environ.get('REPLICA_RANK', 0))
+SHARDS = int(CONF.try_get('manager.multi_task.shards', default=1))
+log_id = f'{module}_{SHARD}'
+
+
+class ManagedTask(object):
+    """
+    一个任务在多任务 manager 里的协程，具体的处理和单任务 manager 的各个脚本一样，都在 TaskLifecycle 里
+    """
+
+    def __init__(self, manager, task_id: int):
+        self.manager = manager
+        self.task_id = task_id
+        self.task = None
+        self.lifecycle = None
+        self.log_id = f'#{task_id}#{module}#{SHARD}'
+        self.stop_channel = f'{CONF.manager.stop_channel}:{task_id}'
+        self.suspend_channel = f'{CONF.manager.stop_channel}:suspend:{task_id}'
+        self.pod_events = asyncio.Queue()
+        self.signals = {self.stop_channel: asyncio.Queue(), self.suspend_channel: asyncio.Queue()}
+        # 还在订阅 suspend 信号，suspend_func 只处理第一个信号
+        self.waiting_suspend = True
+        self.pod_versions = {}
+        self.releasing = False
+        self.banned = False
+        self.coroutines = []
+        self.start_time = time.time()
+
+    def run_sync(self, func, *args, **kwargs):
+        return asyncwrap(func)(*args, **kwargs)
+
+    def spawn(self, coro, stage):
+        async def wrapper():
+            with logger.contextualize(uuid=f'{self.log_id}.{stage}'):
+                try:
+                    await coro
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.exception(e)
+                    logger.error(f'{stage} 出错: {e}')
+        self.coroutines.append(asyncio.ensure_future(wrapper()))
+
+    def load_task(self):
+        self.task = TrainingTaskSelector.find_one_by_id(AutoTaskSchemaWithDbImpl, id=self.task_id)
+        register_archive(self.task, sign='id')
+        self.lifecycle = TaskLifecycle(self.task, self.log_id)
+        return self.task
+
+    async def start(self):
+        with logger.contextualize(uuid=f'{self.log_id}.init'):
+            await self.run_sync(self.load_task)
+            self.banned = await a_redis.get(f'manager_ban:{self.task_id}') == b'1'
+            logger.info(f'开始管理任务 {self.task.job_info}, manager_ban: {self.banned}')
+        self.spawn(self.stop_loop(), 'stop_loop')
+        if self.banned:
+            # 和单任务 manager 一样，被 ban 之后只剩 stop_func 在处理信号
+            self.waiting_suspend = False
+            return
+        self.spawn(self.monitor_loop(), 'monitor_loop')
+        self.spawn(self.check_timeout(), 'check_timeout')
+        self.spawn(self.check_unschedulable(), 'check_unschedulable')
+        self.spawn(self.check_suspend(), 'waiting_signal')
+
+    def cancel(self):
+        for coroutine in self.coroutines:
+            coroutine.cancel()
+
+    def on_pod_event(self, pod):
+        # list 重放和 watch 事件可能重复，同一个版本只处理一次
+        name, version = pod['metadata']['name'], pod['metadata'].get('resourceVersion')
+        if self.pod_versions.get(name) == version:
+            return
+        self.pod_versions[name] = version
+        self.pod_events.put_nowait(pod)
+
+    def compute_pods(self):
+        # 在事件循环里取一份快照，线程池里的函数不直接读会被修改的 pod 列表
+        return list(self.manager.task_pods.get(self.task_id, {}).values())
+
+    async def send_stop_signals(self, signals):
+        for signal in signals:
+            await a_redis.lpush(self.stop_channel, ujson.dumps(signal))
+
+    # ------------------------------ check_running ------------------------------
+    async def monitor_loop(self):
+        total_num = len(self.task.assigned_nodes)
+        if len([pod for pod in self.task.pods if pod.status in EXP_STATUS.FINISHED]) == total_num:
+            logger.warning(f'一开始就发现所有pod都在终态，不再检查 running 了')
+            return
+        k8s_pods = self.compute_pods()
+        for pod in k8s_pods:
+            self.pod_versions[pod['metadata']['name']] = pod['metadata'].get('resourceVersion')
+        if not await self.run_sync(self.lifecycle.check_pod_disappeared, k8s_pods):
+            return
+        first_sleep = True
+        while True:
+            pod = await self.pod_events.get()
+            try:
+                status, pod_id, message = self.lifecycle.pod_status(pod)
+                logger.info(f'new event ---- status: {status}; pod_id: {pod_id}; message: {message}')
+                signals, done = await self.run_sync(self.lifecycle.handle_pod_status, pod_id, status)
+            except Exception as e:
+                logger.info(f'ignored exception: {str(e)}')
+                continue
+            # 先等 5 秒，等其它可能的 fail 态节点被观察到
+            if status == EXP_STATUS.FAILED and signals and first_sleep:
+                await self.send_zmq(5779, 'worker_exited', wait_reply=False)
+                await asyncio.sleep(5)
+                first_sleep = False
+            await self.send_stop_signals(signals)
+            if done:
+                return
+
+    async def check_timeout(self):
+        """
+        检查任务是不是超过了预设运行时间
+        """
+        if self.task.schema.get('options', {}).get('timeout', -1) > 0:
+            rest_seconds = int(self.task.schema['options']['timeout'] - (time.time() - self.task.begin_at.timestamp()))
+            if rest_seconds > 0:
+                await asyncio.sleep(rest_seconds)
+            logger.info(f'发现{self.task_id} 运行超时了（设定运行时间 {self.task.schema["options"]["timeout"]}s），发送stop信号尝试关闭该任务')
+            await self.send_stop_signals([{'action': 'stop', 'flag': STOP_CODE.STOP}])
+
+    # ------------------------------ check_unschedulable ------------------------------
+    async def check_unschedulable(self):
+        timeout_Ms = float(CONF.manager.get('unschedulable_timeout_Ms', 3))
+        await asyncio.sleep(max(0, 60 * timeout_Ms - (time.time() - self.start_time)))
+        await self.run_sync(self.lifecycle.mark_unschedulable, self.compute_pods(), timeout_Ms)
+
+    # ------------------------------ check_resource_released ------------------------------
+    def check_resource_released(self, alive_pod_ids):
+        """
+        和 k8s_watcher 一样靠共享的 pod 列表判断 pod 是否已经释放，兜底单点风险
+        """
+        self.lifecycle.release_pods(self.lifecycle.unreleased_pods(), alive_pod_ids)
+
+    async def release_resource(self):
+        if self.releasing or self.banned or self.task is None:
+            return
+        self.releasing = True
+        try:
+            with logger.contextualize(uuid=f'{self.log_id}.check_resource_released'):
+                await self.run_sync(self.check_resource_released, {pod['metadata']['name'] for pod in self.compute_pods()})
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.releasing = False
+
+    # ------------------------------ suspend_func ------------------------------
+    async def send_zmq(self, port, message, wait_reply=True):
+        """
+        给任务的 0 号 pod 发 zmq 消息，等回复最多 3 秒，和单任务 manager 的 recv_ignore_err 一样
+        """
+        if port not in self.manager.sockets.setdefault(self.task_id, {}):
+            socket = self.manager.zmq_context.socket(zmq.REQ)
+            socket.connect(f'tcp://{self.lifecycle.pod_prefix}-0:{port}')
+            self.manager.sockets[self.task_id][port] = socket
+        socket = self.manager.sockets[self.task_id][port]
+        await socket.send_string(message)
+        if wait_reply:
+            try:
+                await asyncio.wait_for(socket.recv(), timeout=3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def check_suspend(self):
+        info = await self.signals[self.suspend_channel].get()
+        self.waiting_suspend = False
+        await self.run_sync(self.lifecycle.record_suspend, info.stop_code)
+        await self.send_zmq(5778, 'set_suspend_flag')
+        sr_waiting_seconds = int(CONF.manager.suspend_waiting_seconds.recieved)
+        await asyncio.sleep(sr_waiting_seconds)
+        try:
+            await self.send_zmq(5778, 'destroy_suspend_flag')
+        except Exception:
+            logger.warning('可能已经被用户 go suspend 掉了')
+        msg = await self.run_sync(self.lifecycle.check_suspend_received, info.stop_code, sr_waiting_seconds)
+        await asyncio.sleep(int(CONF.manager.suspend_waiting_seconds.final))
+        await self.run_sync(self.lifecycle.force_suspend, info.stop_code, sr_waiting_seconds, msg)
+
+    # ------------------------------ stop_func ------------------------------
+    async def stop_loop(self):
+        await self.run_sync(self.lifecycle.check_finished_on_start)
+        while True:
+            info = await self.signals[self.stop_channel].get()
+            try:
+                if await self.run_sync(self.lifecycle.handle_stop_signal, info):
+                    self.manager.release(self.task_id)
+                    return
+            except Exception as e:
+                logger.exception(e)
+                logger.error(f'在做stop的时候出问题了，请尽快检查: {e}')
+                # 单任务 manager 这时候会重启所有进程，这里把任务放掉，下次 reconcile 重新接管
+                self.manager.release(self.task_id, readopt=True)
+                return
+
+
+class TaskPodListWatcher(ListWatcher):
+    """
+    多任务 manager 共用的 pod list-watch，事件转给 asyncio 里的 MultiTaskManager
+    """
+
+    def __init__(self, manager, namespaces, process_interval=10):
+        list_watch_funcs = {'default': (get_custom_corev1_api().list_namespaced_pod, get_corev1_api().list_namespaced_pod)}
+        super().__init__('pod', list_watch_funcs, namespaces, label_selector='task_id', process_interval=process_interval)
+        self.manager = manager
+
+    def on_event(self, index, event):
+        self.manager.loop.call_soon_threadsafe(self.manager.on_pod_event, event['type'], event['object'])
+
+    def process(self):
+        pods = {name: pod for data in list(self._data.values()) for name, pod in list(data.items())}
+        self.manager.loop.call_soon_threadsafe(self.manager.reconcile, pods)
+
+
+class MultiTaskManager(object):
+    def __init__(self, shard=SHARD, shards=SHARDS):
+        self.shard = shard
+        self.shards = shards
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.zmq_context = zmq.asyncio.Context()
+        self.sockets: Dict[int, Dict[int, zmq.asyncio.Socket]] = {}
+        self.tasks: Dict[int, ManagedTask] = {}
+        # 被放掉的任务，manager pod 删掉之前不再接管
+        self.released = set()
+        self.task_pods: Dict[int, Dict[str, dict]] = {}
+        self.mass_update_scheduled = False
+        self.watcher = TaskPodListWatcher(self, list(CONF.launcher.task_namespaces_by_role.values()),
+                                          process_interval=int(CONF.try_get('manager.multi_task.process_interval', default=10)))
+
+    def owned_manager_pod(self, pod):
+        labels = pod['metadata'].get('labels', {})
+        return labels.get('type') == 'manager' and labels.get(MULTI_TASK_LABEL) == 'true' \
+            and int(labels['task_id']) % self.shards == self.shard
+
+    def adopt(self, pod):
+        # manager pod Running 说明 init_manager 已经跑完，任务的 pod 都创建好了
+        task_id = int(pod['metadata']['labels']['task_id'])
+        if task_id in self.tasks or task_id in self.released or pod.get('status', {}).get('phase') != 'Running':
+            return
+        managed = ManagedTask(self, task_id)
+        self.tasks[task_id] = managed
+        self.update_mass()
+        asyncio.ensure_future(managed.start())
+
+    def release(self, task_id, readopt=False):
+        managed = self.tasks.pop(task_id, None)
+        if managed is None:
+            return
+        if not readopt:
+            self.released.add(task_id)
+        managed.cancel()
+        for socket in self.sockets.pop(task_id, {}).values():
+            socket.close(linger=0)
+        if managed.task is not None:
+            remove_archive_locally(managed.task)
+        self.update_mass()
+
+    def update_mass(self):
+        # 一次 reconcile 可能接管很多任务，合并成一次更新
+        if self.mass_update_scheduled:
+            return
+        self.mass_update_scheduled = True
+
+        def flush():
+            self.mass_update_scheduled = False
+            update_mass_key_list([generate_key(class_name=TrainingTask.__name__, sign='id', value=task_id) for task_id in self.tasks])
+        self.loop.call_soon(flush)
+
+    def index_pods(self, pods):
+        task_pods = {}
+        for name, pod in pods.items():
+            labels = pod['metadata'].get('labels', {})
+            if str(labels.get('task_id', '')).isdigit() and labels.get('type') != 'manager':
+                task_pods.setdefault(int(labels['task_id']), {})[name] = pod
+        return task_pods
+
+    def on_pod_event(self, event_type, pod):
+        name = pod['metadata']['name']
+        labels = pod['metadata'].get('labels', {})
+        if not str(labels.get('task_id', '')).isdigit():
+            return
+        task_id = int(labels['task_id'])
+        if labels.get('type') == 'manager':
+            if self.owned_manager_pod(pod) and event_type != 'DELETED':
+                self.adopt(pod)
+            return
+        if event_type == 'DELETED':
+            self.task_pods.get(task_id, {}).pop(name, None)
+        else:
+            self.task_pods.setdefault(task_id, {})[name] = pod
+        if (managed := self.tasks.get(task_id)) is not None:
+            managed.on_pod_event(pod)
+
+    def reconcile(self, pods):
+        self.task_pods = self.index_pods(pods)
+        manager_pods = {
+            int(pod['metadata']['labels']['task_id']): pod for pod in pods.values()
+            if str(pod['metadata'].get('labels', {}).get('task_id', '')).isdigit() and self.owned_manager_pod(pod)
+        }
+        self.released &= set(manager_pods)
+        for pod in manager_pods.values():
+            self.adopt(pod)
+        for task_id in list(self.tasks):
+            if task_id not in manager_pods:
+                logger.info(f'任务 {task_id} 的 manager 已经删除，不再管理')
+                self.release(task_id)
+        for managed in self.tasks.values():
+            for pod in managed.compute_pods():
+                managed.on_pod_event(pod)
+            asyncio.ensure_future(managed.release_resource())
+
+    async def signal_loop(self):
+        """
+        所有任务的 stop / suspend 信号用一个 brpop 订阅，收到之后交给对应任务的协程
+        """
+        while True:
+            channels = {}
+            for managed in self.tasks.values():
+                channels[managed.stop_channel] = managed
+                if managed.waiting_suspend:
+                    channels[managed.suspend_channel] = managed
+            if not channels:
+                await asyncio.sleep(1)
+                continue
+            try:
+                result = await a_redis.brpop(list(channels), timeout=1)
+            except Exception as e:
+                logger.exception(e)
+                logger.error(f'订阅 stop 信号出错: {e}')
+                await asyncio.sleep(1)
+                continue
+            if result is None:
+                continue
+            channel, value = result[0].decode(), result[1].decode()
+            if (managed := channels.get(channel)) is None or managed.task_id not in self.tasks:
+                logger.warning(f'{channel} 收到 {value} 的时候任务已经不归这个 manager 管了')
+                continue
+            managed.signals[channel].put_nowait(munch.Munch.fromJSON(value))
+
+    @log_stage(log_id)
+    def run(self):
+        logger.info(f'启动多任务 manager，分片 {self.shard} / {self.shards}')
+        initialize_user_data_roaming(overwrite_enable_roaming=False)
+        set_mass_info(key_list=[], mass_name=f'{module}_{self.shard}')
+        register_parliament()
+        self.watcher.run()
+        self.loop.run_until_complete(self.signal_loop())
+
+
+if __name__ == '__main__':
+    # 是否交给这里管理看任务 manager pod 上的 label，manager.multi_task.enabled 关掉之后之前起的任务也要继续管到结束
+    MultiTaskManager().run()
@@ -0,0 +1,153 @@
+"""
+manager 上接收训练进程 runtime 调用的服务, 协议见 conf/runtime_channel.py:
+  - 一个 asyncio 线程处理所有连接, 长连接和老的一次一连接的协议共用一个端口
+  - handler 会访问数据库 / redis, 放到有上限的线程池里跑
+  - 相同的调用 (source 和参数都一样, 比如所有 rank 一起 receive_suspend_command) 正在跑的时候合并成一次, 直接等它的结果
+  - CACHED_AFTER_FINISH 里的调用刚跑完 coalesce_seconds 秒内也直接返回上次的结果 (中间没有同名的其他参数的调用),
+    其他调用的结果会变 (比如 receive_suspend_command), 跑完之后再来的要重新跑
+"""
+import asyncio
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple
+
+from conf.runtime_channel import CHANNEL_MAGIC, FRAME_HEADER
+from logm import logger
+
+
+# 合并调用时不看的参数, 比如不同 rank 报告同一个 commit 只需要处理一次
+COALESCE_IGNORED_FIELDS = {
+    'report_git_revision': {'rank'},
+}
+# 跑完之后在 coalesce_seconds 秒内再来还是同样的结果的调用, 重复跑没有意义: 第一次上报的 commit 才会记下来, 打断只要做一次
+CACHED_AFTER_FINISH = {'report_git_revision', 'go_suspend'}
+
+
+def coalesce_key(data: dict) -> Tuple[str, bytes]:
+    ignored = COALESCE_IGNORED_FIELDS.get(data['source'], ())
+    return data['source'], pickle.dumps(sorted((k, v) for k, v in data.items() if k not in ignored))
+
+
+class RuntimeServer(threading.Thread):
+
+    def __init__(self, port: int, handlers: Dict[str, Callable], workers: int = 16, coalesce_seconds: float = 10,
+                 backlog: int = 4096):
+        super(RuntimeServer, self).__init__(name='runtime-server')
+        self.port = port
+        self.handlers = handlers
+        self.coalesce_seconds = coalesce_seconds
+        self.backlog = backlog
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='runtime-handler')
+        self.loop = None
+        self.ready = threading.Event()
+        # key -> 正在跑的调用; key -> (结束时间, 结果); source -> 最近一次开始跑的 key
+        self.inflight: Dict[Tuple[str, bytes], asyncio.Future] = {}
+        self.finished: Dict[Tuple[str, bytes], Tuple[float, dict]] = {}
+        self.last_key: Dict[str, Tuple[str, bytes]] = {}
+        self.stats = {'requests': 0, 'executed': 0, 'coalesced': 0, 'connections': 0}
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, '0.0.0.0', self.port, backlog=self.backlog))
+        logger.info(f'启动成功，正开始监听: {self.port}')
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+
+    def execute(self, data: dict) -> Tuple[dict, bool]:
+        """
+        在线程池里跑 handler, 返回 (结果, 是否正常结束)
+        """
+        try:
+            return self.handlers[data['source']](**data), True
+        except Exception as e:
+            logger.error(f'用户调用 runtime 接口异常，data: {data}; exception: {e}')
+            return {
+                'success': 0,
+                'msg': '用户调用 runtime 接口异常，请联系管理员'
+            }, False
+
+    async def _run(self, key, data: dict) -> dict:
+        self.last_key[data['source']] = key
+        try:
+            self.stats['executed'] += 1
+            logger.info(f'收到 {data}')
+            result, ok = await self.loop.run_in_executor(self.executor, self.execute, data)
+            if ok and data['source'] in CACHED_AFTER_FINISH:
+                now = time.monotonic()
+                self.finished = {k: v for k, v in self.finished.items() if now - v[0] < self.coalesce_seconds}
+                self.finished[key] = (now, result)
+            return result
+        finally:
+            self.inflight.pop(key, None)
+
+    async def dispatch(self, b_data: bytes) -> dict:
+        self.stats['requests'] += 1
+        try:
+            data = pickle.loads(b_data)
+            key = coalesce_key(data)
+        except Exception as e:  # 传过来的消息不对
+            logger.error(f'解析出问题了，raw data: {b_data}; exception: {e}')
+            return {
+                'success': 0,
+                'msg': '数据解析出问题了，请联系管理员'
+            }
+        finished = self.finished.get(key)
+        if finished is not None and self.last_key.get(data['source']) == key \
+                and time.monotonic() - finished[0] < self.coalesce_seconds:
+            self.stats['coalesced'] += 1
+            return finished[1]
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = asyncio.ensure_future(self._run(key, data))
+        else:
+            self.stats['coalesced'] += 1
+        return await asyncio.shield(future)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        try:
+            # 老协议的请求和长连接的 CHANNEL_HELLO 都是 [8 字节总长度][payload]
+            head = await reader.readexactly(8)
+            b_data = await reader.readexactly(int(head) - len(head))
+            if b_data == CHANNEL_MAGIC:
+                writer.write(CHANNEL_MAGIC)
+                await self.serve_channel(reader, writer)
+            else:
+                writer.write(pickle.dumps(await self.dispatch(b_data)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f'处理 runtime 连接出错: {e}')
+        finally:
+            self.stats['connections'] -= 1
+            writer.close()
+
+    async def serve_channel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        drain_lock = asyncio.Lock()
+
+        async def respond(request_id, b_data):
+            result = pickle.dumps(await self.dispatch(b_data))
+            writer.write(FRAME_HEADER.pack(len(result), request_id) + result)
+            # 多个响应同时 drain 会出错
+            async with drain_lock:
+                await writer.drain()
+
+        tasks = set()
+        try:
+            while True:
+                length, request_id = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                task = asyncio.ensure_future(respond(request_id, await reader.readexactly(length)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # 连接断了, 还没回的请求不用再回了, 已经开始跑的 handler 不受影响 (shield)
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,399 @@
+"""
+任务 manager 各个检查的逻辑，单任务 manager pod 里的 check_running / check_resource_released / check_unschedulable /
+stop_func / suspend_func 和 multi_task_manager 共用
+这里只有同步的判断和对数据库、redis、k8s 的操作，pod 列表从哪来、什么时候调用、出错之后怎么处理由调用方决定
+"""
+from functools import wraps
+
+import ujson
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from conf import CONF, CONTAINER_NAME
+from conf.flags import EXP_STATUS, STOP_CODE, QUE_STATUS, SUSPEND_CODE, TASK_FLAG, TASK_TYPE, VALIDATION_TASK_FLAG
+from db import redis_conn, MarsDB
+from k8s import get_corev1_api, get_appsv1_api
+from k8s.podstate_utils import get_pod_state
+from logm import logger, log_stage
+from roman_parliament import cancel_archive, withdraw_parliament
+from server_model.auto_task_impl import AutoTaskSchemaImpl, AutoTaskSchemaWithDbImpl
+from server_model.selector import TrainingTaskSelector, BaseTaskSelector
+from server_model.task_impl import DbOperationImpl
+
+# 交给多任务 manager 管理的任务，launcher 在 manager pod 上打这个 label
+MULTI_TASK_LABEL = 'multi_task_manager'
+MANAGER_MODULES = ['check_logs', 'check_resource_released', 'check_running', 'check_unschedulable', 'stop_func',
+                   'suspend_func', 'init_manager', 'client_handler']
+
+s_code = STOP_CODE()
+pod_delete_option = client.V1DeleteOptions(
+    api_version='v1',
+    grace_period_seconds=CONF.manager.delete_pod.grace_period_seconds,
+    propagation_policy='Background'
+)
+
+
+def get_terminated_critical_sidecars(pod_state):
+    return [
+        (c, c_info['state']['terminated']['exitCode'])
+        for c, c_info in pod_state['details']['container_statuses'].items() if
+        c.endswith('-critical') and c_info['state'].get('terminated') is not None
+    ]
+
+
+def pod_rank(pod_id):
+    return int(pod_id.split('-')[-1])
+
+
+def lifecycle_stage(func):
+    """
+    和 log_stage(log_id) 一样, 日志的 uuid 是 {log_id}.{函数名}, log_id 跟着 TaskLifecycle 对象走
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return log_stage(self.log_id)(func)(self, *args, **kwargs)
+    return wrapper
+
+
+class TaskLifecycle(object):
+    """
+    一个任务的生命周期处理，状态 (已经结束的 pod、是否关过节点) 跟着对象走
+    """
+
+    def __init__(self, task, log_id):
+        self.task = task
+        self.log_id = log_id
+        self.task_id = task.id
+        self.pod_prefix = f'{task.user_name.replace("_", "-")}-{task.id}'
+        self.stop_channel = f'{CONF.manager.stop_channel}:{task.id}'
+        self.suspend_channel = f'{CONF.manager.stop_channel}:suspend:{task.id}'
+        self.finished_pod_ids = set()
+        self.pod_last_status = {}
+        self.stop_nodes_already_called = False
+
+    @property
+    def pod_ids(self):
+        return {f'{self.pod_prefix}-{i}' for i in range(len(self.task.assigned_nodes))}
+
+    def send_stop_signal(self, signal):
+        redis_conn.lpush(self.stop_channel, ujson.dumps(signal))
+
+    # ------------------------------ check_running ------------------------------
+    @staticmethod
+    def pod_status(pod):
+        """
+        返回 (状态, pod_id, message)，critical sidecar 退出了算 failed
+        """
+        pod_state = get_pod_state(pod_dict=pod, container_names=[CONTAINER_NAME])
+        status = pod_state['status']
+        pod_id = pod_state['details']['pod_name']
+        terminated_sidecars = get_terminated_critical_sidecars(pod_state)
+        if len(terminated_sidecars) > 0:
+            logger.info(f'查询到pod_id为{pod_id}的 terminated_sidecars: {terminated_sidecars}，将任务标记为失败')
+            status = EXP_STATUS.FAILED
+        return status, pod_id, pod_state['message']
+
+    def check_pod_disappeared(self, k8s_pods):
+        """
+        用刚 list 到的 pod 刷新状态，检查是否有pod已经退出了，如果有，则标记该任务failed
+        :return: 是否还需要继续看 pod 的状态
+        """
+        pod_ids = self.pod_ids
+        is_failed_or_stopped = False
+        watched_pod_ids = set()
+        for k8s_pod in k8s_pods:
+            job_status, pod_id, _ = self.pod_status(k8s_pod)
+            watched_pod_ids.add(pod_id)
+            # 这边会刷数据库
+            logger.info(f'查询到pod_id为{pod_id}的节点状态为{job_status}')
+            self.task.update_pod_status(rank=pod_rank(pod_id), status=job_status)
+            if job_status in [EXP_STATUS.STOPPED, EXP_STATUS.FAILED]:
+                self.finished_pod_ids.add(pod_id)
+                is_failed_or_stopped = True
+            if job_status == EXP_STATUS.SUCCEEDED:
+                self.finished_pod_ids.add(pod_id)
+                self.send_stop_signal({'action': 'stop_single_pod', 'pod_id': pod_id})
+
+        if len(self.finished_pod_ids) == len(pod_ids):  # 一开始就全部成功
+            logger.warning(f'在一开始就发现所有节点都到了终态，强制关闭该任务并释放资源')
+            self.send_stop_signal({'action': 'stop', 'flag': STOP_CODE.STOP})
+            return False
+
+        logger.info(f'查询在manager启动前就stop了的pod, 已经finished的pod: {self.finished_pod_ids}')
+        for unwatched_pod_id in pod_ids - watched_pod_ids - self.finished_pod_ids:
+            logger.info(f'pod_id为{unwatched_pod_id}的节点已经stop了')
+            # 只标记非manager删除的pod为stopped
+            self.task.update_pod_status(rank=pod_rank(unwatched_pod_id), status=EXP_STATUS.STOPPED)
+            is_failed_or_stopped = True
+
+        if is_failed_or_stopped:
+            logger.warning(f'在一开始就发现failed或者stopped或者没找到的节点，强制关闭该任务并释放资源')
+            for pod_id in pod_ids:
+                # 需要将所有任务标记为 EXP_STATUS.FINISHED
+                if pod_id not in self.finished_pod_ids:
+                    self.task.update_pod_status(rank=pod_rank(pod_id), status=EXP_STATUS.FAILED)
+            self.send_stop_signal({'action': 'stop', 'flag': STOP_CODE.INIT_FAILED})
+            return False
+        return True
+
+    def handle_pod_status(self, pod_id, status):
+        """
+        记录 pod 的新状态，返回 (要发的 stop 信号, 是否不用再看 pod 了)
+        信号由调用方发，failed 的时候调用方要先通知任务、等其它可能的 fail 态节点被观察到
+        """
+        self.task.update_pod_status(rank=pod_rank(pod_id), status=status)
+        signals, done = [], False
+        if status in EXP_STATUS.FINISHED:
+            # 防止多次运行，因为 pod 在进入终态的时候还是会多次调用
+            if pod_id in self.pod_last_status:
+                return signals, done
+            self.pod_last_status[pod_id] = status
+            self.finished_pod_ids.add(pod_id)
+            if len(self.finished_pod_ids) == len(self.task.assigned_nodes):
+                # 在多个节点的情况下，就是为 success 准备的
+                logger.info(f'发现所有节点都到了终态，任务容器应该在关闭了或者可以success退出了')
+                signals.append({'action': 'stop', 'flag': STOP_CODE.STOP})
+                done = True
+        if status in [EXP_STATUS.STOPPED, EXP_STATUS.FAILED]:
+            logger.info(f'发现{pod_id}处于{status}态，发送stop信号尝试关闭该任务')
+            signals.append({'action': 'stop', 'flag': STOP_CODE.FAILED if status == EXP_STATUS.FAILED else STOP_CODE.STOP})
+            done = True
+        if status in [EXP_STATUS.SUCCEEDED]:
+            signals.append({'action': 'stop_single_pod', 'pod_id': pod_id})
+        return signals, done
+
+    # ------------------------------ check_unschedulable ------------------------------
+    def mark_unschedulable(self, k8s_pods, timeout_Ms):
+        """
+        启动 timeout_Ms 分钟之后还没跑起来的 pod 标记为 failed，并发 stop 信号
+        """
+        logger.info('检查是否unschedulable')
+        blocked_pods = []
+        for k8s_pod in k8s_pods:
+            pod_state = get_pod_state(pod_dict=k8s_pod, container_names=[CONTAINER_NAME])
+            job_status = pod_state['status']
+            pod_id = pod_state['details']['pod_name']
+            logger.debug(f'unschedulable检查：查询到pod_id为{pod_id}的节点状态为{job_status}')
+            if job_status in [EXP_STATUS.CREATED, EXP_STATUS.BUILDING, EXP_STATUS.UNSCHEDULABLE]:
+                blocked_pods.append([pod for pod in self.task.pods if pod.pod_id == pod_id][0])
+        if not blocked_pods:
+            logger.debug(f'检查通过没有处于 UNSCHEDULABLE 的节点')
+            return
+        # 生成 msg 放在前面不然报警的时候会看不清楚
+        alert_msg = f'{self.task.job_info} 状态为 unschedulable，超过 {timeout_Ms} 分钟, 出错节点：{[p.node for p in blocked_pods]}，已经将该任务结束'
+        logger.error(f'{alert_msg}。将unschedulable的节点标记为failed并发送stop信号')
+        # 先标记成failed再stop
+        redis_conn.append(f'lifecycle:{self.task_id}:failed_msg', f'{alert_msg}\n')
+        for pod in blocked_pods:
+            self.task.update_pod_status(rank=int(pod.job_id), status=EXP_STATUS.FAILED)
+        logger.f_error(f'检查失败，有处于 UNSCHEDULABLE 的节点 ({[p.node for p in blocked_pods]})，将重启训练', task=self.task)
+        self.send_stop_signal({'action': 'stop', 'flag': STOP_CODE.UNSCHEDULABLE})
+
+    # ------------------------------ check_resource_released ------------------------------
+    def unreleased_pods(self):
+        return {pod.pod_id for pod in self.task.re_pods().pods if pod.status not in EXP_STATUS.FINISHED}
+
+    def release_pods(self, unreleased_pods, alive_pod_ids):
+        """
+        已经不在 k8s 里的 pod 正式进入结束状态，全都结束了就通知关闭 manager
+        """
+        for reported_pod in unreleased_pods - set(alive_pod_ids):
+            logger.info(f'发现{reported_pod}已经结束，该pod正式进入结束状态')  # 更改pod状态
+            self.task.update_pod_status(rank=pod_rank(reported_pod), status='terminated')
+        if len(unreleased_pods) == 0:  # 所有pod都结束了
+            logger.info('发送stop manager')  # 加进日志大盘里
+            self.send_stop_signal({'action': 'stop_manager'})
+            redis_conn.expire(self.stop_channel, 5 * 60)
+
+    # ------------------------------ suspend_func ------------------------------
+    def record_suspend(self, stop_code):
+        redis_conn.append(f'lifecycle:{self.task_id}:stop_code', f'{stop_code}\n')
+        logger.info('告知用户任务被打断')  # 这里要进日志大盘
+
+    def check_suspend_received(self, stop_code, waiting_seconds):
+        """
+        告知用户 waiting_seconds 秒之后调用，任务没有响应的话直接挂起，返回给日志的说明
+        """
+        task = BaseTaskSelector.find_one(AutoTaskSchemaImpl, id=self.task_id)
+        if task.suspend_code & TASK_FLAG.SUSPEND_CODE < SUSPEND_CODE.SUSPEND_RECEIVED:
+            msg = f'任务 {waiting_seconds}s 没有响应，我把它挂起'
+            self.send_stop_signal({'action': 'stop', 'flag': stop_code})
+        else:
+            msg = f'任务 {waiting_seconds}s 响应，知道将被挂起， code={task.suspend_code & TASK_FLAG.SUSPEND_CODE} '
+        logger.info(msg)  # 收到用户反馈或者没收到用户反馈
+        return msg
+
+    def force_suspend(self, stop_code, waiting_seconds, msg):
+        """
+        无论用户是否优雅保存，都直接挂起
+        """
+        task = BaseTaskSelector.find_one(AutoTaskSchemaImpl, id=self.task_id)  # 获取现在的suspend_code
+        if task.suspend_code & TASK_FLAG.SUSPEND_CODE == SUSPEND_CODE.SUSPEND_RECEIVED:  # 只收到，没go suspend
+            logger.info(f'{task.user_name}的任务{task.job_info}在收到suspend_command指令后未正确go_suspend，请检查代码，挂起原因：{msg}')
+        self.send_stop_signal({'action': 'stop', 'flag': stop_code})
+        logger.info(f'等任务 {waiting_seconds}s 后主动挂起')  # 强制关闭任务
+
+    # ------------------------------ stop_func ------------------------------
+    def get_stop_code(self):
+        stop_code = 0
+        recorded_stop_code = redis_conn.get(f'lifecycle:{self.task_id}:stop_code')
+        if not recorded_stop_code:
+            return 0
+        for code in recorded_stop_code.decode().strip().split('\n'):
+            stop_code |= int(code)
+        return stop_code
+
+    def check_finished_on_start(self):
+        """
+        处理manager在写完finished出于某种原因没删除自己导致的僵尸manager
+        """
+        task = self.task
+        if task.queue_status != QUE_STATUS.FINISHED:
+            return
+        logger.warning('检测到manager一启动任务已经finished')
+        if all([pod.status in EXP_STATUS.FINISHED for pod in task.pods]):
+            logger.warning('检测到所有pod均已结束，直接关闭manager')  # 任务正常结束
+            self.send_stop_signal({'action': 'stop_manager'})
+            redis_conn.expire(self.stop_channel, 5 * 60)
+        else:
+            logger.warning('检测到有pod还未结束，尝试去结束pod')  # pod残留
+            redis_conn.set(f'ban:{task.user_name}:{task.nb_name}:{task.chain_id}', 1)
+            redis_conn.lpush(self.suspend_channel, ujson.dumps({'stop_code': STOP_CODE.MANUAL_STOP}))
+
+    @lifecycle_stage
+    def delete_pod(self, pod_id):
+        try:
+            get_corev1_api().delete_namespaced_pod_with_retry(name=pod_id, namespace=self.task.user.config.task_namespace, body=pod_delete_option)
+            logger.info(f'删除pod {pod_id} grace_period_seconds={CONF.manager.delete_pod.grace_period_seconds}')  # 加到日志大盘里
+        except ApiException as e:
+            if e.status == 404:
+                logger.debug(f'未找到pod_id为{pod_id}的节点，可能已删除')
+            else:
+                logger.exception(e)
+                logger.error(f'无法删除pod_id为{pod_id}的节点，错误编号{e}')
+
+    @lifecycle_stage
+    def stop_nodes(self):
+        """
+        manager 把 子node 全关掉
+        """
+        if self.stop_nodes_already_called:
+            logger.info(f'之前已经关闭过，不作任何处理')
+            return
+        self.stop_nodes_already_called = True
+        logger.debug(f'开始关闭任务节点')
+        if CONF.manager.not_stop_node_for_test:
+            logger.warning(f'为了测试，不关闭任务节点，请到时候人工关闭')
+            return
+        for i in range(len(self.task.assigned_nodes)):
+            self.delete_pod(f'{self.pod_prefix}-{i}')
+
+    @lifecycle_stage
+    def stop_manager(self):
+        redis_conn.lpush('finished_task_channel', self.task_id)
+        logger.info('注销群众和档案')  # 加进日志大盘
+        for m in MANAGER_MODULES:
+            withdraw_parliament(mass_name=f'{self.task_id}_{m}.py')
+        cancel_archive(archive=self.task, sign='id')
+        logger.info('删除manager')  # 加进日志大盘
+        manager_id = f'{self.pod_prefix}-manager'
+        try:
+            get_appsv1_api().delete_namespaced_stateful_set_with_retry(name=manager_id, namespace=self.task.user.config.task_namespace)
+        except ApiException as e:
+            if e.status == 404:
+                logger.debug(f'未找到manager sts {manager_id}，可能已删除')
+            else:
+                logger.exception(e)
+                logger.error(f'无法删除manager sts {manager_id}，错误编号{e}', fetion=True)
+
+    @lifecycle_stage
+    def restart_exp(self):
+        task = self.task
+        logger.info(f'开始检查重启')  # 加到日志大盘里
+        if task.nb_name.endswith(VALIDATION_TASK_FLAG):
+            logger.warning('是测试任务，不重启')
+            return
+        stop_code = self.get_stop_code()
+        if stop_code < STOP_CODE.HOOK_RESTART:  # 遇到硬件坏了的时候，除非manual_stop，不然重启
+            # INTERRUPT，UNSCHEDULABLE 才需要重启
+            if not (stop_code & STOP_CODE.INTERRUPT) and not (stop_code & STOP_CODE.UNSCHEDULABLE):
+                return
+        if redis_conn.get(f'ban:{task.user_name}:{task.nb_name}:{task.chain_id}'):
+            # 这个任务被用户打断和重启同时发生，只关闭不重启
+            logger.info('强制刷新 stop_code 为 manual stop')
+            redis_conn.append(f'lifecycle:{task.id}:stop_code', f'{STOP_CODE.MANUAL_STOP}\n')
+            return
+        if task.task_type == TASK_TYPE.JUPYTER_TASK and task.user.is_external and not task.group.startswith(CONF.jupyter.shared_node_group_prefix):
+            logger.info('外部用户独占节点，不重启, 并刷新 stop_code 为 manual stop')
+            redis_conn.append(f'lifecycle:{task.id}:stop_code', f'{STOP_CODE.MANUAL_STOP}\n')
+            return
+        logger.info('创建新任务')  # 加到日志大盘里
+        log_msg = f'执行restart_exp({task.job_info})，优先级为{task.priority}，尝试重启任务，信号为 {bin(stop_code)}, 解析成: {s_code.name(stop_code)}'
+        try:
+            new_task = TrainingTaskSelector.find_one(DbOperationImpl, id=self.task_id)
+            with MarsDB() as conn:
+                task.queue_status = QUE_STATUS.FINISHED  # 告知k8sworker这个任务已经结束了
+                task.update(('queue_status',), (QUE_STATUS.FINISHED,), db_conn=conn)
+                new_task = new_task.resume(db_conn=conn)
+            log_msg += ' -> 成功' if new_task else '失败'
+            logger.warning(log_msg)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f'{task.job_info} 重启的时候发生了未知错误: {e}')
+
+    def finish(self, stop_code):
+        task = self.task
+        redis_conn.set(f'manager_ban:{self.task_id}', b'1')
+        logger.info(f'收到 stop_manager 信号 {bin(stop_code)}, manager 处理信号: {bin(stop_code)} - {s_code.name(stop_code)}')
+        task.update(('stop_code',), (stop_code,))
+        self.restart_exp()
+        task.queue_status = QUE_STATUS.FINISHED  # 告知k8sworker这个任务已经结束了
+        task.update(('queue_status',), (QUE_STATUS.FINISHED,))
+        # 根据 stop_code 更新 save_metric 终态
+        failed_msg = redis_conn.get(f'lifecycle:{self.task_id}:failed_msg')
+        task_event = redis_conn.get(f'lifecycle:{self.task_id}:task_event')
+        if failed_msg or task_event:
+            error_info = (failed_msg.decode() if failed_msg else "") + (task_event.decode() if task_event else "")
+            if task.task_type == TASK_TYPE.VALIDATION_TASK:  # 如果是validation任务，得找到相对应的virtual任务才行
+                virtual_task = TrainingTaskSelector.find_one(AutoTaskSchemaWithDbImpl, chain_id=task.chain_id.split('_main_')[0])
+                virtual_task.create_error_info(error_info)
+            else:
+                task.create_error_info(error_info)
+        logger.info(f'清空redis')  # 加到日志大盘
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for key in [
+                f'disable_warn:{self.task_id}', f'watch_dog_time:{task.user_name}:{self.task_id}',
+                f'exp_est_time:{task.user_name}:{self.task_id}', f'{self.stop_channel}:update_status.py',
+                self.suspend_channel, self.stop_channel, f'{CONF.manager.redis_message_channel}',
+                f'lifecycle:{self.task_id}:log_time', f'lifecycle:{self.task_id}:failed_msg',
+                f'lifecycle:{self.task_id}:task_event', f'lifecycle:{self.task_id}:stop_code',
+            ] + [f'module:{self.task_id}:{m}.py' for m in MANAGER_MODULES + ['update_status', 'client_responder']]:
+                pipe.expire(key, 5 * 60)
+            pipe.execute()
+        logger.info(f'调用 stop_manager， 开始关闭 manager')
+        self.stop_manager()
+
+    def handle_stop_signal(self, info):
+        """
+        处理一个 stop 信号，返回任务是否已经结束
+        """
+        task = self.task
+        logger.debug(f'received {info}')
+        if 'flag' in info:
+            redis_conn.append(f'lifecycle:{self.task_id}:stop_code', f'{info.flag}\n')
+        stop_code = self.get_stop_code()
+        if info.action == 'stop_single_pod':  # pod complete的时候把它删掉
+            self.delete_pod(info.pod_id)
+        elif info.action == 'stop':
+            logger.info(f'收到 stop 信号 {bin(info.flag)}, 解析成: {s_code.name(info.flag)}, 合成 {bin(stop_code)} - {s_code.name(stop_code)}')
+            if stop_code & STOP_CODE.MANUAL_FAILED:
+                for rank in range(task.nodes):
+                    task.update_pod_status(rank, EXP_STATUS.FAILED)
+            elif stop_code & STOP_CODE.MANUAL_SUCCEEDED:
+                for rank in range(task.nodes):
+                    task.update_pod_status(rank, EXP_STATUS.SUCCEEDED)
+            self.stop_nodes()
+        else:  # stop manager
+            self.finish(stop_code)
+            return True
+        return False
@@ -2,20 +2,44 @@
 
 from .default import *
 from .custom import *
-import pickle
+import time
 import pandas as pd
+from conf import CONF
 from k8s import get_corev1_api
 from logm import logger
 from utils import asyncwrap
+from utils.columnar import loads_state
 from db import a_redis
-from k8s_watcher.node_watcher import NODES_DF_COLUMNS
+from k8s_watcher.node_watcher import NODES_DF_COLUMNS, NODES_DF_PAYLOAD_KEY, NODES_DF_VERSION_KEY
 
 k8s_corev1_api = get_corev1_api()
+# 进程内缓存的 nodes_df 最多多久去 redis 检查一次版本，单位秒
+NODES_DF_MAX_STALENESS = CONF.try_get('k8swatcher.nodes_df_max_staleness', default=1)
+_nodes_df_cache = {'version': None, 'nodes_df': None, 'checked_at': 0}
+
+
+async def _get_cached_nodes_df():
+    """
+    只有 redis 里的版本变了才重新拉取 nodes_df，版本检查本身也按 NODES_DF_MAX_STALENESS 节流
+    """
+    now = time.time()
+    if _nodes_df_cache['nodes_df'] is not None and now - _nodes_df_cache['checked_at'] < NODES_DF_MAX_STALENESS:
+        return _nodes_df_cache['nodes_df']
+    version = await a_redis.get(NODES_DF_VERSION_KEY)
+    if version is None:
+        return pd.DataFrame(columns=NODES_DF_COLUMNS)
+    if version != _nodes_df_cache['version']:
+        # 版本和 payload 是 watcher 在一个事务里写的，一起读出来保证对得上
+        version, payload = await a_redis.mget(NODES_DF_VERSION_KEY, NODES_DF_PAYLOAD_KEY)
+        _nodes_df_cache['nodes_df'] = loads_state(payload)['nodes_df']
+        _nodes_df_cache['version'] = version
+    _nodes_df_cache['checked_at'] = now
+    return _nodes_df_cache['nodes_df']
 
 
 async def async_get_nodes_df(monitor=False):
-    nodes_df_pickle = await a_redis.get('nodes_df_pickle')
-    nodes_df = pd.DataFrame(columns=NODES_DF_COLUMNS) if nodes_df_pickle is None else pickle.loads(nodes_df_pickle)
+    # 调用方会原地修改 nodes_df，不能把缓存给出去
+    nodes_df = (await _get_cached_nodes_df()).copy()
     if len(nodes_df) == 0:
         return nodes_df
     if monitor:
@@ -12,6 +12,8 @@ from .utils import module
 
 
 class ListWatcher(ABC):
+    # 是否记录有变化的对象名，打开的子类要在 process 里调用 pop_dirty 取走
+    track_dirty = False
     def __init__(self, object_type, list_watch_funcs: Dict, namespaces: Optional[List] = None,
                  label_selector=None, field_selector=None, process_interval=10):
         self.object_type = object_type
@@ -29,6 +31,9 @@ class ListWatcher(ABC):
         self._ready = dict()
         # 最近一次cache更新的时间
         self.last_update = dict()
+        # 上次 pop_dirty 之后有变化的对象名，index -> set(name)
+        self._dirty = dict()
+        self._dirty_lock = threading.Lock()
         self._stop = False
 
     def log_info(self, info, index=None):
@@ -55,7 +60,14 @@ class ListWatcher(ABC):
                 self.log_info(f'start {self.object_type} list with args {kwargs}', index)
                 raw = list_func(**kwargs)
                 latest_resource_version = raw['metadata']['resourceVersion']
+                old_data = self._data.get(index)
                 self._data[index] = {item['metadata']['name']: item for item in raw['items']}
+                # 重新 list 的时候没法知道哪些变了，新旧都算有变化
+                self._mark_dirty(index, set(old_data or {}) | set(self._data[index]))
+                try:
+                    self.on_relist(index, old_data, self._data[index])
+                except Exception as e:
+                    logger.error(f'{index} {self.object_type} relist callback exception: {e}')
                 self.last_update[index] = datetime.now()
                 self._ready[index] = True
                 # 为了保证stream重试，不需要添加timeout_seconds参数，且需指定resource_version
@@ -65,22 +77,73 @@ class ListWatcher(ABC):
                 for event in self.watchers[index].stream(watch_func, **kwargs):
                     try:
                         name = event['object']['metadata']['name']
-                        if event['type'] == 'ADDED' or event['type'] == 'MODIFIED':
-                            self._data[index][name] = event['object']
-                        elif event['type'] == 'DELETED':
-                            self._data[index].pop(name, None)
-                        self.last_update[index] = datetime.now()
-                        # 调用到这里的时候，list cache肯定已经ready了
-                        # 目前不需要event trigger process运行
-                        # 如node: setlabel, cordon, uncordon操作产生的event，时效性都不强
-                        # self.process()
-                    except:
+                    except (KeyError, TypeError):
                         logger.debug(f'{index} {self.object_type} bookmark event: {event}')
+                        continue
+                    if event['type'] == 'ADDED' or event['type'] == 'MODIFIED':
+                        self._data[index][name] = event['object']
+                    elif event['type'] == 'DELETED':
+                        self._data[index].pop(name, None)
+                    self._mark_dirty(index, (name, ))
+                    self.last_update[index] = datetime.now()
+                    # on_event 出错不影响缓存，也不能当成 bookmark 吞掉
+                    try:
+                        self.on_event(index, event)
+                    except Exception as e:
+                        logger.exception(e)
+                        logger.error(f'{index} {self.object_type} event callback exception: {e}, event: {event["type"]} {name}')
+                    # 调用到这里的时候，list cache肯定已经ready了
+                    # 目前不需要event trigger process运行
+                    # 如node: setlabel, cordon, uncordon操作产生的event，时效性都不强
+                    # self.process()
             except Exception as e:
                 logger.error(f'{index} {self.object_type} watcher exception: {str(e)}, '
                              f'last update time: {self.last_update[index].strftime("%Y-%m-%d %H:%M:%S") if index in self.last_update.keys() else "None"}!')
             time.sleep(5)
 
+    def _mark_dirty(self, index, names):
+        if not self.track_dirty:
+            return
+        with self._dirty_lock:
+            self._dirty.setdefault(index, set()).update(names)
+
+    def pop_dirty(self):
+        """
+        取出上次调用之后有变化的对象名，返回 {index: set(name)}
+        """
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, dict()
+        return dirty
+
+    def on_event(self, index, event):
+        # 收到 watch 事件之后的回调，默认不处理，需要实时响应事件的子类重写
+        pass
+
+    def on_relist(self, index, old_data: Optional[Dict], new_data: Dict):
+        """
+        重新 list 之后的回调，old_data 为 None 表示这个进程第一次 list
+        watch 出错 / 超时之后会重新 list，断开的这段时间里的变化没有 watch 事件，默认把前后两次缓存的差别当成事件交给 on_event
+        """
+        if old_data is None:
+            return
+        for event in self.diff_events(old_data, new_data):
+            self.on_event(index, event)
+
+    @staticmethod
+    def diff_events(old_data: Dict, new_data: Dict) -> List[Dict]:
+        """
+        两次 list 结果的差别，转成 ADDED / MODIFIED / DELETED 事件，resourceVersion 没变的对象跳过
+        """
+        events = []
+        for name, obj in new_data.items():
+            old_obj = old_data.get(name)
+            if old_obj is None:
+                events.append({'type': 'ADDED', 'object': obj})
+            elif old_obj['metadata'].get('resourceVersion') != obj['metadata'].get('resourceVersion'):
+                events.append({'type': 'MODIFIED', 'object': obj})
+        events.extend({'type': 'DELETED', 'object': obj} for name, obj in old_data.items() if name not in new_data)
+        return events
+
     @abstractmethod
     def process(self):
         # process 运行有两种触发方式：定时任务，或者接收到k8s watch事件
@@ -4,7 +4,6 @@ from .default import *
 from .custom import *
 
 
-import pickle
 from operator import ior
 from functools import reduce
 from k8s_watcher.base import ListWatcher
@@ -17,6 +16,7 @@ from conf.flags import QUE_STATUS, TASK_TYPE, EXP_STATUS, NODE_FLAG
 from conf import MARS_GROUP_FLAG
 from db import MarsDB, redis_conn
 from logm import logger, log_stage
+from utils.columnar import dumps_state
 
 
 # 用来只留需要的列
@@ -28,6 +28,9 @@ NODES_DF_COLUMNS = [
 NODES_DF_COLUMNS += EXTRA_NODES_DF_COLUMNS
 if MARS_GROUP_FLAG not in NODES_DF_COLUMNS:
     NODES_DF_COLUMNS.append(MARS_GROUP_FLAG)
+# nodes_df 按列编码后放在 NODES_DF_PAYLOAD_KEY，每次更新 NODES_DF_VERSION_KEY 加一，读的一方版本没变就不用重新拉取
+NODES_DF_PAYLOAD_KEY = 'nodes_df_columnar'
+NODES_DF_VERSION_KEY = 'nodes_df_version'
 
 
 class NodeListWatcher(ListWatcher):
@@ -149,6 +152,10 @@ class NodeListWatcher(ListWatcher):
     def process(self):
         nodes_df = self._get_nodes_df()
         if not nodes_df.equals(self.last_nodes_df):
-            logger.info(f'set nodes_df_pickle in redis')
-            redis_conn.set('nodes_df_pickle', pickle.dumps(nodes_df))  # 这里改成 pickle，json 反序列化 None 可能会变成 NAN
+            logger.info(f'set {NODES_DF_PAYLOAD_KEY} in redis')
+            # 不用 json，json 反序列化 None 可能会变成 NAN；payload 和 version 在一个事务里写，读的一方不会读到不一致的
+            with redis_conn.pipeline() as pipe:
+                pipe.set(NODES_DF_PAYLOAD_KEY, dumps_state({'nodes_df': nodes_df}))
+                pipe.incr(NODES_DF_VERSION_KEY)
+                pipe.execute()
             self.last_nodes_df = nodes_df
@@ -4,39 +4,72 @@ import ujson
 import time
 
 from .base import ListWatcher
-from logm import log_stage
+from conf import CONF
+from logm import logger, log_stage
 from base_model.training_task import TrainingTask
 from server_model.auto_task_impl import AutoTaskSchemaImpl
 from server_model.pod import Pod
 from roman_parliament import archive_dict
+from roman_parliament.utils import generate_key
 from db import redis_conn
 from .utils import all_corev1, all_custom_corev1
 from k8s.podstate_utils import get_pod_state
 
 module = os.environ.get('POD_NAME', 'k8swatcher-0')
+# 存活的任务 pod 名，set
+ACTIVE_PODS_KEY = 'active_pods'
+# 每个 pod 的状态和进入这个状态的时间，hash，pod_id -> json
+LOG_FOREST_POD_STATUS_KEY = 'log_forest_watcher_pod_status_hash'
+# 老的全量 key，这个 repo 之外还有读的，每次都要整个写一遍，有变化之后最多每 LEGACY_KEYS_INTERVAL 秒写一次
+LEGACY_ACTIVE_PODS_KEY = 'active_pods_name'
+LEGACY_LOG_FOREST_POD_STATUS_KEY = 'log_forest_watcher_pod_status'
+LEGACY_KEYS_INTERVAL = CONF.try_get('k8swatcher.legacy_keys_interval', default=10)
+# 平时只检查有 pod 消失的任务，每隔这么多秒把所有任务检查一遍兜底
+TASK_FULL_SWEEP_INTERVAL = CONF.try_get('k8swatcher.task_full_sweep_interval', default=60)
 
 
 class PodListWatcher(ListWatcher):
+    track_dirty = True
+
     def __init__(self, namespaces=None, label_selector=None, field_selector=None, process_interval=10):
         list_watch_funcs = {
             host: (all_custom_corev1[host].list_namespaced_pod, all_corev1[host].list_namespaced_pod)
             for host in all_custom_corev1.keys()
         }
         super().__init__('pod', list_watch_funcs, namespaces, label_selector, field_selector, process_interval)
-        self.old_pods_namelist = set()
         self.last_redis_update_time = time.time()
         self.last_task_set = set()
-        self.current_task_list = []
+        self.last_full_sweep_time = 0
+        self.current_task_list = set()
+        # pod 名 -> task_id，pod 被删掉之后事件里没有 label 了，从这里找是哪个任务的
+        self.pod_task_ids = {}
+        # 等着写的老 key
+        self.legacy_dirty = set()
+        self.last_legacy_update_time = 0
+        # 还没写到 redis 的存活 pod 变化，pod 名 -> 是否存活
+        self.active_pods_changes = {}
+        self.active_pods_published = False
         self.count = 0
         # log forest watcher
         self.last_result = {}
+        self.log_forest_published = False
         # record pod exit status
         self.recorded_exit_pod = set()
+        self.pending_exit_pod = set()
+        self._changed_pods = {}
 
-    def _update_pods(self):
-        keys = list(filter(lambda x: TrainingTask.__name__ in x, archive_dict.keys()))
+    def _update_pods(self, dirty_task_ids):
+        """
+        只检查 dirty_task_ids 里 (有 pod 从 k8s 上消失) 的任务，每隔 TASK_FULL_SWEEP_INTERVAL 秒检查一遍所有任务
+        """
+        full_sweep = time.time() - self.last_full_sweep_time > TASK_FULL_SWEEP_INTERVAL
+        if full_sweep:
+            self.last_full_sweep_time = time.time()
+            keys = list(filter(lambda x: TrainingTask.__name__ in x, archive_dict.keys()))
+        else:
+            keys = [generate_key(class_name=TrainingTask.__name__, sign='id', value=task_id) for task_id in dirty_task_ids]
         if self.count % 1000 == 0:
-            self.log_info(f'运行了 [{self.count + 1}] 次 当前存活id长度: [{len(keys)}]')
+            self.log_info(f'运行了 [{self.count + 1}] 次 当前存活id长度: [{len(self.last_task_set)}]')
 
         all_task_info = []
         removed_pod_ids = []
@@ -50,73 +83,186 @@ class PodListWatcher(ListWatcher):
                     removed_pod_ids.append(reported_pods.pod_id)
             except:
                 pass
-        # 打印任务变动细节
-        task_set = set(all_task_info)
-        add_task_set = task_set - self.last_task_set
-        remove_task_set = self.last_task_set - task_set
-        for sk, info in zip([add_task_set, remove_task_set], ['新增', '删除']):
-            if (lsk := len(sk)) > 0:
-                self.log_info(f'当前 {info} id: 长度 [{lsk}]，详情 {sk}')
-        self.last_task_set = task_set
+        # 打印任务变动细节，只有检查了所有任务的时候才知道
+        if full_sweep:
+            task_set = set(all_task_info)
+            add_task_set = task_set - self.last_task_set
+            remove_task_set = self.last_task_set - task_set
+            for sk, info in zip([add_task_set, remove_task_set], ['新增', '删除']):
+                if (lsk := len(sk)) > 0:
+                    self.log_info(f'当前 {info} id: 长度 [{lsk}]，详情 {sk}')
+            self.last_task_set = task_set
         # 打印删除的细节
         if (len_rm_keys := len(removed_pod_ids)) > 0:
             self.log_info(f'本次通知删除id len: [{len_rm_keys}], ids: {sorted(removed_pod_ids)}')
         self.count += 1
 
+    def on_event(self, index, event):
+        # 任务的 pod 有变化就写到这个任务的 stream 里，check_running 订阅，不用每个任务各开一个 watch
+        self._publish_pod_events(index, [event])
+
+    def on_relist(self, index, old_data, new_data):
+        if old_data is None:
+            # 这个 k8swatcher 刚启动，之前 (比如主备切换期间) 的变化拿不到，更新 epoch 让订阅的 manager 自己重新 list
+            redis_conn.set(f'{CONF.manager.pod_event_stream}:epoch', f'{module}:{time.time()}')
+            return
+        # watch 断开期间的变化补发到 stream 里，标记一下是 relist 补出来的
+        self._publish_pod_events(index, [{**event, 'relist': True} for event in self.diff_events(old_data, new_data)])
+
+    def _publish_pod_events(self, index, events):
+        events = [
+            event for event in events
+            if 'task_id' in (labels := event['object']['metadata'].get('labels', {})) and labels.get('type') != 'manager'
+        ]
+        if not events:
+            return
+        try:
+            with redis_conn.pipeline(transaction=False) as pipe:
+                for event in events:
+                    stream = f'{CONF.manager.pod_event_stream}:{event["object"]["metadata"]["labels"]["task_id"]}'
+                    fields = {'type': event['type'], 'object': ujson.dumps(event['object'])}
+                    if event.get('relist'):
+                        fields['relist'] = 1
+                    pipe.xadd(stream, fields, maxlen=CONF.manager.pod_event_stream_maxlen, approximate=True)
+                    pipe.expire(stream, CONF.manager.pod_event_stream_ttl)
+                pipe.execute()
+        except Exception as e:
+            logger.error(f'{index} 发布 {[event["object"]["metadata"]["name"] for event in events]} 的 pod 事件失败: {e}')
+
     def process(self):
-        self._data_copied = {k: v.copy() for k, v in self._data.items()}
-        self.process_pod_update()
-        self.process_pod_exit()
-        self.process_logforest()
+        # 只处理上次 process 之后有变化的 pod，pod 被删除的话值是 None
+        dirty = self.pop_dirty()
+        self._changed_pods = {
+            name: self._data.get(index, {}).get(name)
+            for index, names in dirty.items() for name in names
+        }
+        try:
+            self.process_pod_update()
+            self.process_pod_exit()
+            self.process_logforest()
+            self.process_legacy_keys()
+        except:
+            # 处理失败的话下次再处理一遍，各个阶段重复处理同一个 pod 没有影响
+            for index, names in dirty.items():
+                self._mark_dirty(index, names)
+            raise
+
+    @staticmethod
+    def _is_task_pod(pod):
+        # task pods has label compute_node=true
+        return pod is not None and pod['metadata'].get('labels', {}).get('compute_node', '') == 'true'
 
     @log_stage(module)
     def process_pod_update(self):
-        # task pods has label compute_node=true
-        self.current_task_list = [
-            k for data in self._data_copied.values() for k, v in data.items()
-            if v['metadata'].get('labels', {}).get('compute_node', '') == 'true'
-        ]
+        dirty_task_ids = set()
+        for name, pod in self._changed_pods.items():
+            is_task_pod = self._is_task_pod(pod)
+            if is_task_pod and (task_id := pod['metadata']['labels'].get('task_id')) is not None:
+                self.pod_task_ids[name] = int(task_id)
+            if is_task_pod != (name in self.current_task_list):
+                if is_task_pod:
+                    self.current_task_list.add(name)
+                else:
+                    self.current_task_list.discard(name)
+                    if (task_id := self.pod_task_ids.get(name)) is not None:
+                        dirty_task_ids.add(task_id)
+                self.active_pods_changes[name] = is_task_pod
+            if pod is None:
+                self.pod_task_ids.pop(name, None)
 
-        # 只有pod变化时，才需要触发update_pods
-        self._update_pods()
-        # 更新redis
+        self._update_pods(dirty_task_ids)
+        # 更新redis，只写有变化的 pod
         # 注：这里的运行间隔不需要像update_pods那么频繁，故增加5s的延迟
         if time.time() - self.last_redis_update_time > 5:
             self.last_redis_update_time = time.time()
-            redis_conn.set('active_pods_time', time.time())
-            new_pods_namelist = set(self.current_task_list)
-            if self.old_pods_namelist == new_pods_namelist:
-                return
-            redis_conn.set('active_pods_name', ujson.dumps(self.current_task_list))
-            self.old_pods_namelist = new_pods_namelist
+            with redis_conn.pipeline() as pipe:
+                if not self.active_pods_published:
+                    # 第一次写的时候把上一个 k8swatcher 留下的清掉
+                    pipe.delete(ACTIVE_PODS_KEY)
+                    self.active_pods_changes = {name: True for name in self.current_task_list}
+                added = [name for name, is_active in self.active_pods_changes.items() if is_active]
+                removed = [name for name, is_active in self.active_pods_changes.items() if not is_active]
+                if added:
+                    pipe.sadd(ACTIVE_PODS_KEY, *added)
+                if removed:
+                    pipe.srem(ACTIVE_PODS_KEY, *removed)
+                pipe.set('active_pods_time', time.time())
+                pipe.execute()
+            if added or removed or not self.active_pods_published:
+                self.legacy_dirty.add(LEGACY_ACTIVE_PODS_KEY)
+            self.active_pods_changes = {}
+            self.active_pods_published = True
 
     @log_stage(module)
     def process_logforest(self):
-        result = {
-            pod_id: {
-                'status': get_pod_state(pod_dict=event)['status'],
-                'start_time': None
-            }
-            for data in self._data_copied.values() for pod_id, event in data.items()
-        }
-        pod_id_list = list(result.keys())
-        for pod_id in pod_id_list:
-            if pod_id in self.last_result and self.last_result[pod_id]['status'] == result[pod_id]['status']:
-                result[pod_id]['start_time'] = self.last_result[pod_id]['start_time']
-            else:  # 全新的 pod_id 或者是全新的 status
-                result[pod_id]['start_time'] = time.time()
+        updated, removed = {}, []
+        for pod_id, pod in self._changed_pods.items():
+            if pod is None:
+                if pod_id in self.last_result:
+                    removed.append(pod_id)
+                continue
+            status = get_pod_state(pod_dict=pod)['status']
+            if pod_id in self.last_result and self.last_result[pod_id]['status'] == status:
+                continue
+            # 全新的 pod_id 或者是全新的 status
+            updated[pod_id] = {'status': status, 'start_time': time.time()}
+        if self.log_forest_published and not updated and not removed:
+            return
+        # 写成功之后再更新 last_result，写失败的话下次还能算出同样的变化
+        result = {**self.last_result, **updated}
+        for pod_id in removed:
+            result.pop(pod_id)
+        with redis_conn.pipeline() as pipe:
+            if not self.log_forest_published:
+                pipe.delete(LOG_FOREST_POD_STATUS_KEY)
+                updated = result
+            if updated:
+                pipe.hset(LOG_FOREST_POD_STATUS_KEY, mapping={pod_id: ujson.dumps(value) for pod_id, value in updated.items()})
+            if removed:
+                pipe.hdel(LOG_FOREST_POD_STATUS_KEY, *removed)
+            pipe.execute()
         self.last_result = result
-        redis_conn.set('log_forest_watcher_pod_status', pickle.dumps(result))
+        self.log_forest_published = True
+        self.legacy_dirty.add(LEGACY_LOG_FOREST_POD_STATUS_KEY)
+
+    @log_stage(module)
+    def process_legacy_keys(self):
+        if not self.legacy_dirty or time.time() - self.last_legacy_update_time < LEGACY_KEYS_INTERVAL:
+            return
+        with redis_conn.pipeline() as pipe:
+            if LEGACY_ACTIVE_PODS_KEY in self.legacy_dirty:
+                pipe.set(LEGACY_ACTIVE_PODS_KEY, ujson.dumps(list(self.current_task_list)))
+            if LEGACY_LOG_FOREST_POD_STATUS_KEY in self.legacy_dirty:
+                pipe.set(LEGACY_LOG_FOREST_POD_STATUS_KEY, pickle.dumps(self.last_result))
+            pipe.execute()
+        self.legacy_dirty = set()
+        self.last_legacy_update_time = time.time()
 
     @log_stage(module)
     def process_pod_exit(self):
-        for data in self._data_copied.values():
-            for k, v in data.items():
-                if v['metadata'].get('labels', {}).get('compute_node', '') == 'true' and k not in self.recorded_exit_pod:
-                    try:
-                        exit_code = v['status']['containerStatuses'][0]['state']['terminated']['exitCode']
-                        Pod.find_pods_by_pod_id(k)[0].update(('exit_code',), (str(exit_code),))
-                        self.recorded_exit_pod.add(k)
-                        self.log_info(f'更新pod {k} 退出码 {exit_code}')
-                    except:
-                        pass
+        # 上次更新数据库失败的 pod 再试一次
+        candidates = {**{name: self._get_pod(name) for name in self.pending_exit_pod}, **self._changed_pods}
+        for k, v in candidates.items():
+            if v is None:
+                self.recorded_exit_pod.discard(k)
+                self.pending_exit_pod.discard(k)
+                continue
+            if not self._is_task_pod(v) or k in self.recorded_exit_pod:
+                continue
+            try:
+                exit_code = v['status']['containerStatuses'][0]['state']['terminated']['exitCode']
+            except:
+                continue
+            try:
+                Pod.find_pods_by_pod_id(k)[0].update(('exit_code',), (str(exit_code),))
+                self.recorded_exit_pod.add(k)
+                self.pending_exit_pod.discard(k)
+                self.log_info(f'更新pod {k} 退出码 {exit_code}')
+            except:
+                self.pending_exit_pod.add(k)
+
+    def _get_pod(self, name):
+        for data in list(self._data.values()):
+            if (pod := data.get(name)) is not None:
+                return pod
+        return None
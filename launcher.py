@@ -6,8 +6,13 @@ import time
 import ujson
 import asyncio
 import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from cachetools import cached, Cache
 from kubernetes.client.rest import ApiException
+from prometheus_client import Histogram, start_http_server
 
 from base_model.training_task import TrainingTask
 from conf import CONF
@@ -40,9 +45,28 @@ if manager_mounts := CONF.try_get('launcher.manager_mounts'):
         manager_mount_path.append(v.split(':')[1])
         manager_mount_ro.append(v.split(':')[-1] == 'ro')
 RETRY_TIMES = 2
+# 并发启动任务的线程数, 以及每个 namespace 同时在启动的任务数
+LAUNCH_WORKERS = CONF.try_get('launcher.workers', default=16)
+NAMESPACE_CONCURRENCY = CONF.try_get('launcher.namespace_concurrency', default=8)
 
 module = os.environ.get('POD_NAME', 'launcher')
 
+START_EXP_STAGE_SECONDS = Histogram(
+    'launcher_start_exp_stage_seconds',
+    'Latency of each stage when launcher starts a task.',
+    labelnames=('stage',),      # queue / insert_pods / statefulset / service / configmap / total
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+
+@contextmanager
+def observe_stage(stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        START_EXP_STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started_at)
+
 
 class DuplicatedPods(Exception):
     """重复插入了 pods"""
@@ -55,12 +79,26 @@ def get_manager_resource(big):
 
 
 # image info 不会变来变去的
-@cached(cache=Cache(maxsize=1024))
+@cached(cache=Cache(maxsize=1024), lock=threading.Lock())
 def get_image_info(image_name):
     # 在这里查询数据库，获取 image 的信息，这样的好处是，以后可以和议会的集成起来
     return TrainImageSelector.find_one(os.path.basename(image_name))
 
 
+# 每个任务的 configmap 内容都一样, launcher 运行期间不会变, 不用每次都读文件 / dump
+@lru_cache(maxsize=None)
+def get_dir_files(path):
+    return {
+        file: open(os.path.join(path, file), 'r').read()
+        for file in os.listdir(path) if os.path.isfile(os.path.join(path, file))
+    }
+
+
+@lru_cache(maxsize=None)
+def get_override_toml():
+    return toml.dumps(CONF)
+
+
 nodes_dict = {}
 lock = threading.Lock()
 def start_get_nodes_df():
@@ -93,7 +131,7 @@ def insert_pods(task: TrainingTask):
         task_cpu = task.config_json['assigned_resource']['cpu']
         task_assigned_gpus = task.config_json['assigned_resource']['assigned_gpus']
         try:
-            with MarsDB() as conn:
+            with observe_stage('insert_pods'), MarsDB() as conn:
                 for i, node in enumerate(task.assigned_nodes):
                     Pod(
                         task_id=task.id, pod_id=f'{task.user_name.replace("_", "-")}-{task.id}-{i}', job_id=i,
@@ -114,15 +152,14 @@ def create_manager(task: TrainingTask, user_name):
     namespace = task.user.config.task_namespace
     # 先创建 configmap
     manager_name = f'{user_name.replace("_", "-")}-{task_id}-manager'
-    lock.acquire()
-    try:
-        nodes_flags = [str(nodes_dict[n]['flag']) for n in task.assigned_nodes]
-        nodes_zones = [str(nodes_dict[n]['schedule_zone']) for n in task.assigned_nodes]
-    except Exception as e:
-        logger.error('没有正确获取到 nodes_df')
-        logger.error(e)
-        raise e
-    lock.release()
+    with lock:
+        try:
+            nodes_flags = [str(nodes_dict[n]['flag']) for n in task.assigned_nodes]
+            nodes_zones = [str(nodes_dict[n]['schedule_zone']) for n in task.assigned_nodes]
+        except Exception as e:
+            logger.error('没有正确获取到 nodes_df')
+            logger.error(e)
+            raise e
     env = [
         get_env_var(key='TASK_ID', value=task_id),
         get_env_var(key='MANAGER_NAME', value=manager_name),
@@ -135,6 +172,9 @@ def create_manager(task: TrainingTask, user_name):
         get_env_var(key='MARSV2_NODE_FLAGS', value=','.join(nodes_flags)),
         get_env_var(key='MARSV2_TASK_SIDECARS', value=ujson.dumps(task.schema.get('options', {}).get('sidecar', [])))
     ]
+    # manager pod 的 supervisord 看自己 pod 上的 multi_task_manager label 决定要不要启动那几个检查进程，没有这个 label 时为空
+    env.append(client.V1EnvVar(name='MULTI_TASK_MANAGER', value_from=client.V1EnvVarSource(
+        field_ref=client.V1ObjectFieldSelector(field_path="metadata.labels['multi_task_manager']"))))
     if 'CUSTOM_FILE_NAME' in os.environ:
         env.append(get_env_var(key='CUSTOM_FILE_NAME', value=os.environ.get('CUSTOM_FILE_NAME', '')))
     if manager_envs := CONF.try_get('launcher.manager_envs'):
@@ -224,6 +264,9 @@ def create_manager(task: TrainingTask, user_name):
         'user_id': user_name,
         'type': 'manager'
     }
+    if CONF.try_get('manager.multi_task.enabled', default=0):
+        # 交给 multi_task_manager 管理，pod 里只跑 check_logs 和 client_responder
+        labels['multi_task_manager'] = 'true'
     podspec = client.V1PodSpec(
         init_containers=containers[0:1],
         containers=containers[1:],
@@ -255,7 +298,8 @@ def create_manager(task: TrainingTask, user_name):
         service_name=f'{user_name.replace("_", "-")}-{task_id}-manager'
     )
     st = client.V1StatefulSet(metadata=metadata, spec=stspec)
-    st_resp = k8s_appsv1_api.create_namespaced_stateful_set_with_retry(namespace=namespace, body=st)
+    with observe_stage('statefulset'):
+        st_resp = k8s_appsv1_api.create_namespaced_stateful_set_with_retry(namespace=namespace, body=st)
     # 接下来所有的资源 owner_ref 都指向 manager
     owner_ref = client.V1OwnerReference(api_version='apps/v1', kind='StatefulSet', name=st_resp.metadata.name, uid=st_resp.metadata.uid, controller=False, block_owner_deletion=True)
 
@@ -267,50 +311,46 @@ def create_manager(task: TrainingTask, user_name):
     )
     spec = client.V1ServiceSpec(selector={'statefulset.kubernetes.io/pod-name': f'{user_name.replace("_", "-")}-{task_id}-manager-0'}, cluster_ip='None')
     service = client.V1Service(api_version='v1', kind='Service', metadata=metadata, spec=spec)
-    k8s_corev1_api.create_namespaced_service_with_retry(namespace=namespace, body=service)
+    with observe_stage('service'):
+        k8s_corev1_api.create_namespaced_service_with_retry(namespace=namespace, body=service)
     # 创建任务所需的 configmap，实际上可以先创建 manager 再创建 manager 需要的 configmap，这样所有资源的 ref 都能指向 manager
-    k8s_corev1_api.create_namespaced_config_map_with_retry(
-        namespace=namespace,
-        body=client.V1ConfigMap(
-            immutable=True,
-            data={'override.toml': toml.dumps(CONF)},
-            metadata=client.V1ObjectMeta(
-                name=f'etc-configmap-{task_id}',
-                namespace=namespace,
-                owner_references=[owner_ref]
+    with observe_stage('configmap'):
+        k8s_corev1_api.create_namespaced_config_map_with_retry(
+            namespace=namespace,
+            body=client.V1ConfigMap(
+                immutable=True,
+                data={'override.toml': get_override_toml()},
+                metadata=client.V1ObjectMeta(
+                    name=f'etc-configmap-{task_id}',
+                    namespace=namespace,
+                    owner_references=[owner_ref]
+                )
             )
         )
-    )
-    k8s_corev1_api.create_namespaced_config_map_with_retry(
-        namespace=namespace,
-        body=client.V1ConfigMap(
-            immutable=True,
-            data={
-                file: open(os.path.join('marsv2/scripts', file), 'r').read()
-                for file in os.listdir('marsv2/scripts') if os.path.isfile(os.path.join('marsv2/scripts', file))
-            },
-            metadata=client.V1ObjectMeta(
-                name=f'marsv2-scripts-{task_id}', # 这里不像别的资源一样，加上用户名，因为 storage 表不支持 replace 字符串
-                namespace=namespace,
-                owner_references=[owner_ref]
+        k8s_corev1_api.create_namespaced_config_map_with_retry(
+            namespace=namespace,
+            body=client.V1ConfigMap(
+                immutable=True,
+                data=get_dir_files('marsv2/scripts'),
+                metadata=client.V1ObjectMeta(
+                    name=f'marsv2-scripts-{task_id}', # 这里不像别的资源一样，加上用户名，因为 storage 表不支持 replace 字符串
+                    namespace=namespace,
+                    owner_references=[owner_ref]
+                )
             )
         )
-    )
-    k8s_corev1_api.create_namespaced_config_map_with_retry(
-        namespace=namespace,
-        body=client.V1ConfigMap(
-            immutable=True,
-            data={
-                file: open(os.path.join('marsv2/entrypoints', file), 'r').read()
-                for file in os.listdir('marsv2/entrypoints') if os.path.isfile(os.path.join('marsv2/entrypoints', file))
-            },
-            metadata=client.V1ObjectMeta(
-                name=f'marsv2-entrypoints-{task_id}',
-                namespace=namespace,
-                owner_references=[owner_ref]
+        k8s_corev1_api.create_namespaced_config_map_with_retry(
+            namespace=namespace,
+            body=client.V1ConfigMap(
+                immutable=True,
+                data=get_dir_files('marsv2/entrypoints'),
+                metadata=client.V1ObjectMeta(
+                    name=f'marsv2-entrypoints-{task_id}',
+                    namespace=namespace,
+                    owner_references=[owner_ref]
+                )
             )
         )
-    )
 
 
 def manual_make_task_finished(task: TrainingTask):
@@ -355,13 +395,82 @@ def start_exp(task: TrainingTask):
     manual_make_task_finished(task)
 
 
+class LaunchQueue(object):
+    """
+    档案袋里新来的任务按到达顺序排队, 由线程池并发启动, 一个任务的 k8s 请求慢不会拖住后面的任务;
+    同一个 namespace 同时在启动的任务数有上限, 超过的留在队列里, 不占线程
+    """
+
+    def __init__(self, workers, namespace_concurrency):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='start_exp')
+        self.namespace_concurrency = namespace_concurrency
+        self.cond = threading.Condition()
+        self.pending = deque()                  # (archive_key, task, namespace, 入队时间)
+        self.running_by_namespace = Counter()
+        self.known_archive_keys = set()         # 已经入队 / 启动过的任务
+
+    @staticmethod
+    def get_namespace(task: TrainingTask):
+        try:
+            return UserSelector.from_user_name(user_name=task.user_name).config.task_namespace
+        except Exception:
+            return ''   # 拿不到的放在一起限流, start_exp 里会报错
+
+    def scan(self):
+        """
+        对比档案袋, 把新任务放进队列
+        """
+        archive_keys = set(key for key in list(archive_dict.keys()) if TrainingTask.__name__ in key)
+        with self.cond:
+            # 已经不在档案袋里的任务不用再记着了
+            self.known_archive_keys &= archive_keys
+            for archive_key in archive_keys - self.known_archive_keys:
+                if (task := archive_dict.get(archive_key, None)) is None:
+                    continue
+                self.known_archive_keys.add(archive_key)
+                self.pending.append((archive_key, task, self.get_namespace(task), time.perf_counter()))
+            self._dispatch()
+
+    def _dispatch(self):
+        skipped = deque()
+        while self.pending:
+            item = self.pending.popleft()
+            namespace = item[2]
+            if self.running_by_namespace[namespace] >= self.namespace_concurrency:
+                skipped.append(item)
+                continue
+            self.running_by_namespace[namespace] += 1
+            self.pool.submit(self._launch, *item)
+        self.pending = skipped
+
+    def _launch(self, archive_key, task, namespace, queued_at):
+        START_EXP_STAGE_SECONDS.labels('queue').observe(time.perf_counter() - queued_at)
+        try:
+            with logger.contextualize(uuid=f'{module}.loop'), observe_stage('total'):
+                try:
+                    start_exp(task)
+                    add_archive_for_senators(trigger_name='TrainingTaskTrigger', data=[task.id])
+                except DuplicatedPods as de:
+                    # 有别的 launcher 启动了这个任务，就不管了
+                    logger.info('有其他 launcher 启动了这个任务, 跳过')
+                    pass
+                except Exception as e:
+                    logger.exception(e)
+                    logger.f_error(f'起 manager 出现了异常：{str(e)}', task=task)
+        finally:
+            with self.cond:
+                self.running_by_namespace[namespace] -= 1
+                self._dispatch()
+
+
 if __name__ == '__main__':
     with logger.contextualize(uuid=f'{module}.setup'):
         logger.info(f'launcher python', sys.version)
         logger.info('开始订阅...')
         add_archive_trigger(LauncherTaskTrigger)
-        # 启动过的任务记录一下
-        started_archive_keys = set()
+        if metrics_port := CONF.try_get('launcher.metrics_port', default=0):
+            start_http_server(metrics_port)
+    launch_queue = LaunchQueue(workers=LAUNCH_WORKERS, namespace_concurrency=NAMESPACE_CONCURRENCY)
     thrd = threading.Thread(target=start_get_nodes_df, daemon=True)
     thrd.start()
     while len(nodes_dict) == 0:
@@ -374,20 +483,7 @@ if __name__ == '__main__':
                 MarsDB().dispose()
                 logger.warning('收到了 stop launcher 的指令，退出自己')
                 os.system("""ps -ef | grep -v PID | awk '{system("kill -KILL " $2)}'""")
-            archive_keys = set(archive_dict.keys())
-            started_archive_keys &= archive_keys
-            for archive_key in filter(lambda x: TrainingTask.__name__ in x, archive_keys - started_archive_keys):
-                if (task := archive_dict.get(archive_key, None)) is None:
-                    continue
-                try:
-                    start_exp(task)
-                    add_archive_for_senators(trigger_name='TrainingTaskTrigger', data=[task.id])
-                except DuplicatedPods as de:
-                    # 有别的 launcher 启动了这个任务，就不管了
-                    logger.info('有其他 launcher 启动了这个任务, 跳过')
-                    pass
-                except Exception as e:
-                    logger.exception(e)
-                    logger.f_error(f'起 manager 出现了异常：{str(e)}', task=task)
-                started_archive_keys.add(archive_key)
-            time.sleep(0.001)
+            # 有新任务时 trigger 会唤醒; 议员重连等不经过 trigger 的变化, 最多晚一秒扫到
+            LauncherTaskTrigger.archive_event.wait(timeout=1)
+            LauncherTaskTrigger.archive_event.clear()
+            launch_queue.scan()
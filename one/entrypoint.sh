@@ -99,6 +99,13 @@ if [[ ${MANUAL_START_SEVER} == "1" ]]; then
   start_server ugc-server ugc 8083
   start_server monitor-server monitor 8084
 else
+    # 开了 manager.multi_task.enabled, 或者关掉之前起的任务还没结束 (还有打了 label 的 manager pod), 才启动 multi_task_manager
+    MULTI_TASK_ENABLED=$(python -c "from conf import CONF; print(int(CONF.try_get('manager.multi_task.enabled', default=0)))")
+    if [[ "${MULTI_TASK_ENABLED}" == "1" || -n $(kubectl get pods -A -l multi_task_manager=true -o name) ]]; then
+      export MULTI_TASK_MANAGER_AUTOSTART=true
+    else
+      export MULTI_TASK_MANAGER_AUTOSTART=false
+    fi
     supervisord -c one/supervisord.conf
 fi
 
@@ -107,12 +107,14 @@ async def get_wc_with_check():
 
 async def push(force: bool = False, no_checksum: bool = False, no_hfignore: bool = False, no_zip: bool = False, no_diff: bool = False,
     list_timeout: int = 300, sync_timeout: int = 300, cloud_connect_timeout: int = 120, token_expires: int = 1800, part_mb_size: int = 100,
-    proxy: str = '', file_type: str = FileType.WORKSPACE, env_provider: str = 'oss', env_local_path: str = '', env_remote_path: str = ''):
+    proxy: str = '', file_type: str = FileType.WORKSPACE, env_provider: str = 'oss', env_local_path: str = '', env_remote_path: str = '',
+    delta: bool = False):
     """
     推送本地workspace到集群
     @param force: 是否强制推送
     @param no_checksum: 是否禁用checksum
     @param no_hfignore: 是否禁用hfignore
+    @param delta: 是否按内容分块增量上传
     @return bool: 标识push是否成功
     """
     # 一层一层往上面找，看看有没有 ./hfai/workspace.yml
@@ -145,7 +147,8 @@ async def push(force: bool = False, no_checksum: bool = False, no_hfignore: bool
         'cloud_connect_timeout': cloud_connect_timeout,
         'token_expires': token_expires,
         'part_mb_size': part_mb_size,
-        'proxy': proxy
+        'proxy': proxy,
+        'delta': delta
     }
 
     return await push_to_cluster(**kwargs)
@@ -19,6 +19,7 @@ from .utils import FileType, SyncDirection, SyncStatus, FileInfo, FileList, File
     get_file_info, list_local_files_inner, hashkey, zip_dir, tz_utc_8
 # cloud_storage/provider
 from .provider import OSSApi, MockApi
+from .provider.delta import upload_delta
 
 from itertools import chain
 
@@ -207,13 +208,14 @@ async def _do_poll_status(batch_size, completed_size, url, progress, task):
 
 async def sync_to_cluster(name: str, file_type: str, files: List[FileInfo],
                           total_size: int, no_zip: bool, timeout: int,
-                          **kwargs):
+                          delta: bool = False, **kwargs):
     """
     同步文件到集群
     @param name: 文件标识
     @param file_type: 文件类型
     @param files: 文件列表
     @param total_size: 总共上传的大小
+    @param delta: 文件是增量上传的, 集群侧按 manifest 拼文件
     """
     token = kwargs.get('token', mars_token())
     completed_size = 0
@@ -225,7 +227,7 @@ async def sync_to_cluster(name: str, file_type: str, files: List[FileInfo],
             paths = [f.path for f in files[current_idx:current_idx + batch]]
             batch_size = sum([f.size for f in files[current_idx:current_idx + batch]])
             file_list = FileList(files=paths)
-            url = f'{mars_url()}/ugc/sync_to_cluster?token={token}&name={name}&file_type={file_type}&no_zip={no_zip}'
+            url = f'{mars_url()}/ugc/sync_to_cluster?token={token}&name={name}&file_type={file_type}&no_zip={no_zip}&delta={delta}'
             result = await async_requests(
                 RequestMethod.POST,
                 url,
@@ -317,7 +319,8 @@ async def push_to_cluster(provider: str,
                           cloud_connect_timeout: int = 120,
                           token_expires: int = 1800,
                           part_mb_size: int = 100,
-                          proxy: str = ''):
+                          proxy: str = '',
+                          delta: bool = False):
     """
     上传本地文件目录到云端 bucket，并删除远端孤儿目录，保持本地和远端目录一致
     @param local_path: 本地工作区目录
@@ -327,6 +330,7 @@ async def push_to_cluster(provider: str,
     @param force: 是否强制推送并覆盖远端文件
     @param no_checksum: 是否禁用checksum
     @param no_hfignore: 是否禁用hfignore
+    @param delta: 是否按内容分块增量上传，只上传有变化的分块，会禁用打包上传
     """
     local_only_files, cluster_only_files, changed_files, _ = await diff_local_cluster(
         local_path,
@@ -354,6 +358,8 @@ async def push_to_cluster(provider: str,
         print('数据已同步，忽略本次操作')
         return True
 
+    if delta:
+        no_zip = True
     if not no_zip:
         print_bold(f'开始打包本地{file_type}目录...')
         zip_file_path = f'/tmp/{os.path.basename(local_path)}.zip'
@@ -385,10 +391,26 @@ async def push_to_cluster(provider: str,
             tzinfo=timezone.utc).astimezone(tz_utc_8) +
                      timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
         part_size = part_mb_size * 1048576
+        uploaded_chunks = set()
         for f in target_files:
             src_file = f'{local_path}/{f.path}' if no_zip else f'/tmp/{f.path}'
             dst_file = f'{remote_path}/{f.path}'
             try:
+                if delta:
+                    # 只上传云端没有的分块和 manifest, 之前已上传过的文件只会对比 manifest
+                    src_file_mode = oct(stat.S_IMODE(os.lstat(src_file).st_mode))
+                    upload_delta_with_retry(cloud_api,
+                                            bucket_name,
+                                            remote_path,
+                                            f.path,
+                                            src_file,
+                                            expire_at=expire_at,
+                                            tagging=f'filemode={src_file_mode}',
+                                            uploaded_chunks=uploaded_chunks,
+                                            percentage=percentage,
+                                            num_threads=4)
+                    completed_size += f.size
+                    continue
                 # 先校验云端是否有，避免打断情况下导致的重复上传，浪费带宽资源
                 skip = False
                 source = 'client'
@@ -432,7 +454,7 @@ async def push_to_cluster(provider: str,
     print_bold('(2/2) 上传成功，开始同步到集群，请等待...')
     try:
         await sync_to_cluster(name, file_type, target_files, completed_size,
-                              no_zip, sync_timeout)
+                              no_zip, sync_timeout, delta=delta)
     except Exception as e:
         print(str(e))
         return False
@@ -579,3 +601,15 @@ def resumable_upload_with_retry(cloud_api, bucket_name, key, filename, multipart
             else:
                 print(f'第{i}次上传失败: {str(e)}, 尝试重试...')
                 continue
+
+
+def upload_delta_with_retry(cloud_api, bucket_name, base, path, filename, retries=3, **kwargs):
+    for i in range(1, retries + 1):
+        try:
+            return upload_delta(cloud_api, bucket_name, base, path, filename, **kwargs)
+        except Exception as e:
+            if i == retries:
+                raise
+            else:
+                print(f'第{i}次上传失败: {str(e)}, 尝试重试...')
+                continue
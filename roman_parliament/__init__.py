@@ -1,7 +1,7 @@
 from .archive import register_archive, archive_dict, remove_archive_locally, cancel_archive, add_archive_for_senators
 from .archive_triggers import add_archive_trigger
 from .attr_hooks import set_attr_hooks
-from .monitor import register_parliament, withdraw_parliament, has_registered
+from .monitor import register_parliament, withdraw_parliament, has_registered, update_mass_key_list
 from .mass import set_mass_info
 
 __all__ = [
@@ -14,5 +14,6 @@ __all__ = [
     'add_archive_trigger',  # 添加 trigger
     'remove_archive_locally',  # 在档案袋中删除该档案
     'set_mass_info',  # 设置群众信息
-    'withdraw_parliament'  # 退出议会，只有群众才会走这个接口
+    'withdraw_parliament',  # 退出议会，只有群众才会走这个接口
+    'update_mass_key_list'  # 更新群众订阅的档案，只有群众才会走这个接口
 ]
@@ -1,6 +1,7 @@
 
 
 import os
+import threading
 from roman_parliament.archive import register_archive, archive_dict
 from roman_parliament.utils import generate_key
 from server_model.selector import TrainingTaskSelector
@@ -18,6 +19,9 @@ class LauncherTaskTrigger(BaseTrigger):
     """
     launcher 专用，订阅启动任务的 trigger
     """
+    # 有新任务放进档案袋时 set, launcher 等在这上面, 不用一直轮询档案袋
+    archive_event = threading.Event()
+
     @classmethod
     def create_archive(cls, data):
         if CURRENT_LAUNCHER >= 0:
@@ -29,3 +33,4 @@ class LauncherTaskTrigger(BaseTrigger):
                     task = TrainingTaskSelector.find_one_by_id(AutoTaskSchemaImpl, id=task_id)
                     if task.task_type in [TASK_TYPE.JUPYTER_TASK, TASK_TYPE.TRAINING_TASK, TASK_TYPE.VALIDATION_TASK, TASK_TYPE.BACKGROUND_TASK]:
                         register_archive(archive=task, sign='id')
+                        cls.archive_event.set()
@@ -6,7 +6,7 @@ from .data_processor import DataProcessor
 from .backends import backend
 from .attr_hooks import set_attr_hooks
 from .utils import is_senator
-from .mass import get_mass_info, record_mass
+from .mass import get_mass_info, record_mass, set_mass_info
 from conf.flags import PARLIAMENT_SOURCE_TYPE
 from conf import CONF
 from logm import logger
@@ -65,6 +65,25 @@ def register_parliament():
             time.sleep(retried_times * 10)
 
 
+def update_mass_key_list(key_list):
+    """
+    群众订阅的档案有变化时（比如一个进程管理的任务有增减），重新告知议员
+    :param key_list: List[str]，新的档案key列表
+    """
+    old_key_list, mass_name = get_mass_info()
+    set_mass_info(key_list=key_list, mass_name=mass_name)
+    key_list, _ = get_mass_info()
+    data = {
+        'key_list': key_list,
+        'mass_name': mass_name
+    }
+    # 先注销再注册，议员那边旧的key才会被清掉
+    backend.set({'source': PARLIAMENT_SOURCE_TYPE.CANCEL_MASS, 'data': {'mass_name': mass_name}})
+    backend.set({'source': PARLIAMENT_SOURCE_TYPE.REGISTER_MASS, 'data': data})
+    redis_conn.srem(CONF.parliament.mass_set, pickle.dumps({'key_list': old_key_list, 'mass_name': mass_name}))
+    redis_conn.sadd(CONF.parliament.mass_set, pickle.dumps(data))
+
+
 def withdraw_parliament(mass_name):
     data = {
         'mass_name': mass_name
@@ -1,6 +1,6 @@
 import functools
-import inspect
 import os
+import sys
 import time
 from collections import defaultdict
 from typing import Dict
@@ -12,6 +12,7 @@ from logm import logger
 from k8s import K8sPreStopHook
 from .base_types import TickData
 from .connection import ProcessConnection
+from .instrument import Span, SpanRecorder
 
 
 class TickDataDescriptor(object):
@@ -55,7 +56,7 @@ class BaseProcessor(object):
         self.__global_config_conn = global_config_conn
         self.__last_perf_counter = -1
         self.__last_perf_counter_list = defaultdict(list)
-        self.__last_write_result = -1
+        self.__span_recorder = SpanRecorder()
 
     def _log(self, log_func, *args, **kwargs):
         with logger.contextualize(uuid=f'{self.name}#{self.seq}'):
@@ -75,6 +76,7 @@ class BaseProcessor(object):
         if self.upstreams.get(name):
             raise Exception('不能设置相同名字的 upstream')
         self.upstreams[name] = conn
+        conn.add_waiter(self.name)
         self.__upstream_seqs[name] = 0
 
     def register_global_config(self, **default_global_config):
@@ -93,14 +95,15 @@ class BaseProcessor(object):
     def waiting_for_upstream_data(self, upstream='default') -> TickData:
         """
         阻塞式调用，等待并返回某个上游的下一次数据，不一定正好是下一次，但一定比现在新
-        默认为 default
+        默认为 default，上游写入数据时会唤醒，超时醒来会再检查一次 seq
         """
-        while True:
-            if self.upstreams[upstream].header.seq > self.__upstream_seqs[upstream]:
-                upstream_data = self.upstreams[upstream].get()
-                self.__upstream_seqs[upstream] = upstream_data.seq
-                return upstream_data
-            time.sleep(0.001)
+        with self.span('wait_upstream'):
+            while True:
+                if self.upstreams[upstream].header.seq > self.__upstream_seqs[upstream]:
+                    upstream_data = self.upstreams[upstream].get()
+                    self.__upstream_seqs[upstream] = upstream_data.seq
+                    return upstream_data
+                self.upstreams[upstream].wait(self.name)
 
     def set_tick_data(self, tick_data=None):
         """
@@ -128,7 +131,8 @@ class BaseProcessor(object):
         self.valid = True
         if not self.__load_global_config():
             self.valid = False
-        self.user_tick_process()
+        with self.span('tick'):
+            self.user_tick_process()
         self.__write_result()
 
     def user_tick_process(self):
@@ -141,16 +145,24 @@ class BaseProcessor(object):
         self.metrics[name] = value
         self.debug(f'update metric {name} {value}')
 
+    def span(self, name: str) -> Span:
+        """
+        性能打点，with self.span('name'): ...，本 tick 的耗时 (ms) 会以 name 作为 metric 上报，见 instrument
+        """
+        return self.__span_recorder.span(name)
+
     def __write_result(self):
         """
         写入数据
         """
         self.tick_data.extra_data['registered_global_config'] = self.__registered_global_config
-        if self.__last_write_result > 0:
-            self.update_metric('write_result', self.__last_write_result)
-        self.perf_counter()
-        self.__conn.put(self.tick_data, seq=self.seq)
-        self.__last_write_result = self.perf_counter()
+        # write_result 本身的耗时在下一个 tick 上报
+        tick_values, perf = self.__span_recorder.flush()
+        for name, value in tick_values.items():
+            self.update_metric(name, value)
+        self.tick_data.extra_data['perf'] = perf
+        with self.span('write_result'):
+            self.__conn.put(self.tick_data, seq=self.seq)
 
     def __load_global_config(self):
         """
@@ -167,7 +179,7 @@ class BaseProcessor(object):
 
     def perf_counter(self, kind='last', keep=1, comp=0):
         """
-        返回距离上次调用经过的 ms 时间，简化 export 性能 metric
+        返回距离上次调用经过的 ms 时间，简化 export 性能 metric，新代码用 span 打点
         keep 为在当前调用位置保留几次数据
         case kind:
             last: 返回调用位置 perf 的最后一次数据（即本次调用的数据）
@@ -177,8 +189,9 @@ class BaseProcessor(object):
             lt_counter: 返回调用位置最近 keep 次数小于 comp 的次数
         """
         new_counter = time.perf_counter()
-        calframe = inspect.getouterframes(inspect.currentframe(), 2)[1]
-        caller = (calframe.filename, calframe.function, calframe.lineno)
+        # 只取调用者的 frame，不要用 inspect.getouterframes，它会读源码构造所有外层 frame 的信息
+        calframe = sys._getframe(1)
+        caller = (calframe.f_code.co_filename, calframe.f_code.co_name, calframe.f_lineno)
         if self.__last_perf_counter > 0:
             self.__last_perf_counter_list[caller].append((new_counter - self.__last_perf_counter) * 1000)
         self.__last_perf_counter_list[caller] = self.__last_perf_counter_list[caller][-keep:]
@@ -9,6 +9,7 @@ import pandas as pd
 
 from . import get_dfs
 from .base_processor import BaseProcessor
+from .instrument import timed
 from db import MarsDB
 from server_model.user_data import initialize_user_data_roaming
 from base_model.base_task import BaseTask
@@ -19,14 +20,16 @@ from roman_parliament import register_parliament
 class Beater(BaseProcessor):
     """
     Beater 负责每隔 interval 的毫秒数，就处理一次数据发出来
+    task_df_full_refresh_interval 大于 0 时增量获取 task_df，每隔这么多毫秒做一次全量查询兜底
     """
 
-    def __init__(self, *, get_dfs_module=get_dfs, interval: int, **kwargs):
+    def __init__(self, *, get_dfs_module=get_dfs, interval: int, task_df_full_refresh_interval: int = 0, **kwargs):
         self.interval = interval
         # 还在预热阶段
         self.warmup = True
         self._loop = None
         self.get_dfs_module = get_dfs_module
+        self.incremental_task_df = get_dfs.IncrementalTaskDf(task_df_full_refresh_interval) if task_df_full_refresh_interval > 0 else None
         super(Beater, self).__init__(**kwargs)
         self.__last_tick_data = self.tick_data
         self.runtime_config = TaskRuntimeConfig(BaseTask())
@@ -34,37 +37,39 @@ class Beater(BaseProcessor):
     def start(self):
         register_parliament()
         initialize_user_data_roaming(tables_to_subscribe=['scheduler_user'], overwrite_enable_roaming=True)
+        # 不是增量模式的话 task_runtime_config 的 trigger 不用 touch 任务行
+        get_dfs.set_task_df_incremental(self.incremental_task_df is not None)
         super(Beater, self).start()
 
     def user_tick_process(self):
         # 等下一个 tick 到来
         r = datetime.datetime.now().timestamp() * 1000 / self.interval
         next_step = int(r + 1)
-        time.sleep(self.interval * (next_step - r) / 1000)
+        with self.span('sleep'):
+            time.sleep(self.interval * (next_step - r) / 1000)
         self.get_tick_data(next_step * self.interval)
         self.feedback_modify()
         if self.valid:
             self.record_priority()
             self.__last_tick_data = self.tick_data
 
+    @timed('get_dfs')
     def get_tick_data(self, seq):
-        self.perf_counter()
         self.set_tick_data()
         self.valid = True
         self.seq = seq
-        self.task_df = self.get_dfs_module.get_task_df()
+        self.task_df = self.incremental_task_df.get() if self.incremental_task_df else self.get_dfs_module.get_task_df()
         self.user_df = self.get_dfs_module.get_user_df()
         self.resource_df = self.get_dfs_module.get_resource_df(self.loop)
         if len(self.resource_df) == 0:
             self.valid = False
             self.error('没有拿到可用节点，请检查')
-        self.update_metric('get_dfs', self.perf_counter())
 
+    @timed()
     def record_priority(self):
         """
         记录最真实的优先级只能在这个地方做掉
         """
-        self.perf_counter()
         priority_tick = int(time.time())
         priority_changed_tasks = \
             set((tid, pri) for tid, pri in zip(self.task_df.id, self.task_df.priority)) - \
@@ -73,7 +78,8 @@ class Beater(BaseProcessor):
         params = ()
         for task_id, priority in list(sorted(priority_changed_tasks)):
             task = self.task_df.loc[task_id]
-            running_priority = task.runtime_config_json.get('running_priority', [])
+            # 复制一份再改，不要改到增量缓存里的 task_df
+            running_priority = list(task.runtime_config_json.get('running_priority', []))
             if len(running_priority) == 0 or running_priority[-1]['priority'] != priority:
                 running_priority.append({
                     'priority': priority,
@@ -85,7 +91,6 @@ class Beater(BaseProcessor):
                 params += p
         if sql:
             MarsDB().execute(sql, params)
-        self.update_metric('record_priority', self.perf_counter())
 
     @property
     def loop(self):
@@ -94,11 +99,11 @@ class Beater(BaseProcessor):
             asyncio.set_event_loop(self._loop)
         return self._loop
 
+    @timed('feedback')
     def feedback_modify(self):
         """
         根据 FeedBacker 们的修改意见重写 df
         """
-        self.perf_counter()
         if self.warmup:
             # 还在预热阶段，直接发送就可以了
             self.valid = False
@@ -113,4 +118,3 @@ class Beater(BaseProcessor):
                 # 这样写感觉不是很直观，但暂时没想到更好的办法，这里需要定义操作，而不是传过来改动后的 df，因为有可能已经过时了
                 for exec_str in modifier.extra_data.get('exec_list', []):
                     exec(exec_str)
-        self.update_metric('feedback', self.perf_counter())
@@ -13,6 +13,8 @@ from scheduler.base_model.base_types import TickData
 
 # 默认 5 个 rotate 位置
 DEFAULT_ROTATE_NUM = CONF.scheduler.get('rotate_num', 5)
+# 等待上游数据时，最多阻塞多少秒就醒来检查一次，防止漏掉通知
+DEFAULT_WAIT_TIMEOUT = CONF.scheduler.get('upstream_wait_timeout', 1)
 Header = namedtuple('Header', ['seq', 'frames'])
 
 
@@ -28,6 +30,9 @@ class ProcessConnection(object):
     ):
         self.dumps = dumps
         self.loads = loads
+        self.shm_name = shm_name
+        # 等待方的名字 -> 信号量，put 的时候逐个唤醒
+        self.waiters = {}
         self.rotate_num = rotate_num
         self.header_size = (128 + 16 * rotate_num) * 2 + 1
         self.shm = posix_ipc.SharedMemory(shm_name, posix_ipc.O_CREAT, mode=0o777)
@@ -42,6 +47,49 @@ class ProcessConnection(object):
             for i in range(self.rotate_num):
                 self.put(init_obj)
 
+    def add_waiter(self, waiter_name):
+        """
+        注册一个等待方，put 之后会唤醒它，注意要在启动（fork）写入进程之前注册
+        """
+        if waiter_name not in self.waiters:
+            semaphore = posix_ipc.Semaphore(
+                f'{self.shm_name}_{waiter_name}_notify', posix_ipc.O_CREAT, mode=0o777, initial_value=0
+            )
+            # fork 出来的进程继承打开的信号量，不需要再按名字打开，名字直接删掉，进程都退出（包括被 kill）之后信号量就释放了
+            posix_ipc.unlink_semaphore(semaphore.name)
+            self.waiters[waiter_name] = semaphore
+
+    def close(self, unlink=False):
+        """
+        关掉信号量和 mmap，unlink 为 True 时把共享内存也删掉，下次会重新创建
+        """
+        for semaphore in self.waiters.values():
+            semaphore.close()
+        self.waiters = {}
+        self.mm.close()
+        self.shm.close_fd()
+        if unlink:
+            try:
+                posix_ipc.unlink_shared_memory(self.shm_name)
+            except posix_ipc.ExistentialError:  # 别的进程已经删掉了
+                pass
+
+    def notify(self):
+        for semaphore in self.waiters.values():
+            # 等待方醒来后会自己对比 seq，所以只需要保证有一次唤醒，不用累加
+            if semaphore.value == 0:
+                semaphore.release()
+
+    def wait(self, waiter_name, timeout=DEFAULT_WAIT_TIMEOUT) -> bool:
+        """
+        阻塞直到有新数据写入或者超时，超时返回 False
+        """
+        try:
+            self.waiters[waiter_name].acquire(timeout)
+            return True
+        except posix_ipc.BusyError:
+            return False
+
     def set_header(self, header: Header):
         # 我们是只有一个进程一秒钟一个脉冲 put obj，所以这样没有问题
         self.mm.seek(0)
@@ -93,3 +141,4 @@ class ProcessConnection(object):
         self.mm.seek(position)
         self.mm.write(pickle_bytes)
         self.set_header(Header(seq=seq, frames=(header.frames + [(position, pickle_bytes_length)])[-self.rotate_num:]))
+        self.notify()
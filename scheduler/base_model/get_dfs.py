@@ -1,5 +1,6 @@
 
 
+import time
 import pandas as pd
 
 from conf.flags import EXP_STATUS, QUE_STATUS, TASK_TYPE
@@ -23,8 +24,11 @@ def get_resource_df(loop):
     return df
 
 
-def get_task_df():
-    sql = f"""
+def get_task_df_sql(task_filter: str = 'true'):
+    """
+    task_df 的 sql，task_filter 作用在 unfinished_task_ng 上，用于只查部分任务
+    """
+    return f"""
     select
         "tmp".*,
         coalesce(("config_json"->'schema'->'resource'->'is_spot')::bool, false) as "is_spot_jupyter",
@@ -64,6 +68,7 @@ def get_task_df():
                 inner join "user" on "unfinished_task_ng"."user_name" = "user"."user_name"
                 left join "host" on "unfinished_task_ng"."assigned_nodes"[1] = "host"."node"
                 left join "pod_ng" on "unfinished_task_ng"."id" = "pod_ng"."task_id" and "pod_ng"."status" = '{EXP_STATUS.SUCCEEDED}'
+                where {task_filter}
                 group by "unfinished_task_ng"."id", "host"."node", "user"."role"
             ) as "tmp"
         ) as "tmp"
@@ -77,7 +82,10 @@ def get_task_df():
             "tmp"."scheduler_msg", "tmp"."created_seconds"
     ) as "tmp"
     """
-    task_df = pd.DataFrame.from_records([{**res} for res in MarsDB().execute(sql)])
+
+
+def format_task_df(records) -> pd.DataFrame:
+    task_df = pd.DataFrame.from_records([{**res} for res in records])
     if len(task_df) == 0:
         task_df = SAMPLE_TICK_DATA.task_df.copy()
     # index 存为 task_id，方便使用
@@ -90,6 +98,73 @@ def get_task_df():
     return task_df
 
 
+def get_task_df():
+    return format_task_df(MarsDB().execute(get_task_df_sql()))
+
+
+def set_task_df_incremental(enabled: bool):
+    """
+    task_runtime_config 的 trigger 只在增量模式下 touch 任务行 (见 db_schemas/035)，由 beater 启动时设置
+    """
+    MarsDB().execute('''
+    insert into "multi_server_config" ("key", "value", "module")
+    values ('task_df_incremental', %s, 'beater')
+    on conflict ("key", "module") do update set "value" = excluded."value"
+    ''', ('true' if enabled else 'false', ))
+
+
+class IncrementalTaskDf(object):
+    """
+    增量地获取 task_df，保留上一次的结果，每次只查有变化的任务
+    通过 unfinished_task_ng 的 xmin 判断任务行有没有变化：
+        pod_ng 状态变化会通过 trigger 更新 worker_status，task_runtime_config 变化会通过 trigger touch 任务行，都会让 xmin 变化
+        (后者要先 set_task_df_incremental(True))
+    user 的 role、host 的 schedule_zone、multi_server_config 的变化不会体现在 xmin 上，靠定期全量刷新兜底
+    """
+
+    def __init__(self, full_refresh_interval: int):
+        # 全量刷新的间隔，单位 ms
+        self.full_refresh_interval = full_refresh_interval
+        self.task_df = None
+        # task_id -> xmin
+        self.versions = {}
+        self.db_now = None
+        self.last_full_refresh = 0
+
+    def get(self) -> pd.DataFrame:
+        full_refresh = self.task_df is None or (time.time() - self.last_full_refresh) * 1000 >= self.full_refresh_interval
+        # 同一个事务里的 current_timestamp 一样，running_seconds / created_seconds 才能对得上
+        with MarsDB() as conn:
+            db_now = conn.execute('select extract(epoch from current_timestamp)').scalar()
+            versions = dict(conn.execute('select "id", "xmin"::text from "unfinished_task_ng"').fetchall())
+            if full_refresh:
+                task_df = format_task_df(conn.execute(get_task_df_sql()))
+            else:
+                changed_ids = [task_id for task_id, version in versions.items() if self.versions.get(task_id) != version]
+                changed_task_df = format_task_df(
+                    conn.execute(get_task_df_sql('"unfinished_task_ng"."id" = any(%s)'), (changed_ids, ))
+                ) if changed_ids else None
+        if full_refresh:
+            self.last_full_refresh = time.time()
+        else:
+            task_df = self.task_df[self.task_df.index.isin(list(versions)) & ~self.task_df.index.isin(changed_ids)].copy()
+            # 没变化的任务只需要把时间往后推
+            task_df['running_seconds'] = task_df.running_seconds + (db_now - self.db_now)
+            task_df['created_seconds'] = task_df.created_seconds + (db_now - self.db_now)
+            if changed_task_df is not None and len(changed_task_df):
+                task_df = pd.concat([task_df, changed_task_df]) if len(task_df) else changed_task_df
+                task_df.sort_index(inplace=True)
+        self.task_df = task_df
+        self.versions = versions
+        self.db_now = db_now
+        # 调用方会在返回的 df 上原地修改，缓存的这份不能给出去
+        task_df = task_df.copy()
+        task_df['memory'] = None
+        task_df['cpu'] = None
+        task_df['assigned_gpus'] = None
+        return task_df
+
+
 def get_user_df():
     user_df = SchedulerUserTable.df
     if len(user_df) == 0:
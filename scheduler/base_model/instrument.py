@@ -0,0 +1,165 @@
+"""
+调度组件的性能打点:
+    with self.span('get_dfs'):          # 或者用 @timed('get_dfs') 装饰组件的方法
+        ...
+  - span 可以嵌套, 按调用栈记成 tick;get_dfs 这样的路径, 路径和 span 对象都会缓存, 打点只有两次 perf_counter 和几次 dict 操作
+  - 每个路径的耗时记在 HDR 风格的直方图里: 按 2 的幂分桶, 每个区间再线性分 SUB_BUCKETS 份, 相对误差 1 / SUB_BUCKETS
+  - 每个 tick 结束的时候, 本 tick 各 span 的耗时按名字作为 metrics 上报, 本 tick 的调用栈耗时 (collapsed stack 格式,
+    可以直接给 flamegraph.pl) 和累计的直方图放在 tick_data.extra_data['perf'] 里, 由 monitor 汇总导出
+"""
+import functools
+import math
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+
+SUB_BUCKETS = 16
+
+
+class LatencyHistogram(object):
+    """
+    毫秒耗时的直方图, counts 为 {桶号: 次数}, 只记有数据的桶
+    """
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self, counts: Dict[int, int] = None, total_sum: float = 0):
+        self.counts = counts if counts is not None else defaultdict(int)
+        self.count = sum(self.counts.values())
+        self.sum = total_sum
+
+    @staticmethod
+    def bucket_of(ms: float) -> int:
+        # 按微秒分桶, 1 微秒以下的都算 1 微秒
+        mantissa, exponent = math.frexp(max(ms * 1000, 1))
+        return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+    @staticmethod
+    def upper_bound(bucket: int) -> float:
+        exponent, sub = divmod(bucket, SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), exponent) / 1000
+
+    def record(self, ms: float):
+        self.counts[self.bucket_of(ms)] += 1
+        self.count += 1
+        self.sum += ms
+
+    def percentile(self, q: float) -> float:
+        """
+        q 分位数 (0 ~ 100) 所在桶的上界, 没有数据时返回 0
+        """
+        if self.count == 0:
+            return 0
+        target, seen = self.count * q / 100, 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return self.upper_bound(bucket)
+        return self.upper_bound(max(self.counts))
+
+    def cumulative(self, bounds: List[float]) -> List[int]:
+        """
+        不超过各个 bound (ms, 升序) 的累计次数, 跨 bound 的桶算到下一个 bound 里
+        """
+        result, buckets, i, seen = [], sorted(self.counts), 0, 0
+        for bound in bounds:
+            while i < len(buckets) and self.upper_bound(buckets[i]) <= bound:
+                seen += self.counts[buckets[i]]
+                i += 1
+            result.append(seen)
+        return result
+
+    def dump(self) -> Tuple[Dict[int, int], float]:
+        return dict(self.counts), self.sum
+
+    @classmethod
+    def load(cls, dumped: Tuple[Dict[int, int], float]) -> 'LatencyHistogram':
+        counts, total_sum = dumped
+        return cls(defaultdict(int, counts), total_sum)
+
+
+class Span(object):
+    """
+    同一个名字的 span 只有一个对象, 可以重复进入, 也可以递归嵌套
+    """
+    __slots__ = ('recorder', 'name', 'paths')
+
+    def __init__(self, recorder: 'SpanRecorder', name: str):
+        self.recorder = recorder
+        self.name = name
+        # 父路径 -> 自己的路径
+        self.paths = {}
+
+    def __enter__(self):
+        stack = self.recorder.stack
+        parent = stack[-1][0] if stack else None
+        path = self.paths.get(parent)
+        if path is None:
+            path = self.paths[parent] = self.name if parent is None else f'{parent};{self.name}'
+        stack.append((path, time.perf_counter()))
+        return self
+
+    def __exit__(self, *exc_info):
+        path, started_at = self.recorder.stack.pop()
+        self.recorder.record(path, self.name, (time.perf_counter() - started_at) * 1000)
+        return False
+
+
+class SpanRecorder(object):
+
+    def __init__(self):
+        self.spans: Dict[str, Span] = {}
+        self.stack: List[Tuple[str, float]] = []
+        self.histograms: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        # 本 tick 的数据: span 名字 -> ms, 路径 -> ms
+        self.tick_values: Dict[str, float] = defaultdict(float)
+        self.tick_paths: Dict[str, float] = defaultdict(float)
+
+    def span(self, name: str) -> Span:
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = Span(self, name)
+        return span
+
+    def record(self, path: str, name: str, ms: float):
+        self.tick_values[name] += ms
+        self.tick_paths[path] += ms
+        self.histograms[path].record(ms)
+
+    def flush(self) -> Tuple[Dict[str, float], dict]:
+        """
+        结束一个 tick, 返回本 tick 各 span 的耗时, 以及给 monitor 的 perf 数据
+        """
+        tick_values, tick_paths = self.tick_values, self.tick_paths
+        self.tick_values, self.tick_paths = defaultdict(float), defaultdict(float)
+        return dict(tick_values), {
+            'flame': dict(tick_paths),
+            'histograms': {path: histogram.dump() for path, histogram in self.histograms.items()},
+        }
+
+
+def timed(name: str = None):
+    """
+    把组件的方法整个记成一个 span, 默认用方法名
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.span(span_name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collapsed_stacks(flame: Dict[str, float], prefix: str = '') -> List[str]:
+    """
+    路径耗时转成 flamegraph.pl 的输入, 每行 "a;b;c 自身耗时(微秒)", 自身耗时 = 总耗时 - 子 span 的总耗时
+    """
+    self_ms = dict(flame)
+    for path, ms in flame.items():
+        parent = path.rpartition(';')[0]
+        if parent in self_ms:
+            self_ms[parent] -= ms
+    return [f'{prefix}{path} {max(int(ms * 1000), 0)}' for path, ms in sorted(self_ms.items())]
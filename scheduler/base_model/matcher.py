@@ -1,3 +1,5 @@
+import time
+
 import pandas as pd
 import ujson
 from sqlalchemy.engine import Connection
@@ -25,6 +27,13 @@ def modify_task_df_safely(task_df, task_id, **kwargs):
     return task_df
 
 
+def stop_signal(stop_code):
+    """
+    pipeline 里的 lpush 不会经过 db.redis 里加 hf_timestamp 的 patch，这里自己加上
+    """
+    return ujson.dumps({'stop_code': stop_code, 'hf_timestamp': time.time()})
+
+
 class InsertTaskTimeout(Exception):
     """上次插入任务超时了"""
     pass
@@ -44,13 +53,15 @@ class Matcher(BaseProcessor):
 
     def user_tick_process(self):
         # match
-        self.process_match()
+        with self.span('process_match'):
+            self.process_match()
         # apply_db & send_signal
         if self.valid:
             try:
-                with MarsDB() as conn:
+                with self.span('apply_db'), MarsDB() as conn:
                     self.apply_db(conn)
-                self.send_signal()
+                with self.span('send_signal'):
+                    self.send_signal()
             except InsertTaskTimeout as e:
                 self.info(str(e))
             except Exception as e:
@@ -76,44 +87,69 @@ class Matcher(BaseProcessor):
         self.tasks_to_stop_df = self.task_df[self.task_df.match_result == MATCH_RESULT.STOP]
         if not any([len(self.tasks_to_start_df), len(self.tasks_to_suspend_df), len(self.tasks_to_stop_df)]):
             return
-        self.start_db_task(conn)
-        self.stop_db_task(conn)
-        self.suspend_db_task(conn)
+        with self.span('start_db_task'):
+            self.start_db_task(conn)
+        with self.span('stop_db_task'):
+            self.stop_db_task(conn)
+        with self.span('suspend_db_task'):
+            self.suspend_db_task(conn)
 
     def start_db_task(self, conn: Connection):
-        for _, row in self.tasks_to_start_df.sort_index().iterrows():
-            sql, params = f"""
-                update "unfinished_task_ng" 
-                set  "queue_status" = %s, "assigned_nodes" = %s, "config_json" = "config_json" || %s, "worker_status" = %s
-                where "id" = %s and "queue_status" = %s
-                returning "unfinished_task_ng"."id"
-            """, (
-                QUE_STATUS.SCHEDULED,
-                row.assigned_nodes,
-                ujson.dumps({
+        """
+        一条 sql 启动所有任务，只更新还在排队的任务，有任务没更新到就整体回滚
+        """
+        if len(self.tasks_to_start_df) == 0:
+            return
+        tasks_to_start = self.tasks_to_start_df.sort_index()
+        started_tasks = [
+            {
+                'id': int(task_id),
+                'assigned_nodes': assigned_nodes,
+                'config_json': {
                     'assigned_resource': {
-                        'memory': row.memory,
-                        'cpu': row.cpu,
-                        'assigned_gpus': row.assigned_gpus,
-                        'assigned_numa': row.assigned_numa
+                        'memory': memory,
+                        'cpu': cpu,
+                        'assigned_gpus': assigned_gpus,
+                        'assigned_numa': assigned_numa
                     }
-                }),
-                EXP_STATUS.CREATED,
-                row.id,
-                QUE_STATUS.QUEUED
+                }
+            }
+            for task_id, assigned_nodes, memory, cpu, assigned_gpus, assigned_numa in zip(
+                tasks_to_start.id, tasks_to_start.assigned_nodes, tasks_to_start.memory, tasks_to_start.cpu,
+                tasks_to_start.assigned_gpus, tasks_to_start.assigned_numa
             )
-            # self.info(f'[SQL] ' + sql.replace("\n", " ").strip() + f' {params}')
-            res = conn.execute(sql, params).fetchall()
-            if len(res) == 0:
-                raise InsertTaskTimeout('这个任务已经不是排队状态了，可能用户停止了 / 上一个 tick 已经调度到这个任务了')
+        ]
+        res = conn.execute(f"""
+            update "unfinished_task_ng"
+            set
+                "queue_status" = %s, "assigned_nodes" = "started"."assigned_nodes",
+                "config_json" = "unfinished_task_ng"."config_json" || "started"."config_json", "worker_status" = %s
+            from jsonb_to_recordset(cast(%s as jsonb)) as "started"("id" integer, "assigned_nodes" varchar[], "config_json" jsonb)
+            where "unfinished_task_ng"."id" = "started"."id" and "unfinished_task_ng"."queue_status" = %s
+            returning "unfinished_task_ng"."id"
+        """, (QUE_STATUS.SCHEDULED, EXP_STATUS.CREATED, ujson.dumps(started_tasks), QUE_STATUS.QUEUED)).fetchall()
+        not_queued_ids = {t['id'] for t in started_tasks} - {r[0] for r in res}
+        if not_queued_ids:
+            raise InsertTaskTimeout(f'任务 {sorted(not_queued_ids)} 已经不是排队状态了，可能用户停止了 / 上一个 tick 已经调度到这个任务了')
 
     def stop_db_task(self, conn: Connection):
-        for _, task in self.tasks_to_stop_df.iterrows():
-            conn.execute(f'''
-            update "unfinished_task_ng" set "queue_status" = %s where "id" = %s and "queue_status" = %s
-            ''', (QUE_STATUS.FINISHED, task.id, QUE_STATUS.QUEUED))
-            redis_conn.set(f'ban:{task.user_name}:{task.nb_name}:{task.chain_id}', 1)  # 防止重启
-            redis_conn.lpush(f'{CONF.manager.stop_channel}:suspend:{task.id}', ujson.dumps({'stop_code': STOP_CODE.STOP}))
+        """
+        一条 sql 停止所有任务，redis 的信号走一个 pipeline
+        """
+        if len(self.tasks_to_stop_df) == 0:
+            return
+        stop_ids = [int(task_id) for task_id in self.tasks_to_stop_df.id]
+        res = conn.execute(f'''
+        update "unfinished_task_ng" set "queue_status" = %s where "id" = any(%s) and "queue_status" = %s
+        returning "id"
+        ''', (QUE_STATUS.FINISHED, stop_ids, QUE_STATUS.QUEUED)).fetchall()
+        if not_queued_ids := set(stop_ids) - {r[0] for r in res}:
+            self.info(f'任务 {sorted(not_queued_ids)} 已经不是排队状态了，不用在数据库里停止')
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for task_id, user_name, nb_name, chain_id in zip(stop_ids, self.tasks_to_stop_df.user_name, self.tasks_to_stop_df.nb_name, self.tasks_to_stop_df.chain_id):
+                pipe.set(f'ban:{user_name}:{nb_name}:{chain_id}', 1)  # 防止重启
+                pipe.lpush(f'{CONF.manager.stop_channel}:suspend:{task_id}', stop_signal(STOP_CODE.STOP))
+            pipe.execute()
 
     def suspend_db_task(self, conn: Connection):
         pass
@@ -123,11 +159,11 @@ class Matcher(BaseProcessor):
         发送起停信号
         """
         try:
-            for tid in self.tasks_to_suspend_df.id.to_list():
-                redis_conn.lpush(
-                    f'{CONF.manager.stop_channel}:suspend:{tid}',
-                    ujson.dumps({'stop_code': STOP_CODE.INTERRUPT})
-                )
+            if len(self.tasks_to_suspend_df):
+                with redis_conn.pipeline(transaction=False) as pipe:
+                    for tid in self.tasks_to_suspend_df.id.to_list():
+                        pipe.lpush(f'{CONF.manager.stop_channel}:suspend:{tid}', stop_signal(STOP_CODE.INTERRUPT))
+                    pipe.execute()
         except Exception as e:
             logger.exception(e)
         try:
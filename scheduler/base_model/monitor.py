@@ -6,10 +6,46 @@ import ujson
 import psutil
 import datetime
 
+from prometheus_client import start_http_server
+from prometheus_client.core import REGISTRY, GaugeMetricFamily, HistogramMetricFamily
+
 from conf import CONF
 from db import MarsDB
 from .base_processor import BaseProcessor
 from .connection import ProcessConnection
+from .instrument import LatencyHistogram, collapsed_stacks
+
+
+# 导出到 prometheus 的 span 耗时分桶 (秒)
+SPAN_SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class MonitorCollector(object):
+    """
+    抓取的时候把 monitor 汇总的 tick_metrics 和各模块的 span 数据转成 prometheus 指标
+    """
+    def __init__(self, monitor: 'Monitor'):
+        self.monitor = monitor
+
+    def collect(self):
+        tick_metric = GaugeMetricFamily('scheduler_tick_metric', '各个模块最近一个 tick 上报的 metrics', labels=['module', 'name'])
+        for key, value in self.monitor.tick_metrics.items():
+            module, name = key.split(',', 1)
+            if isinstance(value, (int, float)):
+                tick_metric.add_metric([module, name], value)
+        span_last = GaugeMetricFamily('scheduler_span_last_seconds', '各个模块最近一个 tick 每个调用栈路径的耗时', labels=['module', 'path'])
+        span_seconds = HistogramMetricFamily('scheduler_span_seconds', '各个模块每个调用栈路径的耗时分布', labels=['module', 'path'])
+        bounds = [bound * 1000 for bound in SPAN_SECONDS_BUCKETS]
+        for module, perf in self.monitor.perf.items():
+            for path, ms in perf['flame'].items():
+                span_last.add_metric([module, path], ms / 1000)
+            for path, dumped in perf['histograms'].items():
+                histogram = LatencyHistogram.load(dumped)
+                buckets = [(str(bound), count) for bound, count in zip(SPAN_SECONDS_BUCKETS, histogram.cumulative(bounds))]
+                span_seconds.add_metric([module, path], buckets + [('+Inf', histogram.count)], histogram.sum / 1000)
+        yield tick_metric
+        yield span_last
+        yield span_seconds
 
 
 class Monitor(BaseProcessor):
@@ -32,6 +68,8 @@ class Monitor(BaseProcessor):
         self.global_config_conn = global_config_conn
         self.check_interval = check_interval
         self.tick_metrics = {}
+        # 各模块最近一个 tick 的 span 数据，见 instrument
+        self.perf = {}
         for name, module in scheduler_modules.items():
             self.add_upstream(name, module['conn'])
             self.upstream_seqs[name] = -1
@@ -49,12 +87,27 @@ class Monitor(BaseProcessor):
         ''', (global_config_key, ujson.dumps(global_config_value), 'scheduler'))
         self.global_config_conn.put(self.global_config)
 
+    def start(self):
+        metrics_port = CONF.try_get('scheduler.metrics_port', default=0)
+        if metrics_port:
+            REGISTRY.register(MonitorCollector(self))
+            start_http_server(metrics_port)
+            self.info(f'scheduler metrics 暴露在 {metrics_port} 端口')
+        super(Monitor, self).start()
+
+    def flamegraph(self) -> str:
+        """
+        各模块最近一个 tick 的耗时分布，collapsed stack 格式，可以直接给 flamegraph.pl 画图
+        """
+        return '\n'.join(line for name, perf in self.perf.items() for line in collapsed_stacks(perf['flame'], prefix=f'{name};'))
+
     def user_tick_process(self):
         # 每个整秒进行监控
         ts = datetime.datetime.now().timestamp()
         self.seq = 1000 * (int(ts) + 1)
         time.sleep(int(ts) + 1 - ts)
         tick_metrics = {}
+        perf = {}
         for name, module_config in self.scheduler_modules.items():
             if not module_config['process'].is_alive():
                 self.f_error(f'{name} 进程死了，尝试重启')
@@ -71,9 +124,14 @@ class Monitor(BaseProcessor):
             tick_metrics = {**{
                 f'{name},{k}': v for k, v in tick_data.metrics.items()
             }, **tick_metrics}
+            if 'perf' in tick_data.extra_data:
+                perf[name] = tick_data.extra_data['perf']
             registered_global_config = tick_data.extra_data.get('registered_global_config', {})
             for k, v in registered_global_config.items():
                 # 如果还没有这项全局配置，就加上，赋予默认值
                 if self.global_config.get(k) is None:
                     self.set_global_config(k, v)
         self.tick_metrics = tick_metrics
+        self.perf = perf
+        if self.seq % self.check_interval == 0:
+            self.debug(f'各模块耗时分布:\n{self.flamegraph()}')
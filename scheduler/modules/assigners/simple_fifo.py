@@ -1,10 +1,60 @@
 
 
-import copy
+import numpy as np
+import pandas as pd
 from conf.flags import TASK_TYPE, TASK_PRIORITY, CHAIN_STATUS, QUE_STATUS
 from scheduler.base_model import Assigner, ASSIGN_RESULT
 
 
+def quota_cascade(task_df: pd.DataFrame, raw_quota: dict):
+    """
+    按 task_df 的顺序从前往后挑出 quota 内的任务，返回每个任务的 assign_result 和 priority（AUTO 任务会确定下优先级）
+    固定优先级的任务只占用自己 (user_name, priority, group) 的 quota，放不下就跳过，后面小的任务还可以放
+    AUTO 任务按优先级从高到低找第一个放得下的 quota
+    """
+    user_names = task_df.user_name.to_numpy()
+    groups = task_df.group.to_numpy()
+    priorities = task_df.priority.to_numpy().copy()
+    nodes = task_df.nodes.to_numpy()
+    assign_results = np.full(len(task_df), ASSIGN_RESULT.OUT_OF_QUOTA, dtype=object)
+    if len(task_df) == 0:
+        return assign_results, priorities
+    task_quota = np.array([raw_quota.get(key, 0) for key in zip(user_names.tolist(), priorities.tolist(), groups.tolist())])
+    is_auto = priorities == TASK_PRIORITY.AUTO.value
+    auto_user_groups = set(zip(user_names[is_auto].tolist(), groups[is_auto].tolist()))
+    # 没有 AUTO 任务参与的 key，如果整个 key 的需求都在 quota 内，那每个任务都能放下，不需要逐个计算
+    key_demand = pd.Series(nodes).groupby([user_names, priorities, groups]).transform('sum').to_numpy()
+    no_auto = np.array([key not in auto_user_groups for key in zip(user_names.tolist(), groups.tolist())], dtype=bool)
+    all_fit = ~is_auto & no_auto & (key_demand <= task_quota)
+    assign_results[all_fit] = ASSIGN_RESULT.NOT_SURE
+    # 剩下的按顺序逐个计算，用 python 原生类型，避免在循环里碰 pandas
+    remaining_quota = dict(raw_quota)
+    max_user_group_quota = {}
+    for (user_name, priority, group), quota in raw_quota.items():
+        max_user_group_quota[user_name, group] = max(max_user_group_quota.get((user_name, group), quota), quota)
+    all_priorities = [priority_level.value for priority_level in TASK_PRIORITY.all_priorities()]
+    user_name_list, group_list, priority_list, nodes_list = user_names.tolist(), groups.tolist(), priorities.tolist(), nodes.tolist()
+    for i in np.flatnonzero(~all_fit).tolist():
+        user_name, group, priority, task_nodes = user_name_list[i], group_list[i], priority_list[i], nodes_list[i]
+        if priority != TASK_PRIORITY.AUTO.value:
+            if remaining_quota.get((user_name, priority, group), 0) - task_nodes >= 0:
+                assign_results[i] = ASSIGN_RESULT.NOT_SURE
+                remaining_quota[user_name, priority, group] -= task_nodes
+            elif task_quota[i] < task_nodes:
+                assign_results[i] = ASSIGN_RESULT.QUOTA_EXCEEDED
+        else:
+            for priority_level in all_priorities:
+                if remaining_quota.get((user_name, priority_level, group), 0) - task_nodes >= 0:
+                    assign_results[i] = ASSIGN_RESULT.NOT_SURE
+                    priorities[i] = priority_level
+                    remaining_quota[user_name, priority_level, group] -= task_nodes
+                    break
+            else:
+                if task_nodes > max_user_group_quota.get((user_name, group), 0):
+                    assign_results[i] = ASSIGN_RESULT.QUOTA_EXCEEDED
+    return assign_results, priorities
+
+
 class FIFOAssigner(Assigner):
     """
     一个简单的 FIFO 分配器示例，从前往后选择尽可能多的可以运行的任务，如果有性能需求，建议另行实现
@@ -15,25 +65,11 @@ class FIFOAssigner(Assigner):
         选出 quota 内的任务
         """
         self.task_df = self.task_df[self.task_df.task_type == TASK_TYPE.TRAINING_TASK].copy()
-        self.task_df.assign_result = ASSIGN_RESULT.OUT_OF_QUOTA
         raw_user_training_quota = self.user_df[self.user_df.active & (self.user_df.resource == 'node')].groupby(['user_name', 'priority', 'group']).quota.max().to_dict()
-        user_training_quota = copy.deepcopy(raw_user_training_quota)
-        for _, task in self.task_df.sort_values(['custom_rank', 'first_id']).iterrows():
-            if task.priority != TASK_PRIORITY.AUTO.value:
-                if user_training_quota.get((task.user_name, task.priority, task.group), 0) - task.nodes >= 0:
-                    self.task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.NOT_SURE
-                    user_training_quota[task.user_name, task.priority, task.group] -= task.nodes
-                elif raw_user_training_quota.get((task.user_name, task.priority, task.group), 0) < task.nodes:
-                    self.task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.QUOTA_EXCEEDED
-            else:
-                for priority_level in TASK_PRIORITY.all_priorities():
-                    if user_training_quota.get((task.user_name, priority_level.value, task.group), 0) - task.nodes >= 0:
-                        self.task_df.loc[task.id, ['priority', 'assign_result']] = [priority_level.value, ASSIGN_RESULT.NOT_SURE]
-                        user_training_quota[task.user_name, priority_level.value, task.group] -= task.nodes
-                        break
-                else:
-                    if task.nodes > max(quota for (user_name, priority, group), quota in raw_user_training_quota.items() if user_name == task.user_name and group == task.group):
-                        self.task_df.loc[task.id, 'assign_result'] = ASSIGN_RESULT.QUOTA_EXCEEDED
+        ordered_task_df = self.task_df.sort_values(['custom_rank', 'first_id'])
+        assign_results, priorities = quota_cascade(ordered_task_df, raw_user_training_quota)
+        self.task_df['assign_result'] = pd.Series(assign_results, index=ordered_task_df.index, dtype=object)
+        self.task_df['priority'] = pd.Series(priorities, index=ordered_task_df.index)
 
     def process_schedule(self):
         self.task_df['chain_status'] = CHAIN_STATUS.RUNNING
@@ -0,0 +1,168 @@
+from collections import defaultdict
+from typing import Iterable, List, Optional
+
+
+class IndexedSet(object):
+    """
+    list + 位置索引 实现的集合，add / discard / pop 都是 O(1)
+    """
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def pop(self):
+        item = self.items.pop()
+        del self.positions[item]
+        return item
+
+
+class NodePool(object):
+    """
+    一个分组里可分配节点的池子，撮合器可以复用
+    节点用整数下标表示，每个节点处于 FREE / WORKING 其中一个状态，或者已经被分配出去（不在池子里）
+    每个状态下的节点按 spine -> leaf 分桶，按名字取走 / 还回单个节点是 O(1) 的
+    allocate 的时候按拓扑选节点：尽量放在一个 leaf 里，放不下就尽量放在一个 spine 里
+    """
+    FREE = 'free'
+    WORKING = 'working'
+
+    def __init__(self, names: Iterable[str] = (), spines: Optional[Iterable] = None, leaves: Optional[Iterable] = None):
+        self.names: List[str] = []
+        self.node_index = {}
+        self.node_topology = []
+        self.node_state = []
+        self.buckets = {state: defaultdict(lambda: defaultdict(IndexedSet)) for state in (self.FREE, self.WORKING)}
+        self.spine_counts = {state: defaultdict(int) for state in (self.FREE, self.WORKING)}
+        self.counts = {self.FREE: 0, self.WORKING: 0}
+        names = list(names)
+        spines = [None] * len(names) if spines is None else list(spines)
+        leaves = [None] * len(names) if leaves is None else list(leaves)
+        for name, spine, leaf in zip(names, spines, leaves):
+            self.add(name, spine=spine, leaf=leaf)
+
+    def add(self, name, spine=None, leaf=None, state=FREE):
+        if name in self.node_index:
+            return
+        # 没有打拓扑标签的节点是 NaN，统一成 None，放在同一个桶里
+        spine = None if spine != spine else spine
+        leaf = None if leaf != leaf else leaf
+        self.node_index[name] = len(self.names)
+        self.names.append(name)
+        self.node_topology.append((spine, leaf))
+        self.node_state.append(None)
+        self._put(self.node_index[name], state)
+
+    def _put(self, index, state):
+        spine, leaf = self.node_topology[index]
+        self.buckets[state][spine][leaf].add(index)
+        self.spine_counts[state][spine] += 1
+        self.counts[state] += 1
+        self.node_state[index] = state
+
+    def _remove(self, index):
+        state = self.node_state[index]
+        spine, leaf = self.node_topology[index]
+        self.buckets[state][spine][leaf].discard(index)
+        self.spine_counts[state][spine] -= 1
+        self.counts[state] -= 1
+        self.node_state[index] = None
+
+    def count(self, state=FREE) -> int:
+        return self.counts[state]
+
+    def state_of(self, name):
+        index = self.node_index.get(name)
+        return None if index is None else self.node_state[index]
+
+    def move(self, names: Iterable[str], from_state=FREE, to_state=WORKING) -> List[str]:
+        """
+        把处于 from_state 的节点挪到 to_state，返回挪动了的节点
+        """
+        moved = []
+        for name in names:
+            index = self.node_index.get(name)
+            if index is not None and self.node_state[index] == from_state:
+                self._remove(index)
+                self._put(index, to_state)
+                moved.append(name)
+        return moved
+
+    def take(self, names: Iterable[str], state=FREE) -> List[str]:
+        """
+        把指定的、处于 state 的节点分配出去，返回分配到的节点
+        """
+        taken = []
+        for name in names:
+            index = self.node_index.get(name)
+            if index is not None and self.node_state[index] == state:
+                self._remove(index)
+                taken.append(name)
+        return taken
+
+    def release(self, names: Iterable[str], state=FREE):
+        """
+        把分配出去的节点还回池子
+        """
+        for name in names:
+            index = self.node_index.get(name)
+            if index is not None and self.node_state[index] is None:
+                self._put(index, state)
+
+    def allocate(self, n: int, state=FREE) -> List[str]:
+        """
+        从 state 里按拓扑选出 n 个节点分配出去，不够的话不分配，返回空列表
+        """
+        if n <= 0 or self.counts[state] < n:
+            return []
+        buckets = self.buckets[state]
+        spine_counts = self.spine_counts[state]
+        # 先找能放下的最小的 leaf，把大的 leaf 留给大任务
+        best_leaf = min(
+            ((len(nodes), spine, leaf) for spine, leaves in buckets.items() for leaf, nodes in leaves.items() if len(nodes) >= n),
+            key=lambda t: t[0], default=None
+        )
+        if best_leaf is not None:
+            candidates = [(best_leaf[1], best_leaf[2])]
+        else:
+            # 再找能放下的最小的 spine，都放不下就从大的 spine 开始拿
+            fit_spines = [spine for spine, count in spine_counts.items() if count >= n]
+            if fit_spines:
+                spine_order = [min(fit_spines, key=lambda s: spine_counts[s])]
+            else:
+                spine_order = sorted((s for s in spine_counts if spine_counts[s] > 0), key=lambda s: -spine_counts[s])
+            candidates = [
+                (spine, leaf)
+                for spine in spine_order
+                for leaf, _ in sorted(buckets[spine].items(), key=lambda item: -len(item[1]))
+            ]
+        allocated = []
+        for spine, leaf in candidates:
+            nodes = buckets[spine][leaf]
+            while len(nodes) and len(allocated) < n:
+                index = nodes.items[-1]
+                self._remove(index)
+                allocated.append(self.names[index])
+            if len(allocated) == n:
+                break
+        return allocated
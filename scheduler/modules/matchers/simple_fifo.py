@@ -1,14 +1,14 @@
 
 
-import random
 import pandas as pd
 from conf.flags import QUE_STATUS, TASK_TYPE
 from scheduler.base_model import Matcher, ASSIGN_RESULT, MATCH_RESULT
+from .node_pool import NodePool
 
 
 class FIFOMatcher(Matcher):
     """
-    一个简单的 FIFO 撮合器示例，从前往后选择尽可能多的可以运行的任务
+    一个简单的 FIFO 撮合器示例，从前往后选择尽可能多的可以运行的任务，节点按 leaf / spine 拓扑就近分配
     """
     re_signal_where = f''' "unfinished_task_ng"."task_type" = '{TASK_TYPE.TRAINING_TASK}' '''
     def __init__(self, reserved_cpu=0, reserved_memory=0, **kwargs):
@@ -22,43 +22,38 @@ class FIFOMatcher(Matcher):
             (self.resource_df.status == 'Ready') &
             (self.resource_df.working.apply(lambda w: w is None).astype(bool) | (self.resource_df.working == 'training'))
             ]
-        group_available_nodes = available_resource_df.groupby('group').name.apply(set).to_dict()
-        group_available_nodes = {g: {'free': ns, 'working': set()} for g, ns in group_available_nodes.items()}
+        group_node_pools = {
+            group: NodePool(group_resource_df.name, spines=group_resource_df.spine, leaves=group_resource_df.leaf)
+            for group, group_resource_df in available_resource_df.groupby('group')
+        }
         can_run_task_df = self.task_df[self.task_df.assign_result == ASSIGN_RESULT.CAN_RUN].sort_values(['custom_rank', 'first_id']).sort_values('priority', kind='mergesort', ascending=False)
         running_task_df = can_run_task_df[can_run_task_df.queue_status == QUE_STATUS.SCHEDULED]
-        group_running_nodes = running_task_df.explode('assigned_nodes').groupby('group').assigned_nodes.apply(set).to_dict()
-        for group, g_running_nodes in group_running_nodes.items():
-            if group_available_nodes.get(group) is None:
-                group_available_nodes[group] = {'free': set(), 'working': set()}
-            t = group_available_nodes[group]['free'] & g_running_nodes
-            group_available_nodes[group]['free'] -= t
-            group_available_nodes[group]['working'] |= t
+        # 正在运行的任务占着的节点标记为 working
+        for group, g_running_nodes in running_task_df.explode('assigned_nodes').groupby('group').assigned_nodes:
+            group_node_pools.setdefault(group, NodePool()).move(g_running_nodes, NodePool.FREE, NodePool.WORKING)
         can_run_task_ids = set()
         task_id_assigned_nodes = {}
-        for _, task in can_run_task_df.iterrows():
-            if task.queue_status == QUE_STATUS.SCHEDULED:
-                this_task_assigned_nodes = group_available_nodes[task.group]['working'] & set(task.assigned_nodes)
-                if len(this_task_assigned_nodes) == task.nodes:
-                    can_run_task_ids.add(task.id)
-                    group_available_nodes[task.group]['working'] -= this_task_assigned_nodes
+        for task_id, group, queue_status, assigned_nodes, nodes in zip(
+                can_run_task_df.id, can_run_task_df.group, can_run_task_df.queue_status, can_run_task_df.assigned_nodes, can_run_task_df.nodes
+        ):
+            node_pool = group_node_pools.setdefault(group, NodePool())
+            if queue_status == QUE_STATUS.SCHEDULED:
+                this_task_assigned_nodes = node_pool.take(set(assigned_nodes), NodePool.WORKING)
+                if len(this_task_assigned_nodes) == nodes:
+                    can_run_task_ids.add(task_id)
                     continue
                 else:
-                    group_available_nodes[task.group]['working'] -= this_task_assigned_nodes
-                    group_available_nodes[task.group]['free'] |= this_task_assigned_nodes
-            if len(group_available_nodes[task.group]['free']) >= task.nodes:
-                this_task_assigned_nodes = random.sample(group_available_nodes[task.group]['free'], task.nodes)
-                group_available_nodes[task.group]['free'] -= set(this_task_assigned_nodes)
-            elif len(group_available_nodes[task.group]['free']) + len(group_available_nodes[task.group]['working']) >= task.nodes:
-                this_task_assigned_nodes = list(group_available_nodes[task.group]['free'])
-                group_available_nodes[task.group]['free'] = set()
-                rest_nodes = random.sample(group_available_nodes[task.group]['working'], task.nodes - len(group_available_nodes[task.group]['free']))
-                group_available_nodes[task.group]['working'] -= set(rest_nodes)
-                this_task_assigned_nodes += rest_nodes
+                    node_pool.release(this_task_assigned_nodes, NodePool.FREE)
+            free_count = node_pool.count(NodePool.FREE)
+            if free_count >= nodes:
+                this_task_assigned_nodes = node_pool.allocate(nodes, NodePool.FREE)
+            elif free_count + node_pool.count(NodePool.WORKING) >= nodes:
+                this_task_assigned_nodes = node_pool.allocate(free_count, NodePool.FREE) + node_pool.allocate(nodes - free_count, NodePool.WORKING)
             else:
                 continue
-            if task.queue_status == QUE_STATUS.QUEUED:
-                task_id_assigned_nodes[task.id] = this_task_assigned_nodes
-                can_run_task_ids.add(task.id)
+            if queue_status == QUE_STATUS.QUEUED:
+                task_id_assigned_nodes[task_id] = this_task_assigned_nodes
+                can_run_task_ids.add(task_id)
         node_resource = {
             n: {
                 "cpu": max(c - self.reserved_cpu, 0),
@@ -1,11 +1,13 @@
+import hashlib
 import time
 from collections import defaultdict
+from functools import cached_property
 
 import ujson
 import pandas as pd
 import os
 
-from typing import List
+from typing import Dict, List, Tuple
 
 from conf.server_flags import TASK_PRIORITY
 from db import redis_conn
@@ -13,18 +15,63 @@ from scheduler.base_model import Subscriber, TickData, ASSIGN_RESULT
 from conf.flags import QUE_STATUS, TASK_TYPE
 
 
+class BFFSharedData:
+    """
+    一个 tick 里各个处理单元共用的中间结果，第一次用到的时候算，整个 tick 只算一次
+    """
+    def __init__(self, tick_data: TickData):
+        self.tick_data = tick_data
+
+    @cached_property
+    def training_df(self) -> pd.DataFrame:
+        task_df = self.tick_data.task_df
+        return task_df[task_df.task_type == TASK_TYPE.TRAINING_TASK]
+
+    @cached_property
+    def training_by_status(self) -> Dict[str, pd.DataFrame]:
+        return dict(tuple(self.training_df.groupby('queue_status')))
+
+    def training_status_df(self, queue_status) -> pd.DataFrame:
+        return self.training_by_status.get(queue_status, self.training_df.iloc[0:0])
+
+    @cached_property
+    def active_training_df(self) -> pd.DataFrame:
+        training_df = self.training_df
+        return training_df[training_df.queue_status.isin([QUE_STATUS.QUEUED, QUE_STATUS.SCHEDULED])]
+
+    @cached_property
+    def training_groups(self) -> list:
+        return self.training_df.groupby('group').size().index.tolist()
+
+    def typed_counts(self, columns: List[str]) -> Dict[str, List[dict]]:
+        """
+        按 group 分开，统计每个 group 里 columns 各个取值组合的任务数，一次 groupby 算完所有 group
+        """
+        result = {group: [] for group in self.training_groups}
+        counts = self.training_df.groupby(['group'] + columns).size().to_frame('count').reset_index()
+        for record in counts.to_dict(orient='records'):
+            result[record.pop('group')].append(record)
+        return result
+
+
 class ProcessUnitMeta:
     """
-    计算单个统计数据的类，需要实现 process_tick_data
-    
+    计算单个统计数据的类，需要实现 process_tick_data 和 get_redis_key
+
+    process_tick_data 返回要写进 redis 的字符串，由 BFFProcessor 统一写入；
+    shared 里是这个 tick 各个处理单元共用的中间结果，不要在单元里重复筛选 task_df
+
     新增统计数据的时候新增一个实现
     """
     def __init_subclass__(cls, **kwargs):
         BFFProcessor.process_units.append(cls())
         super().__init_subclass__(**kwargs)
 
-    def process_tick_data(self, tick_data: TickData):
-        raise "[ProcessUnitMeta] should overwrite:process_tick_data"
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData) -> str:
+        raise NotImplementedError("[ProcessUnitMeta] should overwrite:process_tick_data")
+
+    def get_redis_key(self) -> str:
+        raise NotImplementedError("[ProcessUnitMeta] should overwrite:get_redis_key")
 
     def get_redis_key_prefix(self):
         return os.environ.get('BFF_REDIS_PREFIX') or 'bff'
@@ -36,12 +83,23 @@ class BFFProcessor(Subscriber):
 
     last_handle_time: 上次的处理时间，可以在测试的时候节流
     process_units: 处理单元集合
+    force_write_interval: 内容没变的 key 不重复写，但最多隔这么多秒会重写一次，避免 redis 里的 key 丢了之后一直不恢复
     """
     last_handle_time = time.time()
     process_units: List[ProcessUnitMeta] = list()
 
-    def __init__(self, **kwargs):
+    def __init__(self, force_write_interval=60, **kwargs):
         super(BFFProcessor, self).__init__(**kwargs)
+        self.force_write_interval = force_write_interval
+        # redis key -> (上次写入内容的 md5, 写入时间)
+        self.written: Dict[str, Tuple[bytes, float]] = {}
+        # 每个处理单元的耗时单独打点，span 名字为 unit_{key 的最后一段}
+        self.unit_spans = {unit: self.span(f"unit_{unit.get_redis_key().rsplit(':', 1)[-1]}") for unit in self.process_units}
+
+    @staticmethod
+    def merge_upstream_df(dfs: List[pd.DataFrame], subset: List[str]) -> pd.DataFrame:
+        # 只有一个上游的时候不用 concat 和去重
+        return dfs[0] if len(dfs) == 1 else pd.concat(dfs).drop_duplicates(subset=subset)
 
     def process_subscribe(self):
         upstream_data_list = []
@@ -50,9 +108,9 @@ class BFFProcessor(Subscriber):
 
         self.set_tick_data(TickData(
             seq=min(t.seq for t in upstream_data_list),
-            resource_df=pd.concat([t.resource_df for t in upstream_data_list]).drop_duplicates(subset=['name']),
-            task_df=pd.concat([t.task_df for t in upstream_data_list]).drop_duplicates(subset=['id']),
-            user_df=pd.concat([t.user_df for t in upstream_data_list]).drop_duplicates(subset=['user_name', 'resource', 'group', 'priority'])
+            resource_df=self.merge_upstream_df([t.resource_df for t in upstream_data_list], ['name']),
+            task_df=self.merge_upstream_df([t.task_df for t in upstream_data_list], ['id']),
+            user_df=self.merge_upstream_df([t.user_df for t in upstream_data_list], ['user_name', 'resource', 'group', 'priority'])
         ))
         now = time.time()
         # for test:
@@ -60,8 +118,30 @@ class BFFProcessor(Subscriber):
         #     return;
         self.last_handle_time = now
 
+        shared = BFFSharedData(self.tick_data)
+        changed = {}
         for processor in self.process_units:
-            processor.process_tick_data(self.tick_data)
+            key = processor.get_redis_key()
+            with self.unit_spans[processor]:
+                try:
+                    value = processor.process_tick_data(self.tick_data, shared)
+                except Exception as e:
+                    # 一个单元出错不影响其他单元的输出
+                    self.error(f'处理 {key} 失败: {e}')
+                    continue
+                digest = hashlib.md5(value.encode() if isinstance(value, str) else value).digest()
+            last_digest, last_written_at = self.written.get(key, (None, 0))
+            if digest != last_digest or now - last_written_at >= self.force_write_interval:
+                changed[key] = (value, digest)
+
+        if changed:
+            with self.span('write_redis'), redis_conn.pipeline(transaction=False) as pipe:
+                for key, (value, _) in changed.items():
+                    pipe.set(key, value)
+                pipe.execute()
+            for key, (_, digest) in changed.items():
+                self.written[key] = (digest, now)
+        self.update_metric('changed_keys', len(changed))
 
 
 class ProcessUnitUserSelfTasks(ProcessUnitMeta):
@@ -70,17 +150,14 @@ class ProcessUnitUserSelfTasks(ProcessUnitMeta):
 
     将用户的任务根据用户名、状态进行分类，统计数量和最长运行时间 (针对运行的任务)
     """
-    def process_tick_data(self, tick_data: TickData):
-        tasks_json_data = tick_data.task_df[['running_seconds', 'id', 'user_name', 'queue_status']][tick_data.task_df.task_type == TASK_TYPE.TRAINING_TASK] \
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
+        return shared.training_df[['running_seconds', 'id', 'user_name', 'queue_status']] \
             .groupby(by = ['user_name', 'queue_status']) \
             .agg({'id': 'count', 'running_seconds': max}) \
             .reset_index() \
             .rename(columns={'id': 'sum', 'running_seconds': 'max_running_seconds'}) \
             .to_json(orient='records')
 
-        # print('tasks_json_data:', tasks_json_data) # when test
-        redis_conn.set(self.get_redis_key(), tasks_json_data)
-
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:user_self_tasks"
 
@@ -90,23 +167,22 @@ class ProcessUnitUserTopTaskListAll(ProcessUnitMeta):
     缩略展示用户正在运行的任务和排队中的任务
     """
     def process_each_type_data(self, df: pd.DataFrame, order_key):
-        df_grouped = df[[order_key, 'user_name', 'chain_id', 'priority', 'chain_status', 'nb_name', 'nodes', 'group', 'queue_status', 'running_seconds', 'created_seconds', 'custom_rank', 'worker_status']] \
-            .reset_index()  \
-            .groupby('user_name')
+        # 整体排一次序、转一次 dict，再按用户分组，不对每个用户单独排序转换
+        df = df[[order_key, 'user_name', 'chain_id', 'priority', 'chain_status', 'nb_name', 'nodes', 'group', 'queue_status', 'running_seconds', 'created_seconds', 'custom_rank', 'worker_status']] \
+            .reset_index() \
+            .sort_values(by=['user_name', order_key], ascending=[True, False])
         res = {}
-        for group, grouped_df in df_grouped:
-            res[group] = grouped_df.sort_values(by=order_key, ascending=False).to_dict(orient='records')
+        for record in df.to_dict(orient='records'):
+            res.setdefault(record['user_name'], []).append(record)
         return res
 
-    def process_tick_data(self, tick_data: TickData):
-        task_df = tick_data.task_df
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
         top_tasks_json_data_dict = {
-            QUE_STATUS.SCHEDULED: self.process_each_type_data(task_df[(task_df.task_type == TASK_TYPE.TRAINING_TASK) & (task_df.queue_status == QUE_STATUS.SCHEDULED)], 'first_id'),
-            QUE_STATUS.QUEUED: self.process_each_type_data(task_df[(task_df.task_type == TASK_TYPE.TRAINING_TASK) & (task_df.queue_status == QUE_STATUS.QUEUED)], 'first_id'),
+            QUE_STATUS.SCHEDULED: self.process_each_type_data(shared.training_status_df(QUE_STATUS.SCHEDULED), 'first_id'),
+            QUE_STATUS.QUEUED: self.process_each_type_data(shared.training_status_df(QUE_STATUS.QUEUED), 'first_id'),
             'seq': tick_data.seq
         }
-
-        redis_conn.set(self.get_redis_key(), ujson.dumps(top_tasks_json_data_dict))
+        return ujson.dumps(top_tasks_json_data_dict)
 
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:user_top_task_list_all"
@@ -116,13 +192,12 @@ class ProcessUnitUserQuota(ProcessUnitMeta):
     """
     用户超出 Quota 的任务统计（永远不会被调度到的那种）
     """
-    def process_tick_data(self, tick_data: TickData):
-        quota_exceeded_json = tick_data.task_df[(tick_data.task_df.task_type == TASK_TYPE.TRAINING_TASK) & (tick_data.task_df.assign_result == ASSIGN_RESULT.QUOTA_EXCEEDED)]\
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
+        training_df = shared.training_df
+        return training_df[training_df.assign_result == ASSIGN_RESULT.QUOTA_EXCEEDED] \
             [['running_seconds', 'created_seconds', 'id', 'user_name', 'queue_status', 'nb_name']] \
             .to_json(orient='records')
 
-        redis_conn.set(self.get_redis_key(), quota_exceeded_json)
-
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:quota_exceeded"
 
@@ -132,13 +207,12 @@ class ProcessUnitTotalTasks(ProcessUnitMeta):
     """
     当前所有用户运行和结束的任务汇总，主要用于给外部用户展示，同时避免暴露优先级信息
     """
-    def process_tick_data(self, tick_data: TickData):
-        training_df = tick_data.task_df[tick_data.task_df.task_type == TASK_TYPE.TRAINING_TASK]
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
         total_count_dict = {
-            'scheduled': len(training_df[training_df.queue_status == QUE_STATUS.SCHEDULED]),
-            'queued': len(training_df[training_df.queue_status == QUE_STATUS.QUEUED])
+            'scheduled': len(shared.training_status_df(QUE_STATUS.SCHEDULED)),
+            'queued': len(shared.training_status_df(QUE_STATUS.QUEUED))
         }
-        redis_conn.set(self.get_redis_key(), ujson.dumps(total_count_dict))
+        return ujson.dumps(total_count_dict)
 
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:total_tasks"
@@ -149,19 +223,8 @@ class ProcessUnitTotalTypedTasks(ProcessUnitMeta):
     """
     当前所有用户运行和排队的任务汇总，给内部用户展示使用，区分 group 还有优先级 (消费端可以根据 group 区分是 gpu 还是 cpu)
     """
-    def process_each_type_data(self, tasks: pd.DataFrame):
-        df = pd.DataFrame(tasks, columns=["priority", "queue_status"])
-        df = df.groupby(["priority", "queue_status"]).size().to_frame('count').reset_index()
-        df.sort_values(by=['priority', "queue_status"])
-        return df
-
-    def process_tick_data(self, tick_data: TickData):
-        training_df = tick_data.task_df[tick_data.task_df.task_type == TASK_TYPE.TRAINING_TASK]
-        total_count_dict = {}
-        df_grouped = training_df.groupby('group')
-        for group, grouped_df in df_grouped:
-            total_count_dict[group] = self.process_each_type_data(grouped_df).to_dict(orient='records')
-        redis_conn.set(self.get_redis_key(), ujson.dumps(total_count_dict))
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
+        return ujson.dumps(shared.typed_counts(["priority", "queue_status"]))
 
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:total_typed_tasks"
@@ -170,19 +233,8 @@ class ProcessUnitTotalTypedRoleTasks(ProcessUnitMeta):
     """
     当前所有用户运行和排队的任务汇总，可以给下游 bff 进一步消费使用
     """
-    def process_each_type_data(self, tasks: pd.DataFrame):
-        res_columns = ["priority", "queue_status", "user_role"]
-        df = pd.DataFrame(tasks, columns=res_columns).groupby(res_columns).size().to_frame('count').reset_index()
-        df.sort_values(by=res_columns)
-        return df
-
-    def process_tick_data(self, tick_data: TickData):
-        training_df = tick_data.task_df[tick_data.task_df.task_type == TASK_TYPE.TRAINING_TASK]
-        total_count_dict = {}
-        df_grouped = training_df.groupby('group')
-        for group, grouped_df in df_grouped:
-            total_count_dict[group] = self.process_each_type_data(grouped_df).to_dict(orient='records')
-        redis_conn.set(self.get_redis_key(), ujson.dumps(total_count_dict))
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
+        return ujson.dumps(shared.typed_counts(["priority", "queue_status", "user_role"]))
 
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:total_typed_role_tasks"
@@ -192,21 +244,20 @@ class ProcessUnitUsedQuota(ProcessUnitMeta):
     """
     当前所有用户已用节点 quota 的统计
     """
-    def process_tick_data(self, tick_data: TickData):
-        task_df = tick_data.task_df.copy()
-        task_df = task_df[((task_df.queue_status == 'queued') | (task_df.queue_status == 'scheduled')) & (task_df.task_type == 'training')]
+    priority_map = {v: k for k, v in TASK_PRIORITY.items()}
+
+    def process_tick_data(self, tick_data: TickData, shared: BFFSharedData):
+        task_df = shared.active_training_df
         if len(task_df) == 0:
             result = {}
         else:
-            priority_map = {v: k for k, v in TASK_PRIORITY.items()}
-            task_df['group-priority'] = task_df.group + '-' + task_df.priority.apply(lambda x: priority_map.get(x, 'UNKNOWN'))
-            task_df = task_df[['user_name', 'group-priority', 'nodes']]
-            res_df = task_df.groupby(['user_name', 'group-priority']).sum()
+            group_priority = task_df.group + '-' + task_df.priority.map(self.priority_map).fillna('UNKNOWN')
+            res = task_df.nodes.groupby([task_df.user_name, group_priority]).sum()
             result = defaultdict(dict)
-            for (user_name, group_priority), nodes in res_df.to_dict()['nodes'].items():
+            for (user_name, group_priority), nodes in res.to_dict().items():
                 result[user_name][group_priority] = nodes
         result = {'timestamp': int(time.time()), 'data': result}
-        redis_conn.set(self.get_redis_key(), ujson.dumps(result))
+        return ujson.dumps(result)
 
     def get_redis_key(self):
         return f"{self.get_redis_key_prefix()}:all_user_used_quota"
@@ -15,6 +15,24 @@ from scheduler.base_model import Subscriber, ASSIGN_RESULT, MATCH_RESULT, TickDa
 priority_map = TASK_PRIORITY.value_key_map()
 
 
+# 判断调度结果有没有变化只看这几列
+STATE_COLUMNS = ['assign_result', 'match_result', 'scheduler_msg']
+LIFECYCLE_EXPIRE_SECONDS = 60 * 60 * 24 * 30
+# 一条 upsert 最多带这么多行，避免超过 postgres 的参数个数上限
+RULE_BATCH_SIZE = 5000
+
+
+def fmt_log(row: dict):
+    return (
+            f'[TASK_INFO] ' +
+            '{id}, {user_name}, {sliced_chain_id}, {task_type}, {priority_name}, '
+            '{assign_result}, {match_result}, {scheduler_msg}'.format(
+                priority_name=priority_map.get(row['priority'], 'AUTO'),
+                sliced_chain_id=row['chain_id'][:8],
+                **row)
+    )
+
+
 class MatcherLogger(Subscriber):
     """
     专门负责打印 matcher 的日志
@@ -22,55 +40,61 @@ class MatcherLogger(Subscriber):
     def __init__(self, **kwargs):
         super(MatcherLogger, self).__init__(**kwargs)
         self.last_tick_data = TickData()
-        self.runtime_config = TaskRuntimeConfig(task=BaseTask())
+        # 上个 tick 每个任务的调度结果，index 为 task id，列为 STATE_COLUMNS
+        self.last_state = pd.DataFrame(columns=STATE_COLUMNS)
 
     def process_subscribe(self):
         self.set_tick_data(self.waiting_for_upstream_data())
         if self.valid:
-            self.log_task()
+            with self.span('log_task'):
+                self.log_task()
             if 'gpu' in self.name:
-                self.record_rule()
+                with self.span('record_rule'):
+                    self.record_rule()
             self.last_tick_data = self.tick_data
 
+    def changed_tasks(self) -> pd.DataFrame:
+        """
+        和上个 tick 比，调度结果有变化的任务 (包括新出现的任务)，只比较 id 和 STATE_COLUMNS，不 merge 整个 task_df
+        """
+        task_df = self.tick_data.task_df
+        state = pd.DataFrame({column: task_df[column].values for column in STATE_COLUMNS}, index=task_df.id.values)
+        last_state = self.last_state.reindex(state.index)
+        self.last_state = state
+        return task_df[(state != last_state).any(axis=1).values]
+
     def log_task(self):
         """
         打印日志，发送 fetion 消息等
         """
-
-        def fmt_log(rr):
-            return (
-                    f'[TASK_INFO] ' +
-                    '{id}, {user_name}, {sliced_chain_id}, {task_type}, {priority_name}, '
-                    '{assign_result}, {match_result}, {scheduler_msg}'.format(
-                        priority_name=priority_map.get(rr.priority, 'AUTO'),
-                        sliced_chain_id=rr.chain_id[:8],
-                        **rr)
-            )
-
         last_tick_data = self.last_tick_data
         tick_data = self.tick_data
-        tick_data.task_df['task_id'] = tick_data.task_df.id
-        last_tick_data.task_df['task_id'] = last_tick_data.task_df.id
-        tmp_df = pd.merge(tick_data.task_df, last_tick_data.task_df, how='left', on='task_id', suffixes=('', '_last'))
-        res_to_print = tmp_df[(tmp_df.assign_result != tmp_df.assign_result_last) | (tmp_df.match_result != tmp_df.match_result_last) | (tmp_df.scheduler_msg != tmp_df.scheduler_msg_last)]
-        for _, row in res_to_print.iterrows():
-            if row.match_result in {MATCH_RESULT.STARTUP, MATCH_RESULT.SUSPEND, MATCH_RESULT.STOP}:
+        rows = self.changed_tasks().to_dict(orient='records')
+        tick_time = str(datetime.datetime.fromtimestamp(tick_data.seq / 1000))
+        # lifecycle 一次性用 pipeline 写，整组任务被挂起的时候不用来回几千次
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for row in rows:
+                key = f'lifecycle:{row["id"]}:scheduler'
+                pipe.append(key, f'{ujson.dumps([tick_time, tick_data.seq, row["assign_result"], row["match_result"], row["scheduler_msg"]], ensure_ascii=False)}\n')
+                pipe.expire(key, LIFECYCLE_EXPIRE_SECONDS)
+            if rows:
+                pipe.execute()
+        for row in rows:
+            if row['match_result'] in {MATCH_RESULT.STARTUP, MATCH_RESULT.SUSPEND, MATCH_RESULT.STOP}:
                 self.info(fmt_log(row))
-            redis_conn.append(f'lifecycle:{row.id}:scheduler', f'{ujson.dumps([str(datetime.datetime.fromtimestamp(tick_data.seq / 1000)), tick_data.seq, row.assign_result, row.match_result, row.scheduler_msg], ensure_ascii=False)}\n')
-            redis_conn.expire(f'lifecycle:{row.id}:scheduler', 60 * 60 * 24 * 30)
-            if row.assign_result == ASSIGN_RESULT.NODE_ERROR and row.queue_status != QUE_STATUS.QUEUED:
-                if 'NotReady' in tick_data.resource_df[tick_data.resource_df.name.isin(row.assigned_nodes)].status.to_list():
-                    redis_conn.lpush('node_error_task_channel', row.id)
+            if row['assign_result'] == ASSIGN_RESULT.NODE_ERROR and row['queue_status'] != QUE_STATUS.QUEUED:
+                if 'NotReady' in tick_data.resource_df[tick_data.resource_df.name.isin(row['assigned_nodes'])].status.to_list():
+                    redis_conn.lpush('node_error_task_channel', row['id'])
                 self.warning(fmt_log(row))
                 task = BaseTask(**row)
                 task.re_impl(DbOperationImpl)
-                if row.user_name != 'lwf':
-                    self.f_warning(row.scheduler_msg, task=BaseTask(**row))
-                task.set_restart_log(rule='节点异常', reason=row.scheduler_msg, result='智能重启成功')
+                if row['user_name'] != 'lwf':
+                    self.f_warning(row['scheduler_msg'], task=BaseTask(**row))
+                task.set_restart_log(rule='节点异常', reason=row['scheduler_msg'], result='智能重启成功')
         # 这里打印调度认为结束了的任务
-        for _, row in last_tick_data.task_df[~last_tick_data.task_df.index.isin(tick_data.task_df.index)].iterrows():
-            row.scheduler_msg = "任务结束了"
-            self.info(fmt_log(row))
+        last_task_df = last_tick_data.task_df
+        for row in last_task_df[~last_task_df.index.isin(tick_data.task_df.index)].to_dict(orient='records'):
+            self.info(fmt_log({**row, 'scheduler_msg': '任务结束了'}))
 
     def record_rule(self):
         current_rule = [
@@ -79,12 +103,11 @@ class MatcherLogger(Subscriber):
             zip(self.tick_data.task_df.id, self.tick_data.task_df.runtime_config_json, self.tick_data.task_df.match_rank.apply(lambda m: (m >> 19) & 15 if m else -1))
             if tcj.get('scheduler_assign_rule', -1) != tr
         ]
-        sql = ''
-        params = ()
-        for task_id, rule in current_rule:
-            self.runtime_config.task.id = task_id
-            s, p = self.runtime_config.get_insert_sql('scheduler_assign_rule', rule)
-            sql += s
-            params += p
-        if sql:
-            MarsDB().execute(sql, params)
+        if not current_rule:
+            return
+        sql_list, params_list = [], []
+        for i in range(0, len(current_rule), RULE_BATCH_SIZE):
+            sql, params = TaskRuntimeConfig.get_bulk_insert_sql('scheduler_assign_rule', current_rule[i:i + RULE_BATCH_SIZE])
+            sql_list.append(sql)
+            params_list.append(params)
+        MarsDB().execute_many(sql_list, params_list)
@@ -27,6 +27,20 @@ class TaskRuntimeConfig(object):
         on conflict ("{column}", "source") do update set "config_json" = {'"task_runtime_config"."config_json" || ' if update else ''} excluded."config_json";
         """, (self.task.chain_id if chain else self.task.id, ujson.dumps(config_json), source)
 
+    @staticmethod
+    def get_bulk_insert_sql(source, configs, chain=False, update=False, *args, **kwargs):
+        """
+        同一个 source 的多条 config 拼成一条 upsert，configs 为 [(task_id 或 chain_id, config_json)]，id 不能重复
+        """
+        column = 'chain_id' if chain else 'task_id'
+        values = ', '.join(['(%s, %s, %s)'] * len(configs))
+        params = tuple(p for key, config_json in configs for p in (key, ujson.dumps(config_json), source))
+        return f"""
+        insert into "task_runtime_config" ("{column}", "config_json", "source")
+        values {values}
+        on conflict ("{column}", "source") do update set "config_json" = {'"task_runtime_config"."config_json" || ' if update else ''} excluded."config_json";
+        """, params
+
     def insert(self, source, config_json, chain=False, update=False, *args, **kwargs):
         with MarsDB() as conn:
             conn.execute(*self.get_insert_sql(source, config_json, chain, update, args, kwargs))
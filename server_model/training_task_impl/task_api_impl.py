@@ -28,6 +28,8 @@ class TaskApiImpl(AdditionalPropertyImpl, ABC):
         rst_last_seen = None
         last_seen_id = 0 if last_seen is None else last_seen.get('id', 0)
         current_seen_id = last_seen_id
+        max_bytes = CONF.try_get('experiment.log.max_response_bytes', default=0) or None
+        truncated = False
         if service is not None:
             suffix_filter = f'{service}.service_log'
             task_id_list = [task.id]    # 服务日志只查询当前任务, 不查询整个 chain
@@ -37,13 +39,17 @@ class TaskApiImpl(AdditionalPropertyImpl, ABC):
         for task_id in task_id_list:
             if task_id < last_seen_id:
                 continue
-            res = await get_task_node_idx_log(task_id, task.user, rank, last_seen=last_seen, suffix_filter=suffix_filter, max_line_length=CONF.experiment.log.max_line_length)
-            if res['data'] != "还没产生日志":
-                data_list.append(res['data'])
-                current_seen_id = max(current_seen_id, task_id)
-            if res['last_seen'] and res['last_seen']['timestamp']:
-                if not rst_last_seen or res['last_seen']['timestamp'] > rst_last_seen['timestamp']:
-                    rst_last_seen = res['last_seen']
+            # 往后读的时候前一个任务的日志还没读完, 后面的任务下次再读
+            if not (truncated and last_seen is not None):
+                res = await get_task_node_idx_log(task_id, task.user, rank, last_seen=last_seen, suffix_filter=suffix_filter,
+                                                  max_line_length=CONF.experiment.log.max_line_length, max_bytes=max_bytes)
+                truncated |= res['truncated']
+                if res['data'] != "还没产生日志":
+                    data_list.append(res['data'])
+                    current_seen_id = max(current_seen_id, task_id)
+                if res['last_seen'] and res['last_seen']['timestamp']:
+                    if not rst_last_seen or res['last_seen']['timestamp'] > rst_last_seen['timestamp']:
+                        rst_last_seen = res['last_seen']
             if task_id == task_id_list[-1]:
                 try:
                     error_msg = await AioBaseTaskSelector.get_error_info(id=task_id)
@@ -65,7 +71,8 @@ class TaskApiImpl(AdditionalPropertyImpl, ABC):
             "restart_log": await self.restart_log(),
             "success": 1,
             "msg": "get log successfully",
-            "last_seen": rst_last_seen
+            "last_seen": rst_last_seen,
+            "truncated": truncated,
         }
 
     async def sys_log(self):
@@ -7,20 +7,28 @@ import pickle
 import threading
 import time
 import uuid
+from collections import deque
 from datetime import datetime
 from itertools import chain
 from threading import Lock
-from typing import Optional, List, Iterable
+from typing import Optional, List, Iterable, Dict
 
 import pandas as pd
+import sqlalchemy
+import ujson
 
 from conf import CONF
-from db import redis_conn
+from db import MarsDB, redis_conn
+from .metrics import DB_TABLE_CACHE_COUNTER
 from .mq_utils import MessageQueue, MessageType
 from .patchable_dataframe import PatchableDataFrame, PatchConflictException
 from .utils import log_debug, log_info, log_error
 
 
+# 每张表记录最近多少次变化, ComputedTable 落后太多的话就全量计算
+CHANGE_LOG_SIZE = 100
+
+
 class IDataTable:
     """
     接口类, 不可被直接继承
@@ -33,13 +41,22 @@ class IDataTable:
     is_computed = False
     lock: Optional[Lock] = None
     timestamp = None
+    change_log: Optional[deque] = None
+    # 被挤出 change_log 的最新一条变化的时间, 在这之前计算的 ComputedTable 拿不到完整的 patch
+    change_log_truncated_at = 0
 
-    def __init_subclass__(cls, table_name=None, columns=None, dependencies=None, **kwargs):
+    def __init_subclass__(cls, table_name=None, columns=None, dependencies=None, primary_key_columns=None,
+                          change_sources=None, **kwargs):
         cls.table_name = table_name
         cls.columns = columns
+        cls.primary_key_columns = primary_key_columns
+        # 这些 DB 表有变动的时候需要同步这张表, 用于 CDC 模式
+        cls.change_sources = [table_name] if change_sources is None else change_sources
         cls.dependencies = [] if dependencies is None else dependencies
         cls.lock = Lock()
         cls.timestamp = time.time()
+        cls.change_log = deque(maxlen=CHANGE_LOG_SIZE)
+        cls.change_log_truncated_at = 0
 
     @classmethod
     def get_df_no_copy(cls):
@@ -82,8 +99,14 @@ class IDataTable:
         pass
 
     @classmethod
-    def update_timestamp(cls, timestamp=None):
+    def update_timestamp(cls, timestamp=None, patch=None):
+        """
+        patch: 这次变化对应的 DataFramePatch, 记录下来给 ComputedTable 增量计算用; None 表示整表都可能变了
+        """
         cls.timestamp = timestamp or time.time()
+        if len(cls.change_log) == CHANGE_LOG_SIZE:
+            cls.change_log_truncated_at = max(cls.change_log_truncated_at, cls.change_log[0][0])
+        cls.change_log.append((cls.timestamp, patch))
         cls.update_hook()
 
     @classmethod
@@ -122,17 +145,16 @@ class RoamingSqlTable(IDataTable):
 
     @classmethod
     def _apply_patch(cls, patch: dict):
-        (to_del, to_add) = patch['diff']
         with cls.lock:
             if cls._df.timestamp >= patch['timestamp']:
                 log_info(f'忽略过期的 patch. table [{cls.table_name}] 时间差 {cls._df.timestamp - patch["timestamp"]}')
                 return
             try:
-                cls._df.apply_patch(to_del, to_add)
+                cls._df.apply_patch(patch['diff'])
             except PatchConflictException as e:
                 e.table_name = cls.table_name
                 raise e
-        cls.update_timestamp()
+        cls.update_timestamp(patch=patch['diff'])
         log_debug(f'应用 patch 成功: table [{cls.table_name}]')
 
     @classmethod
@@ -192,15 +214,33 @@ class RoamingSqlTable(IDataTable):
     @classmethod
     def pull_diff_from_db(cls):
         cls._apply_patches_on_err_reload()
-        db_df = PatchableDataFrame.load_from_db(sql=cls.sql())
+        db_df = PatchableDataFrame.load_from_db(sql=cls.sql(), primary_key_columns=cls.primary_key_columns)
         df_diff = cls._df.diff(db_df)
         return {'table_name': cls.table_name, 'diff': df_diff, 'timestamp': db_df.timestamp} if df_diff is not None else None
 
+    @classmethod
+    def pull_rows_diff_from_db(cls, keys: list):
+        """
+        只从 DB 拉取主键在 keys 里的行计算 diff, 用于 CDC 模式. keys 是主键值组成的 list
+        """
+        cls._apply_patches_on_err_reload()
+        if not cls._df.primary_key_columns:
+            return cls.pull_diff_from_db()     # 本地的 df 不是按主键定位行的, 只能全表比较
+        pk = ', '.join(f'"rows"."{col}"' for col in cls.primary_key_columns)
+        sql = f'''
+            select * from ({cls.sql()}) as "rows"
+            where jsonb_build_array({pk}) in (select jsonb_array_elements(cast(:keys as jsonb)))
+        '''
+        df = pd.read_sql(sqlalchemy.text(sql), MarsDB(overwrite_use_db='primary').db, params={'keys': ujson.dumps(keys)})
+        db_df = PatchableDataFrame.from_df(df, primary_key_columns=cls.primary_key_columns)
+        df_diff = cls._df.diff(db_df, keys=PatchableDataFrame.primary_key_hashes(keys, cls.primary_key_columns))
+        return {'table_name': cls.table_name, 'diff': df_diff, 'timestamp': db_df.timestamp} if df_diff is not None else None
+
     @classmethod
     def reload(cls):
         try:
             log_debug(f'Reload table [{cls.table_name}]')
-            new_df = PatchableDataFrame.load_from_db(sql=cls.sql())
+            new_df = PatchableDataFrame.load_from_db(sql=cls.sql(), primary_key_columns=cls.primary_key_columns)
             cls._replace_with_newer_df(new_df)
         except Exception as e:
             log_error(f'Reload table {cls.table_name} failed!', e)
@@ -209,7 +249,8 @@ class RoamingSqlTable(IDataTable):
     async def async_reload(cls):
         try:
             log_debug(f'Async Reload table [{cls.table_name}]')
-            new_df = await PatchableDataFrame.async_load_from_db(sql=cls.sql(), columns=cls.columns)
+            new_df = await PatchableDataFrame.async_load_from_db(sql=cls.sql(), columns=cls.columns,
+                                                                 primary_key_columns=cls.primary_key_columns)
             cls._replace_with_newer_df(new_df)
         except Exception as e:
             log_error(f'Async Reload table {cls.table_name} failed!', e)
@@ -227,11 +268,20 @@ class RoamingSqlTable(IDataTable):
 class DBSqlTable(IDataTable):
     """
     完全使用 DB 数据时, 基于 SQL 的表, 继承此类后重写 sql() 方法
+    查询结果在进程内缓存 db_table_cache_ttl 秒, 同一时间的并发请求共用一次查询; 有写操作时 invalidate 让缓存失效
     """
     _df : Optional[pd.DataFrame] = None
+    _loaded_at = 0
+    _generation = 0
+    _load_lock: Optional[Lock] = None
+    _inflight: Optional[tuple] = None    # (event loop, 正在进行的查询 task)
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
+        cls._loaded_at = 0
+        cls._generation = 0
+        cls._load_lock = Lock()
+        cls._inflight = None
 
     @classmethod
     def get_df_no_copy(cls):
@@ -249,6 +299,15 @@ class DBSqlTable(IDataTable):
     def pull_diff_from_db(cls):
         pass        # DB 表不同步 diff
 
+    @classmethod
+    def invalidate(cls):
+        cls._generation += 1
+        cls._loaded_at = 0
+
+    @classmethod
+    def _cache_fresh(cls):
+        return cls._df is not None and time.time() - cls._loaded_at < CONF.user_data_roaming.get('db_table_cache_ttl', 0)
+
     @classmethod
     def _is_df_changed(cls, current_df):
         """
@@ -260,22 +319,49 @@ class DBSqlTable(IDataTable):
         return (cls._df.fillna(value=0) != current_df.fillna(value=0)).any().any()
 
     @classmethod
-    def _update_df_if_changed(cls, new_df):
+    def _update_df_if_changed(cls, new_df, started_at, generation):
         if cls._df is None or cls._is_df_changed(current_df=new_df):
             cls._df = new_df
             cls.update_timestamp()
             log_debug(f'更新了 DB Table [{cls.table_name}]')
+        # 查询期间有写操作的话, 查到的可能是旧数据, 不算缓存
+        if generation == cls._generation:
+            cls._loaded_at = started_at
 
     @classmethod
     def before_get_df_hook(cls):
-        new_df = PatchableDataFrame.load_from_db(sql=cls.sql(), get_raw_df=True).drop(['query_timestamp'], axis='columns')
-        cls._update_df_if_changed(new_df)
+        if cls._cache_fresh():
+            DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'hit').inc()
+            return
+        with cls._load_lock:
+            if cls._cache_fresh():      # 等锁的时候别的线程已经查过了
+                DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'coalesced').inc()
+                return
+            DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'miss').inc()
+            started_at, generation = time.time(), cls._generation
+            new_df = PatchableDataFrame.load_from_db(sql=cls.sql(), get_raw_df=True).drop(['query_timestamp'], axis='columns')
+            cls._update_df_if_changed(new_df, started_at, generation)
 
     @classmethod
-    async def async_before_get_df_hook(cls):
+    async def _async_load(cls):
+        started_at, generation = time.time(), cls._generation
         new_df = await PatchableDataFrame.async_load_from_db(cls.sql(), columns=cls.columns, get_raw_df=True)
         new_df = new_df.drop(['query_timestamp'], axis='columns')
-        cls._update_df_if_changed(new_df)
+        cls._update_df_if_changed(new_df, started_at, generation)
+
+    @classmethod
+    async def async_before_get_df_hook(cls):
+        if cls._cache_fresh():
+            DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'hit').inc()
+            return
+        loop = asyncio.get_running_loop()
+        if cls._inflight is not None and cls._inflight[0] is loop and not cls._inflight[1].done():
+            DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'coalesced').inc()
+        else:
+            DB_TABLE_CACHE_COUNTER.labels(cls.table_name, 'miss').inc()
+            cls._inflight = (loop, asyncio.create_task(cls._async_load()))
+        # 一个请求被取消了不影响其他等待同一个查询的请求
+        await asyncio.shield(cls._inflight[1])
 
     @classmethod
     def initialized(cls):
@@ -304,13 +390,16 @@ class RoamingBaseTable(BaseTable, RoamingSqlTable):
 class ComputedTable(IDataTable):
     """
     本地计算得到的表, 继承此类后重写 compute() 方法
+    依赖表是通过 patch 变化的时候, 可以重写 compute_incremental() 方法只更新受影响的行
     """
     _df: Optional[pd.DataFrame] = None
+    _computed_at = 0
     is_computed = True
 
     def __init_subclass__(cls, dependencies=None, **kwargs):
         dependencies = list(set(cls.collect(dependencies))) if dependencies is not None else []
         super().__init_subclass__(dependencies=dependencies, **kwargs)
+        cls._computed_at = 0
 
     @classmethod
     def collect(cls, tables: List[IDataTable]) -> Iterable[IDataTable]:
@@ -319,7 +408,8 @@ class ComputedTable(IDataTable):
 
     @classmethod
     def get_df_no_copy(cls):
-        if any(dependant.timestamp > cls.timestamp for dependant in cls.dependencies):
+        # 和开始计算的时间比, 计算过程中依赖表的变化下次还要再算
+        if any(dependant.timestamp > cls._computed_at for dependant in cls.dependencies):
             cls._recompute()
         return cls._df
 
@@ -331,6 +421,34 @@ class ComputedTable(IDataTable):
         """
         raise NotImplementedError
 
+    @classmethod
+    def compute_incremental(cls, df: pd.DataFrame, patches: Dict[str, list]) -> Optional[pd.DataFrame]:
+        """
+        根据依赖表的 patch 更新 df, 返回 None 表示做不了增量计算, 会 fallback 到 compute.
+            df: 上次计算的结果, 不要原地修改
+            patches: 依赖表名 -> 上次计算之后这张表的 DataFramePatch 列表, 只包含有变化的依赖表.
+                     上次计算过程中发生的变化也可能在里面, 需要保证重复应用同一个 patch 结果不变
+        """
+        return None
+
+    @classmethod
+    def _collect_patches(cls) -> Optional[Dict[str, list]]:
+        """
+        收集上次计算之后依赖表的 patch, 有依赖表不是通过 patch 变化的 (reload / DB 表等) 或者变化记录不全, 返回 None
+        """
+        patches = {}
+        for dependant in cls.dependencies:
+            if dependant.timestamp <= cls._computed_at:
+                continue
+            if dependant.change_log_truncated_at >= cls._computed_at:
+                # 上次计算之后的变化有被挤出 change_log 的
+                return None
+            changes = [patch for ts, patch in list(dependant.change_log) if ts > cls._computed_at]
+            if len(changes) == 0 or any(patch is None for patch in changes):
+                return None
+            patches[dependant.table_name] = changes
+        return patches
+
     @classmethod
     def before_get_df_hook(cls):
         for dependant in cls.dependencies:
@@ -352,10 +470,19 @@ class ComputedTable(IDataTable):
 
     @classmethod
     def _recompute(cls):
+        started_at = time.time()
+        new_df = None
         try:
-            new_df = cls.compute()
+            if cls._df is not None and (patches := cls._collect_patches()) is not None:
+                new_df = cls.compute_incremental(cls._df, patches)
+        except Exception as e:
+            log_error(f'增量更新 computed view [{cls.table_name}] 失败, 全量计算', e)
+        try:
+            if new_df is None:
+                new_df = cls.compute()
             with cls.lock:
                 cls._df = new_df
+                cls._computed_at = started_at
             cls.update_timestamp()
             log_debug(f'更新 computed view [{cls.table_name}] 完成')
         except Exception as e:
@@ -378,15 +505,13 @@ class InMemoryTable(IDataTable):
     可以重写 `init_sql` 方法执行 SQL 从 DB 获取初始 dataframe 的内容, 如获取全部 username 等.
     """
     _df: Optional[pd.DataFrame] = None
-    primary_key_columns = None
     data_birth_time: datetime = None
     patch_buffer: list = []
 
     def __init_subclass__(cls, dependencies=None, primary_key_columns=None, **kwargs):
         assert dependencies is None, f'{cls.__name__} 作为 InMemoryTable 不能有 dependency'
         assert primary_key_columns is not None, f'InMemoryTable {cls.__name__} 必须有主键列'
-        super().__init_subclass__(dependencies=dependencies, **kwargs)
-        cls.primary_key_columns = primary_key_columns
+        super().__init_subclass__(dependencies=dependencies, primary_key_columns=primary_key_columns, **kwargs)
         cls.patch_buffer = []
         assert len(absent:= [col for col in cls.primary_key_columns if col not in cls.columns]) == 0, \
             f'{cls.__name__} 表的主键列 {absent} 不存在于 columns 中!'
@@ -404,14 +529,13 @@ class InMemoryTable(IDataTable):
         if not cls.initialized():
             cls.patch_buffer.append(patch)  # 尚未拿到初始数据, 缓存一下 patch
             return
-        to_del, to_add = patch['patch']
-        to_del, to_add = to_del.df.set_index(cls.primary_key_columns), to_add.df.set_index(cls.primary_key_columns)
-        # to_del 中有些是先删再增实现修改的, 现在有主键了不需要这样做了
-        delete_index = to_del.index.difference(to_add.index)
+        diff = patch['patch']
+        to_upsert = diff.upserts.df.set_index(cls.primary_key_columns)
+        delete_index = diff.deletes.df.set_index(cls.primary_key_columns).index
         with cls.lock:
             df = cls._df.set_index(cls.primary_key_columns)
-            df = to_add.combine_first(df)                 # 修改或增加行
-            df = df.drop(delete_index, errors='ignore')   # 删除行, 数据不一定是一致的, 找不到要删的 index 不报错
+            df = to_upsert.combine_first(df)                 # 修改或增加行
+            df = df.drop(delete_index, errors='ignore')      # 删除行, 数据不一定是一致的, 找不到要删的 index 不报错
             cls._df = df.reset_index()
         cls.update_timestamp(patch.get('timestamp', time.time()))
 
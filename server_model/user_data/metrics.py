@@ -0,0 +1,10 @@
+
+from prometheus_client import Counter
+
+
+# 通过 api/app.py 里的 instrumentator 暴露在 /metrics
+DB_TABLE_CACHE_COUNTER = Counter(
+    "user_data_db_table_cache_total",
+    "Cache lookups of DB backed user data tables.",
+    labelnames=("table", "result",)     # result: hit / miss / coalesced
+)
@@ -45,6 +45,7 @@ class WatchThread(Thread):
             log_debug(f'通过议会收到 patch about table {[p["table_name"] for p in data]}')
             self.user_data.patch(data, broadcast=False)
         if msg_type == MessageType.SYNC:
+            self.user_data.invalidate_db_tables(data)
             self.user_data.sync_from_db(data)
         if msg_type == MessageType.RELOAD and origin != MessageQueue.origin_id:
             log_info(f'通过议会收到 reload 信号, 重新加载 df ({data})')
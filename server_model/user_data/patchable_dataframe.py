@@ -1,5 +1,9 @@
 
 import time
+from itertools import chain
+from typing import List, Optional
+
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
@@ -12,74 +16,161 @@ class PatchConflictException(Exception):
         self.table_name = None
 
 
+HASH_SAMPLE_SIZE = 256
+BOOL_HASHES = pd.util.hash_array(np.array(['False', 'True'], dtype=object))
+
+
+def hash_rows(df: pd.DataFrame) -> np.ndarray:
+    """
+    逐行计算内容 hash (uint64), 按列向量化计算后合并
+        - list, dict 等 unhashable 类型不能直接 hash, 转为 string 后再 hash
+        - 数值列统一转为 float64, 避免某次查询结果里有 null 导致 int 列变成 float 列, 所有行的 hash 都变了
+        - 时间列按 UTC 时间戳 hash
+        - bool 列和转成 'True' / 'False' 再 hash 的结果一样, 但不用逐个转 string
+    """
+    result = np.full(len(df), 0x345678, dtype='uint64')
+    for _, series in df.items():
+        categorize = True
+        if pd.api.types.is_datetime64_any_dtype(series.dtype):
+            values = pd.to_datetime(series, utc=True).dt.tz_localize(None).values.view('int64')
+        elif series.dtype == bool:
+            result = (result * np.uint64(1000003)) ^ BOOL_HASHES[series.values.astype('int8')]
+            continue
+        elif pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            values = series.values.astype('float64')
+        elif pd.api.types.infer_dtype(series.values, skipna=True) in ('string', 'empty'):
+            values = series.values.astype(object)
+            # 基本不重复的列 (用户名, token 等) 先 factorize 再 hash 反而更慢, 结果是一样的
+            sample = values[:HASH_SAMPLE_SIZE]
+            categorize = len(set(sample)) * 2 <= len(sample)
+        else:
+            values = series.astype(str).values
+        result = (result * np.uint64(1000003)) ^ pd.util.hash_array(values, categorize=categorize)
+    return result
+
+
 class PatchableDataFrame(object):
-    def __init__(self, df=None, df_indexing=None, timestamp=0):
+    def __init__(self, df=None, row_hashes=None, primary_key_columns: Optional[List[str]] = None, timestamp=0):
         """
             timestamp: 上次从 DB 中拉取完整数据的 timestamp, 应用 patch 不会更新.
                         用于防止从数据库拉取最新数据后再收到的过时 patch 被应用.
-            df_indexing: - list, dict 等 unhashable 类型不能用于比较 diff, 因此转为 string 来比较;
-                         - 而逆向转换很难做, 也费时间, 所以同时保留原始的 df 和转换后的 df_indexing
+            primary_key_columns: 有主键的表按主键的 hash 定位行;
+                                 没有主键 (或者主键不唯一, 此时置为 None) 的表按 (行内容 hash, 第几个相同的行) 的 hash 定位行
+            row_hashes: 每行内容的 hash, index 是定位行用的 key, 和 df 的行按位置一一对应.
+                        diff 和 apply_patch 只比较 key 和 hash, 不需要把所有列拿来 merge
         """
         self.df = df
         self.timestamp = timestamp
-        if df_indexing is None:
-            self.df_indexing = df.copy()
-            obj_columns = df.columns[df.dtypes == object]
-            self.df_indexing[obj_columns] = self.df_indexing[obj_columns].astype(str, copy=False)
-            datetime_columns = [col for col in df.columns if pd.api.types.is_datetime64_any_dtype(df[col].dtype)]
-            for col in datetime_columns:
-                transform = lambda t: f'{t.timestamp():.6f}' if not pd.isna(t) else ''
-                self.df_indexing[col] = self.df_indexing[col].apply(transform)
+        self.primary_key_columns = primary_key_columns
+        if row_hashes is None:
+            hashes = hash_rows(df)
+            keys = hash_rows(df[primary_key_columns]) if primary_key_columns else None
+            if keys is None or not pd.Index(keys).is_unique:
+                self.primary_key_columns = None
+                occurrence = pd.Series(hashes).groupby(hashes).cumcount().values
+                keys = hash_rows(pd.DataFrame({'hash': hashes, 'occurrence': occurrence}))
+            self.row_hashes = pd.Series(hashes, index=keys)
         else:
-            self.df_indexing = df_indexing
+            self.row_hashes = row_hashes
 
     @classmethod
-    def from_df(cls, df):
+    def from_df(cls, df, primary_key_columns=None):
         timestamp = df['query_timestamp'][0].timestamp() if len(df) > 0 else time.time()
         df = df.drop(['query_timestamp'], axis='columns')
-        return cls(df=df, timestamp=timestamp)
+        return cls(df=df, primary_key_columns=primary_key_columns, timestamp=timestamp)
 
     @classmethod
-    def load_from_db(cls, sql: str, get_raw_df=False):
+    def load_from_db(cls, sql: str, get_raw_df=False, primary_key_columns=None):
         df = pd.read_sql(sqlalchemy.text(sql), MarsDB(overwrite_use_db='primary').db)
-        return df if get_raw_df else cls.from_df(df)
+        return df if get_raw_df else cls.from_df(df, primary_key_columns=primary_key_columns)
 
     @classmethod
-    async def async_load_from_db(cls, sql: str, columns, get_raw_df=False):
+    async def async_load_from_db(cls, sql: str, columns, get_raw_df=False, primary_key_columns=None):
         result = await MarsDB(overwrite_use_db='primary').a_execute(sql)
         df = pd.DataFrame(result, columns=columns + ['query_timestamp'])
-        return df if get_raw_df else cls.from_df(df)
+        return df if get_raw_df else cls.from_df(df, primary_key_columns=primary_key_columns)
 
-    def index_select(self, indices):
-        return PatchableDataFrame(df=self.df.loc[indices].copy(),
-                                  df_indexing=self.df_indexing.loc[indices].copy(),
+    def select(self, mask):
+        return PatchableDataFrame(df=self.df[mask].reset_index(drop=True),
+                                  row_hashes=self.row_hashes[mask],
+                                  primary_key_columns=self.primary_key_columns,
                                   timestamp=self.timestamp)
 
-    def diff(self, df_new):
-        df_new_indexing = df_new.df_indexing.reset_index().rename(columns={'index': 'rindex'})
-        merged_df = self.df_indexing.reset_index().merge(df_new_indexing, how='outer', indicator=True)
-        to_del_indices = merged_df[merged_df._merge == 'left_only']['index'].astype(int)
-        to_add_indices = merged_df[merged_df._merge == 'right_only']['rindex'].astype(int)
-        if len(to_del_indices) + len(to_add_indices) > 0:
-            return self.index_select(to_del_indices), df_new.index_select(to_add_indices)   # to_del, to_add
+    @staticmethod
+    def primary_key_hashes(keys: list, primary_key_columns: List[str]) -> np.ndarray:
+        return hash_rows(pd.DataFrame(keys, columns=primary_key_columns))
+
+    def diff(self, df_new, keys=None) -> Optional['DataFramePatch']:
+        """
+            keys: 只比较这些 key 对应的行, df_new 里只需要有这些行; keys 里有但 df_new 里没有的行认为被删除了
+        """
+        old, new = self.row_hashes, df_new.row_hashes
+        positions = old.index.get_indexer(new.index)
+        found = positions >= 0
+        upsert_mask = ~found
+        upsert_mask[found] = old.values[positions[found]] != new.values[found]
+        if keys is None:
+            delete_mask = ~old.index.isin(new.index)
         else:
+            delete_mask = np.zeros(len(old), dtype=bool)
+            key_positions = old.index.get_indexer(pd.Index(keys).difference(new.index))
+            delete_mask[key_positions[key_positions >= 0]] = True
+        if not upsert_mask.any() and not delete_mask.any():
             return None
+        replace_mask = np.zeros(len(old), dtype=bool)
+        replace_mask[positions[found & upsert_mask]] = True
+        return DataFramePatch(upserts=df_new.select(upsert_mask),
+                              deletes=self.select(delete_mask),
+                              replaced=self.select(replace_mask))
 
-    def apply_patch(self, to_del, to_add):
-        # check patch sanity
-        merge_w_to_del = self.df_indexing.reset_index().merge(to_del.df_indexing, how='outer', indicator=True)
-        merge_w_to_add = self.df_indexing.reset_index().merge(to_add.df_indexing, how='outer', indicator=True)
-        if len(merge_w_to_del[merge_w_to_del._merge == 'right_only']) > 0:
+    def _positions(self, keys, base_hashes):
+        """
+        找到 keys 在 df 中的位置, 同时检查这些行当前的 hash 和生成 patch 时的一致
+        """
+        positions = self.row_hashes.index.get_indexer(keys)
+        base_positions = base_hashes.index.get_indexer(keys)
+        found = positions >= 0
+        if (found != (base_positions >= 0)).any():
+            raise PatchConflictException("要修改/删除的 data row 不存在, 或者要添加的 data row 已经存在于 df 中")
+        if (self.row_hashes.values[positions[found]] != base_hashes.values[base_positions[found]]).any():
+            raise PatchConflictException("要修改/删除的 data row 已经被修改过了")
+        return positions[found]
+
+    def apply_patch(self, patch: 'DataFramePatch'):
+        if not isinstance(patch, DataFramePatch):
+            # 滚动升级的时候可能收到旧格式的 patch, raise 后直接从数据库重新拉数据
+            raise PatchConflictException(f'不支持的 patch 格式: {type(patch)}')
+        # check patch sanity, 只看 patch 涉及的行
+        deletes = patch.deletes.row_hashes
+        positions = np.concatenate([
+            self._positions(patch.upserts.row_hashes.index, patch.replaced.row_hashes),
+            self._positions(deletes.index, deletes),
+        ])
+        if len(positions) < len(deletes):
             raise PatchConflictException("找不到要删除的 data row")
-        if len(merge_w_to_add[merge_w_to_add._merge == 'both']) > 0:
-            raise PatchConflictException("要添加的 data row 已经存在于 df 中")
         try:
-            # remove rows to delete && add new rows
-            keep_indices = merge_w_to_del[merge_w_to_del._merge == 'left_only']['index'].dropna().astype(int)
-            df = self.df.loc[keep_indices].copy()
-            self.df = pd.concat([df, to_add.df]).reset_index(drop=True)
-            df_indexing = self.df_indexing.loc[keep_indices].copy()
-            self.df_indexing = pd.concat([df_indexing, to_add.df_indexing]).reset_index(drop=True)
+            keep_mask = np.ones(len(self.df), dtype=bool)
+            keep_mask[positions] = False
+            self.df = pd.concat([self.df[keep_mask], patch.upserts.df]).reset_index(drop=True)
+            self.row_hashes = pd.concat([self.row_hashes[keep_mask], patch.upserts.row_hashes])
         except Exception as e:
             # 可能是表字段改变等 corner case, raise 后直接从数据库重新拉数据
             raise PatchConflictException(f'添加/删除 rows 时出错: {e}') from e
+
+
+class DataFramePatch(object):
+    def __init__(self, upserts: PatchableDataFrame, deletes: PatchableDataFrame, replaced: PatchableDataFrame):
+        """
+            upserts: 新增或者修改了的行, 按 key 覆盖
+            deletes: 删除了的行
+            replaced: 被修改的行修改前的样子, 应用 patch 的时候用它的 hash 检查冲突
+        """
+        self.upserts = upserts
+        self.deletes = deletes
+        self.replaced = replaced
+
+    def changed_values(self, column) -> set:
+        """
+        patch 涉及的行 (包括修改前后) 在 column 列上的所有取值
+        """
+        return set(chain(self.upserts.df[column], self.deletes.df[column], self.replaced.df[column]))
@@ -2,6 +2,7 @@
 
 import inspect
 import time
+from itertools import chain
 from typing import Dict, Type, List
 
 import pandas as pd
@@ -25,6 +26,7 @@ class UserTable(PublicDataTable,
     table_name='user',
     # 注意用户表未将 last activity 加入议会, 这一列更新太频繁, 而且只有一个时效性要求很低的 API 用到, 可以直接查从库
     columns=["user_id", "user_name", "token", "role", "active", "shared_group", "nick_name"],
+    primary_key_columns=["user_id"],
 ):
     pass
 
@@ -41,6 +43,7 @@ class QuotaTable(PublicDataTable,
     table_cls=AutoTable.AutoSqlTable,
     table_name='quota',
     columns=["user_name", "resource", "quota", "expire_time"],
+    primary_key_columns=["user_name", "resource"],
 ):
     _sql = r'''
             select
@@ -66,6 +69,8 @@ class UserAllGroupsTable(PublicDataTable,
     table_cls=AutoTable.AutoBaseTable,
     table_name='user_all_groups',
     columns=["user_name", "user_groups"],
+    primary_key_columns=["user_name"],
+    change_sources=["user", "user_group"],  # 物化视图, 跟着 user 和 user_group 表刷新
 ):
     pass
 
@@ -74,6 +79,7 @@ class TrainEnvironmentTable(PublicDataTable,
     table_cls=AutoTable.AutoBaseTable,
     table_name='train_environment',
     columns=["env_name", "image", "schema_template", "config"],
+    primary_key_columns=["env_name"],
 ):
     pass
 
@@ -139,6 +145,15 @@ class UserWithAllGroupsTable(PublicDataTable,
         user_df, user_group_df = UserTable.get_df(), UserAllGroupsTable.get_df()
         return pd.merge(user_df, user_group_df, how='left', on='user_name')
 
+    @classmethod
+    def compute_incremental(cls, df, patches):
+        # 只重新 join 涉及到的用户
+        users = set().union(*[p.changed_values('user_name') for p in chain(*patches.values())])
+        user_df, user_group_df = UserTable.get_df(), UserAllGroupsTable.get_df()
+        changed_df = pd.merge(user_df[user_df.user_name.isin(users)], user_group_df[user_group_df.user_name.isin(users)],
+                              how='left', on='user_name')
+        return pd.concat([df[~df.user_name.isin(users)], changed_df], ignore_index=True)
+
     @classmethod
     @sync_point_only
     def update_hook(cls):
@@ -152,13 +167,32 @@ class UserAllQuotaTable(PublicDataTable,
     dependencies=[QuotaTable, UserAllGroupsTable],
 ):
     @classmethod
-    def compute(cls):
-        quota_df, user_group_df = QuotaTable.get_df(), UserAllGroupsTable.get_df()
-        user_group_df.user_groups += user_group_df.user_name.apply(lambda x: [x])
-        merged_df = user_group_df.explode('user_groups') \
-            .merge(quota_df, how='inner', left_on='user_groups', right_on='user_name', suffixes=('', '_quota'))
+    def _join(cls, quota_df, user_group_df, users=None, groups=None):
+        """
+        users / groups 不为 None 时只计算这些用户, 以及命中这些组的行
+        """
+        if users is not None and not groups:
+            user_group_df = user_group_df[user_group_df.user_name.isin(users)]
+        user_group_df = user_group_df.assign(user_groups=user_group_df.user_groups + user_group_df.user_name.apply(lambda x: [x]))
+        exploded_df = user_group_df.explode('user_groups')
+        if users is not None:
+            exploded_df = exploded_df[exploded_df.user_name.isin(users) | exploded_df.user_groups.isin(groups or set())]
+            quota_df = quota_df[quota_df.user_name.isin(set(exploded_df.user_groups))]
+        merged_df = exploded_df.merge(quota_df, how='inner', left_on='user_groups', right_on='user_name', suffixes=('', '_quota'))
         return merged_df.rename({'user_groups': 'hit_group'}, axis='columns').drop(['user_name_quota'], axis='columns')
 
+    @classmethod
+    def compute(cls):
+        return cls._join(QuotaTable.get_df(), UserAllGroupsTable.get_df())
+
+    @classmethod
+    def compute_incremental(cls, df, patches):
+        # 用户所在的组变了的话重新计算这个用户的所有行; quota 变了的话重新计算命中这个 quota 的所有行
+        users = set().union(*[p.changed_values('user_name') for p in patches.get(UserAllGroupsTable.table_name, [])])
+        groups = set().union(*[p.changed_values('user_name') for p in patches.get(QuotaTable.table_name, [])])
+        changed_df = cls._join(QuotaTable.get_df(), UserAllGroupsTable.get_df(), users=users, groups=groups)
+        return pd.concat([df[~(df.user_name.isin(users) | df.hit_group.isin(groups))], changed_df], ignore_index=True)
+
     @classmethod
     @sync_point_only
     def update_hook(cls):
@@ -37,7 +37,8 @@ class DiffRecorder:
     def commit(self, modified_df: pd.DataFrame):
         assert not self.committed, '不允许一个 context scope 内多次 commit'
         assert modified_df.set_index(self.cls.primary_key_columns).index.is_unique, f'修改后的 {self.cls.__name__} 表主键不唯一'
-        diff = PatchableDataFrame(df=self.df_snapshot).diff(PatchableDataFrame(df=modified_df))
+        pk = self.cls.primary_key_columns
+        diff = PatchableDataFrame(df=self.df_snapshot, primary_key_columns=pk).diff(PatchableDataFrame(df=modified_df, primary_key_columns=pk))
         if diff is not None:
             patch = {'table_name': self.cls.table_name, 'patch': diff, 'timestamp': time.time()}
             get_user_data_instance().patch([patch], broadcast=True)
@@ -2,6 +2,7 @@
 import multiprocessing
 import os
 import pickle
+import select
 import threading
 import time
 from collections import defaultdict
@@ -12,13 +13,27 @@ from typing import Dict, Optional, Type, Union
 import ujson
 
 from conf import CONF
-from db import redis_conn
-from .data_table import IDataTable, InMemoryTable
+from db import MarsDB, redis_conn
+from .data_table import IDataTable, InMemoryTable, RoamingSqlTable, DBSqlTable
 from .table_config import TABLES, UserTable
 from .mq_utils import MessageQueue, MessageType
 from .utils import log_debug, log_info, log_error, log_warning, acquired_lock_file, sync_point_only
 
 
+# 和 db_schemas 里 notify_user_data_change 用的 channel 一致
+CDC_CHANNEL = 'user_data_change'
+
+
+def all_change_sources(table) -> set:
+    """
+    table 直接或者通过 dependencies 间接依赖的 DB 表
+    """
+    sources = {table.table_name, *table.change_sources}
+    for dependant in table.dependencies:
+        sources |= all_change_sources(dependant)
+    return sources
+
+
 class UserDataBase(object):
     def __init__(self):
         self._subscribed_tables = []
@@ -78,6 +93,18 @@ class UserDataBase(object):
     def signal_reload(self, msg):
         pass
 
+    def invalidate_db_tables(self, changed_tables=None):
+        """
+        有写操作后让相关 DB 表的查询缓存失效, changed_tables 为 None 时全部失效
+        """
+        changed_tables = None if changed_tables is None else set(changed_tables)
+        for table in TABLES.values():
+            if not issubclass(table, DBSqlTable):
+                continue
+            # 比如 all_storage 依赖 user_all_groups, 而 user_all_groups 跟着 user_group 表刷新
+            if changed_tables is None or all_change_sources(table) & changed_tables:
+                table.invalidate()
+
 
 class DBUserData(UserDataBase):
     def _get_df(self, table_name):
@@ -93,6 +120,9 @@ class DBUserData(UserDataBase):
             raise Exception(f'当前进程中 UserData 不接入议会, 无法读写纯议会内存表 [{table_name}]')
         return super()._subscribe_single_table(table_name)
 
+    def signal_sync_point(self, changed_tables=None):
+        self.invalidate_db_tables(changed_tables)
+
 
 class UserData(UserDataBase):
     def __init__(self):
@@ -118,6 +148,11 @@ class UserData(UserDataBase):
             time.sleep(1)
         self.user_last_activity_in_ns = {user: time.time_ns() for user in UserTable.df.user_name.tolist()}
         self.shared_group_last_activity_in_ns = {group: time.time_ns() for group in set(UserTable.df.shared_group.tolist())}
+        self._cdc_enabled = bool(CONF.try_get('user_data_roaming.cdc.enabled', default=0))
+        self._cdc_pending = {}
+        self._cdc_lock = threading.Lock()
+        if self._cdc_enabled:
+            Thread(target=self._cdc_listener, daemon=True).start()
         Thread(target=self._sync_timer, daemon=True).start()
         Thread(target=self._redis_dumper, daemon=True).start()
         Thread(target=self._last_activity_modifier, daemon=True).start()
@@ -125,7 +160,11 @@ class UserData(UserDataBase):
 
     def _sync_timer(self):
         while True:
-            time.sleep(CONF.user_data_roaming.get('sync_interval', 1.0))
+            # CDC 模式下由数据库推送变动, 定时全量同步只是兜底 (比如 quota 过期这种没有写操作的变化)
+            if self._cdc_enabled:
+                time.sleep(CONF.try_get('user_data_roaming.cdc.full_sync_interval', default=60))
+            else:
+                time.sleep(CONF.user_data_roaming.get('sync_interval', 1.0))
             try:
                 self.sync_from_db()
                 if self._pending_reload is not None:
@@ -135,6 +174,65 @@ class UserData(UserDataBase):
                 log_error('Sync from db 出错', e, fetion_interval=60)
                 time.sleep(1)
 
+    def _cdc_listener(self):
+        """
+        仅在 sync point 进程中开线程执行, LISTEN 数据库触发器发出的变动通知
+        """
+        while True:
+            conn = None
+            try:
+                conn = MarsDB(overwrite_use_db='primary').db.raw_connection()
+                conn.detach()       # 长连接, 不占连接池
+                dbapi_conn = conn.connection
+                dbapi_conn.set_session(autocommit=True)
+                dbapi_conn.cursor().execute(f'listen "{CDC_CHANNEL}"')
+                log_info('CDC 开始监听 DB 变动')
+                # 没连上的这段时间可能漏了变动, 全量同步一次
+                self.sync_from_db()
+                while True:
+                    if select.select([dbapi_conn], [], [], 5) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        self._on_db_change(ujson.loads(dbapi_conn.notifies.pop(0).payload))
+                    self._sync_thread.submit(self._sync_db_changes).add_done_callback(self._sync_callback)
+            except Exception as e:
+                log_error(f'CDC 监听 DB 变动出错: {e}', e, fetion_interval=60)
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _on_db_change(self, change):
+        """
+        change: {'table': DB 表名, 'keys': 变动行的主键}, 语句级触发器没有 keys, 需要同步整张表
+        """
+        keys = change.get('keys')
+        with self._cdc_lock:
+            for table in self._tables.values():
+                if not issubclass(table, RoamingSqlTable) or change['table'] not in table.change_sources:
+                    continue
+                pending = self._cdc_pending.get(table.table_name, set())
+                if keys is None or change['table'] != table.table_name or not table.primary_key_columns or pending is None:
+                    self._cdc_pending[table.table_name] = None
+                else:
+                    self._cdc_pending[table.table_name] = pending | set(tuple(key) for key in keys)
+
+    def _sync_db_changes(self):
+        with self._cdc_lock:
+            pending, self._cdc_pending = self._cdc_pending, {}
+        if len(pending) == 0:
+            return
+        patches = self._make_patches(table_names={table_name for table_name, keys in pending.items() if keys is None})
+        for table_name, keys in pending.items():
+            if keys is not None and (patch := self._tables[table_name].pull_rows_diff_from_db([list(key) for key in keys])) is not None:
+                patches.append(patch)
+        log_debug(f'CDC 同步 DB 变动 {list(pending)}, 有差异的表: {[p["table_name"] for p in patches]}')
+        self.patch(patches, broadcast=True)
+
     def _last_activity_modifier(self):
         while True:
             try:
@@ -174,9 +272,11 @@ class UserData(UserDataBase):
                 shared_group_result = [{**r, 'ts': str(r['ts'])} for r in shared_group_result]
                 redis_conn.set('shared_group_last_activity_in_ns_str', ujson.dumps(shared_group_result))
                 # 主动更新一下 computed tables, 以便内容有更新时触发其注册的 update_hook, 目前用于 `UserWithAllGroupsTable` 的 update 时间戳更新
+                # 只需要触发计算, 不需要 copy 出来
                 for table in self._tables.values():
                     if table.is_computed:
-                        self._get_df(table.table_name)
+                        table.before_get_df_hook()
+                        table.get_df_no_copy()
             except Exception as e:
                 log_error(f'dump user last activity failed: {e}', exception=e, fetion_interval=60)
 
@@ -277,6 +377,7 @@ class UserData(UserDataBase):
         ).start()
 
     def signal_sync_point(self, changed_tables=None):
+        self.invalidate_db_tables(changed_tables)   # 其他进程收到 sync 消息后再 invalidate
         MessageQueue.send(MessageType.SYNC, changed_tables)
 
     def signal_reload(self, msg):
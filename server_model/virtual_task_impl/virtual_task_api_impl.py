@@ -30,7 +30,8 @@ class VirtualTaskApiImpl(AdditionalPropertyImpl, ABC):
             pods = Pod.find_pods(int(child_task.id))
             for rank, pod in enumerate(pods):
                 if pod.node == node:
-                    res = await get_task_node_idx_log(str(child_task.id), task.user, rank, last_seen=last_seen, max_line_length=CONF.experiment.log.max_line_length)
+                    res = await get_task_node_idx_log(str(child_task.id), task.user, rank, last_seen=last_seen, max_line_length=CONF.experiment.log.max_line_length,
+                                                      max_bytes=CONF.try_get('experiment.log.max_response_bytes', default=0) or None)
                     try:
                         pod_id = f'{task.user.user_name}-{child_task.id}-{rank}'
                         exit_code = (await Pod.aio_find_pods_by_pod_id(pod_id))[0].exit_code
@@ -41,6 +42,7 @@ class VirtualTaskApiImpl(AdditionalPropertyImpl, ABC):
                         "success": 1,
                         "msg": "get log successfully",
                         "last_seen": res['last_seen'],
+                        "truncated": res['truncated'],
                         "stop_code": child_task.stop_code,
                         "exit_code": exit_code,
                         "error_msg": error_msg
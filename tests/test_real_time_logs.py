@@ -0,0 +1,75 @@
+import asyncio
+import datetime
+import os
+from types import SimpleNamespace
+
+from utils.real_time_logs import get_task_node_idx_log
+
+TASK_ID = 1
+START = datetime.datetime(2024, 1, 1)
+
+
+def log_line(i):
+    return f'[{START + datetime.timedelta(seconds=i):%Y-%m-%d %H:%M:%S.%f}] line {i:06d} {"x" * 40}\n'
+
+
+def write_log(path, first, count, mtime):
+    with open(path, 'w') as f:
+        f.writelines(log_line(i) for i in range(first, first + count))
+    os.utime(path, (mtime, mtime))
+
+
+def make_rotated_logs(tmp_path):
+    """
+    轮转过一次的日志: exp#0.log.1 是旧的 2000 行, exp#0.log 是新的 99 行
+    """
+    log_dir = tmp_path / str(TASK_ID)
+    log_dir.mkdir()
+    write_log(log_dir / 'exp#0.log.1', 0, 2000, mtime=1000)
+    write_log(log_dir / 'exp#0.log', 2000, 99, mtime=2000)
+    return log_dir, SimpleNamespace(config=SimpleNamespace(log_dir=lambda: str(tmp_path)))
+
+
+def get_log(user, last_seen, max_bytes):
+    return asyncio.run(get_task_node_idx_log(TASK_ID, user, 0, last_seen=last_seen, max_bytes=max_bytes))
+
+
+def line_numbers(data):
+    return [int(line.split()[3]) for line in data.split('\n') if line]
+
+
+def poll(user, last_seen, max_bytes):
+    """
+    和前端一样一直用返回的 last_seen 接着拉, 直到没有新日志, 返回拉到的行号和最后的 last_seen
+    """
+    numbers = []
+    for _ in range(1000):
+        res = get_log(user, last_seen, max_bytes)
+        numbers += line_numbers(res['data'])
+        if res['last_seen'] == last_seen and not res['truncated']:
+            return numbers, last_seen
+        last_seen = res['last_seen']
+    raise AssertionError('拉了 1000 次还没拉完')
+
+
+def test_poll_across_rotated_files(tmp_path):
+    _, user = make_rotated_logs(tmp_path)
+    before_all = {'timestamp': START - datetime.timedelta(seconds=1), 'offset': 0, 'mtime': 0}
+    numbers, _ = poll(user, before_all, max_bytes=50000)
+    assert numbers == list(range(2099))
+
+
+def test_tail_then_follow_rotated_files(tmp_path):
+    log_dir, user = make_rotated_logs(tmp_path)
+    # 没有 last_seen 时只返回最后 max_bytes 字节
+    res = get_log(user, None, max_bytes=50000)
+    tail = line_numbers(res['data'])
+    assert res['truncated'] and len(res['data']) <= 50000
+    assert tail == list(range(tail[0], 2099))
+
+    numbers, last_seen = poll(user, res['last_seen'], max_bytes=50000)
+    assert numbers == []
+    with open(log_dir / 'exp#0.log', 'a') as f:
+        f.writelines(log_line(i) for i in range(2099, 2105))
+    numbers, _ = poll(user, last_seen, max_bytes=50000)
+    assert numbers == list(range(2099, 2105))
@@ -0,0 +1,151 @@
+
+
+import pickle
+import struct
+
+import numpy as np
+import pandas as pd
+
+
+# 编码格式：[meta 长度 8 字节][pickle 的 meta][按 8 字节对齐的定长列 buffer ...]
+# 定长的 numpy 列（int / float / bool / datetime）直接按内存布局写入 buffer 区，读的时候 np.frombuffer 直接映射，不需要反序列化
+# 重复度高的字符串列（user_name / group / queue_status 等）做字典编码，编码值走 buffer 区，取值表放在 meta 里
+# 其余 object 列（list / dict）以及 extension 列放在 meta 里，作为 side table 用 pickle 传输
+META_LENGTH = struct.Struct('<Q')
+ALIGNMENT = 8
+RAW_DTYPE_KINDS = set('biufcmM')
+# 先看前面这么多行判断是不是低基数的字符串列，nb_name / chain_id 这种每行都不一样的列不用整列 factorize 一遍
+SAMPLE_SIZE = 256
+
+
+class FrameRef(object):
+    """
+    meta 里用来代替 DataFrame 的占位，记录怎么从 buffer 区还原出这个 DataFrame
+    """
+    __slots__ = ('columns', 'index', 'values')
+
+    def __init__(self, columns, index, values):
+        self.columns = columns
+        self.index = index
+        self.values = values
+
+    def __getstate__(self):
+        return self.columns, self.index, self.values
+
+    def __setstate__(self, state):
+        self.columns, self.index, self.values = state
+
+
+class _BufferWriter(object):
+
+    def __init__(self, offset):
+        self.chunks = []
+        self.offset = offset
+
+    def add(self, array: np.ndarray):
+        # datetime 等类型不支持直接导出 buffer，统一按字节视图写入
+        array = np.ascontiguousarray(array).view(np.uint8)
+        padding = (-self.offset) % ALIGNMENT
+        if padding:
+            self.chunks.append(b'\0' * padding)
+            self.offset += padding
+        position = self.offset
+        self.chunks.append(array.data)
+        self.offset += array.nbytes
+        return position
+
+
+def _is_raw_dtype(dtype) -> bool:
+    return isinstance(dtype, np.dtype) and dtype.kind in RAW_DTYPE_KINDS and not dtype.hasobject
+
+
+def _low_cardinality_strings(sample: np.ndarray) -> bool:
+    if pd.api.types.infer_dtype(sample, skipna=False) != 'string':
+        return False
+    # 行数少的时候样本就是整列，和下面 factorize 之后的判断一致
+    return len(set(sample)) * 2 <= len(sample) or len(sample) < SAMPLE_SIZE
+
+
+def _encode_values(values, writer: _BufferWriter):
+    if isinstance(values, np.ndarray) and values.ndim == 1:
+        if _is_raw_dtype(values.dtype):
+            return 'raw', values.dtype.str, writer.add(values), len(values)
+        if values.dtype == object and len(values) > 0 and _low_cardinality_strings(values[:SAMPLE_SIZE]) \
+                and pd.api.types.infer_dtype(values, skipna=False) == 'string':
+            codes, uniques = pd.factorize(values)
+            if len(uniques) * 2 <= len(values):
+                return 'dict', _encode_values(codes.astype(np.int32), writer), uniques
+    return 'obj', values
+
+
+def _decode_values(encoded, buffer):
+    if encoded[0] == 'raw':
+        _, dtype_str, position, length = encoded
+        if length == 0:
+            return np.empty(0, dtype=np.dtype(dtype_str))
+        return np.frombuffer(buffer, dtype=np.dtype(dtype_str), count=length, offset=position)
+    if encoded[0] == 'dict':
+        _, codes, uniques = encoded
+        return uniques.take(_decode_values(codes, buffer))
+    return encoded[1]
+
+
+def _encode_index(index: pd.Index, writer: _BufferWriter):
+    if type(index) is pd.RangeIndex:
+        return 'range', index.start, index.stop, index.step, index.name
+    if not isinstance(index, pd.MultiIndex) and _is_raw_dtype(index.dtype):
+        return 'raw_index', _encode_values(index.to_numpy(), writer), index.name
+    return 'obj', index
+
+
+def _decode_index(encoded, buffer):
+    if encoded[0] == 'range':
+        _, start, stop, step, name = encoded
+        return pd.RangeIndex(start, stop, step, name=name)
+    if encoded[0] == 'raw_index':
+        _, values, name = encoded
+        return pd.Index(_decode_values(values, buffer), name=name)
+    return encoded[1]
+
+
+def _encode_frame(df: pd.DataFrame, writer: _BufferWriter) -> FrameRef:
+    values = []
+    # 按位置取列的 iloc 每列都要走一遍索引逻辑，几十列的 df 光取列就要 1ms 以上
+    for _, series in df.items():
+        # extension 类型（category / 带时区的时间等）用 .array 保留类型，走 side table
+        column_values = series.to_numpy() if isinstance(series.dtype, np.dtype) else series.array
+        values.append(_encode_values(column_values, writer))
+    return FrameRef(columns=df.columns, index=_encode_index(df.index, writer), values=values)
+
+
+def _decode_frame(ref: FrameRef, buffer) -> pd.DataFrame:
+    index = _decode_index(ref.index, buffer)
+    df = pd.DataFrame({i: _decode_values(v, buffer) for i, v in enumerate(ref.values)}, index=index)
+    df.columns = ref.columns
+    return df
+
+
+def dumps_state(state: dict) -> bytes:
+    """
+    把一个 dict 编码成 bytes，dict 里第一层的 DataFrame 会按列编码，其余的值用 pickle
+    """
+    # 先不知道 meta 多长，buffer 区的 offset 先从 0 开始算，最后统一平移
+    writer = _BufferWriter(offset=0)
+    meta = {k: _encode_frame(v, writer) if isinstance(v, pd.DataFrame) else v for k, v in state.items()}
+    meta_bytes = pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+    # buffer 区的起点也对齐，保证 np.frombuffer 拿到的都是对齐的内存
+    head_length = META_LENGTH.size + len(meta_bytes)
+    padding = (-head_length) % ALIGNMENT
+    return b''.join([META_LENGTH.pack(len(meta_bytes)), meta_bytes, b'\0' * padding] + writer.chunks)
+
+
+def loads_state(data) -> dict:
+    """
+    dumps_state 的逆过程，定长列是直接从 data 上映射出来的
+    """
+    buffer = memoryview(data)
+    meta_length, = META_LENGTH.unpack_from(buffer, 0)
+    head_length = META_LENGTH.size + meta_length
+    meta = pickle.loads(buffer[META_LENGTH.size:head_length])
+    body = buffer[head_length + (-head_length) % ALIGNMENT:]
+    return {k: _decode_frame(v, body) if isinstance(v, FrameRef) else v for k, v in meta.items()}
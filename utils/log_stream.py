@@ -0,0 +1,204 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+from logm import logger
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+class InotifyWatcher(object):
+    """
+    用 libc 的 inotify 监听日志目录, 只用来提前唤醒 tail, 不关心具体是哪个事件;
+    共享盘上别的机器写的文件不一定有事件, 所以 tail 还是会按间隔轮询兜底
+    """
+    _libc = None
+
+    @classmethod
+    def available(cls) -> bool:
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                libc.inotify_init1, libc.inotify_add_watch      # 检查有没有这两个符号
+                cls._libc = libc
+            except (OSError, AttributeError):
+                cls._libc = False
+        return cls._libc is not False
+
+    def __init__(self, on_event: Callable[[], None]):
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        self.on_event = on_event
+        self.watched = set()
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(self.fd, self._read)
+
+    def watch(self, paths: List[str]):
+        for path in paths:
+            if path in self.watched or not os.path.isdir(path):
+                continue
+            if self._libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK) >= 0:
+                self.watched.add(path)
+
+    def _read(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.on_event()
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+def cursor_key(last_seen: Optional[dict]):
+    return (-1, '') if not last_seen else (last_seen.get('id', 0), str(last_seen.get('timestamp') or ''))
+
+
+class LogTail(object):
+    """
+    同一个 task / rank 的日志只由一个 tail 去读, 读到的新日志推给所有订阅者;
+    每个订阅者有自己的 cursor, 推过来的日志接不上自己的 cursor 时 (刚订阅 / 队列满了丢了几条), 自己从 cursor 往后补读
+    """
+
+    def __init__(self, key: Hashable, fetch: Callable[[Optional[dict]], Awaitable[dict]],
+                 watch_paths: Callable[[], List[str]], finished: Callable[[dict], bool],
+                 poll_interval: float, use_inotify: bool):
+        """
+            fetch: 从 last_seen 往后读日志, 返回和 /query/task/log 一样的结构
+            watch_paths: 需要监听的目录
+            finished: 这次读到的结果之后不会再有新日志了, tail 和所有订阅者都结束
+        """
+        self.key = key
+        self.fetch = fetch
+        self.watch_paths = watch_paths
+        self.finished = finished
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.subscribers = set()
+        self.cursor = None
+        self.stop_code = None
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def subscribe(self, last_seen: Optional[dict], heartbeat: float):
+        """
+        异步生成器, 依次返回读到的日志, 超过 heartbeat 秒没有新日志返回 None
+        """
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        try:
+            cursor, stop_code = last_seen, None
+            need_fetch = True
+            while True:
+                if need_fetch:
+                    res = await self.fetch(cursor)
+                else:
+                    try:
+                        start, res = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+                    except asyncio.TimeoutError:
+                        yield None
+                        continue
+                    if res is None:
+                        # tail 结束了, 没跟上的话自己补读
+                        if start == cursor:
+                            return
+                        res = await self.fetch(cursor)
+                    elif start != cursor:
+                        if cursor_key(res['last_seen']) > cursor_key(cursor):
+                            res = await self.fetch(cursor)      # 接不上, 自己补读
+                        elif res['stop_code'] == stop_code:
+                            continue                            # 已经读过了
+                        else:
+                            res = {**res, 'data': '', 'last_seen': cursor}     # 只同步状态
+                # 游标没往前走的话接着读也读不到新的, 不管 truncated 都跟着 tail 按间隔读
+                truncated = bool(res.get('truncated')) and cursor_key(res['last_seen']) > cursor_key(cursor)
+                cursor, stop_code = res['last_seen'] or cursor, res['stop_code']
+                yield res
+                if self.finished(res) and not truncated:
+                    return
+                # 还有没读完的日志先自己读完, 读完再跟着 tail
+                need_fetch = truncated
+                if not need_fetch:
+                    self._ensure_running(cursor, stop_code)
+        finally:
+            self.subscribers.discard(queue)
+            if not self.subscribers and self.task is None and _log_tails.get(self.key) is self:
+                _log_tails.pop(self.key)
+
+    def _ensure_running(self, cursor, stop_code):
+        if self.task is None or self.task.done():
+            self.cursor, self.stop_code = cursor, stop_code
+            self.task = asyncio.create_task(self._run())
+
+    def _broadcast(self, start, res):
+        for queue in self.subscribers:
+            if queue.full():
+                # 订阅者太慢了, 丢掉最老的一条, 它下次收到的日志接不上 cursor, 会自己补读
+                queue.get_nowait()
+            queue.put_nowait((start, res))
+
+    async def _run(self):
+        watcher = None
+        if self.use_inotify and InotifyWatcher.available():
+            try:
+                watcher = InotifyWatcher(self.wakeup.set)
+            except OSError as e:
+                logger.warning(f'[{self.key}] inotify 不可用, 轮询日志: {e}')
+        try:
+            while self.subscribers:
+                if watcher is not None:
+                    watcher.watch(self.watch_paths())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                truncated = True
+                while truncated and self.subscribers:
+                    start = self.cursor
+                    try:
+                        res = await self.fetch(start)
+                    except Exception as e:
+                        logger.exception(f'[{self.key}] 读取日志失败: {e}')
+                        break
+                    advanced = cursor_key(res['last_seen']) > cursor_key(start)
+                    # 游标没往前走的话不接着读, 等 poll_interval 之后再试
+                    truncated = res.get('truncated') and advanced
+                    if advanced or res['stop_code'] != self.stop_code:
+                        self.cursor, self.stop_code = res['last_seen'] or start, res['stop_code']
+                        self._broadcast(start, res)
+                    if self.finished(res) and not truncated:
+                        self._broadcast(self.cursor, None)
+                        return
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if _log_tails.get(self.key) is self:
+                _log_tails.pop(self.key)
+
+
+_log_tails: Dict[Hashable, LogTail] = {}
+
+
+def get_log_tail(key: Hashable, **kwargs) -> LogTail:
+    """
+    同一个 key 共享一个 tail, 没有订阅者之后 tail 自己退出
+    """
+    tail = _log_tails.get(key)
+    if tail is None or (tail.task is not None and tail.task.done()):
+        tail = _log_tails[key] = LogTail(key, **kwargs)
+    return tail
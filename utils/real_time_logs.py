@@ -1,138 +1,343 @@
+import asyncio
+import bisect
 import os
 import re
+from collections import OrderedDict
 
 import aiofiles
 import ciso8601
 
 
+INDEX_INTERVAL = 64 * 1024      # 每隔多少字节记一个索引点
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CACHED_INDEXES = 4096
+IDENTITY_SIZE = 256             # 用文件开头多少字节判断是不是同一个文件
+
+
 async def get_timestamp_from_line(line):
     if len(line) <= 28:
         raise Exception()
     return ciso8601.parse_datetime(line[1:27].decode())
 
 
-async def file_read_all(fp, timestamp, offset, mtime):
+def try_get_timestamp(buf, start):
+    try:
+        if len(buf) - start <= 28:
+            return None
+        return ciso8601.parse_datetime(buf[start + 1:start + 27].decode())
+    except:
+        return None
+
+
+def find_line_start(buf, start, end):
+    """
+    buf 从行首开始, 在 [start, end) 里找第一个以 '[' 开头的行的行首
+    """
+    if start == 0 and buf[:1] == b'[' and end > 0:
+        return 0
+    i = buf.find(b'\n[', max(start - 1, 0), end)
+    return -1 if i < 0 else i + 1
+
+
+def rfind_line_start(buf, end):
+    """
+    buf 从行首开始, 找最后一个在 end 之前、以 '[' 开头的行的行首
+    """
+    i = buf.rfind(b'\n[', 0, end)
+    if i >= 0:
+        return i + 1
+    return 0 if buf[:1] == b'[' and end > 0 else -1
+
+
+def last_timestamp_line(buf, end=None):
+    """
+    返回 buf 里最后一个能解析出时间戳的行 (timestamp, 行首在 buf 里的位置), 找不到返回 None
+    """
+    end = len(buf) if end is None else end
+    while (i := rfind_line_start(buf, end)) >= 0:
+        if (ts := try_get_timestamp(buf, i)) is not None:
+            return ts, i
+        end = i
+    return None
+
+
+class LogIndex(object):
+    """
+    单个日志文件的稀疏索引: 每隔 INDEX_INTERVAL 字节记录一个带时间戳的行 (时间戳, 行首偏移).
+    日志文件只会追加, 每次只需要扫描新追加的部分; 行只在索引点附近解析, 其他部分只用 find 找换行.
+    按文件的 (st_dev, st_ino) 缓存, 日志轮转改名之后索引还能用; NFS 上删掉的文件的 inode 可能被新文件复用,
+    所以还会记下文件的第一行 (identity), 对不上的话重新索引
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timestamps = []
+        self.offsets = []
+        self.size = 0           # 已经索引过的字节数, 总是停在行首
+        self.last = None        # 最后一个带时间戳的行 (timestamp, offset)
+        self.identity = b''     # 文件第一行的前 IDENTITY_SIZE 字节, 索引过内容之后才有
+
+    async def same_file(self, fp, size):
+        if size < self.size:    # 文件被截断了
+            return False
+        if self.size == 0:
+            return True
+        await fp.seek(0, 0)
+        return await fp.read(len(self.identity)) == self.identity
+
+    async def update(self, fp, size):
+        if not await self.same_file(fp, size):     # 文件被截断了或者 inode 被别的文件复用了, 重新索引
+            self.reset()
+        pos, remainder = self.size, b''
+        next_index_at = self.offsets[-1] + INDEX_INTERVAL if self.offsets else 0
+        await fp.seek(pos, 0)
+        while pos < size:
+            chunk = await fp.read(min(READ_CHUNK_SIZE, size - pos))
+            if not chunk:
+                break
+            base, buf = pos - len(remainder), remainder + chunk
+            pos += len(chunk)
+            end = buf.rfind(b'\n') + 1     # 只处理完整的行
+            search_from = max(next_index_at - base, 0)
+            while search_from < end and (i := find_line_start(buf, search_from, end)) >= 0:
+                if (ts := try_get_timestamp(buf, i)) is None:
+                    search_from = i + 1
+                    continue
+                self.timestamps.append(ts)
+                self.offsets.append(base + i)
+                next_index_at = base + i + INDEX_INTERVAL
+                search_from = next_index_at - base
+            if (last := last_timestamp_line(buf, end)) is not None:
+                self.last = (last[0], base + last[1])
+            remainder = buf[end:]
+        self.size = pos - len(remainder)
+        if not self.identity and self.size > 0:
+            await fp.seek(0, 0)
+            head = await fp.read(min(IDENTITY_SIZE, self.size))
+            self.identity = head[:head.find(b'\n') + 1] or head
+
+    async def find_after(self, fp, timestamp):
+        """
+        第一个时间戳比 timestamp 大的行的行首偏移, 没有的话返回 None
+        """
+        if self.last is None or self.last[0] <= timestamp:
+            return None
+        # 从最后一个不晚于 timestamp 的索引点开始往后找, 一般只需要读一个索引间隔
+        point = bisect.bisect_right(self.timestamps, timestamp) - 1
+        offset = self.offsets[point] if point >= 0 else 0
+        while offset < self.size:
+            await fp.seek(offset, 0)
+            buf = await fp.read(min(INDEX_INTERVAL * 2, self.size - offset))
+            search_from = 0
+            while (i := find_line_start(buf, search_from, len(buf))) >= 0:
+                ts = try_get_timestamp(buf, i)
+                if ts is not None and ts > timestamp:
+                    return offset + i
+                search_from = i + 1
+            last_line = buf.rfind(b'\n') + 1
+            if last_line == 0:
+                break
+            offset += last_line
+        return self.last[1]
+
+    async def find_line_start_from(self, fp, offset):
+        """
+        offset 之后 (含) 第一个带时间戳的行的行首偏移
+        """
+        while offset < self.size:
+            await fp.seek(offset, 0)
+            buf = await fp.read(min(INDEX_INTERVAL * 2, self.size - offset))
+            prefix = await self._at_line_start(fp, offset)
+            search_from = 0 if prefix else 1
+            while (i := find_line_start(buf, search_from, len(buf))) >= 0:
+                if try_get_timestamp(buf, i) is not None:
+                    return offset + i
+                search_from = i + 1
+            offset += len(buf)
+        return self.size
+
+    async def read_through_newer_line(self, fp, offset, timestamp):
+        """
+        从行首 offset 开始, 读到第一个时间戳比 timestamp 新的行 (含) 为止, 没有的话读到已索引的末尾
+        """
+        end, pos = self.size, offset
+        while (line_start := await self.find_line_start_from(fp, pos)) < self.size:
+            await fp.seek(line_start, 0)
+            line = await fp.readline()
+            if timestamp is None or try_get_timestamp(line, 0) > timestamp:
+                end = line_start + len(line)
+                break
+            pos = line_start + len(line)
+        await fp.seek(offset, 0)
+        return await fp.read(end - offset)
+
+    @staticmethod
+    async def _at_line_start(fp, offset):
+        if offset == 0:
+            return True
+        await fp.seek(offset - 1, 0)
+        return await fp.read(1) == b'\n'
+
+
+_log_indexes = OrderedDict()
+
+
+async def get_log_index(fp, stat) -> LogIndex:
+    key = (stat.st_dev, stat.st_ino)
+    index = _log_indexes.pop(key, None) or LogIndex()
+    _log_indexes[key] = index
+    while len(_log_indexes) > MAX_CACHED_INDEXES:
+        _log_indexes.popitem(last=False)
+    async with index.lock:
+        await index.update(fp, stat.st_size)
+    return index
+
+
+async def file_read_range(fp, index, timestamp, offset, mtime, max_bytes=None):
+    """
+    读取 offset 之后的日志, 最多读 max_bytes 字节 (截断在行尾), last_seen 指向读到的最后一个带时间戳的行;
+    截断的时候保证 last_seen 会往前走, 调用方可以一直用返回的 last_seen 接着读
+    """
+    last_seen = {"timestamp": timestamp, "offset": offset, "mtime": mtime}
+    end = index.size if max_bytes is None else min(index.size, offset + max_bytes)
     await fp.seek(offset, 0)
-    data = await fp.read()
-    leng = len(data)
-    for i in range(leng - 1, -1, -1):
-        if data[i] == ord('[') and (i == 0 or data[i - 1] == ord('\n')):  # 避免找到一行中间的时间戳
-            try:
-                line_timestamp = await get_timestamp_from_line(data[i:])
-                if timestamp and line_timestamp <= timestamp:  # 理论上不会出现这种情况，兜个底
-                    return {
-                        "data": "",
-                        "success": 1,
-                        "last_seen": {
-                            "timestamp": timestamp,
-                            "offset": offset,
-                            "mtime": mtime
-                        }
-                    }
-                return {
-                    "data": data.decode(errors='replace'),  # 如果无法被decode，说明日志烂了
-                    "success": 1,
-                    "last_seen": {
-                        "timestamp": line_timestamp,
-                        "offset": i + offset,
-                        "mtime": mtime
-                    }
-                }
-            except:  # 无法被解析成timestamp
-                pass
-    return {  # 没有找到时间戳，比较尴尬，理论上到达这里意味着没有更多的数据
-        "data": "",
+    if max_bytes is None:
+        data = await fp.read()
+    else:
+        data = await fp.read(end - offset)
+        if end < index.size and (line_end := data.rfind(b'\n') + 1) > 0:
+            data = data[:line_end]
+    last = last_timestamp_line(data)
+    if end < index.size and (last is None or (timestamp is not None and last[0] <= timestamp)):
+        # 截断的窗口里没有比 last_seen 新的带时间戳的行 (比如一大段没有时间戳的输出), 多读到下一个新的带时间戳的行
+        data += await index.read_through_newer_line(fp, offset + len(data), timestamp)
+        last = last_timestamp_line(data)
+    if last is not None and (timestamp is None or last[0] > timestamp):
+        last_seen = {"timestamp": last[0], "offset": offset + last[1], "mtime": mtime}
+        truncated = offset + len(data) < index.size
+        if truncated and (line_end := data.find(b'\n', last[1]) + 1) > 0:
+            # 下次从 last_seen 的下一行开始读, 后面没有时间戳的行留到下次返回, 不然会重复
+            data = data[:line_end]
+    else:
+        data = b''  # 到已索引的末尾都没有新的带时间戳的行, 等后面有新的行再读
+        truncated = False
+    return {
+        "data": data.decode(errors='replace'),  # 如果无法被decode，说明日志烂了
         "success": 1,
-        "last_seen": {
-            "timestamp": timestamp,
-            "offset": offset,
-            "mtime": mtime
-        }
+        "last_seen": last_seen,
+        "size": len(data),
+        "truncated": truncated,
     }
 
 
-async def get_file_log(path, last_seen):
+async def get_file_log(path, last_seen, max_bytes=None, skip_before=0):
+    """
+    :param max_bytes: 最多返回多少字节
+    :param skip_before: 没有 last_seen 的时候, 跳过这个偏移之前的日志 (只看最后一部分)
+    """
+    stat = os.stat(path)
+    mtime = stat.st_mtime
     # 判断是否要跳过该文件，如果该文件更新时间比上次看到的最晚更新时间要少，说明没必要再看
-    mtime = os.path.getmtime(path)
     if last_seen and 'mtime' in last_seen and mtime < last_seen['mtime']:
-        return {
-            "data": "",
-            "success": 1,
-            "last_seen": last_seen
-        }
+        return {"data": "", "success": 1, "last_seen": last_seen, "size": 0, "truncated": False}
     async with aiofiles.open(path, "rb") as fp:
+        index = await get_log_index(fp, stat)
         if not last_seen:
-            return await file_read_all(fp, None, 0, mtime)
-        # 先判断能否match上
-        offset = last_seen['offset']
+            offset = await index.find_line_start_from(fp, skip_before) if skip_before > 0 else 0
+            return await file_read_range(fp, index, None, offset, mtime, max_bytes)
         timestamp = last_seen['timestamp']
-        await fp.seek(offset, 0)
-        line = await fp.readline()
-        try:
-            line_timestamp = await get_timestamp_from_line(line)
-            if not timestamp == line_timestamp:
-                raise Exception()
-            # match上了，下一行就是要开始读取的数据
-            return await file_read_all(fp, timestamp, await fp.tell(), mtime)
-        except:
-            pass
-        # 然后判断是否需要全部输出
-        await fp.seek(0, 0)
-        line = await fp.readline()
-        try:
-            line_timestamp = await get_timestamp_from_line(line)
-            if timestamp < line_timestamp:
-                return await file_read_all(fp, timestamp, 0, mtime)
-        except:
-            # 存在一次试错机会，因为一行可能被分到两个文件中，第二行理应是正确的
-            try:
-                current_idx = await fp.tell()
-                line = await fp.readline()
-                line_timestamp = await get_timestamp_from_line(line)
-                if timestamp < line_timestamp:
-                    return await file_read_all(fp, timestamp, current_idx, mtime)
-            except Exception as e:  # 第二次再失败，可能是因为输出的一行太长打爆导致的
-                pass
-        # 兜底，理论上不会到达这一段
-        return await file_read_all(fp, timestamp, 0, mtime)
+        # 先判断能否match上, match上了下一行就是要开始读取的数据
+        offset = last_seen['offset']
+        if offset < index.size:
+            await fp.seek(offset, 0)
+            line = await fp.readline()
+            if try_get_timestamp(line, 0) == timestamp:
+                return await file_read_range(fp, index, timestamp, offset + len(line), mtime, max_bytes)
+        # match 不上 (比如是另一个文件的 last_seen), 用索引找到第一个比 last_seen 新的行
+        offset = await index.find_after(fp, timestamp)
+        if offset is None:
+            return {"data": "", "success": 1, "last_seen": last_seen, "size": 0, "truncated": False}
+        return await file_read_range(fp, index, timestamp, offset, mtime, max_bytes)
 
 
 def check_file_match(file_name: str, idx: int):
     return f'#{idx}.' in file_name or file_name.endswith(f'#{idx}')
 
 
-async def get_task_node_idx_log(task_id, user, node_idx: int, last_seen=None, suffix_filter=None, max_line_length=4096):
+_dir_listings = OrderedDict()
+
+
+def list_log_dir(path):
+    """
+    目录的 mtime 没变的话文件列表也没变, 不用每次都 listdir
+    """
+    dir_mtime = os.stat(path).st_mtime
+    if (cached := _dir_listings.pop(path, None)) is not None and cached[0] == dir_mtime:
+        files = cached[1]
+    else:
+        files = os.listdir(path)
+    _dir_listings[path] = (dir_mtime, files)
+    while len(_dir_listings) > MAX_CACHED_INDEXES:
+        _dir_listings.popitem(last=False)
+    return files
+
+
+async def get_task_node_idx_log(task_id, user, node_idx: int, last_seen=None, suffix_filter=None, max_line_length=4096,
+                                max_bytes=None):
     """
     :param task_id:
     :param user:
     :param node_idx:
     :param last_seen:
     :param suffix_filter:
+    :param max_bytes: 一次最多返回多少字节的日志, 有 last_seen 时从 last_seen 往后读, 否则只返回最后 max_bytes 字节;
+                      有日志没返回的话 truncated 为 True, 用返回的 last_seen 可以接着往后读
     :return:
     """
     log_dir = user.config.log_dir()
     path = os.path.join(log_dir, str(task_id))
     try:
-        files = os.listdir(path)
-        valid_files = [(file, os.path.getmtime(os.path.join(path, file)))
+        files = list_log_dir(path)
+        valid_files = [(file, os.stat(os.path.join(path, file)))
                        for file in files
                        if check_file_match(file, node_idx) and not file.endswith('error') \
                             and not file.startswith('events') and not file.startswith('debug') \
                             and (suffix_filter is None or
                                  re.search(re.escape(suffix_filter)+r'(\.\d+)*$', file) is not None)
                        ]
-        sorted_valid_files = sorted(valid_files, key=lambda t: t[1])
+        sorted_valid_files = [(file, stat.st_size) for file, stat in sorted(valid_files, key=lambda t: t[1].st_mtime)]
         for file in files:
             if check_file_match(file, node_idx) and file.endswith('error'):
-                sorted_valid_files.append((file, 0))
+                sorted_valid_files.append((file, os.path.getsize(os.path.join(path, file))))
+        # 没有 last_seen 且日志太多的时候, 只看最后 max_bytes 字节
+        skip_before = [0] * len(sorted_valid_files)
+        if not last_seen and max_bytes:
+            budget = max_bytes
+            for i in range(len(sorted_valid_files) - 1, -1, -1):
+                skip_before[i] = max(sorted_valid_files[i][1] - budget, 0) if budget > 0 else sorted_valid_files[i][1]
+                budget -= sorted_valid_files[i][1] - skip_before[i]
         data = []
         rst_last_seen = last_seen
-        for file in sorted_valid_files:
-            info = await get_file_log(os.path.join(path, file[0]), last_seen)
+        budget = max_bytes
+        truncated = any(skip > 0 for skip in skip_before)
+        for (file, _), skip in zip(sorted_valid_files, skip_before):
+            if budget is not None and budget <= 0:
+                truncated = True
+                break
+            info = await get_file_log(os.path.join(path, file), last_seen, max_bytes=budget, skip_before=skip)
             if info['last_seen'] and info['last_seen']['timestamp']:
                 if not rst_last_seen or info['last_seen']['timestamp'] > rst_last_seen['timestamp']:
                     rst_last_seen = info['last_seen']
             data.append(info['data'])
+            if info['truncated']:
+                # 这个文件还没读完, 不能再读后面更新的文件, 不然 last_seen 会跳到新文件, 下次这个文件剩下的行就被跳过了
+                truncated = True
+                break
+            if budget is not None:
+                budget -= info['size']
         data = "".join(data)
         cut_log = []
         for line_log in data.split('\n'):
@@ -143,7 +348,8 @@ async def get_task_node_idx_log(task_id, user, node_idx: int, last_seen=None, su
             "data": '\n'.join(cut_log) if cut_log else "还没产生日志",
             "success": 1,
             "msg": "get log successfully",
-            "last_seen": rst_last_seen
+            "last_seen": rst_last_seen,
+            "truncated": truncated,
         }
     except Exception as exp:  # 共享盘里文件还没创建的情况
         if os.path.exists(path):  # path 存在的情况下，应该是出了异常了
@@ -152,7 +358,8 @@ async def get_task_node_idx_log(task_id, user, node_idx: int, last_seen=None, su
             "data": "还没产生日志",
             "success": 1,
             "msg": f'{task_id} 找不到相应日志, node_idx: {node_idx}, 错误编号: {exp}',
-            "last_seen": None
+            "last_seen": None,
+            "truncated": False,
         }
 
 __all__ = ['get_task_node_idx_log']